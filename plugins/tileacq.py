@@ -37,6 +37,7 @@ from odemis.acq.stitching import WEAVER_MEAN, WEAVER_COLLAGE_REVERSE
 from odemis.acq.stream import Stream, SEMStream, CameraStream, \
     RepetitionStream, StaticStream, UNDEFINED_ROI, EMStream, ARStream, SpectrumStream, \
     FluoStream, MultipleDetectorStream, MonochromatorSettingsStream, CLStream
+from odemis.dataio import tiff
 import odemis.gui
 from odemis.gui.comp import popup
 from odemis.gui.conf import get_acqui_conf
@@ -789,6 +790,8 @@ class TileAcqPlugin(Plugin):
 
         # For stitching only
         da_list = []  # for each position, a list of DataArrays
+        # The registration of the tiles is computed in the background, during the acquisition
+        registrar = stitching.get_registrar() if self.stitch.value else None
         i = 0
         prev_idx = [0, 0]
         try:
@@ -819,6 +822,8 @@ class TileAcqPlugin(Plugin):
                 if self.stitch.value:
                     # Sort tiles (largest sem on first position)
                     da_list.append(self.sort_das(das, stitch_ss))
+                    if da_list[0]:
+                        stitching.add_tile(registrar, da_list[-1])
 
                 # Check the FoV is correct using the data, and if not update
                 if i == 0:
@@ -838,7 +843,7 @@ class TileAcqPlugin(Plugin):
                 ft.set_progress(end=self.estimate_time(0) + time.time())
 
                 logging.info("Computing big image out of %d images", len(da_list))
-                das_registered = stitching.register(da_list)
+                das_registered = stitching.update_positions(registrar, da_list)
 
                 # Select weaving method
                 # On a Sparc system the mean weaver gives the best result since it
@@ -855,21 +860,25 @@ class TileAcqPlugin(Plugin):
                     weaving_method = WEAVER_MEAN
                     logging.info("Using weaving method WEAVER_MEAN.")
 
+                # With TIFF, the stitched image is only generated while saving it,
+                # strip by strip, so that it's never entirely in memory.
+                exporter = dataio.find_fittest_converter(fn)
+                lazy = exporter is tiff
+
                 # Weave every stream
                 if isinstance(das_registered[0], tuple):
                     for s in range(len(das_registered[0])):
                         streams = []
                         for da in das_registered:
                             streams.append(da[s])
-                        da = stitching.weave(streams, weaving_method)
+                        da = stitching.weave(streams, weaving_method, lazy=lazy)
                         da.metadata[model.MD_DIMS] = "YX"  # TODO: do it in the weaver
                         st_data.append(da)
                 else:
-                    da = stitching.weave(das_registered, weaving_method)
+                    da = stitching.weave(das_registered, weaving_method, lazy=lazy)
                     st_data.append(da)
 
                 # Save
-                exporter = dataio.find_fittest_converter(fn)
                 if exporter.CAN_SAVE_PYRAMID:
                     exporter.export(fn, st_data, pyramid=True)
                 else:
@@ -910,5 +919,8 @@ class TileAcqPlugin(Plugin):
                                          lvl=logging.ERROR)
         finally:
             logging.info("Tiled acquisition ended")
+            if registrar is not None:
+                # Stop the registration, in case the acquisition didn't complete
+                registrar.close()
             main_data.stage.moveAbs(orig_pos)
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+
+# This script measures the latency of the data received by a slow listener
+# of a remote DataFlow, with and without discarding the old data.
+
+# Usage:
+# dataflow_latency.py [duration]
+
+from __future__ import division, print_function
+
+import logging
+import numpy
+from odemis import model
+import sys
+import threading
+import time
+
+
+PERIOD = 0.05  # s, between each array generated
+LISTENER_DELAY = 0.2  # s, time spent by the listener on each array (> PERIOD)
+
+
+class GeneratorDataFlow(model.DataFlow):
+    """
+    Generates arrays at a regular period. The first pixel contains the index of
+    the array, and MD_ACQ_DATE the time it was generated.
+    """
+
+    def __init__(self):
+        model.DataFlow.__init__(self)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start_generate(self):
+        self._stop.clear()
+        self._thread = threading.Thread(name="array generator", target=self._generate)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop_generate(self):
+        self._stop.set()
+        if threading.current_thread() != self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def _generate(self):
+        i = 0
+        while not self._stop.is_set():
+            i += 1
+            array = model.DataArray(numpy.zeros((1024, 1024), dtype=numpy.uint16),
+                                    {model.MD_ACQ_DATE: time.time()})
+            array[0, 0] = i
+            self.notify(array)
+            time.sleep(PERIOD)
+
+
+class GeneratorComponent(model.Component):
+    """
+    Component with just a dataflow generating arrays
+    """
+
+    def __init__(self, name, daemon=None):
+        model.Component.__init__(self, name=name, daemon=daemon)
+        self.data = GeneratorDataFlow()
+
+
+class SlowListener(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.indices = []
+
+    def on_data(self, dataflow, data):
+        self.latencies.append(time.time() - data.metadata[model.MD_ACQ_DATE])
+        self.indices.append(int(data[0, 0]))
+        time.sleep(LISTENER_DELAY)
+
+
+def main(args):
+    """
+    Handles the command line arguments
+    args is the list of arguments passed
+    return (int): value to return to the OS as program exit code
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    if len(args) == 2:
+        duration = float(args[1])
+    else:
+        duration = 5  # s
+
+    cont, comp = model.createInNewContainer("dataflow-latency", GeneratorComponent,
+                                            {"name": "generator"})
+    try:
+        for discard in (True, False):
+            listener = SlowListener()
+            comp.data.subscribe(listener.on_data, discard=discard)
+            time.sleep(duration)
+            comp.data.unsubscribe(listener.on_data)
+            time.sleep(0.5)  # Wait for the data still in the pipe
+
+            lat = listener.latencies
+            print("discard=%s: received %d arrays (up to #%d), latency avg = %g s, max = %g s" %
+                  (discard, len(lat), max(listener.indices), sum(lat) / len(lat), max(lat)))
+    finally:
+        comp.terminate()
+        cont.terminate()
+
+    return 0
+
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    exit(ret)
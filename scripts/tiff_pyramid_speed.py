@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+
+# This script compares the speed of writing a large pyramidal TIFF image with
+# the previous implementation (each zoom level rescaled from the full image,
+# and the tiles compressed one at a time by libtiff).
+
+# Usage:
+# tiff_pyramid_speed.py [width height]
+
+from __future__ import division, print_function
+
+import libtiff
+import libtiff.libtiff_ctypes as T
+import logging
+import numpy
+from odemis import model
+from odemis.dataio import tiff
+from odemis.util import img
+import os
+import sys
+import tempfile
+import time
+
+
+def export_old(filename, data):
+    """
+    Export a pyramidal image the way it was done before
+    """
+    f = libtiff.TIFF.open(filename, mode='w')
+    resized_shapes = tiff._genResizedShapes(data)
+    f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
+    f.write_tiles(data, tiff.TILE_SIZE, tiff.TILE_SIZE, "lzw", False)
+    for resized_shape in resized_shapes:
+        subim = img.rescale_hq(data, resized_shape)
+        f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+        f.write_tiles(subim, tiff.TILE_SIZE, tiff.TILE_SIZE, "lzw", False)
+    f.close()
+
+
+def main(args):
+    """
+    Handles the command line arguments
+    args is the list of arguments passed
+    return (int): value to return to the OS as program exit code
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    if len(args) == 3:
+        size = int(args[1]), int(args[2])  # X, Y
+    else:
+        size = (6000, 4000)
+
+    # Some structure + noise, to have a realistic compression
+    y, x = numpy.mgrid[0:size[1], 0:size[0]]
+    arr = ((x // 7 + y // 13) % 2000 +
+           numpy.random.randint(0, 50, size[::-1])).astype(numpy.uint16)
+    data = model.DataArray(arr, {model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+
+    fd, fn = tempfile.mkstemp(suffix=tiff.EXTENSIONS[0])
+    os.close(fd)
+    try:
+        for name, func in (("current", lambda: tiff.export(fn, data, pyramid=True)),
+                           ("previous", lambda: export_old(fn, data))):
+            tstart = time.time()
+            func()
+            dur = time.time() - tstart
+            print("%s implementation: pyramidal export of %s took %g s (%d MB)" %
+                  (name, size, dur, os.stat(fn).st_size // 2 ** 20))
+    finally:
+        os.remove(fn)
+
+    return 0
+
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    exit(ret)
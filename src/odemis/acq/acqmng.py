@@ -28,6 +28,7 @@ from __future__ import division
 
 from collections import OrderedDict
 import collections
+from concurrent import futures
 from concurrent.futures import CancelledError
 import logging
 
@@ -280,6 +281,13 @@ class AcquisitionTask(object):
         # Keep order so that the DataArrays are returned in the order they were
         # acquired. Not absolutely needed, but nice for the user in some cases.
         raw_images = OrderedDict()  # stream -> list of raw images
+        # The data of each stream is post-processed in a separate thread, while
+        # the next stream is being acquired.
+        postprocessor = None  # ThreadPoolExecutor, created after the first stream
+        postprocess_futures = OrderedDict()  # stream -> Future returning the list of raw images
+        # The correction metadata from the OverlayStream (always acquired last)
+        # can only be applied once all the streams are acquired.
+        has_overlay = any(isinstance(s, OverlayStream) for s in self._streams)
         try:
             # Tell the leeches that the acquisition is starting
             for s in self._streams:
@@ -321,15 +329,17 @@ class AcquisitionTask(object):
                 # Wait for the acquisition to be finished.
                 # Will pass down exceptions, included in case it's cancelled
                 das = f.result()
-                if not isinstance(das, collections.Iterable):
-                    logging.warning("Future of %s didn't return a list of DataArrays, but %s", s, das)
-                    das = []
 
-                # Add extra settings to metadata
+                # Take a snapshot of the settings now, as they might change for
+                # the next stream
                 if self._settings_obs:
                     settings = self._settings_obs.get_all_settings()
-                    for da in das:
-                        da.metadata[model.MD_EXTRA_SETTINGS] = copy.deepcopy(settings)
+                else:
+                    settings = None
+                if postprocessor is None:
+                    postprocessor = futures.ThreadPoolExecutor(max_workers=1)
+                postprocess_futures[s] = postprocessor.submit(self._postprocess_stream,
+                                                              s, das, settings, not has_overlay)
                 raw_images[s] = das
 
                 # update the time left
@@ -351,6 +361,8 @@ class AcquisitionTask(object):
                     pass
 
         except CancelledError:
+            for pf in postprocess_futures.values():
+                pf.cancel()
             raise
         except Exception as ex:
             # If no acquisition yet => just raise the exception,
@@ -367,14 +379,57 @@ class AcquisitionTask(object):
             self._streamTimes = {}
             self._current_stream = None
             self._current_future = None
-
-        # Update metadata using OverlayStream (if there was one)
-        self._adjust_metadata(raw_images)
+            # The thread ends once the data already submitted is post-processed
+            if postprocessor is not None:
+                postprocessor.shutdown(wait=False)
+
+        for s, pf in postprocess_futures.items():
+            try:
+                raw_images[s] = pf.result()
+            except Exception:
+                logging.exception("Failed to post-process the data of %s", s)
+                if not isinstance(raw_images[s], collections.Iterable):
+                    raw_images[s] = []
+
+        if has_overlay:
+            # Update metadata using OverlayStream
+            self._adjust_metadata(raw_images)
 
         # merge all the raw data (= list of DataArrays) into one long list
         ret = sum(raw_images.values(), [])
         return ret, exp
 
+    def _postprocess_stream(self, stream, das, settings, correct=True):
+        """
+        Check the raw data of a stream, and update its metadata with the
+        information which doesn't depend on the other streams.
+        stream (Stream): the stream which acquired the data
+        das (list of DataArray): the raw data of the stream. It is directly updated.
+        settings (dict or None): snapshot of all the settings, as returned by
+          SettingsObserver.get_all_settings(), to store in the metadata.
+        correct (bool): if True, also apply the correction metadata (as
+          _adjust_metadata() does when there is no OverlayStream)
+        return (list of DataArray): the raw data
+        """
+        if not isinstance(das, collections.Iterable):
+            logging.warning("Future of %s didn't return a list of DataArrays, but %s", stream, das)
+            return []
+
+        for da in das:
+            if settings is not None:
+                # The snapshot is a copy already, so it's shared by all the data
+                da.metadata[model.MD_EXTRA_SETTINGS] = settings
+            # add the stream name to the image if nothing yet. Not for the
+            # OverlayStream, as its metadata is merged into the other data.
+            if (model.MD_DESCRIPTION not in da.metadata and
+                not isinstance(stream, OverlayStream)):
+                da.metadata[model.MD_DESCRIPTION] = stream.name.value
+            # Correction metadata from basic alignment
+            if correct and isinstance(stream, (OpticalStream, EMStream)):
+                img.mergeMetadata(da.metadata)
+
+        return das
+
     def _adjust_metadata(self, raw_data):
         """
         Update/adjust the metadata of the raw data received based on global
@@ -405,12 +460,6 @@ class AcquisitionTask(object):
                 for d in data:
                     img.mergeMetadata(d.metadata, sem_cor_md)
 
-        # add the stream name to the image if nothing yet
-        for s, data in raw_data.items():
-            for d in data:
-                if model.MD_DESCRIPTION not in d.metadata:
-                    d.metadata[model.MD_DESCRIPTION] = s.name.value
-
     def _on_progress_update(self, f, start, end):
         """
         Called when the current future has made a progress (and so it should
@@ -26,6 +26,7 @@ import itertools
 import logging
 import math
 import numpy
+from odemis import model
 from scipy import misc
 import threading
 import cv2
@@ -117,21 +118,16 @@ class AnchoredEstimator(object):
         """
         Scan the anchor area
         """
-        # Save current SEM settings
-        cur_dwell_time = self._emitter.dwellTime.value
-        cur_scale = self._emitter.scale.value
-        cur_resolution = self._emitter.resolution.value
-        cur_trans = self._emitter.translation.value
-
-        try:
-            self._updateSEMSettings()
+        # Change the SEM settings (and put them back afterwards) in one go, as
+        # it's done often during an acquisition
+        with model.temporaryVAs(self._emitter, self._getSEMSettings()) as settings:
             logging.debug("E-beam spot to anchor region: %s",
-                          self._emitter.translation.value)
+                          settings["translation"])
             logging.debug("Scanning anchor region with resolution "
                           "%s and dwelltime %s and scale %s",
-                          self._emitter.resolution.value,
-                          self._emitter.dwellTime.value,
-                          self._emitter.scale.value)
+                          settings["resolution"],
+                          settings["dwellTime"],
+                          settings["scale"])
             data = self._semd.data.get(asap=False)
             if data.shape[::-1] != self._res:
                 logging.warning("Shape of data is %s instead of %s", data.shape[::-1], self._res)
@@ -144,12 +140,6 @@ class AnchoredEstimator(object):
             else:
                 self.raw = self.raw[0:2]
             self.raw.append(data)
-        finally:
-            # Restore SEM settings
-            self._emitter.dwellTime.value = cur_dwell_time
-            self._emitter.scale.value = cur_scale
-            self._emitter.resolution.value = cur_resolution
-            self._emitter.translation.value = cur_trans
 
     def estimate(self):
         """
@@ -246,10 +236,12 @@ class AnchoredEstimator(object):
 
         return itertools.cycle(acq_dc_period)
 
-    def _updateSEMSettings(self):
+    def _getSEMSettings(self):
         """
-        Update the scanning area of the SEM according to the anchor region
-        for drift correction.
+        Compute the settings of the SEM to scan the anchor region, for drift
+        correction.
+        return (list of (str, value)): name of the e-beam VA -> value, in the
+          order they should be set.
         """
         # translation is distance from center (situated at 0.5, 0.5), can be floats
         # we clip translation inside of bounds in case of huge drift
@@ -262,10 +254,10 @@ class AnchoredEstimator(object):
                             "drift of %s clipped to %s", trans, self._trans)
 
         # always in this order
-        self._emitter.scale.value = self._scale
-        self._emitter.resolution.value = self._res
-        self._emitter.translation.value = self._trans
-        self._emitter.dwellTime.value = self._dwell_time
+        return [("scale", self._scale),
+                ("resolution", self._res),
+                ("translation", self._trans),
+                ("dwellTime", self._dwell_time)]
 
 
 def GuessAnchorRegion(whole_img, sample_region):
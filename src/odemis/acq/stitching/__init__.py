@@ -41,28 +41,59 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
         MD_POS metadata
     """
 
+    registrar = get_registrar(method)
+
+    # Register tiles
+    for ts in tiles:
+        add_tile(registrar, ts)
+
+    return update_positions(registrar, tiles)
+
+
+def get_registrar(method=REGISTER_GLOBAL_SHIFT):
+    """
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar,
+      REGISTER_GLOBAL_SHIFT → GlobalShiftRegistrar
+    returns (Registrar): a new registrar, to which the tiles can be passed with add_tile()
+    """
     if method == REGISTER_SHIFT:
-        registrar = ShiftRegistrar()
+        return ShiftRegistrar()
     elif method == REGISTER_IDENTITY:
-        registrar = IdentityRegistrar()
+        return IdentityRegistrar()
     elif method == REGISTER_GLOBAL_SHIFT:
-        registrar = GlobalShiftRegistrar()
+        return GlobalShiftRegistrar()
     else:
         raise ValueError("Invalid registrar %s" % (method,))
 
-    # Register tiles
-    updatedTiles = []
-    for ts in tiles:
-        # Separate tile and dependent_tiles
-        if isinstance(ts, tuple):
-            tile = ts[0]
-            dep_tiles = ts[1:]
-        else:
-            tile = ts
-            dep_tiles = None
-        registrar.addTile(tile, dep_tiles)
 
+def add_tile(registrar, ts):
+    """
+    Passes a tile to the registrar. It can be called while the next tiles are being
+    acquired, so that (with the GlobalShiftRegistrar) the registration runs in the
+    background during the acquisition.
+    registrar (Registrar): as returned by get_registrar()
+    ts (DataArray of shape YX or tuple of DataArrays): the tile. If it's a tuple, the
+      first tile is the “main tile”, and the following ones are dependent tiles.
+    """
+    # Separate tile and dependent_tiles
+    if isinstance(ts, tuple):
+        registrar.addTile(ts[0], ts[1:])
+    else:
+        registrar.addTile(ts, None)
+
+
+def update_positions(registrar, tiles):
+    """
+    registrar (Registrar): registrar to which all the tiles have been passed
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles, in the same
+      order as they were passed to the registrar.
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+        MD_POS metadata
+    """
     # Update positions
+    updatedTiles = []
+    tile_positions, dep_tile_positions = registrar.getPositions()
     for i, ts in enumerate(tiles):
         # Return tuple of positions if dependent tiles are present
         if isinstance(ts, tuple):
@@ -71,20 +102,20 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
 
             # Update main tile
             md = copy.deepcopy(tile.metadata)
-            md[model.MD_POS] = registrar.getPositions()[0][i]
+            md[model.MD_POS] = tile_positions[i]
             tileUpd = model.DataArray(tile, md)
 
             # Update dependent tiles
             tilesNew = [tileUpd]
             for j, dt in enumerate(dep_tiles):
                 md = copy.deepcopy(dt.metadata)
-                md[model.MD_POS] = registrar.getPositions()[1][i][j]
+                md[model.MD_POS] = dep_tile_positions[i][j]
                 tilesNew.append(model.DataArray(dt, md))
             tileUpd = tuple(tilesNew)
 
         else:
             md = copy.deepcopy(ts.metadata)
-            md[model.MD_POS] = registrar.getPositions()[0][i]
+            md[model.MD_POS] = tile_positions[i]
             tileUpd = model.DataArray(ts, md)
 
         updatedTiles.append(tileUpd)
@@ -92,11 +123,14 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
     return updatedTiles
 
 
-def weave(tiles, method=WEAVER_MEAN):
+def weave(tiles, method=WEAVER_MEAN, lazy=False):
     """
     tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration. 
     If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are dependent tiles.
     method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    lazy (bool): if True, a DataArrayShadow is returned instead of a DataArray. The
+      image is then only generated when needed, strip by strip, which allows to save
+      a very large image (with tiff.export(pyramid=True)) without holding it in memory.
     return:
         tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated MD_POS metadata
     """
@@ -112,6 +146,8 @@ def weave(tiles, method=WEAVER_MEAN):
 
     for t in tiles:
         weaver.addTile(t)
+    if lazy:
+        return weaver.getFullImageShadow()
     stitched_image = weaver.getFullImage()
 
     return stitched_image
@@ -29,16 +29,19 @@ content, in other words performing "image registration".
 """
 
 from __future__ import division
+from concurrent import futures
 from odemis.acq.drift import MeasureShift
 import numpy
 import math
+import multiprocessing
 from odemis import model
 import logging
 from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import minimum_spanning_tree
-from collections import deque
+from scipy.sparse.csgraph import minimum_spanning_tree, breadth_first_order
 
 GOOD_MATCH = 0.9  # consider all registrations with match > GOOD_MATCH
+# Default number of threads used to compute the shifts between tiles
+REGISTRATION_THREADS = multiprocessing.cpu_count()
 LEFT_TO_RIGHT = 1
 RIGHT_TO_LEFT = -1
 
@@ -73,6 +76,12 @@ class IdentityRegistrar(object):
         """
         return self.tile_pos, self.dep_tiles_pos
 
+    def close(self):
+        """
+        Frees the resources used. Nothing to do.
+        """
+        pass
+
 
 class ShiftRegistrar(object):
     """
@@ -220,6 +229,12 @@ class ShiftRegistrar(object):
 
         return tile_positions, dep_tile_positions
 
+    def close(self):
+        """
+        Frees the resources used. Nothing to do.
+        """
+        pass
+
     def _find_closest_tile(self, pos):
         """ finds the tile in the grid that is closest to pos.
         returns: 
@@ -446,7 +461,13 @@ class GlobalShiftRegistrar(object):
     neighbours and performs a global optimization to find the best path connecting the tiles.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=REGISTRATION_THREADS):
+        """
+        :param max_workers: (0 <= int) number of threads used to compute the shifts between neighbouring
+        tiles. The shifts are computed in the background as soon as both tiles have been added, so that
+        the registration overlaps with the acquisition of the next tiles. If 0, the shifts are computed
+        synchronously, during addTile().
+        """
         # Store all the tiles. Each cell contains either None or a DataArray
         self.tiles = [[None]]
 
@@ -469,17 +490,37 @@ class GlobalShiftRegistrar(object):
         # Shift between main tile and dependent tiles, shape: number of tiles x number of dep_tiles.
         self.offsets_dep_tiles = []
 
+        # MD_POS of each tile, in order of acquisition, to quickly find the closest tile.
+        # The array has some spare rows at the end, and is extended when full.
+        self._md_pos = numpy.empty((64, 2))
+
+        # Result of getPositions(), or None if it needs to be computed
+        self._positions = None
+
+        # Data computed once per tile, and shared by the shift computations with all its neighbours:
+        # id(tile) -> (numpy.array, float): the raw data of the tile, its average
+        self._tiles_data = {}
+
+        # Shift computations running in the background
+        self._max_workers = max_workers
+        self._executor = None  # created on the first shift computation
+        self._pending_shifts = []  # list of (row of shifts_hor or shifts_ver, col)
+
     def addTile(self, tile, dependent_tiles=None):
         """
         Extends grid by one tile. The first tile is added at the top left position. Any following
         tile must have a neighbour (on either side left, right, top, bottom) that has previously
-        been added.
+        been added. The shifts with the neighbours are computed in the background, so this
+        function returns quickly.
 
         :param tile: (DataArray of shape YX) tile with MD_POS and MD_PIXEL_SIZE metadata.
         :param dependent_tiles: (list of K numpy.arrays or None): dependent tiles with fixed position
         relative to main tile. Their content and metadata are not used for the computation of the final position.
         """
+        self._positions = None
         row, col = self._insert_tile_to_grid(tile)
+        tile_data = numpy.asarray(tile)
+        self._tiles_data[id(tile)] = tile_data, numpy.average(tile_data)
         self._compute_registration(row, col)
 
         if dependent_tiles is not None:
@@ -497,7 +538,14 @@ class GlobalShiftRegistrar(object):
         order they were added
         :returns dep_tile_positions: (list of N tuples of K tuples of 2 floats) for each tile, it returns
         the adjusted position of all dependent tile (in the order they were passed)
+        Note: the positions are only computed once, until a new tile is added.
+        It blocks until all the shifts between the tiles have been computed.
         """
+        if self._positions is not None:
+            return self._positions
+
+        self._wait_shifts()
+
         px_size = self.tiles[0][0].metadata[model.MD_PIXEL_SIZE]
         firstPosition = numpy.divide(self.tiles[0][0].metadata[model.MD_POS], px_size)
         tile_positions = []
@@ -516,7 +564,19 @@ class GlobalShiftRegistrar(object):
                 dts.append((t[0] + sdt[0], t[1] + sdt[1]))
             dep_tile_positions.append(dts)
 
-        return tile_positions, dep_tile_positions
+        self._positions = tile_positions, dep_tile_positions
+        return self._positions
+
+    def _store_md_pos(self, tile):
+        """
+        Records the MD_POS of a new tile, in order of acquisition.
+        :param tile: (DataArray) tile to be inserted
+        :updates self._md_pos:
+        """
+        n = len(self.acq_order)
+        if n >= self._md_pos.shape[0]:
+            self._md_pos = numpy.resize(self._md_pos, (self._md_pos.shape[0] * 2, 2))
+        self._md_pos[n] = tile.metadata[model.MD_POS]
 
     def _insert_tile_to_grid(self, tile):
         """
@@ -529,6 +589,7 @@ class GlobalShiftRegistrar(object):
         """
         if self.tiles[0][0] is None:
             self.tiles[0][0] = tile
+            self._store_md_pos(tile)
             self.acq_order.append([0, 0])
             return 0, 0
 
@@ -540,15 +601,12 @@ class GlobalShiftRegistrar(object):
         num_rows = len(self.tiles)
 
         # Find the registered tile that is closest to the new tile.
-        minDist = float("inf")
-        for i in range(num_rows):
-            for j in range(num_cols):
-                if self.tiles[i][j] is not None:
-                    dist = math.hypot(*numpy.subtract(tile.metadata[model.MD_POS],
-                                                     self.tiles[i][j].metadata[model.MD_POS]))
-                    if dist < minDist:
-                        minDist = dist
-                        prev_row, prev_col = (i, j)
+        n = len(self.acq_order)
+        dists = numpy.hypot(*(numpy.subtract(tile.metadata[model.MD_POS], self._md_pos[:n])).T)
+        # If several tiles are at the same distance, pick the first one in the grid
+        closest = numpy.flatnonzero(dists == dists.min())
+        prev_row, prev_col = min((self.acq_order[i][0] % num_rows, self.acq_order[i][1] % num_cols)
+                                 for i in closest)
 
         # Insert new tile either to the right or to the bottom of the closest tile.
         ver_diff = tile.metadata[model.MD_POS][1] - self.tiles[prev_row][prev_col].metadata[model.MD_POS][1]
@@ -595,6 +653,7 @@ class GlobalShiftRegistrar(object):
                              "with the closest tile." % (hor_diff, ver_diff))
 
         self.tiles[row][col] = tile
+        self._store_md_pos(tile)
         self.acq_order.append([row, col])
         return row, col
 
@@ -608,6 +667,8 @@ class GlobalShiftRegistrar(object):
         :returns: ((int, int), float) x shift, y shift, normalized cross correlation (-1 <= ncc <= 1, higher
         is better)
         """
+        prev_tile_data, prev_tile_avg = self._tiles_data[id(prev_tile)]
+        tile_data, tile_avg = self._tiles_data[id(tile)]
         px_size = tile.metadata[model.MD_PIXEL_SIZE]
         # The y-axis of the reference coordinate system used here is inverted compared to
         # the metadata position.
@@ -630,8 +691,8 @@ class GlobalShiftRegistrar(object):
         else:
             t1, b1 = int(exp_shift[1]), tile.shape[0]
             t2, b2 = 0, tile.shape[0] - int(exp_shift[1])
-        prev_tile_roi = numpy.array(prev_tile)[t1:b1, l1:r1]
-        tile_roi = numpy.array(tile)[t2:b2, l2:r2]
+        prev_tile_roi = prev_tile_data[t1:b1, l1:r1]
+        tile_roi = tile_data[t2:b2, l2:r2]
 
         # If you need to crop the tile without changing the output shift,
         # you can do it here with the pattern tile_roi[t:-b, l:-r]
@@ -639,8 +700,7 @@ class GlobalShiftRegistrar(object):
         shift_total = numpy.subtract(exp_shift, shift)
 
         # Measure accuracy (ncc value)
-        avg = numpy.average(prev_tile), numpy.average(tile)
-        dist = prev_tile_roi - avg[0], tile_roi - avg[1]
+        dist = prev_tile_roi - prev_tile_avg, tile_roi - tile_avg
         covar = numpy.sum(dist[0] * dist[1]) / prev_tile_roi.size
         var = numpy.sum(dist[0] ** 2) / prev_tile_roi.size, numpy.sum(dist[1] ** 2) / tile_roi.size
         stDev = (numpy.sqrt(var[0]), numpy.sqrt(var[1]))
@@ -661,7 +721,8 @@ class GlobalShiftRegistrar(object):
         """
         Performs registration of the tile at grid position row, col with respect to every
         available neighbour. The computed shifts and the respective cross-correlation values
-        are stored in self.shifts.
+        are stored in self.shifts. If a thread pool is used, a Future is stored instead, until
+        _wait_shifts() is called.
 
         :param row: (int) row index
         :param col: (int) col index
@@ -684,14 +745,68 @@ class GlobalShiftRegistrar(object):
 
         # Calculate the shifts to all adjacent tiles that have not been calculated yet
         if nbr_left is not None and not shift_left:
-            self.shifts_hor[row][col - 1] = self._get_shift(nbr_left, tile)
+            self._start_shift(self.shifts_hor, row, col - 1, nbr_left, tile)
         if nbr_right is not None and not shift_right:
-            self.shifts_hor[row][col] = self._get_shift(tile, nbr_right)
+            self._start_shift(self.shifts_hor, row, col, tile, nbr_right)
         if nbr_top is not None and not shift_top:
-            self.shifts_ver[row - 1][col] = self._get_shift(nbr_top, tile)
+            self._start_shift(self.shifts_ver, row - 1, col, nbr_top, tile)
         if nbr_bottom is not None and not shift_bottom:
-            self.shifts_ver[row][col] = self._get_shift(tile, nbr_bottom)
-            
+            self._start_shift(self.shifts_ver, row, col, tile, nbr_bottom)
+
+    def _start_shift(self, shifts, row, col, prev_tile, tile):
+        """
+        Computes the shift between two neighbouring tiles, either immediately, or in
+        the background if a thread pool is used.
+
+        :param shifts: (list of lists) self.shifts_hor or self.shifts_ver
+        :param row: (int) row index of the shift in shifts
+        :param col: (int) col index of the shift in shifts
+        :param prev_tile: (DataArray) static tile to which other tile is compared
+        :param tile: (DataArray) shifted tile
+        :updates shifts:
+        """
+        if self._max_workers <= 0:
+            shifts[row][col] = self._get_shift(prev_tile, tile)
+            return
+
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=self._max_workers)
+        # The FFTs release the GIL, so the computations really run in parallel
+        shifts[row][col] = self._executor.submit(self._get_shift, prev_tile, tile)
+        # Keep a reference to the list (ie, the row), as the grid might be extended meanwhile
+        self._pending_shifts.append((shifts[row], col))
+
+    def _wait_shifts(self):
+        """
+        Waits for all the shift computations running in the background to be over, and
+        replaces the Futures by their result.
+
+        :updates self.shifts:
+        :raises: any exception which happened during the computation of a shift
+        """
+        try:
+            for shifts_row, col in self._pending_shifts:
+                shifts_row[col] = shifts_row[col].result()
+        finally:
+            # No more tiles expected for now => free the threads
+            self.close()
+
+    def close(self):
+        """
+        Cancels the shift computations still pending, and frees the threads, without
+        waiting for the computations already running. If some computations were
+        pending, the positions cannot be computed anymore.
+        It can be called multiple times.
+        """
+        for shifts_row, col in self._pending_shifts:
+            f = shifts_row[col]
+            if isinstance(f, futures.Future):
+                f.cancel()
+        self._pending_shifts = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
     def _assemble_mosaic(self):
         """
         Performs a global optimization to find the best path through the tile grid using 
@@ -700,64 +815,51 @@ class GlobalShiftRegistrar(object):
         :returns: (numpy array with shape: num_rows x num_cols x 2) registered positions relative to the upper left
         tile in pixels
         """
-        # Transform shifts and errors to adjacency matrices
+        # Transform shifts and errors to a (sparse) adjacency matrix.
         # The normalized cross correlation value needs to be transformed, so it can be
         # used in the minimum spanning tree. Lower values are better and the value should
         # never be 0 --> convert to error between [100, 200]
+        # Each tile only has at most 2 edges (with the tile on the right and at the bottom),
+        # so the memory and computation time only grow linearly with the number of tiles.
         num_cols = len(self.tiles[0])
         num_rows = len(self.tiles)
-        errors = numpy.zeros((num_rows * num_cols, num_rows * num_cols))
-        shifts = numpy.zeros((num_rows * num_cols, num_rows * num_cols, 2))
+        num_tiles = num_rows * num_cols
+        edge_src = []
+        edge_dst = []
+        errors = []
+        shifts = {}  # (idx, next idx) -> shift, with idx < next idx
         for row in range(num_rows):
-            for col in range(num_cols - 1):
-                idx = row * num_cols + col
-                if self.shifts_hor[row][col]:
-                    ncc = self.shifts_hor[row][col][1]
-                    errors[idx, idx + 1] = 200 - (ncc + 1) * 50
-                    shifts[idx, idx + 1] = self.shifts_hor[row][col][0]
-
-        for row in range(num_rows - 1):
             for col in range(num_cols):
                 idx = row * num_cols + col
-                if self.shifts_ver[row][col]:
-                    ncc = self.shifts_ver[row][col][1]
-                    errors[idx, idx + num_cols] = 200 - (ncc + 1) * 50
-                    shifts[idx, idx + num_cols] = self.shifts_ver[row][col][0]
+                if col < num_cols - 1 and self.shifts_hor[row][col]:
+                    shift, ncc = self.shifts_hor[row][col]
+                    edge_src.append(idx)
+                    edge_dst.append(idx + 1)
+                    errors.append(200 - (ncc + 1) * 50)
+                    shifts[idx, idx + 1] = shift
+                if row < num_rows - 1 and self.shifts_ver[row][col]:
+                    shift, ncc = self.shifts_ver[row][col]
+                    edge_src.append(idx)
+                    edge_dst.append(idx + num_cols)
+                    errors.append(200 - (ncc + 1) * 50)
+                    shifts[idx, idx + num_cols] = shift
 
         # Build the minimum spanning tree
-        tree = minimum_spanning_tree(csr_matrix(errors))
-        tree = tree.toarray().astype(int)
-
-        # Follow the path through the tree and update positions with the corresponding shifts.
-        # The minimum spanning tree is converted to an adjacency list that contains for every
-        # tile a list of all tiles that should be updated based on the current tile.
-        # The children of the newly updated tile will be placed in a queue waiting to be
-        # updated themselves.
-        adj_list = {}
-        for i in range(len(tree)):
-            adj = []
-            for j in range(len(tree[0])):
-                if tree[i][j] != 0:
-                    adj.append([j, shifts[i][j]])
-                if tree[j][i] != 0:
-                    adj.append([j, shifts[j][i]])
-            adj_list[i] = adj
+        graph = csr_matrix((errors, (edge_src, edge_dst)), shape=(num_tiles, num_tiles))
+        tree = minimum_spanning_tree(graph)
 
+        # Follow the path through the tree (starting from the first tile) and update
+        # positions with the corresponding shifts. Each tile comes after the tile it
+        # is connected to in the tree (its predecessor), so the position of the
+        # predecessor is always already known.
         positions = numpy.zeros((num_rows, num_cols, 2))  # start with no shift for each tile
-        positions_flat = positions.reshape((num_rows * num_cols, 2))  # the tiles in the "idx" notation
-        idx_queue = deque([0])  # start with index 0
-        idx_done = set()  # set of positions that have already been updated
-        while idx_queue:
-            key = idx_queue.popleft()
-            for next_idx, shift in adj_list[key]:
-                if next_idx not in idx_done:  # don't consider positions that have already been dealt with
-                    if next_idx > key:
-                        positions_flat[next_idx] = numpy.add(positions_flat[key], shift)
-                    else:
-                        positions_flat[next_idx] = numpy.subtract(positions_flat[key], shift)
-
-                    idx_done.add(next_idx)
-                    if next_idx not in idx_queue:
-                        idx_queue.append(next_idx)
+        positions_flat = positions.reshape((num_tiles, 2))  # the tiles in the "idx" notation
+        order, predecessors = breadth_first_order(tree, 0, directed=False, return_predecessors=True)
+        for idx in order[1:]:
+            prev_idx = predecessors[idx]
+            if idx > prev_idx:
+                positions_flat[idx] = numpy.add(positions_flat[prev_idx], shifts[prev_idx, idx])
+            else:
+                positions_flat[idx] = numpy.subtract(positions_flat[prev_idx], shifts[idx, prev_idx])
 
         return positions
@@ -21,6 +21,10 @@ import numpy
 from odemis import model, util
 from odemis.util import img
 
+# Number of rows of the global image woven at once. It limits the size of the
+# temporary arrays, and is the height of the strips of DataArrayShadowWoven.
+STRIP_HEIGHT = 256
+
 
 # This is a series of classes which use different methods to generate a large
 # image out of "tile" images.
@@ -30,21 +34,19 @@ from odemis.util import img
 # directly copy the image already transformed.
 # TODO: handle higher dimensions by just copying them as-is
 
-class CollageWeaver(object):
+class Weaver(object):
     """
-    Very straight-forward version, which just paste the images where their center
-    position is. It expects that the pixel size for all the images are identical.
-    It doesn't take into account the rotation and skew metadata.
-    tiles (iterable of 2D DataArray): each image must have at least MD_POS and
-      MD_PIXEL_SIZE metadata. They should all have the same dtype.
-    border (None or value): if there is a value, it's used around each image, to
-     highlight the position
-    return (2D DataArray): same dtype as the tiles, with shape corresponding to
-      the bounding box.
+    Base class for the weavers. It computes the position of each tile in the global
+    image, and builds the global image by horizontal strips, so that only a few rows
+    are processed at once. The global image can be either fully generated in memory,
+    with getFullImage(), or generated strip by strip when needed, with
+    getFullImageShadow().
+    Subclasses must implement _weaveStrip().
     """
 
     def __init__(self):
         self.tiles = []
+        self._layout = None  # cache of _getLayout()
 
     def addTile(self, tile):
         """
@@ -56,100 +58,86 @@ class CollageWeaver(object):
         tile = model.DataArray(tile, tile.metadata.copy())
         img.mergeMetadata(tile.metadata)
         self.tiles.append(tile)
+        self._layout = None
 
     def getFullImage(self):
         """
         return (2D DataArray): same dtype as the tiles, with shape corresponding to the bounding box. 
         """
-
-        tiles = self.tiles
-
-        # Compute the bounding box of each tile and the global bounding box
-
-        # Get a fixed pixel size by using the first one
-        # TODO: use the mean, in case they are all slightly different due to
-        # correction?
-        pxs = tiles[0].metadata[model.MD_PIXEL_SIZE]
-
-        tbbx_phy = []  # tuples of ltrb in physical coordinates
-        for t in tiles:
-            c = t.metadata[model.MD_POS]
-            w = t.shape[-1], t.shape[-2]
-            if not util.almost_equal(pxs[0], t.metadata[model.MD_PIXEL_SIZE][0], rtol=0.01):
-                logging.warning("Tile @ %s has a unexpected pixel size (%g vs %g)",
-                                c, t.metadata[model.MD_PIXEL_SIZE][0], pxs[0])
-            bbx = (c[0] - (w[0] * pxs[0] / 2), c[1] - (w[1] * pxs[1] / 2),
-                   c[0] + (w[0] * pxs[0] / 2), c[1] + (w[1] * pxs[1] / 2))
-
-            tbbx_phy.append(bbx)
-
-        gbbx_phy = (min(b[0] for b in tbbx_phy), min(b[1] for b in tbbx_phy),
-                    max(b[2] for b in tbbx_phy), max(b[3] for b in tbbx_phy))
-
-        # Compute the bounding-boxes in pixel coordinates
-        tbbx_px = []
-
-        # that's the origin (Y is max as Y is inverted)
-        glt = gbbx_phy[0], gbbx_phy[3]
-        for bp, t in zip(tbbx_phy, tiles):
-            lt = (int(round((bp[0] - glt[0]) / pxs[0])),
-                  int(round(-(bp[3] - glt[1]) / pxs[1])))
-            w = t.shape[-1], t.shape[-2]
-            bbx = (lt[0], lt[1],
-                   lt[0] + w[0], lt[1] + w[1])
-            tbbx_px.append(bbx)
-
-        gbbx_px = (min(b[0] for b in tbbx_px), min(b[1] for b in tbbx_px),
-                   max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
-
-        assert gbbx_px[0] == gbbx_px[1] == 0
-
-        if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
-            # Overlap > 50% or missing tiles
-            logging.warning("Global area much bigger than sum of tile areas")
-
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
-        # Use minimum of the values in the tiles for background
-        im[:] = numpy.amin(tiles)
-        for b, t in zip(tbbx_px, tiles):
-            im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = t
-            # TODO: border
-
-        # Update metadata
-        # TODO: check this is also correct based on lt + half shape * pxs
-        c_phy = ((gbbx_phy[0] + gbbx_phy[2]) / 2,
-                 (gbbx_phy[1] + gbbx_phy[3]) / 2)
-        md = tiles[0].metadata.copy()
-        md[model.MD_POS] = c_phy
+        tbbx_px, shape, md = self._getLayout()
+        logging.debug("Generating global image of size %dx%d px", shape[1], shape[0])
+        im = numpy.empty(shape, dtype=self.tiles[0].dtype)
+        for top in range(0, shape[0], STRIP_HEIGHT):
+            self._fillStrip(im[top:top + STRIP_HEIGHT], top)
 
         return model.DataArray(im, md)
 
+    def getFullImageShadow(self):
+        """
+        return (DataArrayShadowWoven): the same image as getFullImage(), but the data is
+          only generated when requested, one strip of STRIP_HEIGHT rows at a time.
+          This allows to export very large images without holding them in memory.
+        """
+        tbbx_px, shape, md = self._getLayout()
+        return DataArrayShadowWoven(self, shape, self.tiles[0].dtype, md)
 
-class CollageWeaverReverse(object):
-    """
-    Similar to CollageWeaver, but only fills parts of the global image with the new tile that
-    are still empty. This is desirable if the quality of the overlap regions is much better the first
-    time a region is imaged due to bleaching effects. The result is equivalent to a collage that starts 
-    with the last tile and pastes the older tiles in reverse order of acquisition.
-    """
-
-    def __init__(self):
-        self.tiles = []
+    def getStrip(self, top, height):
+        """
+        Generates a part of the global image.
+        top (0<=int): index of the first row of the global image
+        height (0<int): number of rows. If the image is shorter, fewer rows are returned.
+        return (2D numpy.array): the rows top -> top + height of the global image
+        """
+        tbbx_px, shape, md = self._getLayout()
+        height = min(height, shape[0] - top)
+        strip = numpy.empty((height, shape[1]), dtype=self.tiles[0].dtype)
+        self._fillStrip(strip, top)
+        return strip
 
-    def addTile(self, tile):
-        # Merge the correction metadata inside each image (to keep the rest of the
-        # code simple)
-        tile = model.DataArray(tile, tile.metadata.copy())
-        img.mergeMetadata(tile.metadata)
-        self.tiles.append(tile)
+    def _fillStrip(self, strip, top):
+        """
+        Fills a strip of the global image with the background and then with the tiles.
+        strip (2D numpy.array): part of the global image, of full width
+        top (0<=int): index of the first row of the strip in the global image
+        """
+        # Use minimum of the values in the tiles for background
+        strip[:] = self._background
+        # Mask of the pixels which already contain tile data (True)
+        mask = numpy.zeros(strip.shape, dtype=bool)
+        bottom = top + strip.shape[0]
+        for b, t in zip(self._layout[0], self.tiles):
+            # Rows of the tile which are within the strip
+            ttop, tbottom = max(top, b[1]), min(bottom, b[3])
+            if ttop >= tbottom:
+                continue
+            tsl = slice(ttop - b[1], tbottom - b[1])
+            ssl = (slice(ttop - top, tbottom - top), slice(b[0], b[2]))
+            self._weaveStrip(strip[ssl], mask[ssl], t, tsl)
+            mask[ssl] = True
+
+    def _weaveStrip(self, roi, moi, tile, tsl):
+        """
+        Inserts the part of a tile which is within a strip into the global image.
+        roi (2D numpy.array): part of the global image which overlaps with the tile rows.
+          It should be updated.
+        moi (2D numpy.array of bool): mask of the pixels of roi which already contain data
+          of another tile.
+        tile (2D DataArray): the tile
+        tsl (slice): the rows of the tile corresponding to roi
+        """
+        raise NotImplementedError()
 
-    def getFullImage(self):
+    def _getLayout(self):
         """
-        return (2D DataArray): same dtype as the tiles, with shape corresponding to the bounding box. 
+        Computes the position of each tile in the global image.
+        return:
+          tbbx_px (list of 4 ints): bounding-box (ltrb) of each tile in pixels in the global image
+          shape (int, int): shape (YX) of the global image
+          md (dict): the metadata of the global image
         """
+        if self._layout is not None:
+            return self._layout
+
         tiles = self.tiles
 
         # Compute the bounding box of each tile and the global bounding box
@@ -191,30 +179,13 @@ class CollageWeaverReverse(object):
                    max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
 
         assert gbbx_px[0] == gbbx_px[1] == 0
+
         if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
             # Overlap > 50% or missing tiles
             logging.warning("Global area much bigger than sum of tile areas")
 
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
         # Use minimum of the values in the tiles for background
-        im[:] = numpy.amin(tiles)
-
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((gbbx_px[-1], gbbx_px[-2]), dtype=numpy.bool)
-
-        for b, t in zip(tbbx_px, tiles):
-            # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-
-            # Insert image at positions that are still empty
-            roi[~moi] = t[~moi]
-
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
+        self._background = min(numpy.amin(t) for t in tiles)
 
         # Update metadata
         # TODO: check this is also correct based on lt + half shape * pxs
@@ -223,140 +194,155 @@ class CollageWeaverReverse(object):
         md = tiles[0].metadata.copy()
         md[model.MD_POS] = c_phy
 
-        return model.DataArray(im, md)
+        self._layout = tbbx_px, (gbbx_px[-1], gbbx_px[-2]), md
+        return self._layout
 
 
-class MeanWeaver(object):
+class DataArrayShadowWoven(model.DataArrayShadow):
     """
-    Pixels of the final image which are corresponding to several tiles are computed as an 
-    average of the pixel of each tile.
+    The global image of a weaver, generated only when needed. Each tile is a full
+    width strip of STRIP_HEIGHT rows. Only the full resolution is available (maxzoom = 0).
     """
 
-    def __init__(self):
-        self.tiles = []
+    def __init__(self, weaver, shape, dtype, metadata):
+        """
+        weaver (Weaver): the weaver which generates the data
+        shape, dtype, metadata: see DataArrayShadow
+        """
+        model.DataArrayShadow.__init__(self, shape, dtype, metadata,
+                                       maxzoom=0, tile_shape=(shape[1], STRIP_HEIGHT))
+        self._weaver = weaver
 
-    def addTile(self, tile):
-        # Merge the correction metadata inside each image (to keep the rest of the
-        # code simple)
-        tile = model.DataArray(tile, tile.metadata.copy())
-        img.mergeMetadata(tile.metadata)
-        self.tiles.append(tile)
+    def getData(self):
+        return self._weaver.getFullImage()
 
-    def getFullImage(self):
+    def getTile(self, x, y, zoom):
         """
-        return (2D DataArray): same dtype as the tiles, with shape corresponding to the bounding box. 
+        x (0): X index of the tile, only 0 is available as the tiles are full width
+        y (0<=int): Y index of the tile
+        zoom (0): only the full resolution is available
+        return (DataArray): the strip of rows y * STRIP_HEIGHT -> (y + 1) * STRIP_HEIGHT
         """
-        tiles = self.tiles
+        if x != 0 or zoom != 0:
+            raise ValueError("Tile %d,%d at zoom %d not available" % (x, y, zoom))
+        strip = self._weaver.getStrip(y * STRIP_HEIGHT, STRIP_HEIGHT)
+        return model.DataArray(strip, self.metadata.copy())
 
-        # Compute the bounding box of each tile and the global bounding box
-
-        # Get a fixed pixel size by using the first one
-        # TODO: use the mean, in case they are all slightly different due to
-        # correction?
-        pxs = tiles[0].metadata[model.MD_PIXEL_SIZE]
 
-        tbbx_phy = []  # tuples of ltrb in physical coordinates
-        for t in tiles:
-            c = t.metadata[model.MD_POS]
-            w = t.shape[-1], t.shape[-2]
-            if not util.almost_equal(pxs[0], t.metadata[model.MD_PIXEL_SIZE][0], rtol=0.01):
-                logging.warning("Tile @ %s has a unexpected pixel size (%g vs %g)",
-                                c, t.metadata[model.MD_PIXEL_SIZE][0], pxs[0])
-            bbx = (c[0] - (w[0] * pxs[0] / 2), c[1] - (w[1] * pxs[1] / 2),
-                   c[0] + (w[0] * pxs[0] / 2), c[1] + (w[1] * pxs[1] / 2))
+class CollageWeaver(Weaver):
+    """
+    Very straight-forward version, which just paste the images where their center
+    position is. It expects that the pixel size for all the images are identical.
+    It doesn't take into account the rotation and skew metadata.
+    tiles (iterable of 2D DataArray): each image must have at least MD_POS and
+      MD_PIXEL_SIZE metadata. They should all have the same dtype.
+    border (None or value): if there is a value, it's used around each image, to
+     highlight the position
+    return (2D DataArray): same dtype as the tiles, with shape corresponding to
+      the bounding box.
+    """
 
-            tbbx_phy.append(bbx)
+    def _weaveStrip(self, roi, moi, tile, tsl):
+        roi[:] = tile[tsl]
+        # TODO: border
 
-        gbbx_phy = (min(b[0] for b in tbbx_phy), min(b[1] for b in tbbx_phy),
-                    max(b[2] for b in tbbx_phy), max(b[3] for b in tbbx_phy))
 
-        # Compute the bounding-boxes in pixel coordinates
-        tbbx_px = []
+class CollageWeaverReverse(Weaver):
+    """
+    Similar to CollageWeaver, but only fills parts of the global image with the new tile that
+    are still empty. This is desirable if the quality of the overlap regions is much better the first
+    time a region is imaged due to bleaching effects. The result is equivalent to a collage that starts 
+    with the last tile and pastes the older tiles in reverse order of acquisition.
+    """
 
-        # that's the origin (Y is max as Y is inverted)
-        glt = gbbx_phy[0], gbbx_phy[3]
-        for bp, t in zip(tbbx_phy, tiles):
-            lt = (int(round((bp[0] - glt[0]) / pxs[0])),
-                  int(round(-(bp[3] - glt[1]) / pxs[1])))
-            w = t.shape[-1], t.shape[-2]
-            bbx = (lt[0], lt[1],
-                   lt[0] + w[0], lt[1] + w[1])
-            tbbx_px.append(bbx)
+    def _weaveStrip(self, roi, moi, tile, tsl):
+        # Insert image at positions that are still empty
+        numpy.copyto(roi, tile[tsl], where=~moi, casting="unsafe")
 
-        gbbx_px = (min(b[0] for b in tbbx_px), min(b[1] for b in tbbx_px),
-                   max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
 
-        assert gbbx_px[0] == gbbx_px[1] == 0
-        if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
-            # Overlap > 50% or missing tiles
-            logging.warning("Global area much bigger than sum of tile areas")
+class MeanWeaver(Weaver):
+    """
+    Pixels of the final image which are corresponding to several tiles are computed as an 
+    average of the pixel of each tile.
+    """
 
-        # Weave tiles by using a smooth gradient. The part of the tile that does not overlap
-        # with any previous tiles is inserted into the part of the
-        # ovv image that is still empty. This part is determined by a mask, which indicates
-        # the parts of the image that already contain image data (True) and the ones that are still
-        # empty (False). For the overlapping parts, the tile is multiplied with weights corresponding
-        # to a gradient that has its maximum at the center of the tile and
-        # smoothly decreases toward the edges. The function for creating the weights is
-        # a distance measure resembling the maximum-norm, i.e. equidistant points lie
-        # on a rectangle (instead of a circle like for the euclidean norm). Additionally,
-        # the x and y values generating this norm are raised to the power of 6 to
-        # create a steeper gradient. The value 6 is quite arbitrary and was found to give
-        # good results during experimentation.
-        # The part of the overview image that overlaps with the new tile is multiplied with the
-        # complementary weights (1 -  weights) and the weighted overlapping parts of the new tile and
-        # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
-        # between all the tiles that have been inserted before and the newly inserted tile.
-
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      gbbx_px[-2], gbbx_px[-1])
-        im = numpy.empty((gbbx_px[-1], gbbx_px[-2]), dtype=tiles[0].dtype)
-        # Use minimum of the values in the tiles for background
-        im[:] = numpy.amin(tiles)
+    # Weave tiles by using a smooth gradient. The part of the tile that does not overlap
+    # with any previous tiles is inserted into the part of the
+    # ovv image that is still empty. This part is determined by a mask, which indicates
+    # the parts of the image that already contain image data (True) and the ones that are still
+    # empty (False). For the overlapping parts, the tile is multiplied with weights corresponding
+    # to a gradient that has its maximum at the center of the tile and
+    # smoothly decreases toward the edges. The function for creating the weights is
+    # a distance measure resembling the maximum-norm, i.e. equidistant points lie
+    # on a rectangle (instead of a circle like for the euclidean norm). Additionally,
+    # the x and y values generating this norm are raised to the power of 6 to
+    # create a steeper gradient. The value 6 is quite arbitrary and was found to give
+    # good results during experimentation.
+    # The part of the overview image that overlaps with the new tile is multiplied with the
+    # complementary weights (1 -  weights) and the weighted overlapping parts of the new tile and
+    # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
+    # between all the tiles that have been inserted before and the newly inserted tile.
+
+    def _weaveStrip(self, roi, moi, tile, tsl):
+        t = numpy.asarray(tile[tsl])
+        if not moi.any():
+            # Insert image at positions that are still empty
+            roi[:] = t
+            return
 
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((gbbx_px[-1], gbbx_px[-2]), dtype=numpy.bool)
+        # Create gradient in overlapping region. Ratio between old image and new tile values determined by
+        # distance to the center of the tile
+        w, cw = _getGradientWeights(tile.shape)
+        w, cw = w[tsl], cw[tsl]
+        merged = t * cw
+        merged += roi * w
+        # Insert image at positions that are still empty
+        numpy.copyto(roi, t, where=~moi, casting="unsafe")
+        # Use weights to create gradient in overlapping region
+        numpy.copyto(roi, merged, where=moi, casting="unsafe")
 
-        for b, t in zip(tbbx_px, tiles):
-            # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
 
-            # Insert image at positions that are still empty
-            roi[~moi] = t[~moi]
-
-            # Create gradient in overlapping region. Ratio between old image and new tile values determined by
-            # distance to the center of the tile
-
-            # Create weight matrix with decreasing values from its center that
-            # has the same size as the tile.
-            sz = numpy.array(roi.shape)
-            hh, hw = sz / 2  # half-height, half-width
-            x = numpy.linspace(-hw, hw, sz[1])
-            y = numpy.linspace(-hh, hh, sz[0])
-            xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
-            w = numpy.maximum(xx, yy)
-            # Hardcoding a weight function is quite arbitrary and might result in
-            # suboptimal solutions in some cases.
-            # Alternatively, different weights might be used. One option would be to select
-            # a fixed region on the sides of the image, e.g. 20% (expected overlap), and
-            # only apply a (linear) gradient to these parts, while keeping the new tile for the
-            # rest of the region. However, this approach does not solve the hardcoding problem
-            # since the overlap region is still arbitrary. Future solutions might adaptively
-            # select the this region.
-
-            # Use weights to create gradient in overlapping region
-            roi[moi] = (t * (1 - w))[moi] + (roi * w)[moi]
-
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
+# shape (int, int) -> weights, as returned by _getGradientWeights()
+_gradient_weights = {}
+# Maximum number of weights kept, as typically all the tiles have the same shape
+GRADIENT_WEIGHTS_CACHE_SIZE = 8
 
-        # Update metadata
-        # TODO: check this is also correct based on lt + half shape * pxs
-        c_phy = ((gbbx_phy[0] + gbbx_phy[2]) / 2,
-                 (gbbx_phy[1] + gbbx_phy[3]) / 2)
-        md = tiles[0].metadata.copy()
-        md[model.MD_POS] = c_phy
 
-        return model.DataArray(im, md)
+def _getGradientWeights(shape):
+    """
+    Creates the weights of the MeanWeaver. As all the tiles typically have the same shape,
+    the weights are only computed once.
+    shape (int, int): shape (YX) of the tile
+    return (2D numpy.array of float, 2D numpy.array of float): the weight of the global image,
+      with decreasing values from its center, and the weight of the tile (= 1 - weight)
+    """
+    try:
+        return _gradient_weights[shape]
+    except KeyError:
+        pass
+
+    # Create weight matrix with decreasing values from its center that
+    # has the same size as the tile.
+    sz = numpy.array(shape)
+    hh, hw = sz / 2  # half-height, half-width
+    x = numpy.linspace(-hw, hw, sz[1])
+    y = numpy.linspace(-hh, hh, sz[0])
+    xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
+    w = numpy.maximum(xx, yy)
+    # Hardcoding a weight function is quite arbitrary and might result in
+    # suboptimal solutions in some cases.
+    # Alternatively, different weights might be used. One option would be to select
+    # a fixed region on the sides of the image, e.g. 20% (expected overlap), and
+    # only apply a (linear) gradient to these parts, while keeping the new tile for the
+    # rest of the region. However, this approach does not solve the hardcoding problem
+    # since the overlap region is still arbitrary. Future solutions might adaptively
+    # select the this region.
+    cw = 1 - w
+    # The arrays are shared between all the calls => make sure they are not modified
+    w.flags.writeable = False
+    cw.flags.writeable = False
+
+    if len(_gradient_weights) >= GRADIENT_WEIGHTS_CACHE_SIZE:
+        _gradient_weights.clear()
+    _gradient_weights[shape] = w, cw
+    return w, cw
@@ -29,6 +29,7 @@ import random
 import copy
 import os
 import itertools
+import time
 
 from odemis.acq.stitching import IdentityRegistrar, ShiftRegistrar, GlobalShiftRegistrar
 from odemis.dataio import find_fittest_converter
@@ -699,6 +700,47 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                         "Position %s pxs off for image '%s', " % (max(diff.flatten()) / px_size[0], img_name) +
                         "%s x %s tiles, %s ovlp, %s method." % (num, num, o, a))
 
+    def test_parallel(self):
+        """ Computing the shifts in the background gives the same result as synchronously """
+        for img, a in itertools.product(IMGS, ["horizontalLines", "horizontalZigzag", "verticalLines"]):
+            conv = find_fittest_converter(img)
+            data = ensure2DImage(conv.read_data(img)[0])
+            tiles, _ = decompose_image(data, 0.3, 3, a)
+
+            registrar_sync = GlobalShiftRegistrar(max_workers=0)
+            registrar_par = GlobalShiftRegistrar(max_workers=4)
+            for tile in tiles:
+                registrar_sync.addTile(tile)
+                registrar_par.addTile(tile)
+            self.assertEqual(registrar_par.getPositions(), registrar_sync.getPositions())
+
+            # Adding more tiles after the positions have been computed restarts the threads
+            registrar_par.addTile(model.DataArray(tiles[0], {
+                model.MD_PIXEL_SIZE: tiles[0].metadata[model.MD_PIXEL_SIZE],
+                model.MD_POS: numpy.add(tiles[-1].metadata[model.MD_POS], (0, -1e-9)),
+            }))
+            self.assertEqual(len(registrar_par.getPositions()[0]), len(tiles) + 1)
+
+    def test_close(self):
+        """ Closing the registrar cancels the shifts not yet computed """
+        tsize, overlap, n = 128, 32, 10
+        step = tsize - overlap
+        px_size = (1e-6, 1e-6)
+        rng = numpy.random.RandomState(0)
+        img = rng.randint(0, 255, (n * step + overlap, n * step + overlap)).astype(numpy.uint8)
+
+        registrar = GlobalShiftRegistrar(max_workers=1)
+        for r, c in itertools.product(range(n), range(n)):
+            md = {model.MD_PIXEL_SIZE: px_size,
+                  model.MD_POS: (c * step * px_size[0], -r * step * px_size[1])}
+            registrar.addTile(model.DataArray(img[r * step:r * step + tsize, c * step:c * step + tsize], md))
+        shifts = [f for shifts_row, col in registrar._pending_shifts for f in [shifts_row[col]]]
+
+        registrar.close()
+        self.assertIsNone(registrar._executor)
+        self.assertTrue(any(f.cancelled() for f in shifts))
+        registrar.close()  # No-op
+
     def test_shift_real_manual(self):
         """ Test case not generated by decompose.py file and manually cropped """
 
@@ -815,6 +857,43 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                     self.assertAlmostEqual(dep_tile[0], p[0] + r1 * px_size[0])
                     self.assertAlmostEqual(dep_tile[1], p[1] + r2 * px_size[1])
 
+    def test_speed(self):
+        """ Check the registration of large grids takes a time linear to the number of tiles """
+        tsize, overlap = 32, 8
+        step = tsize - overlap
+        px_size = (1e-6, 1e-6)
+        dur_per_tile = []
+        for n in (10, 40):
+            rng = numpy.random.RandomState(0)
+            img = rng.randint(0, 255, (n * step + overlap, n * step + overlap)).astype(numpy.uint8)
+            tiles = []
+            for r, c in itertools.product(range(n), range(n)):
+                md = {model.MD_PIXEL_SIZE: px_size,
+                      model.MD_POS: (c * step * px_size[0], -r * step * px_size[1])}
+                tiles.append(model.DataArray(img[r * step:r * step + tsize, c * step:c * step + tsize], md))
+
+            registrar = GlobalShiftRegistrar()
+            tstart = time.time()
+            for t in tiles:
+                registrar.addTile(t)
+            dur_add = time.time() - tstart
+            tstart = time.time()
+            tile_pos, _ = registrar.getPositions()
+            dur_pos = time.time() - tstart
+            logging.info("Registering %d tiles took %g s, and computing the positions %g s",
+                         len(tiles), dur_add, dur_pos)
+            self.assertEqual(len(tile_pos), n * n)
+            dur_per_tile.append((dur_add + dur_pos) / len(tiles))
+
+            # The positions are only computed once
+            positions = registrar.getPositions()
+            self.assertEqual(positions[0], tile_pos)
+            self.assertIs(registrar.getPositions(), positions)
+
+        # 16x more tiles shouldn't take much longer per tile (with a quadratic
+        # algorithm, it would be 16x longer)
+        self.assertLess(dur_per_tile[1], dur_per_tile[0] * 4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -23,6 +23,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import logging
+import math
 import numpy
 from odemis import model
 import odemis
@@ -469,5 +470,39 @@ class TestCollageWeaverReverse(unittest.TestCase):
         numpy.testing.assert_equal(o, 256 * numpy.ones((80, 30)))
 
 
+
+class TestFullImageShadow(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)  # for reproducibility
+
+    def test_same_as_full_image(self):
+        """
+        Test that the image generated strip by strip is identical to the full image
+        """
+        for img in IMGS:
+            conv = find_fittest_converter(img)
+            data = conv.read_data(img)[0]
+            img = ensure2DImage(data)
+            [tiles, _] = decompose_image(img, 0.3, 3, "horizontalZigzag")
+
+            for weaver_cls in (CollageWeaver, CollageWeaverReverse, MeanWeaver):
+                weaver = weaver_cls()
+                for t in tiles:
+                    weaver.addTile(t)
+
+                full = weaver.getFullImage()
+                shadow = weaver.getFullImageShadow()
+                self.assertEqual(shadow.shape, full.shape)
+                self.assertEqual(shadow.dtype, full.dtype)
+                self.assertEqual(shadow.metadata, full.metadata)
+                # Multiple strips are needed
+                ny = int(math.ceil(full.shape[0] / shadow.tile_shape[1]))
+                self.assertGreater(ny, 1)
+                strips = [shadow.getTile(0, y, 0) for y in range(ny)]
+                numpy.testing.assert_array_equal(numpy.concatenate(strips), full)
+                numpy.testing.assert_array_equal(shadow.getData(), full)
+
+
 if __name__ == '__main__':
     unittest.main()
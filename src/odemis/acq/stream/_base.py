@@ -107,6 +107,9 @@ class Stream(object):
 
     # Minimum overhead time in seconds when acquiring an image
     SETUP_OVERHEAD = 0.1
+    # Maximum number of values of the raw data used to compute the histogram.
+    # If the data is bigger, it is sub-sampled. None means all the data is used.
+    HISTOGRAM_MAX_SAMPLES = None
 
     def __init__(self, name, detector, dataflow, emitter, focuser=None, opm=None,
                  hwdetvas=None, hwemtvas=None, detvas=None, emtvas=None, axis_map={},
@@ -190,6 +193,7 @@ class Stream(object):
 
         # Duplicate VA if requested
         self._hwvas = {}  # str (name of the proxied VA) -> original Hw VA
+        self._hwvaorigins = {}  # str (name of the proxied VA) -> (Component, str (name of the original VA))
         self._hwvasetters = {}  # str (name of the proxied VA) -> setter
         self._lvaupdaters = {}  # str (name of the proxied VA) -> listener
         self._axisvaupdaters = {}  # str (name of the axis VA) -> listener (functools.partial)
@@ -385,6 +389,7 @@ class Stream(object):
 
             # Keep the link between the new VA and the original VA so they can be synchronised
             self._hwvas[newname] = va
+            self._hwvaorigins[newname] = (comp, vaname)
             # Keep setters, mostly to not have them dereferenced
             self._hwvasetters[newname] = vasetter
 
@@ -526,24 +531,43 @@ class Stream(object):
         # Make sure the VAs are set in the right order to keep values
         hwvas = list(self._hwvas.items())  # must be a list
         hwvas.sort(key=self._index_in_va_order)
+        hwvas = [(vaname, hwva) for vaname, hwva in hwvas if not hwva.readonly]
 
+        # Set all the VAs of a component at once (ie, in one call, if remote).
+        # That also returns the actual values accepted by the hardware.
+        comp_vas = collections.OrderedDict()  # Component -> list of str (name of the proxied VA)
         for vaname, hwva in hwvas:
-            if hwva.readonly:
-                continue
-            lva = getattr(self, vaname)
+            comp = self._hwvaorigins[vaname][0]
+            comp_vas.setdefault(comp, []).append(vaname)
+
+        hwvalues = {}  # str (name of the proxied VA) -> value
+        for comp, vanames in comp_vas.items():
+            values = [(self._hwvaorigins[n][1], getattr(self, n).value) for n in vanames]
             try:
-                hwva.value = lva.value
+                actual = comp.updateVAs(values)
+                for n in vanames:
+                    hwvalues[n] = actual[self._hwvaorigins[n][1]]
             except Exception:
-                logging.debug(u"Failed to set VA %s to value %s on hardware",
-                              vaname, lva.value)
+                # Either one VA failed, or the component doesn't support updateVAs()
+                # => set them one at a time, ignoring the ones which fail
+                logging.debug(u"Failed to set VAs %s at once on %s, will set them one at a time",
+                              vanames, comp, exc_info=True)
+                for n in vanames:
+                    lva = getattr(self, n)
+                    try:
+                        self._hwvas[n].value = lva.value
+                    except Exception:
+                        logging.debug(u"Failed to set VA %s to value %s on hardware",
+                                      n, lva.value)
 
-        # Immediately read the VAs back, to read the actual values accepted by the hardware
+        # Update the VAs to the actual values accepted by the hardware
         for vaname, hwva in hwvas:
-            if hwva.readonly:
-                continue
             lva = getattr(self, vaname)
             try:
-                lva.value = hwva.value
+                if vaname in hwvalues:
+                    lva.value = hwvalues[vaname]
+                else:  # Immediately read the VA back
+                    lva.value = hwva.value
             except Exception:
                 logging.debug(u"Failed to update VA %s to value %s from hardware",
                               vaname, hwva.value)
@@ -1172,7 +1196,8 @@ class Stream(object):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = img.histogram(data, irange=self._drange,
+                                    max_samples=self.HISTOGRAM_MAX_SAMPLES)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
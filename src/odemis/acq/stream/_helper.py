@@ -257,7 +257,8 @@ class RepetitionStream(LiveStream):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = img.histogram(data, irange=self._drange,
+                                    max_samples=self.HISTOGRAM_MAX_SAMPLES)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
@@ -736,6 +737,10 @@ class SpectrumSettingsStream(CCDSettingsStream):
         # Contains one 1D spectrum (start with an empty array)
         self.image.value = model.DataArray([])
 
+        # If True, the spikes (typically caused by cosmic rays) are removed from
+        # the spectra at the end of the acquisition.
+        self.spikeRemoval = model.BooleanVA(False)
+
         # TODO: grating/cw as VAs (from the spectrometer)
 
     # onActive: same as the standard LiveStream (ie, acquire from the dataflow)
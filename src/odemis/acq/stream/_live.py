@@ -41,6 +41,10 @@ class LiveStream(Stream):
     Abstract class for any stream that can do continuous acquisition.
     """
 
+    # The histogram is recomputed for every new frame, but only used for
+    # display => a sub-sample of a large frame is enough.
+    HISTOGRAM_MAX_SAMPLES = 2 ** 20
+
     def __init__(self, name, detector, dataflow, emitter, forcemd=None, **kwargs):
         """
         forcemd (None or dict of MD_* -> value): force the metadata of the
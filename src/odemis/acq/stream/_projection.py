@@ -22,6 +22,9 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import weakref
 import logging
@@ -39,12 +42,189 @@ except ImportError:
 
 from odemis import model
 from odemis.util import img, angleres
+from odemis.util.conversion import get_tile_md_pos
 from scipy import ndimage
 from odemis.model import MD_PIXEL_SIZE, MD_POL_EPHI, MD_POL_EX, MD_POL_EY, MD_POL_EZ, MD_POL_ETHETA, MD_POL_DS0, \
     MD_POL_S0, MD_POL_DOP, MD_POL_DOLP, MD_POL_UP
 from odemis.acq.stream._static import StaticSpectrumStream
 from abc import abstractmethod
 
+# Maximum memory used by the tiles cache, shared by all the RGBSpatialProjections (in bytes)
+TILE_CACHE_SIZE = 128 * 2 ** 20
+# Maximum number of tiles requested in advance after each update of the image
+MAX_PREFETCH_TILES = 64
+
+
+class TileCache(object):
+    """
+    Least-recently-used cache of tiles, bounded by the memory used.
+    It is thread-safe, so it can be filled by other threads than the one
+    reading it.
+    """
+
+    def __init__(self, max_bytes=TILE_CACHE_SIZE):
+        """
+        max_bytes (int): maximum number of bytes held by the tiles. When exceeded,
+          the tiles least recently used are discarded.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tiles = collections.OrderedDict()  # key -> DataArray
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._tiles
+
+    def get(self, key, default=None):
+        """
+        key (hashable): the key of the tile
+        return (DataArray or default): the tile, if it is in the cache
+        """
+        with self._lock:
+            try:
+                tile = self._tiles[key]
+            except KeyError:
+                return default
+            # Move it to the end, as the most recently used
+            self._tiles[key] = self._tiles.pop(key)
+            return tile
+
+    def put(self, key, tile):
+        """
+        Store a tile, and discard the oldest tiles if the cache is too large.
+        key (hashable): the key of the tile
+        tile (DataArray): the tile
+        """
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            # Always keep at least the tile just added
+            while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+                _, old = self._tiles.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def discard(self, prefix):
+        """
+        Remove all the tiles whose key starts with the given elements
+        prefix (tuple): the first elements of the keys to remove
+        """
+        n = len(prefix)
+        with self._lock:
+            for key in [k for k in self._tiles if k[:n] == prefix]:
+                self.nbytes -= self._tiles.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+
+# Cache of the tiles of all the projections, so that the memory used is bounded
+# whatever the number of pyramidal images opened.
+_tile_cache = TileCache()
+# Unique IDs of the projections in the tiles cache
+_tile_cache_ids = itertools.count()
+# ID -> weak reference to the projection, for all the projections using the
+# tiles cache. Used to clean up once a projection is garbage collected.
+_tile_cache_users = {}
+
+
+def _release_tile_cache_user(cache_id, prefetcher):
+    """
+    Called when a projection using the tiles cache is garbage collected
+    cache_id (int): the ID of the projection in the tiles cache
+    prefetcher (TilePrefetcher): the prefetcher of the projection
+    """
+    del _tile_cache_users[cache_id]
+    prefetcher.shutdown()
+    # The tiles are useless once the projection is gone
+    _tile_cache.discard((cache_id,))
+
+
+class TilePrefetcher(object):
+    """
+    Reads tiles in advance, in separate threads, and stores them in a cache.
+    The threads are only started when the first tile is requested, and are
+    stopped by shutdown().
+    """
+
+    def __init__(self, cache, max_workers=2):
+        """
+        cache (TileCache): where to store the tiles read
+        max_workers (int): maximum number of tiles read simultaneously
+        """
+        self._cache = cache
+        self._max_workers = max_workers
+        self._executor = None  # ThreadPoolExecutor, created on first use
+        self._futures = []  # Futures of the tiles requested
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def __len__(self):
+        """
+        return (int): number of tiles requested since the last cancel()
+        """
+        return len(self._futures)
+
+    def submit(self, das, key):
+        """
+        Request to read a tile. If it's already in the cache when its turn
+        comes, it is not read again.
+        das (DataArrayShadow): the pyramidal data
+        key (tuple int, str, int, int, int): ID, "raw", x, y, z of the tile
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+            f = self._executor.submit(self._readTile, das, key)
+            self._futures.append(f)
+
+    def cancel(self):
+        """
+        Cancel all the requests which haven't started yet
+        """
+        with self._lock:
+            for f in self._futures:
+                f.cancel()
+            self._futures = []
+
+    def shutdown(self):
+        """
+        Cancel all the requests, and stop the threads (without waiting for the
+        tiles currently being read). No more tiles are read afterwards.
+        """
+        self.cancel()
+        with self._lock:
+            self._stopped = True
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _readTile(self, das, key):
+        """
+        Read a tile and store it in the cache. Run in a separate thread.
+        das (DataArrayShadow): the pyramidal data
+        key (tuple int, str, int, int, int): ID, "raw", x, y, z of the tile
+        """
+        if self._stopped or key in self._cache:  # Already read in the meantime
+            return
+        try:
+            tile = das.getTile(*key[2:])
+        except Exception:
+            logging.debug("Failed to prefetch tile %s", key, exc_info=True)
+            return
+        if not self._stopped:
+            self._cache.put(key, tile)
+
 
 class DataProjection(object):
 
@@ -819,8 +999,16 @@ class RGBSpatialProjection(RGBProjection):
     Depending on which type of stream is passed at creation, a more suitable subclass of
     RGBSpatialProjection might be created (via the use of the __new__ operator).
     That is the recommended way to create a RGBSpatialProjection.
+
+    For pyramidal data, the tiles are kept in a cache, shared by all the
+    projections, and limited by TILE_CACHE_SIZE.
+    After every update of the image, the tiles around the displayed area, and
+    at the next zoom levels, are read in advance in background.
     """
 
+    # If False, no tile is read in advance
+    prefetch_tiles = True
+
     def __new__(cls, stream):
 
         if isinstance(stream, StaticSpectrumStream):
@@ -856,10 +1044,14 @@ class RGBSpatialProjection(RGBProjection):
             self.rect = model.TupleContinuous(full_rect, rect_range)
             self.mpp.subscribe(self._onMpp)
             self.rect.subscribe(self._onRect)
-            # initialize the projected tiles cache
-            self._projectedTilesCache = {}
-            # initialize the raw tiles cache
-            self._rawTilesCache = {}
+            # Raw and projected tiles, with keys (ID, "raw"|"proj", x, y, z)
+            self._tilesCache = _tile_cache
+            self._cacheId = next(_tile_cache_ids)
+            # To read the tiles in advance
+            self._prefetcher = TilePrefetcher(self._tilesCache)
+            cache_id, prefetcher = self._cacheId, self._prefetcher
+            _tile_cache_users[cache_id] = weakref.ref(
+                self, lambda o: _release_tile_cache_user(cache_id, prefetcher))
             # When True, the projected tiles cache should be invalidated
             self._projectedTilesInvalid = True
 
@@ -931,7 +1123,8 @@ class RGBSpatialProjection(RGBProjection):
             return raw[0][pixel_pos[1], pixel_pos[0]]
 
     def _onZIndex(self, value):
-        self._shouldUpdateImage()
+        # The projected tiles are from the previous Z => recompute them
+        self._shouldUpdateImageEntirely()
 
     def getBoundingBox(self):
         '''
@@ -987,45 +1180,145 @@ class RGBSpatialProjection(RGBProjection):
             int(round(rect[1] / (-ps[1]) + img_shape[1] / 2)) - 1,
         )
 
-    def _getTile(self, x, y, z, prev_raw_cache, prev_proj_cache):
+    def _getTile(self, x, y, z):
         """
         Get a tile from a DataArrayShadow. Uses cache.
-        The cache for projected tiles and the cache for raw tiles has always the same tiles
         x (int): X coordinate of the tile
         y (int): Y coordinate of the tile
         z (int): zoom level where the tile is
-        prev_raw_cache (dictionary): raw tiles cache from the
-            last execution of _updateImage
-        prev_proj_cache (dictionary): projected tiles cache from the
-            last execution of _updateImage
         return (DataArray, DataArray): raw tile and projected tile
         """
-        # the key of the tile on the cache
-        tile_key = "%d-%d-%d" % (x, y, z)
+        raw_key = (self._cacheId, "raw", x, y, z)
+        proj_key = (self._cacheId, "proj", x, y, z)
 
-        # if the raw tile has been already cached, read it from the cache
-        if tile_key in prev_raw_cache:
-            raw_tile = prev_raw_cache[tile_key]
-        elif tile_key in self._rawTilesCache:
-            raw_tile = self._rawTilesCache[tile_key]
-        else:
+        raw_tile = self._tilesCache.get(raw_key)
+        if raw_tile is None:
             # The tile was not cached, so it must be read from the file
-            raw_tile = self.stream.raw[0].getTile(x, y, z)
+            try:
+                raw_tile = self.stream.raw[0].getTile(x, y, z)
+            except Exception:
+                logging.warning("Failed to read tile %d,%d at zoom %d, will show it blank",
+                                x, y, z, exc_info=True)
+                return self._getBlankTile(x, y, z)
+            self._tilesCache.put(raw_key, raw_tile)
 
-        # if the projected tile has been already cached, read it from the cache
-        if tile_key in prev_proj_cache:
-            proj_tile = prev_proj_cache[tile_key]
-        elif tile_key in self._projectedTilesCache:
-            proj_tile = self._projectedTilesCache[tile_key]
-        else:
+        proj_tile = self._tilesCache.get(proj_key)
+        if proj_tile is None:
             # The tile was not cached, so it must be projected again
             proj_tile = self._projectTile(raw_tile)
+            self._tilesCache.put(proj_key, proj_tile)
 
-        # cache raw and projected tiles
-        self._rawTilesCache[tile_key] = raw_tile
-        self._projectedTilesCache[tile_key] = proj_tile
         return raw_tile, proj_tile
 
+    def _getBlankTile(self, x, y, z):
+        """
+        Create a tile with no data, to show in place of a tile which couldn't be
+        read. It's not cached, so that the tile is read again next time.
+        x (int): X coordinate of the tile
+        y (int): Y coordinate of the tile
+        z (int): zoom level where the tile is
+        return (DataArray, DataArray): raw tile and projected tile
+        """
+        das = self.stream.raw[0]
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        shape = list(das.shape)
+        for d, i, ts in (("X", x, das.tile_shape[0]), ("Y", y, das.tile_shape[1])):
+            di = dims.index(d)
+            # Tiles on the border of the image can be smaller
+            shape[di] = max(1, min(ts, das.shape[di] // (2 ** z) - i * ts))
+
+        raw_tile = model.DataArray(numpy.zeros(shape, dtype=das.dtype), das.metadata.copy())
+        ps = das.metadata.get(MD_PIXEL_SIZE, (1e-6, 1e-6))
+        raw_tile.metadata[MD_PIXEL_SIZE] = tuple(p * 2 ** z for p in ps)
+        raw_tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), das.tile_shape, raw_tile, das)
+        return raw_tile, self._projectTile(raw_tile)
+
+    def _fetchTiles(self, x1, y1, x2, y2, z):
+        """
+        Read all at once the raw tiles of the given area which are not yet in
+        the cache, so that the DataArrayShadow can fetch them in parallel.
+        x1, y1, x2, y2 (int): the tile indices of the area
+        z (int): the zoom level of the area
+        return (set of (int, int, int)): X, Y, zoom of the tiles which couldn't be read
+        """
+        missing = [(x, y, z) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)
+                   if (self._cacheId, "raw", x, y, z) not in self._tilesCache]
+        if len(missing) <= 1:
+            return set()  # Nothing to gain
+
+        try:
+            tiles = self.stream.raw[0].getTiles(missing)
+        except Exception:
+            # The tiles will be read again one at a time, which will report the error
+            logging.debug("Failed to read %d tiles at once", len(missing), exc_info=True)
+            return set()
+
+        failed = set()
+        for (x, y, tz), tile in zip(missing, tiles):
+            if isinstance(tile, Exception):
+                logging.warning("Failed to read tile %d,%d at zoom %d, will show it blank: %s",
+                                x, y, tz, tile)
+                failed.add((x, y, tz))
+            else:
+                self._tilesCache.put((self._cacheId, "raw", x, y, tz), tile)
+        return failed
+
+    def _getTilesRange(self, z):
+        """
+        Compute the number of tiles of the image at a given zoom level
+        z (int): zoom level
+        return (int, int): number of tiles in X and Y
+        """
+        das = self.stream.raw[0]
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        width = das.shape[dims.index('X')] / (2 ** z)
+        height = das.shape[dims.index('Y')] / (2 ** z)
+        return (int(math.ceil(width / das.tile_shape[0])),
+                int(math.ceil(height / das.tile_shape[1])))
+
+    def _prefetchTiles(self, x1, y1, x2, y2, z):
+        """
+        Read in advance, in background, the raw tiles which are likely to be
+        needed next: the tiles around the given area (for panning) and the
+        tiles of the same area at the zoom levels just below and above.
+        x1, y1, x2, y2 (int): the tile indices of the area currently displayed
+        z (int): the zoom level of the area currently displayed
+        """
+        # The area has changed => the previous requests are not so important anymore
+        self._prefetcher.cancel()
+
+        if not self.prefetch_tiles:
+            return
+
+        # Ordered by likelihood of being needed
+        candidates = []
+        nx, ny = self._getTilesRange(z)
+        for x in range(x1 - 1, x2 + 2):
+            for y in range(y1 - 1, y2 + 2):
+                if not (x1 <= x <= x2 and y1 <= y <= y2):
+                    candidates.append((x, y, z, nx, ny))
+        if z > 0:
+            nx, ny = self._getTilesRange(z - 1)
+            for x in range(x1 * 2, x2 * 2 + 2):
+                for y in range(y1 * 2, y2 * 2 + 2):
+                    candidates.append((x, y, z - 1, nx, ny))
+        if z < self.stream.raw[0].maxzoom:
+            nx, ny = self._getTilesRange(z + 1)
+            for x in range(x1 // 2, x2 // 2 + 1):
+                for y in range(y1 // 2, y2 // 2 + 1):
+                    candidates.append((x, y, z + 1, nx, ny))
+
+        das = self.stream.raw[0]
+        for x, y, tz, nx, ny in candidates:
+            if len(self._prefetcher) >= MAX_PREFETCH_TILES:
+                break
+            if not (0 <= x < nx and 0 <= y < ny):
+                continue
+            key = (self._cacheId, "raw", x, y, tz)
+            if key in self._tilesCache:
+                continue
+            self._prefetcher.submit(das, key)
+
     def _projectTile(self, tile):
         """
         Project the tile
@@ -1069,9 +1362,6 @@ class RGBSpatialProjection(RGBProjection):
 
         das = self.stream.raw[0]
 
-        # store the previous cache to use in this execution
-        prev_raw_cache = self._rawTilesCache
-        prev_proj_cache = self._projectedTilesCache
         # Execute at least once. If mpp and rect changed in
         # the last execution of the loops, execute again
         need_recompute = True
@@ -1082,13 +1372,8 @@ class RGBSpatialProjection(RGBProjection):
             rect = [l / (2 ** z) for l in rect]
             rect = [int(math.floor(l / das.tile_shape[0])) for l in rect]
             x1, y1, x2, y2 = rect
-            # the 4 lines below avoids that lots of old tiles
-            # stays in instance caches
-            prev_raw_cache.update(self._rawTilesCache)
-            prev_proj_cache.update(self._projectedTilesCache)
-            # empty current caches
-            self._rawTilesCache = {}
-            self._projectedTilesCache = {}
+
+            failed = self._fetchTiles(x1, y1, x2, y2, z)
 
             raw_tiles = []
             projected_tiles = []
@@ -1101,8 +1386,7 @@ class RGBSpatialProjection(RGBProjection):
                     for y in range(y1, y2 + 1):
                         # the projected tiles cache is invalid
                         if self._projectedTilesInvalid:
-                            self._projectedTilesCache = {}
-                            prev_proj_cache = {}
+                            self._tilesCache.discard((self._cacheId, "proj"))
                             self._projectedTilesInvalid = False
                             raise NeedRecomputeException()
 
@@ -1110,11 +1394,14 @@ class RGBSpatialProjection(RGBProjection):
                         if self._im_needs_recompute.is_set():
                             self._im_needs_recompute.clear()
                             # Raise the exception, so everything will be calculated again,
-                            # but using the cache from the last execution
+                            # but using the tiles already cached
                             raise NeedRecomputeException()
 
-                        raw_tile, proj_tile = \
-                            self._getTile(x, y, z, prev_raw_cache, prev_proj_cache)
+                        if (x, y, z) in failed:
+                            # Don't try again to read it, so that the rest is displayed
+                            raw_tile, proj_tile = self._getBlankTile(x, y, z)
+                        else:
+                            raw_tile, proj_tile = self._getTile(x, y, z)
                         rt_column.append(raw_tile)
                         pt_column.append(proj_tile)
 
@@ -1125,6 +1412,8 @@ class RGBSpatialProjection(RGBProjection):
                 # image changed
                 need_recompute = True
 
+        self._prefetchTiles(x1, y1, x2, y2, z)
+
         return tuple(raw_tiles), tuple(projected_tiles)
 
     def _updateImage(self):
@@ -1196,20 +1485,13 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
             raw_md = self.stream.calibrated.value.metadata
             md = {k: raw_md[k] for k in (model.MD_PIXEL_SIZE, model.MD_POS) if k in raw_md}
 
-            # Average time values if they exist.
-            if data.shape[1] > 1:
-                t = data.shape[1] - 1
-                data = numpy.mean(data[0:t], axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
-
             # pick only the data inside the bandwidth
             spec_range = self.stream._get_bandwidth_in_pixel()
 
             logging.debug("Spectrum range picked: %s px", spec_range)
 
-            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+            # average over the bandwidth (and time, if it exists)
+            av_data = self.stream._get_band_mean(spec_range[0], spec_range[1])
             av_data = img.ensure2DImage(av_data).astype(data.dtype)
             return model.DataArray(av_data, md)
 
@@ -1272,17 +1554,8 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
         """
 
         try:
-            data = self.stream.calibrated.value
             raw_md = self.stream.calibrated.value.metadata
 
-            # Average time values if they exist.
-            if data.shape[1] > 1:
-                t = data.shape[1] - 1
-                data = numpy.mean(data[0:t], axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
-
             # pick only the data inside the bandwidth
             spec_range = self.stream._get_bandwidth_in_pixel()
 
@@ -1291,8 +1564,7 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
             irange = self.stream._getDisplayIRange()  # will update histogram if not yet present
 
             if not hasattr(self.stream, "fitToRGB") or not self.stream.fitToRGB.value:
-                # TODO: use better intermediary type if possible?, cf semcomedi
-                av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+                av_data = self.stream._get_band_mean(spec_range[0], spec_range[1])
                 av_data = img.ensure2DImage(av_data)
                 rgbim = img.DataArray2RGB(av_data, irange)
 
@@ -1313,15 +1585,15 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
                 grange[1] = max(grange)
                 rrange[1] = max(rrange)
 
-                # FIXME: unoptimized, as each channel is duplicated 3 times, and discarded
-                av_data = numpy.mean(data[rrange[0]:rrange[1] + 1], axis=0)
+                # Note: each channel is converted to RGB, and only one component is kept
+                av_data = self.stream._get_band_mean(rrange[0], rrange[1])
                 av_data = img.ensure2DImage(av_data)
                 rgbim = img.DataArray2RGB(av_data, irange)
-                av_data = numpy.mean(data[grange[0]:grange[1] + 1], axis=0)
+                av_data = self.stream._get_band_mean(grange[0], grange[1])
                 av_data = img.ensure2DImage(av_data)
                 gim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 1] = gim[:, :, 0]
-                av_data = numpy.mean(data[brange[0]:brange[1] + 1], axis=0)
+                av_data = self.stream._get_band_mean(brange[0], brange[1])
                 av_data = img.ensure2DImage(av_data)
                 bim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 2] = bim[:, :, 0]
@@ -646,6 +646,13 @@ class StaticSpectrumStream(StaticStream):
         # the raw data after calibration
         self.calibrated = model.VigilantAttribute(image)
 
+        # Cumulative sum along C of the calibrated data (averaged over T), to
+        # quickly compute the average over any band. Computed on demand, and
+        # recomputed whenever .calibrated changes.
+        self._spec_cumsum = None  # numpy.ndarray of float64 of shape C+1, Y, X
+        self._spec_cumsum_src = None  # the calibrated data used to compute the cumsum
+        self._spec_cumsum_lock = threading.Lock()
+
         if "acq_type" not in kwargs:
             if image.shape[0] > 1 and image.shape[1] > 1:
                 kwargs["acq_type"] = model.MD_AT_TEMPSPECTRUM
@@ -764,6 +771,50 @@ class StaticSpectrumStream(StaticStream):
         assert low_px <= high_px
         return low_px, high_px
 
+    def _get_spectrum_cumsum(self):
+        """
+        Return the cumulative sum of the calibrated data along the C dimension.
+        If the data has a T dimension, it is averaged first.
+        returns (numpy.ndarray of float64 of shape C+1, Y, X): the first element
+          is 0, so that the sum from c0 to c1 (included) is cumsum[c1 + 1] - cumsum[c0]
+        """
+        data = self.calibrated.value
+        with self._spec_cumsum_lock:
+            if self._spec_cumsum_src is not data:
+                # Average time values if they exist.
+                if data.shape[1] > 1:
+                    data3d = numpy.mean(data, axis=1)[:, 0]
+                else:
+                    data3d = data[:, 0, 0, :, :]
+
+                cumsum = numpy.empty((data3d.shape[0] + 1,) + data3d.shape[1:], dtype=numpy.float64)
+                cumsum[0] = 0
+                # Much faster than numpy.cumsum(axis=0), thanks to memory locality
+                for c in range(data3d.shape[0]):
+                    numpy.add(cumsum[c], data3d[c], out=cumsum[c + 1])
+                self._spec_cumsum = cumsum
+                self._spec_cumsum_src = data
+
+            return self._spec_cumsum
+
+    def _get_band_mean(self, low, high):
+        """
+        Compute the average of the calibrated data over a range of the C
+        dimension. If the data has a T dimension, it is averaged too.
+        It only takes O(YX) (after the first call for a given calibrated data).
+        low (int): the first index of the band
+        high (int): the last index of the band (included)
+        returns (numpy.ndarray of float64 of shape Y, X): the average
+        """
+        cumsum = self._get_spectrum_cumsum()
+        # Same behaviour as slicing [low:high + 1], if the band is out of the data
+        n = cumsum.shape[0] - 1
+        start, end = min(low, n), min(high + 1, n)
+        if start >= end:
+            logging.warning("Band %d->%d is outside of the data", low, high)
+            return numpy.full(cumsum.shape[1:], numpy.nan)
+        return (cumsum[end] - cumsum[start]) / (end - start)
+
     # We don't have problems of rerunning this when the data is updated,
     # as the data is static.
     def _updateCalibratedData(self, bckg=None, coef=None):
@@ -33,6 +33,7 @@ from functools import partial
 from future.utils import with_metaclass
 import logging
 import math
+import multiprocessing
 import numpy
 from odemis import model, util
 from odemis.acq import drift
@@ -42,7 +43,7 @@ from odemis.acq.stream._live import LiveStream
 from odemis.model import MD_POS, MD_DESCRIPTION, MD_PIXEL_SIZE, MD_ACQ_DATE, MD_AD_LIST, \
     MD_DWELL_TIME, MD_EXP_TIME, MD_DIMS
 from odemis.model import hasVA
-from odemis.util import units, executeAsyncTask, almost_equal, get_best_dtype_for_acc, img
+from odemis.util import units, executeAsyncTask, almost_equal, get_best_dtype_for_acc, img, spectrum
 import queue
 import threading
 import time
@@ -186,6 +187,9 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
         # the data received, in order, for each stream
         self._acq_data = [[] for _ in streams] # latest acquired data
         self._live_data = [[] for _ in streams] # all acquired data in live format, reshaped to the final shape by _assembleFinalData
+        # stream index -> (weakref to the latest DataArray in _live_data, HistogramAccumulator)
+        # Allows to compute the histogram of the live data only over the new data
+        self._live_hists = {}
         self._acq_min_date = None  # minimum acquisition time for the data to be acceptable
 
         # Special subscriber function for each stream dataflow
@@ -823,6 +827,7 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
                        MD_PIXEL_SIZE: pxs,
                        MD_DESCRIPTION: self._streams[n].name.value})
             da = model.DataArray(numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=raw_data.dtype), md)
+            self._live_hists[n] = (weakref.ref(da), img.HistogramAccumulator())
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=numpy.bool)
 
@@ -831,6 +836,7 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
         self._live_data[n][pol_idx][
                        px_idx[0] * tile_shape[0]:(px_idx[0] + 1) * tile_shape[0],
                        px_idx[1] * tile_shape[1]:(px_idx[1] + 1) * tile_shape[1]] = raw_data
+        self._addToLiveHistogram(n, pol_idx, raw_data)
 
     def _assembleLiveData2D(self, n, raw_data, px_idx, rep, pol_idx):
         """
@@ -860,6 +866,7 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
                        MD_PIXEL_SIZE: pxs,
                        MD_DESCRIPTION: self._streams[n].name.value})
             da = model.DataArray(numpy.zeros(shape=rep[::-1], dtype=raw_data.dtype), md)
+            self._live_hists[n] = (weakref.ref(da), img.HistogramAccumulator())
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(rep[::-1], dtype=numpy.bool)
 
@@ -868,6 +875,23 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
         self._live_data[n][pol_idx][
                            px_idx[0]: px_idx[0] + tile_shape[0],
                            px_idx[1]: px_idx[1] + tile_shape[1]] = raw_data
+        self._addToLiveHistogram(n, pol_idx, raw_data)
+
+    def _addToLiveHistogram(self, n, pol_idx, raw_data):
+        """
+        Update the histogram of the live data with the data just acquired.
+        Every pixel is acquired only once per polarisation, so the histogram
+        of the whole live data is always up-to-date, without recomputing it.
+        :param n: (int) number of the current stream
+        :param pol_idx: (int) polarisation index of the live data updated
+        :param raw_data: (DataArray) data just inserted in the live data
+        """
+        try:
+            wda, hist_acc = self._live_hists[n]
+        except KeyError:
+            return
+        if wda() is self._live_data[n][pol_idx]:
+            hist_acc.add(raw_data)
 
     def _assembleFinalData(self, n, data):
         """
@@ -911,9 +935,14 @@ class MultipleDetectorStream(with_metaclass(ABCMeta, Stream)):
         scan_area = self._current_scan_area
         if scan_area is None:
             return None
-        data_acq = data[acq_mask]
-
-        hist, edges = img.histogram(data_acq)
+        # Use the histogram accumulated while the data was received, if it's available
+        hist = None
+        for wda, hist_acc in list(self._live_hists.values()):
+            if wda() is data:
+                hist, edges = hist_acc.get()
+                break
+        if hist is None or hist.size == 0:
+            hist, edges = img.histogram(data[acq_mask])
         irange = img.findOptimalRange(hist, edges, 1/256)
         rgbim = img.DataArray2RGB(data, irange, tint)
         md = self._find_metadata(data.metadata)
@@ -998,6 +1027,9 @@ class SEMCCDMDStream(MultipleDetectorStream):
         self._ccd_df = s1._dataflow
         self._trigger = self._ccd.softwareTrigger
         self._ccd_idx = len(self._streams) - 1  # optical detector is always last in streams
+        # For each stream, the sum of the images integrated so far (DataArray
+        # with the metadata of the latest image) and the original dtype, or None
+        self._acc_data = [None for _ in streams]
 
     def _estimateRawAcquisitionTime(self):
         """
@@ -1100,16 +1132,16 @@ class SEMCCDMDStream(MultipleDetectorStream):
         if fuzzing:
             logging.info("Using fuzzing with tile shape = %s", tile_shape)
             # Handle fuzzing by scanning tile instead of spot
-            self._emitter.scale.value = scale
-            self._emitter.resolution.value = tile_shape  # grid scan
-            self._emitter.dwellTime.value = self._emitter.dwellTime.clip(dt)
+            self._emitter.updateVAs([("scale", scale),
+                                     ("resolution", tile_shape),  # grid scan
+                                     ("dwellTime", self._emitter.dwellTime.clip(dt))])
         else:
             # Set SEM to spot mode, without caring about actual position (set later)
-            self._emitter.scale.value = (1, 1)  # min, to avoid limits on translation
-            self._emitter.resolution.value = (1, 1)
             # Dwell time as long as possible, but better be slightly shorter than
             # CCD to be sure it is not slowing thing down.
-            self._emitter.dwellTime.value = self._emitter.dwellTime.clip(exp + readout)
+            self._emitter.updateVAs([("scale", (1, 1)),  # min, to avoid limits on translation
+                                     ("resolution", (1, 1)),
+                                     ("dwellTime", self._emitter.dwellTime.clip(exp + readout))])
 
         return exp + readout, integration_count
 
@@ -1169,6 +1201,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             tile_size = self._emitter.resolution.value  # how many SEM pixels per ebeam "position"
 
             self._acq_data = [[] for _ in self._streams]  # just to be sure it's really empty
+            self._acc_data = [None for _ in self._streams]
             self._live_data = [[] for _ in self._streams]
             self._raw = []
             self._anchor_raw = []
@@ -1207,7 +1240,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             # prepare detector
             self._ccd_df.synchronizedOn(self._trigger)
             # subscribe to last entry in _subscribers (optical detector)
-            self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
+            self._ccd_df.subscribe(self._subscribers[self._ccd_idx], discard=False)
 
             # Instead of subscribing/unsubscribing to the SEM for each pixel,
             # we've tried to keep subscribed, but request to be unsynchronised/
@@ -1277,9 +1310,9 @@ class SEMCCDMDStream(MultipleDetectorStream):
                                           self._dc_estimator.tot_drift, trans)
                         else:
                             logging.error("Unexpected clipping in the scan spot position %s", trans)
-                    self._emitter.translation.value = cptrans
+                    actual = self._emitter.updateVAs({"translation": cptrans})
                     logging.debug("E-beam spot after drift correction: %s",
-                                  self._emitter.translation.value)
+                                  actual["translation"])
                     logging.debug("Scanning resolution is %s and scale %s",
                                   self._emitter.resolution.value,
                                   self._emitter.scale.value)
@@ -1306,6 +1339,9 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
                         n += 1  # number of images acquired so far
 
+                        if integration_count > 1:
+                            self._accumulateImages(integration_count)
+
                     # integrate/sum images
                     self._integrateImages(integration_count)
 
@@ -1362,6 +1398,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             self._dc_estimator = None
             self._current_future = None
             self._acq_data = [[] for _ in self._streams]  # regain a bit of memory
+            self._acc_data = [None for _ in self._streams]
 
             self._acq_done.set()
             # Only after this flag, as it's used by the im_thread too
@@ -1369,29 +1406,53 @@ class SEMCCDMDStream(MultipleDetectorStream):
             self._streams[0].raw = []
             self._streams[0].image.value = None
 
+    def _accumulateImages(self, n):
+        """
+        Add the latest acquired image of each stream in self._acq_data to the
+        running integration, and remove it from self._acq_data. This way, only
+        the sum (and the image being acquired) are kept in memory, whatever the
+        number of images to integrate.
+        :param n: (int) Number of images that will be integrated in total. Used
+          to pick a dtype large enough to hold the sum.
+        """
+        for stream_idx, das in enumerate(self._acq_data):
+            da = das.pop()
+            if self._acc_data[stream_idx] is None:
+                det_type = da.metadata.get(model.MD_DET_TYPE, model.MD_DT_INTEGRATING)
+                if det_type == model.MD_DT_NORMAL:  # SEM => will be averaged
+                    # Same dtype as numpy.mean()
+                    acc_dtype = numpy.float64 if da.dtype.kind in "biu" else da.dtype
+                else:
+                    acc_dtype = get_best_dtype_for_acc(da.dtype, n)  # avoid saturation and overflow
+                acc = model.DataArray(da.astype(acc_dtype))  # copy
+                self._acc_data[stream_idx] = acc, da.dtype
+            else:
+                acc, _ = self._acc_data[stream_idx]
+                # Same as "acc += da", but also works if the accumulator is
+                # unsigned while the data is signed (like numpy.sum() does)
+                numpy.add(acc, da, out=acc, dtype=acc.dtype, casting="unsafe")
+            # The metadata of the latest image is used for the integrated image
+            acc.metadata = da.metadata
+
     def _integrateImages(self, n):
         """
-        Integrate/sum the last n acquired images in self._acq_data and replace by the
-        integrated image. If values overflow, clip the image. If number of images = 1,
-        no image integration necessary.
+        Convert the sum of the n images accumulated by _accumulateImages() into
+        the integrated image, and append it to self._acq_data. If values overflow,
+        clip the image. If number of images = 1, no image integration necessary.
         :param n: (int) Number of images that need to be integrated (summed).
         """
         # check if we need to integrate images
         if n == 1:
             return
 
-        for stream_idx, das in enumerate(self._acq_data):
-            # get the metadata from last image (should be the same for all images)
-            md = das[-1].metadata
+        for stream_idx, (data, orig_dtype) in enumerate(self._acc_data):
+            md = data.metadata
             det_type = md.get(model.MD_DET_TYPE, model.MD_DT_INTEGRATING)
-            # get the images, which need to be averaged/integrated
-            data2process = das[-n:]
-            orig_dtype = data2process[0].dtype
 
             if det_type == model.MD_DT_NORMAL:  # SEM
                 logging.debug("Average %s images", n)
-                # get the images corresponding to the last acquisition and average
-                data = numpy.mean(data2process, axis=0).astype(orig_dtype)
+                # Same as numpy.mean() of the images
+                data = numpy.true_divide(data, n).astype(orig_dtype)
 
             else:
                 if not det_type == model.MD_DT_INTEGRATING:  # optical
@@ -1399,8 +1460,6 @@ class SEMCCDMDStream(MultipleDetectorStream):
                                     "Will perform image integration anyways.", det_type)
 
                 logging.debug("Integrate %s images", n)
-                best_dtype = get_best_dtype_for_acc(orig_dtype, n)  # avoid saturation and overflow
-                data = numpy.sum(data2process, axis=0, dtype=best_dtype)
 
                 if model.MD_BASELINE in md:
                     baseline = md[model.MD_BASELINE]
@@ -1430,8 +1489,9 @@ class SEMCCDMDStream(MultipleDetectorStream):
                 md[model.MD_EXP_TIME] *= n
             md[model.MD_INTEGRATION_COUNT] = n
 
-            # replace images, which needed to be averaged/integrated, with averaged/integrated image
-            self._acq_data[stream_idx][-n:] = [model.DataArray(data, md)]
+            # add the averaged/integrated image, in place of the images which were integrated
+            self._acq_data[stream_idx].append(model.DataArray(data, md))
+            self._acc_data[stream_idx] = None
 
     def _waitForImage(self, img_time):
         """
@@ -1485,7 +1545,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
             # subscribe to _subscribers
             for s, sub in zip(self._streams[:-1], self._subscribers[:-1]):
-                s._dataflow.subscribe(sub)
+                s._dataflow.subscribe(sub, discard=False)
             # TODO: in theory (aka in a perfect world), the ebeam would immediately
             # be at the requested position after the subscription starts. However,
             # that's not exactly the case due to:
@@ -1540,7 +1600,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
                     # Restart the acquisition, hoping this time we will synchronize
                     # properly
                     time.sleep(1)
-                    self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
+                    self._ccd_df.subscribe(self._subscribers[self._ccd_idx], discard=False)
                     continue
 
             # Normally, the SEM acquisitions have already completed
@@ -1670,7 +1730,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
             # Synchronise the CCD on a software trigger
             self._ccd_df.synchronizedOn(self._trigger)
-            self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
+            self._ccd_df.subscribe(self._subscribers[self._ccd_idx], discard=False)
 
             n = 0  # number of points acquired so far
             for px_idx in numpy.ndindex(*rep[::-1]):  # last dim (X) iterates first
@@ -1722,7 +1782,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
                         raise CancelledError()
 
                     for s, sub in zip(self._streams[:-1], self._subscribers[:-1]):
-                        s._dataflow.subscribe(sub)
+                        s._dataflow.subscribe(sub, discard=False)
 
                     time.sleep(5e-3)  # give more chances spot has been already processed
                     self._trigger.notify()
@@ -1762,7 +1822,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
                             # Restart the acquisition, hoping this time we will synchronize
                             # properly
                             time.sleep(1)
-                            self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
+                            self._ccd_df.subscribe(self._subscribers[self._ccd_idx], discard=False)
                             continue
 
                     # Normally, the SEM acquisitions have already completed
@@ -2036,7 +2096,7 @@ class SEMMDStream(MultipleDetectorStream):
 
                 self._df0.synchronizedOn(self._trigger)
                 for s, sub in zip(self._streams, self._subscribers):
-                    s._dataflow.subscribe(sub)
+                    s._dataflow.subscribe(sub, discard=False)
                 start = time.time()
                 self._acq_min_date = start
                 self._trigger.notify()
@@ -2228,6 +2288,21 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
 
         self._live_data[n][pol_idx][:, 0, 0, px_idx[0], px_idx[1]] = raw_data.reshape(spec_shape[1])
 
+    def _assembleFinalData(self, n, data):
+        """
+        Same as the standard version, but also removes the spikes from the
+        spectrum data, if requested by the spectrum stream.
+        """
+        super(SEMSpectrumMDStream, self)._assembleFinalData(n, data)
+
+        if n == self._ccd_idx and data:
+            s = self._streams[n]
+            if hasVA(s, "spikeRemoval") and s.spikeRemoval.value:
+                da = self._raw[-1]
+                corrected, npixels, nspikes = spectrum.remove_spikes(da, max_workers=multiprocessing.cpu_count())
+                logging.info("Removed %d spikes in %d spectra of %s", nspikes, npixels, s.name.value)
+                self._raw[-1] = model.DataArray(corrected, da.metadata)
+
 
 class SEMTemporalMDStream(MultipleDetectorStream):
     """
@@ -2276,9 +2351,6 @@ class SEMTemporalMDStream(MultipleDetectorStream):
         return img_time (0 < float): estimated time for a one acquisition (not integrated)
                ninteg (int): Number of images to integrate to match the requested dwell time.
         """
-        self._emitter.scale.value = (1, 1)
-        self._emitter.resolution.value = (1, 1)
-
         px_time = self._tc_stream._getDetectorVA("dwellTime").value
         # Re-adjust dwell time for number of drift corrections
         if self._dc_estimator:
@@ -2290,7 +2362,9 @@ class SEMTemporalMDStream(MultipleDetectorStream):
         logging.debug("Setting dwell time for ebeam and TC detector to %s "
                       "to account for sub-pixel drift corrections.", dwell_time)
         self._tc_stream._detector.dwellTime.value = dwell_time
-        self._emitter.dwellTime.value = dwell_time
+        self._emitter.updateVAs([("scale", (1, 1)),
+                                 ("resolution", (1, 1)),
+                                 ("dwellTime", dwell_time)])
 
         return px_time, ninteg
 
@@ -2406,9 +2480,8 @@ class SEMTemporalMDStream(MultipleDetectorStream):
             for ce in self._acq_complete:
                 ce.clear()
 
-            self._emitter.translation.value = (x, y)
             # checks the hardware has accepted it
-            trans = self._emitter.translation.value
+            trans = self._emitter.updateVAs({"translation": (x, y)})["translation"]
             if math.hypot(x - trans[0], y - trans[1]) > 1e-3:
                 logging.warning("Ebeam translation is %s instead of requested %s.", trans, (x, y))
 
@@ -2416,7 +2489,7 @@ class SEMTemporalMDStream(MultipleDetectorStream):
 
             # Get data
             for s, sub in zip(self._streams, self._subscribers):
-                s._dataflow.subscribe(sub)
+                s._dataflow.subscribe(sub, discard=False)
 
             # Wait for detector to acquire image
             for i, s in enumerate(self._streams):
@@ -2689,7 +2762,7 @@ class ScannedFluoMDStream(MultipleDetectorStream):
             for i, s in enumerate(self._streams):
                 p_subscriber = partial(self._onData, i)
                 subscribers.append(p_subscriber)
-                s._dataflow.subscribe(p_subscriber)
+                s._dataflow.subscribe(p_subscriber, discard=False)
                 self._acq_complete[i].clear()
 
             if self._acq_state == CANCELLED:
@@ -27,7 +27,7 @@ import numpy
 from odemis import model
 import odemis
 from odemis.acq import acqmng
-from odemis.util import test
+from odemis.util import test, executeAsyncTask
 import os
 import time
 import unittest
@@ -65,11 +65,64 @@ class Fake0DDataFlow(model.DataFlow):
         return da
 
 
+class FakeStream(object):
+    """
+    Mock object just sufficient to be acquired: it generates one (small) image
+    after some time.
+    """
+    def __init__(self, name, duration):
+        self.name = model.StringVA(name)
+        self.duration = duration
+        self.acq_times = []  # (float, float): start and end of each acquisition
+
+    def estimateAcquisitionTime(self):
+        return self.duration
+
+    def acquire(self):
+        f = model.ProgressiveFuture()
+        executeAsyncTask(f, self._run_acquisition)
+        return f
+
+    def _run_acquisition(self):
+        start = time.time()
+        time.sleep(self.duration)
+        self.acq_times.append((start, time.time()))
+        return [model.DataArray(numpy.zeros((4, 5), dtype=numpy.uint16))]
+
+
 class TestNoBackend(unittest.TestCase):
     # No backend, and only fake streams that don't generate anything
 
-    # TODO
-    pass
+    def test_postprocess_pipeline(self):
+        """
+        The data of a stream is post-processed while the next stream is acquired
+        """
+        postprocess_times = {}  # stream -> (float, float)
+        orig_postprocess = acqmng.AcquisitionTask._postprocess_stream
+
+        def slow_postprocess(task, s, *args, **kwargs):
+            start = time.time()
+            time.sleep(0.2)
+            ret = orig_postprocess(task, s, *args, **kwargs)
+            postprocess_times[s] = (start, time.time())
+            return ret
+
+        streams = [FakeStream("s1", 0.5), FakeStream("s2", 1)]
+        acqmng.AcquisitionTask._postprocess_stream = slow_postprocess
+        try:
+            data, exp = acqmng.acquire(streams).result()
+        finally:
+            acqmng.AcquisitionTask._postprocess_stream = orig_postprocess
+
+        self.assertIsNone(exp)
+        self.assertEqual(len(data), 2)
+        self.assertEqual([d.metadata[model.MD_DESCRIPTION] for d in data], ["s1", "s2"])
+
+        # The post-processing of s1 happened during the acquisition of s2
+        pp_start, pp_end = postprocess_times[streams[0]]
+        acq_start, acq_end = streams[1].acq_times[0]
+        self.assertLess(pp_start, acq_end)
+        self.assertLess(pp_end, acq_end)
 
 # @skip("simple")
 class SECOMTestCase(unittest.TestCase):
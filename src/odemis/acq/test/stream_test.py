@@ -38,7 +38,8 @@ from odemis.dataio import tiff, hdf5
 from odemis.driver import simcam
 from odemis.model import MD_POL_NONE, MD_POL_HORIZONTAL, MD_POL_VERTICAL, \
     MD_POL_POSDIAG, MD_POL_NEGDIAG, MD_POL_RHC, MD_POL_LHC, DataArrayShadow
-from odemis.util import test, conversion, img, spectrum, find_closest
+from odemis.util import test, conversion, img, spectrum, find_closest, \
+    get_best_dtype_for_acc
 from odemis.util.test import assert_array_not_equal
 import os
 from past.builtins import long
@@ -462,6 +463,134 @@ class StreamTestCase(unittest.TestCase):
         assert(wss() is None)
 
 
+class FakeIntegratingMDStream(object):
+    """
+    Holds just the state needed by the image integration methods of
+    SEMCCDMDStream, so that they can be tested without hardware.
+    """
+    _accumulateImages = stream.SEMCCDMDStream._accumulateImages
+    _integrateImages = stream.SEMCCDMDStream._integrateImages
+
+    def __init__(self, nstreams):
+        self._acq_data = [[] for _ in range(nstreams)]
+        self._acc_data = [None for _ in range(nstreams)]
+
+    def integrate(self, stacks):
+        """
+        Pass the images one at a time, as during an acquisition
+        stacks (list of list of DataArray): for each stream, the images to integrate
+        return (list of DataArray): for each stream, the integrated image
+        """
+        n = len(stacks[0])
+        for imgs in zip(*stacks):
+            for das, im in zip(self._acq_data, imgs):
+                das.append(im)
+            if n > 1:
+                self._accumulateImages(n)
+        self._integrateImages(n)
+        return [das[-1] for das in self._acq_data]
+
+
+class ImageIntegrationTestCase(unittest.TestCase):
+    """
+    Test the running integration of images of the SEMCCDMDStream
+    """
+
+    def _gen_images(self, n, shape, dtype, vrange, md):
+        return [model.DataArray(numpy.random.randint(vrange[0], vrange[1], shape).astype(dtype), md.copy())
+                for _ in range(n)]
+
+    def test_sem_ccd(self):
+        """
+        SEM images are averaged, CCD images are summed
+        """
+        n = 7
+        md_sem = {model.MD_DET_TYPE: model.MD_DT_NORMAL, model.MD_DWELL_TIME: 1e-6}
+        md_ccd = {model.MD_DET_TYPE: model.MD_DT_INTEGRATING, model.MD_EXP_TIME: 0.1}
+        sem_imgs = self._gen_images(n, (1, 1), numpy.uint16, (0, 4096), md_sem)
+        ccd_imgs = self._gen_images(n, (16, 32), numpy.uint16, (0, 4096), md_ccd)
+
+        acqs = FakeIntegratingMDStream(2)
+        sem_da, ccd_da = acqs.integrate([sem_imgs, ccd_imgs])
+
+        exp_sem = numpy.mean(sem_imgs, axis=0).astype(numpy.uint16)
+        self.assertEqual(sem_da.dtype, numpy.uint16)
+        numpy.testing.assert_array_equal(sem_da, exp_sem)
+        self.assertAlmostEqual(sem_da.metadata[model.MD_DWELL_TIME], n * 1e-6)
+        self.assertEqual(sem_da.metadata[model.MD_INTEGRATION_COUNT], n)
+
+        exp_ccd = numpy.sum(ccd_imgs, axis=0)
+        self.assertEqual(ccd_da.dtype, get_best_dtype_for_acc(numpy.dtype(numpy.uint16), n))
+        numpy.testing.assert_array_equal(ccd_da, exp_ccd)
+        self.assertAlmostEqual(ccd_da.metadata[model.MD_EXP_TIME], n * 0.1)
+        self.assertEqual(ccd_da.metadata[model.MD_INTEGRATION_COUNT], n)
+
+        # The input images must not have been modified
+        self.assertEqual(sem_imgs[0].metadata[model.MD_DWELL_TIME], 1e-6)
+        self.assertEqual(ccd_imgs[0].metadata[model.MD_EXP_TIME], 0.1)
+
+        # A single image is passed as-is
+        ccd_imgs = self._gen_images(1, (16, 32), numpy.uint16, (0, 4096), md_ccd)
+        acqs = FakeIntegratingMDStream(1)
+        ccd_da, = acqs.integrate([ccd_imgs])
+        self.assertIs(ccd_da, ccd_imgs[0])
+
+    def test_baseline(self):
+        """
+        The baseline is only kept once in the integrated image
+        """
+        n = 10
+        md = {model.MD_DET_TYPE: model.MD_DT_INTEGRATING, model.MD_BASELINE: 100}
+        imgs = self._gen_images(n, (16, 32), numpy.uint16, (100, 4096), md)
+
+        acqs = FakeIntegratingMDStream(1)
+        da, = acqs.integrate([imgs])
+
+        exp = numpy.sum(imgs, axis=0) - (n - 1) * 100
+        numpy.testing.assert_array_equal(da, exp)
+        self.assertEqual(da.metadata[model.MD_BASELINE], 100)
+
+        # Baseline higher than the actual data => don't subtract more than the min
+        md = {model.MD_DET_TYPE: model.MD_DT_INTEGRATING, model.MD_BASELINE: 1000}
+        imgs = self._gen_images(n, (16, 32), numpy.uint16, (50, 60), md)
+
+        acqs = FakeIntegratingMDStream(1)
+        da, = acqs.integrate([imgs])
+
+        exp_sum = numpy.sum(imgs, axis=0)
+        minv = exp_sum.min()
+        self.assertLess(minv, (n - 1) * 1000)
+        numpy.testing.assert_array_equal(da, exp_sum - minv)
+        self.assertEqual(da.min(), 0)  # No underflow
+        self.assertEqual(da.metadata[model.MD_BASELINE], n * 1000 - minv)
+
+    def test_overflow(self):
+        """
+        The sum of many images close to the max value doesn't overflow
+        """
+        md = {model.MD_DET_TYPE: model.MD_DT_INTEGRATING}
+        for dtype, n in ((numpy.uint8, 3), (numpy.uint16, 2 ** 16 + 10), (numpy.uint32, 5)):
+            maxv = numpy.iinfo(dtype).max
+            shape = (4, 5) if n > 100 else (16, 32)
+            imgs = self._gen_images(n, shape, dtype, (maxv - 10, maxv + 1), md)
+
+            acqs = FakeIntegratingMDStream(1)
+            da, = acqs.integrate([imgs])
+
+            exp = numpy.sum(imgs, axis=0, dtype=numpy.uint64)
+            self.assertEqual(da.dtype, get_best_dtype_for_acc(numpy.dtype(dtype), n))
+            self.assertGreater(numpy.iinfo(da.dtype).max, maxv)
+            numpy.testing.assert_array_equal(da, exp)
+
+        # Floating point data is summed as-is
+        imgs = [model.DataArray(numpy.random.random((16, 32)).astype(numpy.float32), md.copy())
+                for _ in range(4)]
+        acqs = FakeIntegratingMDStream(1)
+        da, = acqs.integrate([imgs])
+        self.assertEqual(da.dtype, numpy.float32)
+        numpy.testing.assert_array_almost_equal(da, numpy.sum(imgs, axis=0), decimal=5)
+
+
 # @skip("faster")
 class SECOMTestCase(unittest.TestCase):
     """
@@ -4634,6 +4763,39 @@ class StaticStreamsTestCase(unittest.TestCase):
         assert_array_not_equal(im2d_bgcorr, im2d_effcorr)
         assert_array_not_equal(im2d_bgcorr, prev_im2d)
 
+    def test_spectrum_band_mean(self):
+        """Test the average over a band of a Static Spectrum Stream"""
+        spec = self._create_spectrum_data()
+        specs = stream.StaticSpectrumStream("test spectrum band", spec)
+
+        cube = specs.calibrated.value[:, 0, 0]
+        for low, high in ((0, 0), (2, 5), (0, cube.shape[0] - 1)):
+            av_data = specs._get_band_mean(low, high)
+            numpy.testing.assert_allclose(av_data, numpy.mean(cube[low:high + 1], axis=0))
+
+        # Changing the calibration should update the average
+        dcalib = numpy.array([1, 1.3, 2, 3.5, 4, 5, 1.3, 6, 9.1], dtype=numpy.float64)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 400e-9 + numpy.arange(dcalib.shape[0]) * 10e-9
+        specs.efficiencyCompensation.value = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+
+        cube = specs.calibrated.value[:, 0, 0]
+        av_data = specs._get_band_mean(2, 5)
+        numpy.testing.assert_allclose(av_data, numpy.mean(cube[2:6], axis=0))
+
+    def test_temporal_spectrum_band_mean(self):
+        """Test the average over a band of a Static Spectrum Stream with T > 1"""
+        data = self._create_temporal_spectrum_data()
+        tss = stream.StaticSpectrumStream("test temporal spectrum band", data)
+
+        nc = data.shape[0]
+        for low, high in ((0, 0), (2, 5), (nc - 10, nc - 1), (0, nc - 1)):
+            av_data = tss._get_band_mean(low, high)
+            self.assertEqual(av_data.shape, data.shape[-2:])
+            # Averaged over T and the band
+            exp_data = data[low:high + 1, :, 0].mean(axis=(0, 1))
+            numpy.testing.assert_allclose(av_data, exp_data)
+
     def _create_temporal_spectrum_data(self):
         """Create temporal spectrum data."""
         data = numpy.random.randint(1, 100, size=(256, 128, 1, 20, 30), dtype="uint16")
@@ -5041,6 +5203,8 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         tiff.DataArrayShadowPyramidalTIFF._getTileOldSP = tiff.DataArrayShadowPyramidalTIFF.getTile
         tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        # Don't read tiles in advance, to be able to count the tiles read
+        stream.RGBSpatialProjection.prefetch_tiles = False
 
         POS = (5.0, 7.0)
         size = (3000, 2000, 3)
@@ -5085,11 +5249,11 @@ class StaticStreamsTestCase(unittest.TestCase):
         self.assertEqual(len(pj.image.value), 3)
         self.assertEqual(len(pj.image.value[0]), 4)
 
-        # half image (right side), only the center tiles will are cached
+        # half image (right side), all tiles are still cached
         pj.rect.value = (POS[0], POS[1] - 0.001, POS[0] + 0.0015, POS[1] + 0.001)
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(40, len(read_tiles))
+        self.assertEqual(28, len(read_tiles))
         self.assertEqual(len(pj.image.value), 4)
         self.assertEqual(len(pj.image.value[0]), 4)
 
@@ -5098,7 +5262,7 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(40, len(read_tiles))
+        self.assertEqual(28, len(read_tiles))
         self.assertEqual(len(pj.image.value), 1)
         self.assertEqual(len(pj.image.value[0]), 1)
 
@@ -5110,6 +5274,7 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         # get the old function back to the class
         tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSP
+        stream.RGBSpatialProjection.prefetch_tiles = True
 
     def test_rgb_tiled_stream_zoom(self):
         read_tiles = []
@@ -5120,6 +5285,8 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ = tiff.DataArrayShadowPyramidalTIFF.getTile
         tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        # Don't read tiles in advance, to be able to count the tiles read
+        stream.RGBSpatialProjection.prefetch_tiles = False
 
         POS = (5.0, 7.0)
         dtype = numpy.uint8
@@ -5174,11 +5341,11 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of the left tile
         numpy.testing.assert_array_equal([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # top-right pixel of the left tile
-        numpy.testing.assert_array_equal([173, 0, 0], pj.image.value[0][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0], pj.image.value[0][0][0, 255, :])
         # bottom-left pixel of the left tile
-        numpy.testing.assert_array_equal([0, 254, 0], pj.image.value[0][0][249, 0, :])
+        numpy.testing.assert_array_equal([0, 255, 0], pj.image.value[0][0][249, 0, :])
         # bottom-right pixel of the right tile
-        numpy.testing.assert_array_equal([254, 254, 0], pj.image.value[1][0][249, 117, :])
+        numpy.testing.assert_array_equal([254, 255, 0], pj.image.value[1][0][249, 117, :])
 
         # really small rect on the center, the tile is in the cache
         pj.rect.value = (POS[0], POS[1], POS[0] + 0.00001, POS[1] + 0.00001)
@@ -5192,9 +5359,9 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of the only tile
         numpy.testing.assert_array_equal([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # top-right pixel of the only tile
-        numpy.testing.assert_array_equal([173, 0, 0],pj.image.value[0][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0],pj.image.value[0][0][0, 255, :])
         # bottom-left pixel of the only tile
-        numpy.testing.assert_array_equal([0, 254, 0], pj.image.value[0][0][249, 0, :])
+        numpy.testing.assert_array_equal([0, 255, 0], pj.image.value[0][0][249, 0, :])
 
         # Now, just the tiny rect again, but at the minimum mpp (= fully zoomed in)
         # => should just need one new tile
@@ -5227,23 +5394,24 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        # Only 2 tiles read from disk. It means that the loop inside _updateImage,
-        # triggered by the change on .rect was immediately stopped when .mpp changed
-        if len(read_tiles) == 8:
-            logging.warning("Two tiles read while expected to have just one, but "
+        # No tile read from disk, as the tiles at max zoom are still cached. It
+        # means that the loop inside _updateImage, triggered by the change on
+        # .rect was immediately stopped when .mpp changed
+        if len(read_tiles) == 6:
+            logging.warning("One tile read while expected to have none, but "
                             "this is acceptable as updateImage thread might have "
                             "gone very fast.")
         else:
-            self.assertEqual(7, len(read_tiles))
+            self.assertEqual(5, len(read_tiles))
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 1)
 
         # top-left pixel of the left tile
         numpy.testing.assert_array_equal([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # bottom-right pixel of the left tile
-        numpy.testing.assert_array_equal([173, 0, 0], pj.image.value[0][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0], pj.image.value[0][0][0, 255, :])
         # bottom-right pixel of right right
-        numpy.testing.assert_array_equal([254, 254, 0], pj.image.value[1][0][249, 117, :])
+        numpy.testing.assert_array_equal([254, 255, 0], pj.image.value[1][0][249, 117, :])
 
         read_tiles = []  # reset, to keep the numbers simple
 
@@ -5265,11 +5433,11 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of a center tile
         numpy.testing.assert_array_equal([87, 0, 0], pj.image.value[1][0][0, 0, :])
         # top-right pixel of a center tile
-        numpy.testing.assert_array_equal([173, 0, 0], pj.image.value[1][0][0, 255, :])
+        numpy.testing.assert_array_equal([174, 0, 0], pj.image.value[1][0][0, 255, :])
         # bottom-left pixel of a center tile
         numpy.testing.assert_array_equal([87, 130, 0], pj.image.value[1][0][255, 0, :])
         # bottom pixel of a center tile
-        numpy.testing.assert_array_equal([173, 130, 0], pj.image.value[1][0][255, 255, :])
+        numpy.testing.assert_array_equal([174, 130, 0], pj.image.value[1][0][255, 255, :])
 
         delta = [d / 8 for d in dfr]
         # this rect is 1/8 the size of the full image, in the center of the image
@@ -5282,8 +5450,9 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
 
-        # reads 4 tiles from the disk, no tile is cached becase the zoom changed
-        self.assertEqual(10, len(read_tiles))
+        # reads 3 tiles from the disk, the center one is still cached from the
+        # first time the minimum mpp was used
+        self.assertEqual(9, len(read_tiles))
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 2)
         # top-left pixel of the top-left tile
@@ -5297,6 +5466,144 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         # get the old function back to the class
         tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ
+        stream.RGBSpatialProjection.prefetch_tiles = True
+
+    def test_rgb_tiled_stream_prefetch(self):
+        """
+        Check the tiles around the displayed area are read in advance
+        """
+        read_tiles = []  # (x, y, zoom), only the tiles read by the image thread
+        def getTileMock(self, x, y, zoom):
+            if threading.current_thread().name == "Image computation":
+                read_tiles.append((x, y, zoom))
+            return tiff.DataArrayShadowPyramidalTIFF._getTileOldSPf(self, x, y, zoom)
+
+        tiff.DataArrayShadowPyramidalTIFF._getTileOldSPf = tiff.DataArrayShadowPyramidalTIFF.getTile
+        tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+
+        POS = (5.0, 7.0)
+        md = {
+            model.MD_DIMS: 'YXC',
+            model.MD_POS: POS,
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        }
+        arr = numpy.zeros((2000, 3000, 3), dtype=numpy.uint8)
+        data = model.DataArray(arr, metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        acd = tiff.open_data(FILENAME)
+        ss = stream.RGBStream("test", acd.content[0])
+        pj = stream.RGBSpatialProjection(ss)
+
+        # One tile in the center, fully zoomed in
+        pj.mpp.value = pj.mpp.range[0]
+        pj.rect.value = (POS[0] + 0.00001, POS[1] + 0.00001, POS[0] + 0.00002, POS[1] + 0.00002)
+        time.sleep(1)
+        self.assertEqual(pj.image.value[0][0].shape, (256, 256, 3))
+        del read_tiles[:]
+
+        # Pan by one tile => the tiles are already in the cache
+        pj.rect.value = (POS[0] + 0.00027, POS[1] + 0.00001, POS[0] + 0.00028, POS[1] + 0.00002)
+        time.sleep(0.5)
+        self.assertEqual(len(pj.image.value), 1)
+        self.assertEqual(read_tiles, [])
+
+        # Zoom out => the tiles of the next zoom level are already in the cache
+        pj.mpp.value = 2e-6
+        time.sleep(0.5)
+        self.assertEqual(read_tiles, [])
+
+        # A second projection uses the same cache (and so the same memory budget)
+        pj2 = stream.RGBSpatialProjection(ss)
+        self.assertIs(pj2._tilesCache, pj._tilesCache)
+        self.assertNotEqual(pj2._cacheId, pj._cacheId)
+        pj2.mpp.value = pj2.mpp.range[0]
+        pj2.rect.value = (POS[0] + 0.00001, POS[1] + 0.00001, POS[0] + 0.00002, POS[1] + 0.00002)
+        time.sleep(1)
+        self.assertNotEqual(read_tiles, [])  # Doesn't use the tiles of the other projection
+
+        # Once the projection is deleted, its tiles are discarded and no more read
+        cache, cache_id, prefetcher = pj2._tilesCache, pj2._cacheId, pj2._prefetcher
+        del pj2
+        gc.collect()
+        self.assertEqual(len(prefetcher), 0)
+        self.assertIsNone(prefetcher._executor)
+        time.sleep(0.2)  # In case a tile was being read
+        self.assertFalse(any(k[0] == cache_id for k in list(cache._tiles)))
+
+        tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSPf
+
+    def test_rgb_tiled_stream_failure(self):
+        """
+        Check that a tile which cannot be read is shown blank, without preventing
+        the other tiles to be shown
+        """
+        broken = {(5, 3, 0)}
+        def getTileMock(self, x, y, zoom):
+            if (x, y, zoom) in broken:
+                raise IOError("Failed to read tile")
+            return tiff.DataArrayShadowPyramidalTIFF._getTileOldF(self, x, y, zoom)
+
+        tiff.DataArrayShadowPyramidalTIFF._getTileOldF = tiff.DataArrayShadowPyramidalTIFF.getTile
+        tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        try:
+            POS = (5.0, 7.0)
+            md = {
+                model.MD_DIMS: 'YXC',
+                model.MD_POS: POS,
+                model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+            }
+            arr = numpy.full((2000, 3000, 3), 100, dtype=numpy.uint8)
+            data = model.DataArray(arr, metadata=md)
+            tiff.export(FILENAME, data, pyramid=True)
+
+            acd = tiff.open_data(FILENAME)
+            ss = stream.RGBStream("test", acd.content[0])
+            pj = stream.RGBSpatialProjection(ss)
+            pj.prefetch_tiles = False
+
+            # Several tiles around the center, fully zoomed in
+            pj.mpp.value = pj.mpp.range[0]
+            pj.rect.value = (POS[0] - 0.0003, POS[1] - 0.0003, POS[0] + 0.0003, POS[1] + 0.0003)
+            time.sleep(1)
+            tiles = [t for col in pj.image.value for t in col]
+            self.assertGreater(len(tiles), 4)
+            blank_tiles = [t for t in tiles if t.max() == 0]
+            self.assertEqual(len(blank_tiles), 1)
+            self.assertEqual(blank_tiles[0].shape, (256, 256, 3))
+
+            # The tile is not cached, so once it can be read, it's shown
+            broken.clear()
+            pj.rect.value = (POS[0] - 0.0003, POS[1] - 0.0003, POS[0] + 0.00031, POS[1] + 0.0003)
+            time.sleep(1)
+            tiles = [t for col in pj.image.value for t in col]
+            self.assertTrue(all(t.max() == 100 for t in tiles))
+        finally:
+            tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldF
+
+    def test_tile_cache(self):
+        """
+        Check the TileCache discards the tiles least recently used
+        """
+        cache = stream.TileCache(max_bytes=2500)
+        tiles = [model.DataArray(numpy.zeros(1000, dtype=numpy.uint8)) for i in range(3)]
+        cache.put((0, "raw", 0, 0, 0), tiles[0])
+        cache.put((0, "raw", 1, 0, 0), tiles[1])
+        self.assertIs(cache.get((0, "raw", 0, 0, 0)), tiles[0])  # 0 becomes most recent
+        cache.put((1, "proj", 0, 0, 0), tiles[2])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 2000)
+        self.assertIsNone(cache.get((0, "raw", 1, 0, 0)))
+        self.assertIn((0, "raw", 0, 0, 0), cache)
+
+        cache.discard((0, "proj"))  # Nothing to discard
+        self.assertEqual(len(cache), 2)
+        cache.discard((1, "proj"))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 1000)
+        cache.discard((0,))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
 
     def test_rgb_updatable_stream(self):
         """Test RGBUpdatableStream """
@@ -27,17 +27,24 @@ try:
 except ImportError:  # Python 3 naming
     import configparser as ConfigParser
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
 import math
 import numpy
+import os
 import re
 import requests
+import threading
 from future.moves.urllib.parse import urlparse, parse_qs
 
 from PIL import Image
 from io import BytesIO
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 from odemis import model
 from odemis.dataio import AuthenticationError
@@ -82,6 +89,21 @@ SUPPORTED_CONTENT_TYPES = {
 
 KEY_PATH = "~/.local/share/odemis/catmaid.key"
 
+# Directory where the tiles downloaded are kept, to not download them again.
+# If None, the tiles are not cached on disk.
+CACHE_PATH = "~/.cache/odemis/catmaid"
+# Maximum size of all the tiles in the cache (in bytes)
+CACHE_SIZE = 1024 * 2 ** 20
+
+# Maximum number of tiles downloaded simultaneously (for all the images)
+MAX_CONNECTIONS = 8
+# Number of times a tile is requested again in case of (temporary) error of
+# the server or of the connection. The delay between each attempt doubles.
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.2  # s
+# Maximum time to wait for the server to answer a tile request
+TIMEOUT = 10  # s
+
 # Tile Source Types
 FILE_BASED = 1
 REQUEST_QUERY = 2
@@ -173,6 +195,15 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
 
         self._base_url = base_url
         self._session = requests.Session()
+        # Keep enough connections open to download all the tiles in parallel,
+        # and retry on temporary errors (but not on 404 as it's a normal "no tile")
+        retry = Retry(total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF,
+                      status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = _get_downloader()
+        self._cache = _get_tile_cache()
         _, username, password = read_config_file(self._base_url, username=True, password=True)
         self._auth = (username, password)
         self._stack_info = stack_info
@@ -189,6 +220,11 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
         depth (0<=int): The Z index of the stack.
         return:
             tile (DataArray): tile containing the image data and the relevant metadata.
+              If the server has no tile at this position, the tile is blank.
+        raise:
+            AuthenticationError: if the server refused the credentials
+            IOError: if the tile couldn't be downloaded (even after retrying).
+              It can be requested again later.
         """
         tile_width, tile_height = self.tile_shape
         tile_url = format_tile_url(
@@ -202,14 +238,27 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
             tile_width=tile_width,
             tile_height=tile_height,
         )
-        try:
-            image = response_to_array(self._session.get(tile_url, auth=self._auth))
-        except HTTPError as e:
-            if e.response.status_code == 401:
-                raise AuthenticationError("Authentication failed while getting tiles at {}".format(tile_url))
-            else:
-                logging.error("No tile at %s (error %s), returning blank tile", tile_url, e.response.status_code)
-                image = numpy.zeros((tile_width, tile_height), dtype=self.dtype)
+        content = self._cache.get(tile_url) if self._cache else None
+        if content is not None:
+            image = content_to_array(content)
+        else:
+            try:
+                response = self._session.get(tile_url, auth=self._auth, timeout=TIMEOUT)
+                image = response_to_array(response)
+                if self._cache:
+                    self._cache.put(tile_url, response.content)
+            except HTTPError as e:
+                if e.response.status_code == 401:
+                    raise AuthenticationError("Authentication failed while getting tiles at {}".format(tile_url))
+                elif e.response.status_code == 404:
+                    # Normal for the tiles outside of the data
+                    logging.debug("No tile at %s, returning blank tile", tile_url)
+                    image = numpy.zeros((tile_width, tile_height), dtype=self.dtype)
+                else:
+                    raise IOError("Failed to get tile at {} (error {})".format(tile_url, e.response.status_code))
+            except requests.RequestException as e:
+                # Connection error, timeout...
+                raise IOError("Failed to get tile at {}: {}".format(tile_url, e))
 
         tile = model.DataArray(image, self.metadata.copy())
         orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1e-6, 1e-6))
@@ -222,6 +271,25 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
 
         return tile
 
+    def getTiles(self, tiles, depth=0):
+        """
+        Fetches several tiles, in parallel
+        tiles (iterable of (0<=int, 0<=int, 0<=int)): X, Y indices and zoom
+          level of each tile.
+        depth (0<=int): The Z index of the stack.
+        return (list of DataArrays or Exceptions): the tiles, in the same order
+          as requested. If a tile couldn't be downloaded, the exception raised
+          (see getTile()) is in place of the tile.
+        """
+        fs = [self._executor.submit(self.getTile, x, y, z, depth) for x, y, z in tiles]
+        das = []
+        for f in fs:
+            try:
+                das.append(f.result())
+            except Exception as ex:
+                das.append(ex)
+        return das
+
     def getData(self):
         """Abstract method of DataArrayShadow"""
         raise NotImplementedError()
@@ -290,14 +358,147 @@ def response_to_array(response):
     content_type = response.headers['Content-Type']
 
     if content_type in SUPPORTED_CONTENT_TYPES:
-        buffer = BytesIO(response.content)  # opening directly from raw response doesn't work for JPEGs
-        raw_img = Image.open(buffer).convert('L')
-        return numpy.array(raw_img)
+        return content_to_array(response.content)
     else:
         raise ValueError('Image fetching is only implemented for greyscale PNG and JPEG, not {}'.format(
             content_type.upper().split('/')[1]))
 
 
+def content_to_array(content):
+    """
+    content (bytes): the content of a PNG or JPEG file
+    return:
+       image (numpy array): the image, as greyscale.
+    """
+    buffer = BytesIO(content)  # opening directly from raw response doesn't work for JPEGs
+    raw_img = Image.open(buffer).convert('L')
+    return numpy.array(raw_img)
+
+
+class TileDiskCache(object):
+    """
+    Cache of the (compressed) tiles on disk, bounded by its size. When it is
+    too large, the tiles least recently used are deleted.
+    It's thread-safe.
+    """
+
+    def __init__(self, path, max_bytes):
+        """
+        path (str): directory where to store the tiles. It's created if needed.
+        max_bytes (int): maximum size of all the tiles
+        """
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # filename -> size, from the least recently used to the most recently used.
+        # The modification time of the files is updated on use, so that the
+        # order is kept between sessions.
+        files = []
+        for fn in os.listdir(self.path):
+            st = os.stat(os.path.join(self.path, fn))
+            files.append((st.st_mtime, fn, st.st_size))
+        files.sort()
+        self._files = OrderedDict((fn, size) for _, fn, size in files)
+        self.nbytes = sum(self._files.values())
+
+    def _get_filename(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        key (str): the key of the tile (typically, its URL)
+        return (bytes or None): the content of the tile, or None if not in the cache
+        """
+        fn = self._get_filename(key)
+        with self._lock:
+            if fn not in self._files:
+                return None
+            self._files[fn] = self._files.pop(fn)  # Now the most recently used
+            fullfn = os.path.join(self.path, fn)
+            try:
+                with open(fullfn, "rb") as f:
+                    content = f.read()
+                os.utime(fullfn, None)
+            except (IOError, OSError):
+                logging.warning("Failed to read cached tile %s", fullfn, exc_info=True)
+                self.nbytes -= self._files.pop(fn)
+                return None
+        return content
+
+    def put(self, key, content):
+        """
+        Store a tile, and delete the oldest tiles if the cache is too large.
+        key (str): the key of the tile (typically, its URL)
+        content (bytes): the content of the tile
+        """
+        fn = self._get_filename(key)
+        fullfn = os.path.join(self.path, fn)
+        with self._lock:
+            try:
+                # Write to a temporary file first, so that the cache never
+                # contains a partial file
+                with open(fullfn + ".tmp", "wb") as f:
+                    f.write(content)
+                os.rename(fullfn + ".tmp", fullfn)
+            except (IOError, OSError):
+                logging.warning("Failed to cache tile %s", fullfn, exc_info=True)
+                return
+            self.nbytes -= self._files.pop(fn, 0)
+            self._files[fn] = len(content)
+            self.nbytes += len(content)
+
+            # Always keep at least the tile just added
+            while self.nbytes > self.max_bytes and len(self._files) > 1:
+                oldfn, size = self._files.popitem(last=False)
+                self.nbytes -= size
+                try:
+                    os.remove(os.path.join(self.path, oldfn))
+                except OSError:
+                    logging.warning("Failed to delete cached tile %s", oldfn, exc_info=True)
+
+
+# The disk cache and the threads downloading the tiles are shared by all the
+# images, so that the total size of the cache and number of connections are bounded.
+_tile_cache = None  # TileDiskCache
+_downloader = None  # ThreadPoolExecutor
+_shared_lock = threading.Lock()
+
+
+def _get_tile_cache():
+    """
+    return (TileDiskCache or None): the cache of the tiles, in CACHE_PATH, or
+      None if the tiles should not be cached.
+    """
+    global _tile_cache
+    if not CACHE_PATH:
+        return None
+
+    with _shared_lock:
+        path = os.path.expanduser(CACHE_PATH)
+        if _tile_cache is None or _tile_cache.path != path:
+            try:
+                _tile_cache = TileDiskCache(path, CACHE_SIZE)
+            except (IOError, OSError):
+                logging.warning("Failed to open the tile cache at %s, tiles will not be cached", CACHE_PATH,
+                                exc_info=True)
+                return None
+        return _tile_cache
+
+
+def _get_downloader():
+    """
+    return (ThreadPoolExecutor): the threads to download the tiles in parallel
+    """
+    global _downloader
+    with _shared_lock:
+        if _downloader is None:
+            _downloader = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS)
+        return _downloader
+
+
 STACK_URL = "{base_url}/{project_id}/stack/{stack_id}/info"
 
 
@@ -27,10 +27,12 @@ import h5py
 import json
 import logging
 import numpy
+import numbers
 from odemis import model
 import odemis
+from odemis.model import DataArrayShadow, AcquisitionData
 from odemis.util import spectrum, img, fluo
-from odemis.util.conversion import JsonExtraEncoder
+from odemis.util.conversion import get_tile_md_pos, JsonExtraEncoder
 import os
 import time
 
@@ -40,7 +42,9 @@ FORMAT = "HDF5"
 # list of file-name extensions possible, the first one is the default when saving a file
 EXTENSIONS = [u".h5", u".hdf5"]
 LOSSY = False
-CAN_SAVE_PYRAMID = False
+CAN_SAVE_PYRAMID = True
+
+TILE_SIZE = 256  # Tile size of pyramidal images
 
 # We are trying to follow the same format as SVI, as defined here:
 # http://www.svi.nl/HDF5
@@ -58,6 +62,10 @@ CAN_SAVE_PYRAMID = False
 #     + PhysicalData
 #     + SVIData (Not necessary for us)
 
+# Pyramidal images (our extension) have the full image stored in tiles (ie,
+# chunks of TILE_SIZE x TILE_SIZE in YX), and each zoom level z (image
+# shape // 2**z in X and Y) stored similarly in ImageData/ImageZoom<z>.
+
 
 # Image is an official extension to HDF5:
 # http://www.hdfgroup.org/HDF5/doc/ADGuide/ImageSpec.html
@@ -139,16 +147,26 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     """
     assert(len(image.shape) >= 2)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    _add_image_class(image_dataset, image.shape, (image.min(), image.max()))
+    return image_dataset
 
+
+def _add_image_class(image_dataset, shape, minmax):
+    """
+    Set the attributes of a dataset to follow the HDF5 image specification
+    image_dataset (HDF Dataset): the dataset containing the image
+    shape (tuple of int): the shape of the image
+    minmax (tuple of 2 numbers): the minimum and maximum values in the image
+    """
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
     # Colour image?
-    if image.ndim == 3 and (image.shape[-3] == 3 or image.shape[-1] == 3):
+    if len(shape) == 3 and (shape[-3] == 3 or shape[-1] == 3):
         # TODO: check dtype is int?
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_TRUECOLOR")
         image_dataset.attrs["IMAGE_COLORMODEL"] = numpy.string_("RGB")
-        if image.shape[-3] == 3:
+        if shape[-3] == 3:
             # Stored as [pixel components][height][width]
             image_dataset.attrs["INTERLACE_MODE"] = numpy.string_("INTERLACE_PLANE")
         else: # This is the numpy standard
@@ -157,19 +175,18 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     else:
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_GRAYSCALE")
         image_dataset.attrs["IMAGE_WHITE_IS_ZERO"] = numpy.array(0, dtype="uint8")
-        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
+        image_dataset.attrs["IMAGE_MINMAXRANGE"] = list(minmax)
 
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
-
 
-def _read_image_dataset(dataset):
+def _read_image_dataset_md(dataset):
     """
-    Get a numpy array from a dataset respecting the HDF5 image specification.
-    returns (numpy.ndimage): it has at least 2 dimensions and if RGB, it has
-     a 3 dimensions and the metadata MD_DIMS indicates the order.
+    Get the metadata describing the format of a dataset respecting the HDF5
+    image specification. The data itself is not read.
+    returns (dict str->val): the metadata. If the image is RGB, MD_DIMS
+     indicates the order of the (3) dimensions.
     raises
      IOError: if it doesn't conform to the standard
      NotImplementedError: if the image uses so fancy standard features
@@ -184,7 +201,7 @@ def _read_image_dataset(dataset):
     # conversion is almost entirely different depending on subclass
     subclass = dataset.attrs.get("IMAGE_SUBCLASS", b"IMAGE_GRAYSCALE")
 
-    image = model.DataArray(dataset[...])
+    md = {}
     if subclass == b"IMAGE_GRAYSCALE":
         pass
     elif subclass == b"IMAGE_TRUECOLOR":
@@ -203,9 +220,9 @@ def _read_image_dataset(dataset):
 
         if il_mode == b"INTERLACE_PLANE":
             # colour is first dim
-            image.metadata[model.MD_DIMS] = "CYX"
+            md[model.MD_DIMS] = "CYX"
         elif il_mode == b"INTERLACE_PIXEL":
-            image.metadata[model.MD_DIMS] = "YXC"
+            md[model.MD_DIMS] = "YXC"
         else:
             raise NotImplementedError("Unable to handle images of subclass '%s'" % subclass)
 
@@ -217,7 +234,7 @@ def _read_image_dataset(dataset):
     if dorig != b"UL":
         logging.warning("Image rotation %s not handled", dorig)
 
-    return image
+    return md
 
 
 def _add_image_info(group, dataset, image):
@@ -621,9 +638,10 @@ def _parse_physical_data(pdgroup, da):
     """
     Parse the metadata found in PhysicalData, and cut the DataArray if necessary.
     pdgroup (HDF Group): the group "PhysicalData" associated to an image
-    da (DataArray): the DataArray that was obtained by reading the ImageData
-    returns (list of DataArrays): The same data, but broken into smaller 
-      DataArrays if necessary, and with additional metadata.
+    da (DataArray or DataArrayShadowHDF5): the data that was obtained by reading
+      the ImageData
+    returns (list of DataArrays or DataArrayShadowHDF5s): The same data, but
+      broken into smaller DataArrays if necessary, and with additional metadata.
     """
     # The information in PhysicalData might be different for each channel (e.g.
     # fluorescence image). In this case, the DA must be separated into smaller
@@ -643,6 +661,9 @@ def _parse_physical_data(pdgroup, da):
             logging.warning("Image has %d channels and %d metadata, failed to map",
                             da.shape[0], n)
             das = [da]
+        elif isinstance(da, DataArrayShadow):
+            # Each sub-shadow has its own copy of the metadata
+            das = [da[c] for c in range(n)]
         else:
             # list(da) does almost what we need, but metadata is shared
             das = [model.DataArray(c, da.metadata.copy()) for c in da]
@@ -1154,13 +1175,15 @@ def _add_svi_info(group):
     gi["URL"] = "www.delmic.com"
 
 
-def _add_acquistion_svi(group, data, mds, **kwargs):
+def _add_acquistion_svi(group, data, mds, pyramid=False, **kwargs):
     """
     Adds the acquisition data according to the sub-format by SVI
     group (HDF Group): the group that will contain the metadata (named "PhysicalData")
     data (DataArray): image with (global) metadata, all the images must
       have the same shape.
     mds (None or list of dict): metadata for each C of the image (if different) 
+    pyramid (boolean): whether the image should be stored tiled, along with
+      the different zoom levels.
     """
     gi = group.create_group("ImageData")
 
@@ -1169,12 +1192,64 @@ def _add_acquistion_svi(group, data, mds, **kwargs):
     _h5py_enum_commit(group, b"StateEnumeration", _dtstate)
 
     # TODO: use scaleoffset to store the number of bits used (MD_BPP)
-    ids = _create_image_dataset(gi, "Image", data, **kwargs)
+    if pyramid:
+        ids = _create_image_dataset(gi, "Image", data, chunks=_getTileChunks(data), **kwargs)
+        _add_zoom_levels(gi, data, **kwargs)
+    else:
+        ids = _create_image_dataset(gi, "Image", data, **kwargs)
     _add_image_info(gi, ids, data)
     _add_image_metadata(group, data, mds)
     _add_svi_info(group)
 
 
+def _getTileChunks(data):
+    """
+    Computes the shape of the chunks to store an image as tiles
+    data (DataArray): the image, with X and Y as last dimensions
+    return (tuple of int): the chunk shape, with the same length as data.shape
+    """
+    dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim:])
+    # Keep the colour channels together, as they are always displayed together
+    return tuple(min(s, TILE_SIZE) if d in "XY" else (s if dims == "CYX" else 1)
+                 for s, d in zip(data.shape, dims))
+
+
+def _genResizedShapes(data):
+    """
+    Generates a list of tuples with the size of the resized images
+    data (DataArray): The original image, with X and Y as last dimensions
+    return (list of tuples): List of the tuples with the size of the resized images
+    """
+    shape = data.shape
+    resized_shapes = []
+    z = 0
+    while shape[-1] >= TILE_SIZE and shape[-2] >= TILE_SIZE:
+        z += 1
+        shape = data.shape[:-2] + (data.shape[-2] // 2 ** z, data.shape[-1] // 2 ** z)
+        resized_shapes.append(shape)
+
+    return resized_shapes
+
+
+def _add_zoom_levels(group, data, **kwargs):
+    """
+    Adds the zoom levels of a pyramidal image, as datasets ImageZoom<z>.
+    group (HDF Group): the group "ImageData" which contains the image
+    data (DataArray): the full image, with X and Y as last dimensions
+    """
+    zdata = data
+    for z, shape in enumerate(_genResizedShapes(data), 1):
+        # Each zoom level is computed from the previous one, which is 4x smaller
+        # than the full image, so it's much faster.
+        prev = zdata
+        zdata = model.DataArray(numpy.empty(shape, data.dtype), data.metadata)
+        for i in numpy.ndindex(*shape[:-2]):
+            zdata[i] = img.rescale_hq(numpy.asarray(prev[i]), shape[-2:])
+
+        _create_image_dataset(group, "ImageZoom%d" % z, zdata,
+                              chunks=_getTileChunks(zdata), **kwargs)
+
+
 def _findImageGroups(das):
     """
     Find groups of images which should be considered part of the same acquisition
@@ -1342,14 +1417,13 @@ def _updateRGBMD(da):
     da.metadata[model.MD_DIMS] = dims
 
 
-def _thumbFromHDF5(filename):
+def _thumbFromHDF5(f):
     """
-    Read thumbnails from an HDF5 file.
+    Open thumbnails from an HDF5 file.
     Expects to find them as IMAGE in Preview/Image.
-    return (list of model.DataArray)
+    f (h5py.File): the root of the file
+    return (list of DataArrayShadowHDF5)
     """
-    f = h5py.File(filename, "r")
-
     thumbs = []
     # look for the Preview directory
     try:
@@ -1363,29 +1437,47 @@ def _thumbFromHDF5(filename):
         # an image? (== has the attribute CLASS: IMAGE)
         if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == b"IMAGE":
             try:
-                da = _read_image_dataset(ds)
+                md = _read_image_dataset_md(ds)
             except Exception:
                 logging.info("Skipping image '%s' which couldn't be read.", name)
                 continue
 
             if name == "Image":
                 try:
-                    da.metadata = _read_image_info(grp)
+                    md.update(_read_image_info(grp))
                 except Exception:
                     logging.debug("Failed to parse metadata of acquisition '%s'", name)
                     continue
 
-            thumbs.append(da)
+            thumbs.append(DataArrayShadowHDF5([ds], md))
 
     return thumbs
 
 
+def _findZoomLevels(group):
+    """
+    Find the datasets of the zoom levels of a pyramidal image.
+    group (HDF Group): the group "ImageData" that contains the image
+    return (list of HDF Dataset): the datasets for zoom level 1, 2, 3...
+      It's empty if the image is not pyramidal.
+    """
+    if group["Image"].chunks is None:
+        return []
+
+    zds = []
+    while True:
+        ds = group.get("ImageZoom%d" % (len(zds) + 1))
+        if not isinstance(ds, h5py.Dataset):
+            return zds
+        zds.append(ds)
+
+
 def _dataFromSVIHDF5(f):
     """
-    Read microscopy data from an HDF5 file using the SVI convention.
+    Open microscopy data from an HDF5 file using the SVI convention.
     Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
     f (h5py.File): the root of the file
-    return (list of model.DataArray)
+    return (list of DataArrayShadowHDF5)
     """
     data = []
 
@@ -1399,31 +1491,30 @@ def _dataFromSVIHDF5(f):
         except KeyError:
             continue  # not conforming => try next object
 
-        # Read the raw data
+        # Check the format of the raw data (but don't read it)
         try:
-            da = _read_image_dataset(image)
+            md = _read_image_dataset_md(image)
         except Exception:
             logging.exception("Failed to read data of acquisition '%s'", obj.name)
+            continue
 
         # TODO: read more metadata
         try:
-            da.metadata.update(_read_image_info(imagedata))
+            md.update(_read_image_info(imagedata))
         except Exception:
             logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
 
-        das = _parse_physical_data(physicaldata, da)
-        data.extend(das)
+        das = DataArrayShadowHDF5([image] + _findZoomLevels(imagedata), md)
+        data.extend(_parse_physical_data(physicaldata, das))
     return data
 
 
-def _dataFromHDF5(filename):
+def _dataFromHDF5(f):
     """
-    Read microscopy data from an HDF5 file.
-    filename (string): path of the file to read
-    return (list of model.DataArray)
+    Open microscopy data from an HDF5 file.
+    f (h5py.File): the root of the file
+    return (list of DataArrayShadowHDF5)
     """
-    f = h5py.File(filename, "r")
-
     # if follows SVI convention => use the special function
     # If it has at least one directory like XXX/SVIData => it follows SVI conventions
     for obj in f.values():
@@ -1444,9 +1535,10 @@ def _dataFromHDF5(filename):
                 return
             # TODO: if it's an image, open it as an image
             # TODO: try to get some metadata?
-            da = model.DataArray(obj[...])
+            da = DataArrayShadowHDF5([obj], {})
         except Exception:
             logging.info("Skipping '%s' as it doesn't seem a correct data", name)
+            return
         data.append(da)
 
     f.visititems(addIfWorthy)
@@ -1465,7 +1557,7 @@ def _mergeCorrectionMetadata(da):
     return model.DataArray(da, md) # create a view
 
 
-def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
+def _saveAsHDF5(filename, ldata, thumbnail, compressed=True, pyramid=False):
     """
     Saves a list of DataArray as a HDF5 (SVI) file.
     filename (string): name of the file to save
@@ -1473,6 +1565,7 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
      Should have at least one array.
     thumbnail (None or DataArray): see export
     compressed (boolean): whether the file is compressed or not.
+    pyramid (boolean): whether the images are saved in the pyramidal format.
     """
     # h5py will extend the current file by default, so we want to make sure
     # there is no file at all.
@@ -1503,14 +1596,14 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     acq, mds = _groupImages(ldata)
     for i, da in enumerate(acq):
         ga = f.create_group("Acquisition%d" % i)
-        _add_acquistion_svi(ga, da, mds[i], compression=compression)
+        _add_acquistion_svi(ga, da, mds[i], pyramid=pyramid, compression=compression)
 
     f.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
-def export(filename, data, thumbnail=None):
+# Note: to save large data without having everything in memory simultaneously,
+# use AcquisitionWriter.
+def export(filename, data, thumbnail=None, compressed=True, pyramid=False):
     '''
     Write an HDF5 file with the given image and metadata
     filename (unicode): filename of the file to create (including path)
@@ -1524,13 +1617,171 @@ def export(filename, data, thumbnail=None):
       (reasonable) size. Must be either 2D array (greyscale) or 3D with last 
       dimension of length 3 (RGB). If the exporter doesn't support it, it will
       be dropped silently.
+    compressed (boolean): whether the file is compressed or not.
+    pyramid (boolean): whether the file should be saved in the pyramidal format
+      or not. In this format, each image is saved tiled, along with the
+      different zoom levels, which allows to display quickly large images.
     '''
     # TODO: add an argument to not do any clever data aggregation?
     if not isinstance(data, (list, tuple)):
         # TODO should probably not enforce it: respect duck typing
         assert(isinstance(data, model.DataArray))
         data = [data]
-    _saveAsHDF5(filename, data, thumbnail)
+    _saveAsHDF5(filename, data, thumbnail, compressed, pyramid)
+
+
+class AcquisitionWriter(object):
+    """
+    Writes an HDF5 (SVI) file progressively, so that data larger than the
+    memory can be saved. The data of each acquisition is written block by block,
+    as it arrives, and the metadata is written when the file is closed.
+    Typical usage:
+      writer = AcquisitionWriter(filename)
+      acq = writer.add_acquisition((512, 256, 256), numpy.uint16, md)
+      for each block: writer.write(acq, block, pos)
+      writer.close()
+    Contrarily to export(), no aggregation of the data is done: each acquisition
+    is stored as a separate group.
+    """
+
+    def __init__(self, filename, compressed=True):
+        """
+        filename (unicode): filename of the file to create (including path).
+          If it already exists, it will be overwritten.
+        compressed (boolean): whether the file is compressed or not.
+        """
+        # h5py will extend the current file by default, so we want to make sure
+        # there is no file at all.
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w")
+        self._compression = "gzip" if compressed else None
+        # For each acquisition: the group, the dataset, the dimensions of the
+        # data passed by the caller, the metadata, and the min/max values written
+        self._acqs = []
+
+    def add_acquisition(self, shape, dtype, md=None, chunks=True):
+        """
+        Declare a new acquisition. The data is initially all 0s.
+        shape (tuple of int): the shape of the complete data, in the order
+          given by MD_DIMS.
+        dtype (numpy.dtype): the type of the data
+        md (None or dict): the metadata of the acquisition. It can be updated
+          later with update_metadata(). MD_DIMS must be a subset of "CTZYX",
+          in the same order. If not present, it's assumed to be the last
+          dimensions of "CTZYX".
+        chunks (True or tuple of int): the size of the chunks stored in the
+          file, in the same order as shape. If True, it's automatically
+          selected. For best performance, the blocks written should be aligned
+          with the chunks.
+        return (int): the index of the acquisition, to be passed to write()
+        raises:
+          ValueError: if the dimensions are not supported
+        """
+        md = dict(md or {})
+        dims = md.get(model.MD_DIMS, "CTZYX"[-len(shape):])
+        if len(dims) != len(shape):
+            raise ValueError("MD_DIMS %s doesn't match shape %s" % (dims, shape))
+        if [d for d in "CTZYX" if d in dims] != list(dims):
+            raise ValueError("MD_DIMS %s must be ordered as CTZYX" % (dims,))
+
+        shape5d = self._to5d(dims, shape, 1)
+        if chunks is not True:
+            chunks = self._to5d(dims, chunks, 1)
+
+        ga = self._file.create_group("Acquisition%d" % len(self._acqs))
+        gi = ga.create_group("ImageData")
+        ids = gi.create_dataset("Image", shape=shape5d, dtype=dtype,
+                                chunks=chunks, compression=self._compression)
+        md[model.MD_DIMS] = dims
+        self._acqs.append((ga, ids, dims, md, [None, None]))
+        return len(self._acqs) - 1
+
+    @staticmethod
+    def _to5d(dims, values, default):
+        """
+        Convert a tuple of values along the given dims to CTZYX
+        return (tuple of 5 values)
+        """
+        return tuple(values[dims.index(d)] if d in dims else default
+                     for d in "CTZYX")
+
+    def write(self, acq, data, pos=None):
+        """
+        Write a block of data into an acquisition.
+        acq (int): the index of the acquisition, as returned by add_acquisition()
+        data (numpy.ndarray): the block of data, with the same number of
+          dimensions as the acquisition.
+        pos (None or tuple of int): the index of the first element of the block
+          in the acquisition, for each dimension. If None, it's 0 everywhere.
+        raises:
+          ValueError: if the block doesn't fit in the acquisition
+        """
+        ga, ids, dims, md, minmax = self._acqs[acq]
+        if data.ndim != len(dims):
+            raise ValueError("Data has shape %s while acquisition has dims %s" %
+                             (data.shape, dims))
+        if pos is None:
+            pos = (0,) * data.ndim
+        start = self._to5d(dims, pos, 0)
+        shape = self._to5d(dims, data.shape, 1)
+        if any(s + l > m for s, l, m in zip(start, shape, ids.shape)):
+            raise ValueError("Data of shape %s at %s doesn't fit in acquisition of shape %s" %
+                             (data.shape, pos, ids.shape))
+
+        ids[tuple(slice(s, s + l) for s, l in zip(start, shape))] = data.reshape(shape)
+
+        if data.size:
+            dmin, dmax = data.min(), data.max()
+            minmax[0] = dmin if minmax[0] is None else min(minmax[0], dmin)
+            minmax[1] = dmax if minmax[1] is None else max(minmax[1], dmax)
+
+    def update_metadata(self, acq, md):
+        """
+        Update the metadata of an acquisition. Useful for the metadata only
+        known at the end of the acquisition (eg, MD_ACQ_DATE, MD_POS...).
+        acq (int): the index of the acquisition
+        md (dict): the metadata to add (or overwrite)
+        """
+        md = dict(md)
+        md.pop(model.MD_DIMS, None)  # The dimensions cannot change anymore
+        self._acqs[acq][3].update(md)
+
+    def close(self, thumbnail=None):
+        """
+        Write the metadata and close the file. The writer cannot be used
+        afterwards.
+        thumbnail (None or DataArray): see export
+        """
+        try:
+            if thumbnail is not None:
+                thumbnail = _mergeCorrectionMetadata(thumbnail)
+                prevg = self._file.create_group("Preview")
+                _updateRGBMD(thumbnail)  # ensure RGB info is there if needed
+                ids = _create_image_dataset(prevg, "Image", thumbnail,
+                                            compression=self._compression)
+                _add_image_info(prevg, ids, thumbnail)
+
+            for ga, ids, dims, md, minmax in self._acqs:
+                if minmax[0] is None:  # Nothing written => all 0s
+                    minmax = [0, 0]
+                _add_image_class(ids, ids.shape, minmax)
+
+                # The metadata functions only need the shape and the metadata,
+                # so pass a (virtual) array, which doesn't use any memory.
+                md = dict(md)
+                img.mergeMetadata(md)
+                md[model.MD_DIMS] = "CTZYX"
+                da = model.DataArray(numpy.broadcast_to(numpy.zeros((), ids.dtype), ids.shape), md)
+
+                _h5py_enum_commit(ga, b"StateEnumeration", _dtstate)
+                _add_image_info(ga["ImageData"], ids, da)
+                _add_image_metadata(ga, da, None)
+                _add_svi_info(ga)
+        finally:
+            self._file.close()
 
 
 def read_data(filename):
@@ -1549,8 +1800,8 @@ def read_data(filename):
     # TODO: support filename to be a File or Stream (but it seems very difficult
     # to do it without looking at the .filename attribute)
     # see http://pytables.github.io/cookbook/inmemory_hdf5_files.html
-
-    return _dataFromHDF5(filename)
+    acd = open_data(filename)
+    return [acd.content[n].getData() for n in range(len(acd.content))]
 
 
 def read_thumbnail(filename):
@@ -1564,6 +1815,169 @@ def read_thumbnail(filename):
         IOError in case the file format is not as expected.
     """
     # TODO: support filename to be a File or Stream
+    acd = open_data(filename)
+    return [acd.thumbnails[n].getData() for n in range(len(acd.thumbnails))]
+
+
+def open_data(filename):
+    """
+    Opens an HDF5 file, and return an AcquisitionData instance. The data is
+    only read when requested.
+    filename (string): path to the file
+    return (AcquisitionData): an opened file
+    raises:
+        IOError in case the file format is not as expected.
+    """
+    return AcquisitionDataHDF5(filename)
 
-    return _thumbFromHDF5(filename)
+
+class DataArrayShadowHDF5(DataArrayShadow):
+    """
+    This class implements the read of an image stored in an HDF5 dataset.
+    It has all the useful attributes of a DataArray, and the data is only read
+    when requested. Sub-parts of the data can be read by indexing it, like
+    a numpy array.
+    """
+
+    def __new__(cls, datasets, *args, **kwargs):
+        """
+        Returns an instance of DataArrayShadowHDF5 or DataArrayShadowPyramidalHDF5,
+        depending if the image is pyramidal or not.
+        """
+        if len(datasets) > 1:
+            subcls = DataArrayShadowPyramidalHDF5
+        else:
+            subcls = DataArrayShadowHDF5
+        return super(DataArrayShadowHDF5, cls).__new__(subcls)
+
+    def __init__(self, datasets, metadata=None, index=()):
+        """
+        Constructor
+        datasets (list of HDF Dataset): the dataset containing the image,
+          followed by the datasets containing each zoom level, if the image is
+          pyramidal.
+        metadata (dict str->val): The metadata
+        index (tuple of int): the index of the part of the dataset represented,
+          on the first dimensions. Empty tuple for the whole dataset.
+        """
+        self._datasets = datasets
+        self._index = index
+        ds = datasets[0]
+        DataArrayShadow.__init__(self, ds.shape[len(index):], ds.dtype, metadata)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return model.DataArray(self._datasets[0][self._index], self.metadata.copy())
+
+    def __getitem__(self, key):
+        """
+        Reads a sub-part of the data. If only integers are given for the first
+        dimensions (and not for X and Y), a new DataArrayShadowHDF5 is returned,
+        representing the sub-part, and nothing is read. Otherwise, only the data
+        of the sub-part is read, and returned as a DataArray.
+        key (int, slice, or tuple of int and slices): standard numpy index
+        return (DataArrayShadowHDF5 or DataArray): the sub-part of the data
+        raises:
+          IndexError: if the index is out of bounds
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        nint = 0
+        for k in key:
+            if not isinstance(k, numbers.Integral):
+                break
+            nint += 1
+
+        if (0 < nint <= self.ndim - 2 and
+            all(isinstance(k, slice) and k == slice(None) for k in key[nint:])):
+            index = []
+            for k, s in zip(key[:nint], self.shape):
+                if not -s <= k < s:
+                    raise IndexError("Index %d out of bounds for dimension of size %d" % (k, s))
+                index.append(int(k) % s)
+
+            md = self.metadata.copy()
+            if model.MD_DIMS in md:
+                md[model.MD_DIMS] = md[model.MD_DIMS][nint:]
+            return DataArrayShadowHDF5(self._datasets, md, self._index + tuple(index))
+
+        data = self._datasets[0][self._index + key]
+        md = self.metadata.copy()
+        if numpy.ndim(data) != self.ndim:
+            md.pop(model.MD_DIMS, None)
+        return model.DataArray(data, md)
+
+
+class DataArrayShadowPyramidalHDF5(DataArrayShadowHDF5):
+    """
+    This class implements the read of a pyramidal image stored in HDF5
+    datasets. IOW, reading the zoom levels and tiles.
+    """
+
+    def __init__(self, datasets, metadata=None, index=()):
+        """
+        Constructor
+        datasets (list of HDF Dataset): the dataset containing the (tiled) image,
+          followed by the datasets containing each zoom level.
+        metadata (dict str->val): The metadata
+        index (tuple of int): the index of the part of the dataset represented,
+          on the first dimensions. Empty tuple for the whole dataset.
+        """
+        self._datasets = datasets
+        self._index = index
+        ds = datasets[0]
+        if ds.chunks is None:
+            raise ValueError("The image is not tiled")
+        tile_shape = (ds.chunks[-1], ds.chunks[-2])
+        DataArrayShadow.__init__(self, ds.shape[len(index):], ds.dtype, metadata,
+                                 len(datasets) - 1, tile_shape)
+
+    def getTile(self, x, y, zoom):
+        '''
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        return (DataArray): the shape of the DataArray is typically of shape
+        '''
+        if not 0 <= zoom <= self.maxzoom:
+            raise ValueError("Invalid Z value %d" % (zoom,))
+
+        xp = x * self.tile_shape[0]
+        yp = y * self.tile_shape[1]
+        zshape = self._datasets[zoom].shape
+        if not (0 <= xp < zshape[-1] and 0 <= yp < zshape[-2]):
+            raise ValueError("Invalid tile %d, %d at zoom %d" % (x, y, zoom))
+        key = (self._index + (slice(None),) * (self.ndim - 2) +
+               (slice(yp, yp + self.tile_shape[1]), slice(xp, xp + self.tile_shape[0])))
+        tile = model.DataArray(self._datasets[zoom][key], self.metadata.copy())
+
+        # calculate the pixel size of the tile for the zoom level
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        tile.metadata[model.MD_PIXEL_SIZE] = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
+        # calculate the center of the tile
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+
+        return tile
+
+
+class AcquisitionDataHDF5(AcquisitionData):
+    """
+    Implements AcquisitionData for HDF5 files
+    """
+    def __init__(self, filename):
+        """
+        Constructor
+        filename (string): The name of the HDF5 file
+        """
+        # The file stays open as long as the datasets are referenced
+        f = h5py.File(filename, "r")
+        data = _dataFromHDF5(f)
+        thumbnails = _thumbFromHDF5(f)
+        AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
 
@@ -22,17 +22,37 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 """
 from __future__ import division
 
+from PIL import Image
+from future.moves.http.server import BaseHTTPRequestHandler, HTTPServer
+from future.moves.socketserver import ThreadingMixIn
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import numpy
 from requests import ConnectionError
 
-from odemis.dataio import AuthenticationError
-from odemis.dataio.catmaid import open_data
+from odemis.dataio import AuthenticationError, catmaid
+from odemis.dataio.catmaid import open_data, TileDiskCache
 
 
 class TestCatmaid(unittest.TestCase):
 
+    def setUp(self):
+        # Don't fill up the cache of the user
+        self.cache_path = tempfile.mkdtemp()
+        self._orig_cache_path = catmaid.CACHE_PATH
+        catmaid.CACHE_PATH = self.cache_path
+
+    def tearDown(self):
+        catmaid.CACHE_PATH = self._orig_cache_path
+        shutil.rmtree(self.cache_path)
+
     def test_open_data_virtualflybrain(self):
         """
         Test requesting different tiles from the virtualflybrain server.
@@ -92,5 +112,232 @@ class TestCatmaid(unittest.TestCase):
         numpy.testing.assert_array_equal(tile, numpy.zeros(size))
 
 
+TILE_SIZE = 64
+STACK_INFO = {
+    "dimension": {"x": 4 * TILE_SIZE, "y": 4 * TILE_SIZE, "z": 1},
+    "resolution": {"x": 10.0, "y": 10.0, "z": 50.0},
+    "num_zoom_levels": 2,
+    "mirrors": [{
+        "tile_width": TILE_SIZE,
+        "tile_height": TILE_SIZE,
+        "tile_source_type": catmaid.FILE_BASED,
+        "file_extension": "png",
+        "image_base": None,  # Set once the server is started
+    }],
+}
+
+
+class FakeCatmaidHandler(BaseHTTPRequestHandler):
+    """
+    Serves the stack info and tiles of a small (fake) Catmaid instance.
+    The tile at row, column, zoom has all its pixels set to row * 16 + col * 4 + zoom.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.concurrent += 1
+            server.max_concurrent = max(server.max_concurrent, server.concurrent)
+        try:
+            if self.path == "/1/stack/1/info":
+                self._send(200, "application/json", json.dumps(server.stack_info).encode("utf-8"))
+                return
+
+            # /tiles/{depth}/{row}_{col}_{zoom}.png
+            name = self.path.split("/")[-1].split(".")[0]
+            row, col, zoom = (int(v) for v in name.split("_"))
+            if row >= 4 or col >= 4:
+                self._send(404, "text/plain", b"Not found")
+                return
+            with server.lock:
+                if (row, col, zoom) in server.broken:  # Simulate a permanent failure
+                    self._send(503, "text/plain", b"Broken")
+                    return
+                if server.failures > 0:  # Simulate a temporary failure
+                    server.failures -= 1
+                    self._send(503, "text/plain", b"Busy")
+                    return
+            time.sleep(server.delay)
+            im = Image.new("L", (TILE_SIZE, TILE_SIZE), row * 16 + col * 4 + zoom)
+            buf = BytesIO()
+            im.save(buf, "PNG")
+            self._send(200, "image/png", buf.getvalue())
+        finally:
+            with server.lock:
+                server.concurrent -= 1
+
+    def _send(self, code, content_type, content):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in a separate thread
+    """
+    daemon_threads = True
+
+
+class TestCatmaidLocal(unittest.TestCase):
+    """
+    Test fetching the tiles, with a local server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCatmaidHandler)
+        cls.server.lock = threading.Lock()
+        base_url = "http://127.0.0.1:%d" % (cls.server.server_address[1],)
+        cls.server.stack_info = json.loads(json.dumps(STACK_INFO))
+        cls.server.stack_info["mirrors"][0]["image_base"] = base_url + "/tiles/"
+        cls.url = base_url.replace("http://", "catmaid://") + "/?pid=1&sid0=1"
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever)
+        cls.server_thread.daemon = True
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.concurrent = 0
+        self.server.max_concurrent = 0
+        self.server.failures = 0
+        self.server.broken = set()
+        self.server.delay = 0
+        self.cache_path = tempfile.mkdtemp()
+        self._orig_cache_path = catmaid.CACHE_PATH
+        catmaid.CACHE_PATH = self.cache_path
+
+    def tearDown(self):
+        catmaid.CACHE_PATH = self._orig_cache_path
+        shutil.rmtree(self.cache_path)
+
+    def _tile_requests(self):
+        return [r for r in self.server.requests if r.startswith("/tiles/")]
+
+    def test_get_tiles(self):
+        """
+        getTiles() returns the same tiles as getTile(), and downloads them in parallel
+        """
+        das = open_data(self.url).content[0]
+        self.server.delay = 0.05
+        tiles_idx = [(x, y, 0) for x in range(4) for y in range(4)]
+        tiles = das.getTiles(tiles_idx)
+        self.assertEqual(len(tiles), len(tiles_idx))
+        self.assertGreater(self.server.max_concurrent, 1)
+        self.assertLessEqual(self.server.max_concurrent, catmaid.MAX_CONNECTIONS)
+        for (x, y, z), t in zip(tiles_idx, tiles):
+            self.assertEqual(t.shape, (TILE_SIZE, TILE_SIZE))
+            self.assertEqual(t[0, 0], y * 16 + x * 4 + z)
+            t1 = das.getTile(x, y, z)
+            numpy.testing.assert_array_equal(t, t1)
+            self.assertEqual(t.metadata, t1.metadata)
+
+        # Non-existing tiles are blank
+        tiles = das.getTiles([(10, 10, 0), (1, 1, 0)])
+        numpy.testing.assert_array_equal(tiles[0], numpy.zeros((TILE_SIZE, TILE_SIZE)))
+        self.assertEqual(tiles[1][0, 0], 1 * 16 + 1 * 4)
+
+    def test_disk_cache(self):
+        """
+        Tiles already downloaded are read from the disk cache
+        """
+        das = open_data(self.url).content[0]
+        tiles_idx = [(x, y, 1) for x in range(2) for y in range(2)]
+        tiles = das.getTiles(tiles_idx)
+        self.assertEqual(len(self._tile_requests()), 4)
+
+        # A new instance (eg, opened later) should reuse the cache
+        das2 = open_data(self.url).content[0]
+        self.assertIs(das2._cache, das._cache)
+        self.assertIs(das2._executor, das._executor)
+        das = das2
+        tiles_cached = das.getTiles(tiles_idx)
+        self.assertEqual(len(self._tile_requests()), 4)
+        for t, tc in zip(tiles, tiles_cached):
+            numpy.testing.assert_array_equal(t, tc)
+
+        # Non-existing tiles are not cached
+        das.getTile(10, 10, 0)
+        das.getTile(10, 10, 0)
+        self.assertEqual(len(self._tile_requests()), 6)
+
+    def test_retry(self):
+        """
+        Temporary errors of the server are retried
+        """
+        das = open_data(self.url).content[0]
+        self.server.failures = 2
+        tile = das.getTile(2, 3, 0)
+        self.assertEqual(tile[0, 0], 3 * 16 + 2 * 4)
+        self.assertEqual(len(self._tile_requests()), 3)
+
+    def test_failure(self):
+        """
+        A tile which cannot be downloaded raises an error, and is not cached
+        """
+        das = open_data(self.url).content[0]
+        self.server.failures = 100  # Fails every time
+        with self.assertRaises(IOError):
+            das.getTile(1, 2, 0)
+        tiles = das.getTiles([(0, 0, 0), (1, 2, 0)])
+        self.assertIsInstance(tiles[0], IOError)
+        self.assertIsInstance(tiles[1], IOError)
+
+        # Once the server works again, the tile is available
+        self.server.failures = 0
+        tile = das.getTile(1, 2, 0)
+        self.assertEqual(tile[0, 0], 2 * 16 + 1 * 4)
+
+    def test_failure_partial(self):
+        """
+        If some tiles cannot be downloaded, the other ones are still returned
+        """
+        das = open_data(self.url).content[0]
+        self.server.broken = {(2, 1, 0)}
+        tiles_idx = [(x, y, 0) for x in range(3) for y in range(3)]
+        tiles = das.getTiles(tiles_idx)
+        for (x, y, z), t in zip(tiles_idx, tiles):
+            if (y, x, z) in self.server.broken:
+                self.assertIsInstance(t, IOError)
+            else:
+                self.assertEqual(t[0, 0], y * 16 + x * 4 + z)
+
+        # The tiles downloaded are cached
+        nreq = len(self._tile_requests())
+        das.getTile(0, 0, 0)
+        self.assertEqual(len(self._tile_requests()), nreq)
+
+    def test_cache_eviction(self):
+        """
+        The least recently used tiles are deleted when the cache is full
+        """
+        cache = TileDiskCache(self.cache_path, 250)
+        cache.put("a", b"a" * 100)
+        cache.put("b", b"b" * 100)
+        self.assertEqual(cache.get("a"), b"a" * 100)  # "a" is now the most recent
+        cache.put("c", b"c" * 100)
+        self.assertEqual(cache.nbytes, 200)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"a" * 100)
+        self.assertEqual(cache.get("c"), b"c" * 100)
+        self.assertEqual(len(os.listdir(self.cache_path)), 2)
+
+        # A new instance finds back the tiles
+        cache = TileDiskCache(self.cache_path, 250)
+        self.assertEqual(cache.nbytes, 200)
+        self.assertEqual(cache.get("c"), b"c" * 100)
+
+
 if __name__ == '__main__':
     unittest.main()
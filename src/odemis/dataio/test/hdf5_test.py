@@ -492,6 +492,174 @@ class TestHDF5IO(unittest.TestCase):
         self.assertEqual(im[blue[::-1]].tolist(), [0, 0, 255])
         self.assertAlmostEqual(im.metadata[model.MD_POS], thumbnail.metadata[model.MD_POS])
 
+    def testAcquisitionWriter(self):
+        """
+        Checks that data written progressively can be read back
+        """
+        shape = (100, 20, 30)  # C, Y, X
+        dtype = numpy.dtype("uint16")
+        md = {model.MD_DIMS: "CYX",
+              model.MD_DESCRIPTION: "Spectrum",
+              model.MD_PIXEL_SIZE: (1e-6, 2e-6),
+              model.MD_POS: (1e-3, -30e-3),
+              model.MD_WL_LIST: [500e-9 + i * 1e-9 for i in range(shape[0])],
+              }
+        full = numpy.random.randint(0, 4000, shape).astype(dtype)
+
+        writer = hdf5.AcquisitionWriter(FILENAME)
+        acq = writer.add_acquisition(shape, dtype, md, chunks=(shape[0], 1, 1))
+        acq_se = writer.add_acquisition(shape[1:], numpy.float32,
+                                        {model.MD_DESCRIPTION: "SE"})
+        # One spectrum at a time, as during a SPARC acquisition
+        for y in range(shape[1]):
+            for x in range(shape[2]):
+                writer.write(acq, full[:, y:y + 1, x:x + 1], (0, y, x))
+            writer.write(acq_se, numpy.full((1, shape[2]), y, numpy.float32), (y, 0))
+
+        with self.assertRaises(ValueError):
+            writer.write(acq_se, numpy.zeros((2, shape[2]), numpy.float32), (shape[1] - 1, 0))
+
+        writer.update_metadata(acq, {model.MD_ACQ_DATE: 1234.5})
+        writer.close()
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 2)
+
+        im = rdata[0]
+        self.assertEqual(im.shape, (shape[0], 1, 1) + shape[1:])
+        numpy.testing.assert_array_equal(im[:, 0, 0], full)
+        self.assertEqual(im.metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+        self.assertEqual(im.metadata[model.MD_PIXEL_SIZE], md[model.MD_PIXEL_SIZE])
+        self.assertEqual(im.metadata[model.MD_POS], md[model.MD_POS])
+        self.assertEqual(im.metadata[model.MD_ACQ_DATE], 1234.5)
+        numpy.testing.assert_allclose(im.metadata[model.MD_WL_LIST], md[model.MD_WL_LIST])
+
+        im = rdata[1]
+        self.assertEqual(im.shape, (1, 1, 1) + shape[1:])
+        self.assertEqual(im[0, 0, 0, 5, 3], 5)
+        self.assertEqual(im.metadata[model.MD_DESCRIPTION], "SE")
+
+    def testOpenData(self):
+        """
+        Checks that the data is only read when requested, and partially
+        """
+        size = (10, 3, 1, 200, 300)  # C, T, Z, Y, X
+        dtype = numpy.dtype("uint16")
+        arr = numpy.arange(numpy.prod(size), dtype=numpy.uint32).reshape(size)
+        arr = (arr % 4096).astype(dtype)
+        md = {model.MD_DESCRIPTION: "Temporal Spectrum",
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -30e-3),
+              model.MD_WL_LIST: [500e-9 + i * 1e-9 for i in range(size[0])],
+              }
+        data = model.DataArray(arr, md)
+        hdf5.export(FILENAME, data)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 1)
+        self.assertEqual(len(acd.thumbnails), 0)
+        das = acd.content[0]
+        self.assertIsInstance(das, model.DataArrayShadow)
+        self.assertFalse(hasattr(das, "maxzoom"))
+        self.assertEqual(das.shape, size)
+        self.assertEqual(das.dtype, dtype)
+        self.assertEqual(das.metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+        self.assertEqual(das.metadata[model.MD_POS], md[model.MD_POS])
+
+        # Only integers => a smaller shadow
+        subdas = das[2, 1]
+        self.assertIsInstance(subdas, model.DataArrayShadow)
+        self.assertEqual(subdas.shape, size[2:])
+        numpy.testing.assert_array_equal(subdas.getData(), arr[2, 1])
+        self.assertEqual(subdas.getData().metadata[model.MD_POS], md[model.MD_POS])
+
+        # Slices => the data is read
+        spec = das[:, 0, 0, 50, 60]
+        self.assertIsInstance(spec, model.DataArray)
+        numpy.testing.assert_array_equal(spec, arr[:, 0, 0, 50, 60])
+        sub = das[3, :, 0, 10:20, 30:50]
+        numpy.testing.assert_array_equal(sub, arr[3, :, 0, 10:20, 30:50])
+
+        with self.assertRaises(IndexError):
+            das[10]
+
+        numpy.testing.assert_array_equal(das.getData(), arr)
+
+    def testOpenDataFluo(self):
+        """
+        Checks that opening a file with multiple channels separates them
+        """
+        size = (3, 1, 1, 100, 150)
+        ldata = []
+        for i in range(size[0]):
+            a = model.DataArray(numpy.full(size[1:], i, dtype=numpy.uint16))
+            a.metadata = {model.MD_DESCRIPTION: "Fluo %d" % i,
+                          model.MD_IN_WL: (500e-9 + i * 50e-9, 520e-9 + i * 50e-9),
+                          model.MD_OUT_WL: (600e-9 + i * 50e-9, 630e-9 + i * 50e-9),
+                          model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                          model.MD_POS: (1e-3, -30e-3),
+                          }
+            ldata.append(a)
+        hdf5.export(FILENAME, ldata)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), size[0])
+        for i, das in enumerate(acd.content):
+            self.assertIsInstance(das, model.DataArrayShadow)
+            self.assertEqual(das.shape, size[1:])
+            self.assertEqual(das.metadata[model.MD_DESCRIPTION], "Fluo %d" % i)
+            da = das.getData()
+            self.assertEqual(da[0, 0, 10, 10], i)
+            self.assertEqual(da.metadata[model.MD_DESCRIPTION], "Fluo %d" % i)
+
+    def testExportPyramid(self):
+        """
+        Checks that a pyramidal image can be read by tiles
+        """
+        size = (1, 1, 1, 600, 1000)
+        arr = numpy.arange(numpy.prod(size), dtype=numpy.uint32).reshape(size)
+        arr = (arr % 60000).astype(numpy.uint16)
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -30e-3),
+              }
+        data = model.DataArray(arr, md)
+        hdf5.export(FILENAME, data, pyramid=True)
+
+        acd = hdf5.open_data(FILENAME)
+        das = acd.content[0]
+        self.assertEqual(das.shape, size)
+        self.assertEqual(das.maxzoom, 2)
+        self.assertEqual(das.tile_shape, (256, 256))
+
+        tile = das.getTile(1, 0, 0)
+        self.assertEqual(tile.shape, (1, 1, 1, 256, 256))
+        numpy.testing.assert_array_equal(tile, arr[..., 0:256, 256:512])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+
+        # Last tile is smaller
+        tile = das.getTile(3, 2, 0)
+        self.assertEqual(tile.shape, (1, 1, 1, 600 - 512, 1000 - 768))
+
+        tile = das.getTile(0, 0, 2)
+        self.assertEqual(tile.shape, (1, 1, 1, 600 // 4, 1000 // 4))
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (4e-6, 4e-6))
+
+        with self.assertRaises(ValueError):
+            das.getTile(50, 0, 0)
+        with self.assertRaises(ValueError):
+            das.getTile(0, 0, 3)
+
+        # A 2D sub-shadow is still pyramidal
+        subdas = das[0, 0, 0]
+        self.assertEqual(subdas.shape, size[-2:])
+        self.assertEqual(subdas.maxzoom, 2)
+        tile = subdas.getTile(0, 0, 1)
+        self.assertEqual(tile.shape, (256, 256))
+
+        # The full data is still the same
+        rdata = hdf5.read_data(FILENAME)
+        numpy.testing.assert_array_equal(rdata[0], arr)
+
     def testReadAndSaveMDSpec(self):
         """
         Checks that we can save and read back the metadata of a spectrum image.
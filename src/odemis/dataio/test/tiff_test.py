@@ -26,6 +26,7 @@ from __future__ import division
 from PIL import Image
 import libtiff
 import logging
+import math
 import numpy
 from numpy.polynomial import polynomial
 from odemis import model
@@ -1890,14 +1891,139 @@ class TestTiffIO(unittest.TestCase):
         # read the subimage
         subimage = im.read_image()
         self.assertEqual(subimage.shape, (147, 128))
-        # Checking the values in the corner of the tile. The downsampling uses
-        # the neighbour pixels to calculate a pixel in the resized image.
-        self.assertEqual(subimage[0][0], 130)
-        self.assertEqual(subimage[0][-1], 385)
-        self.assertEqual(subimage[-1][0], 9893)
-        self.assertEqual(subimage[-1][-1], 10148)
-
-    def testExportThinPyramid(self):           
+        # Checking the values in the corner of the tile. The downsampling
+        # averages each block of 2x2 pixels (the last odd row is dropped).
+        self.assertEqual(subimage[0][0], 129)
+        self.assertEqual(subimage[0][-1], 383)
+        self.assertEqual(subimage[-1][0], 9637)
+        self.assertEqual(subimage[-1][-1], 9891)
+
+    def _readPyramidPages(self, filename):
+        """
+        Read all the zoom levels of the first image of a pyramidal TIFF file
+        return (list of tuple (ndarray, int, int, int)): for each zoom level, the
+          image, tile width, tile height and compression
+        """
+        f = libtiff.TIFF.open(filename)
+        try:
+            pages = []
+            sub_ifds = f.GetField(T.TIFFTAG_SUBIFD) or []
+            for sifd in [None] + list(sub_ifds):
+                if sifd is not None:
+                    f.SetSubDirectory(sifd)
+                pages.append((f.read_image(),
+                              f.GetField(T.TIFFTAG_TILEWIDTH),
+                              f.GetField(T.TIFFTAG_TILELENGTH),
+                              f.GetField(T.TIFFTAG_COMPRESSION)))
+            return pages
+        finally:
+            f.close()
+
+    def testExportPyramidPages(self):
+        """
+        Checks that a pyramidal image has the same pages as with the previous
+        implementation (each zoom level rescaled from the full image, and the
+        tiles compressed by libtiff).
+        """
+        size = (1301, 901)  # X, Y, odd and not a multiple of the tile size
+        dtype = numpy.uint16
+        # Smooth structure + a bit of noise
+        y, x = numpy.mgrid[0:size[1], 0:size[0]]
+        arr = (1000 + 500 * numpy.sin(x / 50) * numpy.cos(y / 70) +
+               numpy.random.randint(0, 4, size[::-1])).astype(dtype)
+        data = model.DataArray(arr, {model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+
+        tiff.export(FILENAME, data, pyramid=True)
+        pages = self._readPyramidPages(FILENAME)
+
+        # Previous implementation
+        fn_old = "old" + FILENAME
+        f = libtiff.TIFF.open(fn_old, mode='w')
+        resized_shapes = tiff._genResizedShapes(data)
+        f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
+        f.write_tiles(data, tiff.TILE_SIZE, tiff.TILE_SIZE, "lzw", False)
+        for resized_shape in resized_shapes:
+            subim = img.rescale_hq(data, resized_shape)
+            f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+            f.write_tiles(subim, tiff.TILE_SIZE, tiff.TILE_SIZE, "lzw", False)
+        f.close()
+        try:
+            pages_old = self._readPyramidPages(fn_old)
+        finally:
+            os.remove(fn_old)
+
+        self.assertEqual(len(pages), len(resized_shapes) + 1)
+        self.assertEqual(len(pages), len(pages_old))
+        numpy.testing.assert_array_equal(pages[0][0], arr)
+        prev_level = arr.astype(numpy.uint32)
+        for z, ((im, tw, th, comp), (im_old, tw_old, th_old, _)) in enumerate(zip(pages, pages_old)):
+            self.assertEqual(im.dtype, im_old.dtype)
+            self.assertEqual(im.shape, im_old.shape)
+            self.assertEqual((tw, th), (tw_old, th_old))
+            # Compressed (but not necessarily with LZW)
+            self.assertNotEqual(comp, T.COMPRESSION_NONE)
+
+            if z > 0:
+                # Each zoom level is the average of each 2x2 block of the previous one
+                h, w = im.shape
+                block = prev_level[:2 * h, :2 * w]
+                exp = (block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2] + 2) // 4
+                numpy.testing.assert_array_equal(im, exp)
+                prev_level = exp
+                # ... which is nearly the same as rescaling the full image
+                diff = numpy.abs(im.astype(numpy.int32) - im_old)
+                self.assertLess(diff.mean(), 5)
+
+    def testExportPyramidShadow(self):
+        """
+        Checks that a DataArrayShadow can be exported as a pyramid, tile by tile,
+        and gives the same file as the DataArray.
+        """
+        size = (1100, 700)  # X, Y, not a multiple of the tile size
+        arr = numpy.random.randint(0, 4000, size[::-1]).astype(numpy.uint16)
+        data = model.DataArray(arr, {model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        tiff.export(FILENAME, data, pyramid=True)
+        das = tiff.open_data(FILENAME).content[0]
+
+        # Export the (tiled) DataArrayShadow read from the file
+        fn_shadow = "shadow" + FILENAME
+        tiff.export(fn_shadow, das, pyramid=True)
+        try:
+            das_shadow = tiff.open_data(fn_shadow).content[0]
+            self.assertEqual(das_shadow.shape, das.shape)
+            self.assertEqual(das_shadow.maxzoom, das.maxzoom)
+            for z in range(das.maxzoom + 1):
+                for x in range(int(math.ceil(size[0] / 2 ** z / das.tile_shape[0]))):
+                    for y in range(int(math.ceil(size[1] / 2 ** z / das.tile_shape[1]))):
+                        numpy.testing.assert_array_equal(das_shadow.getTile(x, y, z),
+                                                         das.getTile(x, y, z))
+
+            # Non pyramidal export just reads the whole data
+            tiff.export(fn_shadow, das)
+            numpy.testing.assert_array_equal(tiff.read_data(fn_shadow)[0], arr)
+        finally:
+            os.remove(fn_shadow)
+
+    def testExportPyramidBool(self):
+        """
+        Checks that a boolean image can be exported as a pyramid
+        """
+        size = (700, 600)  # X, Y
+        arr = numpy.zeros(size[::-1], dtype=bool)
+        arr[100:400, 50:300] = True
+        data = model.DataArray(arr, {model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        tiff.export(FILENAME, data, pyramid=True)
+
+        rdata = tiff.read_data(FILENAME)
+        numpy.testing.assert_array_equal(rdata[0], arr)
+        das = tiff.open_data(FILENAME).content[0]
+        self.assertEqual(das.maxzoom, 2)
+        numpy.testing.assert_array_equal(das.getTile(0, 1, 0), arr[256:512, 0:256])
+        exp = numpy.zeros((256, 256), dtype=bool)
+        exp[50:200, 25:150] = True
+        numpy.testing.assert_array_equal(das.getTile(0, 0, 1) != 0, exp)
+
+    def testExportThinPyramid(self):
         """
         Checks that can both write and read back a thin pyramidal grayscale 16 bit image
         """
@@ -25,11 +25,14 @@ from past.builtins import basestring
 from builtins import range
 
 import calendar
+import collections
+from concurrent import futures
 from datetime import datetime
 import json
 from libtiff import TIFF
 import logging
 import math
+import multiprocessing
 import numpy
 from odemis import model, util
 import odemis
@@ -43,6 +46,7 @@ import sys
 import threading
 import time
 import uuid
+import zlib
 
 import libtiff.libtiff_ctypes as T  # for the constant names
 import xml.etree.ElementTree as ET
@@ -69,6 +73,8 @@ STIFF_SPLIT = ".0."  # pattern to replace with the "stiff" multiple file
 
 CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
 TILE_SIZE = 256 # Tile size of pyramidal images
+# Number of threads used to compress the tiles of pyramidal images
+COMPRESSION_THREADS = multiprocessing.cpu_count()
 LOSSY = False
 
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
@@ -1641,14 +1647,41 @@ def _mergeCorrectionMetadata(da):
     """
     Create a new DataArray with metadata updated to with the correction metadata
     merged.
-    da (DataArray): the original data
-    return (DataArray): new DataArray (view) with the updated metadata
+    da (DataArray or DataArrayShadow): the original data
+    return (DataArray or DataArrayShadow): new DataArray (view) with the updated
+      metadata
     """
     md = da.metadata.copy() # to avoid modifying the original one
     img.mergeMetadata(md)
+    if isinstance(da, DataArrayShadow):
+        return _DataArrayShadowView(da, md)
     return model.DataArray(da, md) # create a view
 
 
+class _DataArrayShadowView(DataArrayShadow):
+    """
+    Same data as another DataArrayShadow, but with different metadata
+    """
+
+    def __init__(self, das, metadata):
+        """
+        das (DataArrayShadow): the original data
+        metadata (dict str->val): the new metadata
+        """
+        if hasattr(das, "maxzoom"):
+            DataArrayShadow.__init__(self, das.shape, numpy.dtype(das.dtype), metadata,
+                                     das.maxzoom, das.tile_shape)
+        else:
+            DataArrayShadow.__init__(self, das.shape, numpy.dtype(das.dtype), metadata)
+        self._das = das
+
+    def getData(self):
+        return model.DataArray(self._das.getData(), self.metadata.copy())
+
+    def getTile(self, x, y, zoom):
+        return model.DataArray(self._das.getTile(x, y, zoom), self.metadata.copy())
+
+
 def _saveAsMultiTiffLT(filename, ldata, thumbnail, compressed=True, multiple_files=False,
                        file_index=None, uuid_list=None, pyramid=False):
     """
@@ -1783,6 +1816,13 @@ def _saveAsMultiTiffLT(filename, ldata, thumbnail, compressed=True, multiple_fil
             f.SetField(T.TIFFTAG_IMAGEDESCRIPTION, ometxt)
             ometxt = None
 
+        # A tiled DataArrayShadow can be written tile by tile, without ever
+        # loading the whole image, only if it's compressed as a pyramid.
+        if (isinstance(data, DataArrayShadow) and
+            not (pyramid and compression is not None and hasattr(data, "tile_shape")
+                 and _canWriteTilesParallel(data) and data.dtype not in [numpy.int64, numpy.uint64])):
+            data = data.getData()
+
         # if metadata indicates YXC format just handle it as RGB
         if data.metadata.get(model.MD_DIMS) == 'YXC' and data.shape[-1] in (3, 4):
             write_rgb = True
@@ -1805,6 +1845,9 @@ def _saveAsMultiTiffLT(filename, ldata, thumbnail, compressed=True, multiple_fil
                     f.SetField(key, val)
                 except Exception:
                     logging.exception("Failed to store tag %s with value '%s'", key, val)
+            if isinstance(data, DataArrayShadow):  # 2D, so i == ()
+                write_image(f, data, compression=compression, pyramid=pyramid)
+                continue
             if data[i].dtype in [numpy.int64, numpy.uint64]:
                 c = None # libtiff doesn't support compression on these types
             else:
@@ -1834,10 +1877,201 @@ def _genResizedShapes(data):
     return resized_shapes
 
 
-def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
+def _halveImage(data, shape):
+    """
+    Reduce the size of an image by 2 in X and Y, by averaging each block of 2x2
+    pixels. The image is processed by bands of TILE_SIZE rows (of the output),
+    so that only a small amount of extra memory is needed.
+    data (DataArray): The original image
+    shape (tuple of int): the shape of the output, which must be the shape of
+      the original image // 2 in X and Y.
+    return (DataArray): the reduced image, with the same metadata as the original
+    """
+    dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim:])
+    yi, xi = dims.index("Y"), dims.index("X")
+    h, w = shape[yi], shape[xi]
+    if data.dtype.kind == "f":
+        acc_type = numpy.float64
+    elif data.dtype.kind == "i":
+        acc_type = numpy.int64
+    else:
+        acc_type = numpy.uint64
+
+    src = numpy.asarray(data)
+    out = numpy.empty(shape, dtype=data.dtype)
+    for yo in range(0, h, TILE_SIZE):
+        ye = min(yo + TILE_SIZE, h)
+        acc = None
+        for dy in (0, 1):
+            for dx in (0, 1):
+                sl = [slice(None)] * data.ndim
+                sl[yi] = slice(2 * yo + dy, 2 * ye, 2)
+                sl[xi] = slice(dx, 2 * w, 2)
+                if acc is None:
+                    acc = src[tuple(sl)].astype(acc_type)
+                else:
+                    acc += src[tuple(sl)]
+
+        osl = [slice(None)] * data.ndim
+        osl[yi] = slice(yo, ye)
+        if data.dtype.kind == "f":
+            out[tuple(osl)] = acc / 4
+        else:
+            out[tuple(osl)] = (acc + 2) // 4  # rounded
+
+    return model.DataArray(out, data.metadata)
+
+
+def _compressTile(tile, predictor):
+    """
+    Compress one tile with the DEFLATE algorithm, the same way as libtiff does.
+    Note: zlib releases the GIL, so it can be run in parallel in threads.
+    tile (numpy.ndarray of shape TILE_SIZE, TILE_SIZE): the data of the tile
+    predictor (boolean): if True, the horizontal differencing predictor is
+      applied before compression (only for integers).
+    return (bytes): the compressed data
     """
+    if predictor:
+        diff = tile.copy()
+        diff[:, 1:] -= tile[:, :-1]  # Wraps around, as expected by the TIFF spec
+        tile = diff
+    # The fastest level gives almost the same size as the default level (6) on
+    # microscopy images, while being ~5x faster
+    return zlib.compress(tile.tobytes(), 1)
+
+
+def _canWriteTilesParallel(arr):
+    """
+    arr (DataArray or DataArrayShadow): image to be written
+    return (boolean): True if the image can be written by _writeTilesParallel()
+    """
+    return arr.ndim == 2 and arr.dtype.kind in "iuf"
+
+
+def _iterBands(arr, height):
+    """
+    Iterates over an image by bands of rows. If the image is a tiled DataArrayShadow,
+    only the tiles needed for the current band are loaded.
+    arr (DataArray or DataArrayShadow): 2D image. If it's a DataArrayShadow, it
+      must support getTile().
+    height (0<int): number of rows of each band
+    yields (int, numpy.ndarray): index of the first row, and the band (the last
+      one can have fewer rows)
+    """
+    h, w = arr.shape
+    if not isinstance(arr, DataArrayShadow):
+        for y in range(0, h, height):
+            yield y, arr[y:y + height]
+        return
+
+    tw, th = arr.tile_shape
+    ntiles_x = int(math.ceil(w / tw))
+    rows = {}  # tile row index -> full width row of tiles
+    for y in range(0, h, height):
+        ye = min(y + height, h)
+        for ty in list(rows.keys()):
+            if ty < y // th:
+                del rows[ty]  # Not needed anymore
+
+        band = []
+        for ty in range(y // th, (ye - 1) // th + 1):
+            if ty not in rows:
+                rows[ty] = numpy.concatenate([arr.getTile(tx, ty, 0) for tx in range(ntiles_x)], axis=1)
+            band.append(rows[ty][max(y, ty * th) - ty * th:min(ye, (ty + 1) * th) - ty * th])
+        yield y, numpy.concatenate(band, axis=0)
+
+
+def _writeTilesParallel(f, arr, reduced=None):
+    """
+    Write a greyscale image as DEFLATE compressed tiles. The compression of the
+    tiles is done in parallel, while they are written in order in the file.
+    f (libtiff file handle): Handle of a TIFF file
+    arr (DataArray or DataArrayShadow): 2D image of int or float. If it's a
+      DataArrayShadow, it is read tile by tile, so the whole image is never in memory.
+    reduced (None or numpy.ndarray): if not None, the image is also reduced by 2
+      (as with _halveImage()) into this array, which must have the corresponding shape.
+    """
+    if arr.dtype.kind == "f":
+        sample_format = T.SAMPLEFORMAT_IEEEFP
+        predictor = False
+    elif arr.dtype.kind == "i":
+        sample_format = T.SAMPLEFORMAT_INT
+        predictor = True
+    else:
+        sample_format = T.SAMPLEFORMAT_UINT
+        predictor = True
+
+    height, width = arr.shape
+    f.SetField(T.TIFFTAG_IMAGEWIDTH, width)
+    f.SetField(T.TIFFTAG_IMAGELENGTH, height)
+    f.SetField(T.TIFFTAG_BITSPERSAMPLE, numpy.dtype(arr.dtype).itemsize * 8)
+    f.SetField(T.TIFFTAG_SAMPLEFORMAT, sample_format)
+    f.SetField(T.TIFFTAG_SAMPLESPERPIXEL, 1)
+    f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK)
+    f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+    f.SetField(T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT)
+    f.SetField(T.TIFFTAG_TILEWIDTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_TILELENGTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_COMPRESSION, T.COMPRESSION_ADOBE_DEFLATE)
+    if predictor:
+        f.SetField(T.TIFFTAG_PREDICTOR, T.PREDICTOR_HORIZONTAL)
+
+    def write_tile(index, future):
+        buf = future.result()
+        r = T.libtiff.TIFFWriteRawTile(f, index, buf, len(buf))
+        if r.value < 0:
+            raise IOError("Failed to write tile %d" % (index,))
+
+    # Tiles are numbered by row, then column
+    ntiles_x = int(math.ceil(width / TILE_SIZE))
+    # Only keep a limited number of tiles in memory, waiting to be written
+    pending = collections.deque()
+    executor = futures.ThreadPoolExecutor(max_workers=COMPRESSION_THREADS)
+    try:
+        for y, band in _iterBands(arr, TILE_SIZE):
+            if reduced is not None:
+                rshape = band.shape[0] // 2, reduced.shape[1]
+                reduced[y // 2:y // 2 + rshape[0]] = _halveImage(model.DataArray(band), rshape)
+
+            for x in range(0, width, TILE_SIZE):
+                # Tiles on the edge are filled with 0
+                tile = numpy.zeros((TILE_SIZE, TILE_SIZE), dtype=arr.dtype)
+                sub = band[:, x:x + TILE_SIZE]
+                tile[:sub.shape[0], :sub.shape[1]] = sub
+                index = (y // TILE_SIZE) * ntiles_x + x // TILE_SIZE
+                pending.append((index, executor.submit(_compressTile, tile, predictor)))
+                if len(pending) > 2 * COMPRESSION_THREADS:
+                    write_tile(*pending.popleft())
+
+        while pending:
+            write_tile(*pending.popleft())
+    finally:
+        executor.shutdown(wait=True)
+
+    f.WriteDirectory()
+
+
+def _writeTiles(f, arr, compression=None, write_rgb=False):
+    """
+    Write an image as tiles of TILE_SIZE x TILE_SIZE
     f (libtiff file handle): Handle of a TIFF file
     arr (DataArray): DataArray to be written to the file
+    compression (None or str): Compression type to be used. If not None,
+      greyscale images are compressed with DEFLATE, in parallel.
+    write_rgb (boolean): True if the image is RGB, False if the image is grayscale
+    """
+    if compression is not None and _canWriteTilesParallel(arr):
+        _writeTilesParallel(f, arr)
+    else:
+        f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+
+
+def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
+    """
+    f (libtiff file handle): Handle of a TIFF file
+    arr (DataArray or DataArrayShadow): DataArray to be written to the file.
+      A DataArrayShadow is only supported for pyramidal, compressed, greyscale
+      images. It is then read tile by tile, without ever holding the whole image.
     compression (boolean): Compression type to be used on the TIFF file
     write_rgb (boolean): True if the image is RGB, False if the image is grayscale
     pyramid (boolean): whether the file should be saved in the pyramid format or not.
@@ -1862,16 +2096,30 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
         f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
 
     # write the original image
-    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+    if isinstance(arr, DataArrayShadow):
+        # The first zoom level is computed while reading the original image,
+        # so that it only has to be read once. The next ones are 4x smaller,
+        # so they are just kept in memory.
+        first_level = numpy.empty(resized_shapes[0], dtype=arr.dtype) if resized_shapes else None
+        _writeTilesParallel(f, arr, first_level)
+    else:
+        first_level = None
+        _writeTiles(f, arr, compression, write_rgb)
     # generate the rescaled images and write the tiled image
+    subim = arr
     for resized_shape in resized_shapes:
-        # rescale the image
-        subim = img.rescale_hq(arr, resized_shape)
+        if first_level is not None:
+            subim = model.DataArray(first_level, arr.metadata)
+            first_level = None
+        else:
+            # Each zoom level is computed from the previous one, which is 4x
+            # smaller than the original image
+            subim = _halveImage(subim, resized_shape)
 
         # Before writting the actual data, we set the special metadata
         f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
         # write the tiled image to the TIFF file
-        f.write_tiles(subim, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+        _writeTiles(f, subim, compression, write_rgb)
 
 
 def export(filename, data, thumbnail=None, compressed=True, multiple_files=False, pyramid=False):
@@ -1884,6 +2132,10 @@ def export(filename, data, thumbnail=None, compressed=True, multiple_files=False
        Time, Z, Y, X. However, all the first dimensions of size 1 can be omitted
        (ex: an array of 111YX can be given just as YX, but RGB images are 311YX,
        so must always be 5 dimensions).
+       It can also be a DataArrayShadow supporting getTile() (or a list of them).
+       When saving a 2D greyscale image as a compressed pyramid, the data is then
+       read tile by tile, so that the whole image is never held in memory.
+       Otherwise, the whole data is read with getData().
     thumbnail (None or numpy.array): Image used as thumbnail
       for the file. Can be of any (reasonable) size. Must be either 2D array
       (greyscale) or 3D with last dimension of length 3 (RGB). If the exporter
@@ -1910,7 +2162,7 @@ def export(filename, data, thumbnail=None, compressed=True, multiple_files=False
             _saveAsMultiTiffLT(filename, data, thumbnail, compressed, pyramid=pyramid)
     else:
         # TODO should probably not enforce it: respect duck typing
-        assert(isinstance(data, model.DataArray))
+        assert(isinstance(data, (model.DataArray, DataArrayShadow)))
         _saveAsMultiTiffLT(filename, [data], thumbnail, compressed, pyramid=pyramid)
 
 
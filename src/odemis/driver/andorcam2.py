@@ -32,6 +32,7 @@ import numpy
 from odemis import model, util, dataio
 from odemis.model import HwError, oneway
 from odemis.util import img
+from odemis.util.driver import BufferPool
 import os
 import random
 import sys
@@ -740,6 +741,8 @@ class AndorCam2(model.DigitalCamera):
         self.acquisition_lock = threading.Lock()
         self.acquire_must_stop = threading.Event()
         self.acquire_thread = None
+        # Memory for the images, recycled once the previous images are not used anymore
+        self._buffer_pool = BufferPool()
 
         # For temporary stopping the acquisition (kludge for the andorshrk
         # SR303i which cannot communicate during acquisition)
@@ -1856,9 +1859,11 @@ class AndorCam2(model.DigitalCamera):
 
     def _allocate_buffer(self, size):
         """
-        returns a cbuffer of the right size for an image
+        returns a cbuffer of the right size for an image. The memory comes from
+        the buffer pool, and goes back to it once the image is not used anymore.
         """
-        cbuffer = (c_uint16 * (size[0] * size[1]))() # empty array
+        ndbuffer = self._buffer_pool.get((size[1], size[0]), numpy.uint16) # numpy shape is H, W
+        cbuffer = (c_uint16 * (size[0] * size[1])).from_buffer(ndbuffer) # keeps a reference to ndbuffer
         return cbuffer
 
     def _buffer_as_array(self, cbuffer, size, metadata=None):
@@ -2068,7 +2073,8 @@ class AndorCam2(model.DigitalCamera):
             self.acquisition_lock.release()
             gc.collect()
             # TODO: close the shutter if it was opened?
-            logging.debug("Acquisition thread closed")
+            logging.debug("Acquisition thread closed (buffer pool: %d hits, %d misses)",
+                          self._buffer_pool.hits, self._buffer_pool.misses)
             self.acquire_must_stop.clear()
 
     def _acquire_thread_synchronized(self, callback):
@@ -2203,7 +2209,8 @@ class AndorCam2(model.DigitalCamera):
             self.atcore.FreeInternalMemory() # TODO not sure it's needed
             self.acquisition_lock.release()
             gc.collect()
-            logging.debug("Acquisition thread closed")
+            logging.debug("Acquisition thread closed (buffer pool: %d hits, %d misses)",
+                          self._buffer_pool.hits, self._buffer_pool.misses)
             self.acquire_must_stop.clear()
 
     def _start_acquisition(self):
@@ -2434,7 +2441,8 @@ class AndorCam2DataFlow(model.DataFlow):
         """
         camera: andorcam instance ready to acquire images
         """
-        model.DataFlow.__init__(self)
+        # The frames are large, and typically sent to another process (the GUI)
+        model.DataFlow.__init__(self, use_shm=True)
         self._sync_event = None # synchronization Event
         self.component = weakref.ref(camera)
         self._prev_max_discard = self._max_discard
@@ -1944,7 +1944,8 @@ class AndorCam3DataFlow(model.DataFlow):
         """
         camera: andorcam instance ready to acquire images
         """
-        model.DataFlow.__init__(self)
+        # The frames are large, and typically sent to another process (the GUI)
+        model.DataFlow.__init__(self, use_shm=True)
         self.component = weakref.ref(camera)
         self._sync_event = None # synchronization Event
         self._prev_max_discard = self._max_discard
@@ -352,7 +352,8 @@ class Camera(model.DigitalCamera):
 
 class SimpleDataFlow(model.DataFlow):
     def __init__(self, ccd):
-        super(SimpleDataFlow, self).__init__()
+        # Same as a real camera: large frames, passed via shared memory
+        super(SimpleDataFlow, self).__init__(use_shm=True)
         self._ccd = ccd
         self._sync_event = None
         self._evtq = None  # a Queue to store received events (= float, time of the event)
@@ -39,6 +39,61 @@ import time
 import weakref
 
 
+def _get_sampling_indices(start, step, n):
+    """
+    Computes the pixels of the fake image sampled along one axis
+    start (0 <= float): position of the first pixel
+    step (0 < float): distance between two pixels
+    n (0 < int): number of pixels
+    return (ndarray of int): index of each pixel
+    """
+    return numpy.round(start + numpy.arange(n) * step).astype(numpy.intp)
+
+
+def _indices_to_slice(idx):
+    """
+    idx (ndarray of int): increasing indices
+    return (slice or None): the slice corresponding to the indices, or None if
+      they are not regularly spaced.
+    """
+    if len(idx) == 1:
+        return slice(idx[0], idx[0] + 1)
+    steps = numpy.diff(idx)
+    if steps[0] > 0 and (steps == steps[0]).all():
+        return slice(idx[0], idx[-1] + 1, steps[0])
+    return None
+
+
+# (sigma, truncate) -> weights, as returned by _get_gaussian_kernel()
+_gaussian_kernels = {}
+# Maximum number of kernels kept (typically, the blur doesn't change often)
+GAUSSIAN_KERNELS_CACHE_SIZE = 16
+
+
+def _get_gaussian_kernel(sigma, truncate=4.0):
+    """
+    Computes the 1D gaussian kernel, as used by ndimage.gaussian_filter()
+    sigma (0 < float): standard deviation of the gaussian
+    truncate (0 < float): number of standard deviations of the kernel
+    return (ndarray of float, read-only): the weights
+    """
+    try:
+        return _gaussian_kernels[(sigma, truncate)]
+    except KeyError:
+        pass
+
+    radius = int(truncate * sigma + 0.5)
+    x = numpy.arange(-radius, radius + 1)
+    weights = numpy.exp(-0.5 / (sigma * sigma) * x ** 2)
+    weights /= weights.sum()
+    weights.flags.writeable = False
+
+    if len(_gaussian_kernels) >= GAUSSIAN_KERNELS_CACHE_SIZE:
+        _gaussian_kernels.clear()
+    _gaussian_kernels[(sigma, truncate)] = weights
+    return weights
+
+
 class SimSEM(model.HwComponent):
     '''
     This is an extension of the model.HwComponent class. It first reads and
@@ -328,13 +383,17 @@ class Detector(model.Detector):
     of the fake SEM. It sets up a Dataflow and notifies it every time that a fake
     SEM image is generated. It also keeps and updates a “drift vector”
     """
-    def __init__(self, name, role, parent, **kwargs):
+    def __init__(self, name, role, parent, noise=False, **kwargs):
         """
         Note: parent should have a child "scanner" already initialised
+        noise (bool): if True, Poisson (shot) noise is added to each image
         """
         # It will set up ._shape and .parent
         model.Detector.__init__(self, name, role, parent=parent, **kwargs)
         self.data = SEMDataFlow(self, parent)
+        # Same data as .data, but each line is sent as soon as it is "scanned"
+        self.lines = SEMLineDataFlow(self)
+        self._noise = noise
         self._acquisition_thread = None
         self._acquisition_lock = threading.Lock()
         self._acquisition_init_lock = threading.Lock()
@@ -375,7 +434,7 @@ class Detector(model.Detector):
 
     def terminate(self):
         self._update_drift_timer.cancel()
-        self.stop_acquire()
+        self.stop_acquire(force=True)
 
     @isasync
     def applyAutoContrast(self):
@@ -387,17 +446,28 @@ class Detector(model.Detector):
         self.brightness.value = 0.5
         return model.InstantaneousFuture()
 
-    def start_acquire(self, callback):
+    def start_acquire(self):
+        """
+        Start the acquisition, if it's not already running (for the other dataflow)
+        """
         with self._acquisition_lock:
+            if (self._acquisition_thread and self._acquisition_thread.is_alive()
+                and not self._acquisition_must_stop.is_set()):
+                return
             self._wait_acquisition_stopped()
             target = self._acquire_thread
             self._acquisition_thread = threading.Thread(target=target,
-                    name="SimSEM acquire flow thread",
-                    args=(callback,))
+                    name="SimSEM acquire flow thread")
             self._acquisition_thread.start()
 
-    def stop_acquire(self):
+    def stop_acquire(self, force=False):
+        """
+        Stop the acquisition, unless one of the dataflows still has subscribers
+        force (bool): if True, stop even if there are still subscribers
+        """
         with self._acquisition_lock:
+            if not force and (self.data._count_listeners() or self.lines._count_listeners()):
+                return
             with self._acquisition_init_lock:
                 self._acquisition_must_stop.set()
 
@@ -438,6 +508,8 @@ class Detector(model.Detector):
         metadata.update(scanner._metadata)
         metadata.update(self._metadata)
 
+        # Only read the settings while holding the lock, the image itself can
+        # be computed afterwards, without blocking the stop of the acquisition.
         with self._acquisition_init_lock:
             logging.debug("Simulating an image")
             pxs = scanner.pixelSize.value  # m/px
@@ -446,72 +518,119 @@ class Detector(model.Detector):
             scale = scanner.scale.value
             res = scanner.resolution.value
             shi = scanner.shift.value
-
-            phy_pos = metadata.get(model.MD_POS, (0, 0))
-            trans = scanner.pixelToPhy(pxs_pos)
-            updated_phy_pos = (phy_pos[0] + trans[0], phy_pos[1] + trans[1])
-
-            shape = self.fake_img.shape
-            # Simulate shift and drift
-            center = (shape[1] / 2 - shi[0] / pxs[0] - self.current_drift,
-                      shape[0] / 2 - shi[1] / pxs[1] + self.current_drift)
-
-            lt = (center[0] + pxs_pos[0] - (res[0] / 2) * scale[0],
-                  center[1] + pxs_pos[1] - (res[1] / 2) * scale[1])
-            assert(lt[0] >= 0 and lt[1] >= 0)
-            # compute each row and column that will be included
-            coord = ([int(round(lt[0] + i * scale[0])) for i in range(res[0])],
-                     [int(round(lt[1] + i * scale[1])) for i in range(res[1])])
-            sim_img = self.fake_img[numpy.ix_(coord[1], coord[0])] # copy
-
-            # reduce image depth if requested
+            drift = self.current_drift
             bpp = self.bpp.value
-            if bpp < 16:
-                mind, maxd = sim_img.min(), sim_img.max()
-                maxf = 2 ** bpp - 1
-                b = maxf / max(1, (maxd - mind))
-                # Multiply by a float and drop to the original dtype
-                numpy.multiply(sim_img - mind, b, out=sim_img, casting="unsafe")
-                if bpp <= 8:
-                    sim_img = sim_img.astype(numpy.uint8)
-
-            metadata[model.MD_BPP] = bpp
 
             if self.parent._focus:
-                # apply the defocus
                 pos = self.parent._focus.position.value['z']
                 dist = abs(pos - self.parent._focus._good_focus) * 1e4
-                sim_img = ndimage.gaussian_filter(sim_img, sigma=dist)
+            else:
+                dist = 0
 
-            # update fake output metadata
-            metadata[model.MD_POS] = updated_phy_pos
-            metadata[model.MD_PIXEL_SIZE] = (pxs[0] * scale[0], pxs[1] * scale[1])
-            metadata[model.MD_ACQ_DATE] = time.time()
             metadata[model.MD_ROTATION] = scanner.rotation.value
             metadata[model.MD_DWELL_TIME] = scanner.dwellTime.value
             metadata[model.MD_EBEAM_CURRENT] = scanner.probeCurrent.value
             metadata[model.MD_EBEAM_VOLTAGE] = scanner.accelVoltage.value
-            return model.DataArray(sim_img, metadata)
 
-    def _acquire_thread(self, callback):
+        phy_pos = metadata.get(model.MD_POS, (0, 0))
+        trans = scanner.pixelToPhy(pxs_pos)
+        updated_phy_pos = (phy_pos[0] + trans[0], phy_pos[1] + trans[1])
+
+        shape = self.fake_img.shape
+        # Simulate shift and drift
+        center = (shape[1] / 2 - shi[0] / pxs[0] - drift,
+                  shape[0] / 2 - shi[1] / pxs[1] + drift)
+
+        lt = (center[0] + pxs_pos[0] - (res[0] / 2) * scale[0],
+              center[1] + pxs_pos[1] - (res[1] / 2) * scale[1])
+        assert(lt[0] >= 0 and lt[1] >= 0)
+        # compute each row and column that will be included
+        cols = _get_sampling_indices(lt[0], scale[0], res[0])
+        rows = _get_sampling_indices(lt[1], scale[1], res[1])
+        rsl, csl = _indices_to_slice(rows), _indices_to_slice(cols)
+        if rsl is not None and csl is not None:
+            # Regular sampling (ie, integer scale) => strided view
+            sim_img = self.fake_img[rsl, csl].copy()
+        else:
+            sim_img = self.fake_img[numpy.ix_(rows, cols)]  # copy
+
+        # reduce image depth if requested
+        if bpp < 16:
+            mind, maxd = sim_img.min(), sim_img.max()
+            maxf = 2 ** bpp - 1
+            b = maxf / max(1, (maxd - mind))
+            # Multiply by a float and drop to the original dtype
+            numpy.multiply(sim_img - mind, b, out=sim_img, casting="unsafe")
+            if bpp <= 8:
+                sim_img = sim_img.astype(numpy.uint8)
+
+        metadata[model.MD_BPP] = bpp
+
+        if dist > 0:
+            # apply the defocus (same as ndimage.gaussian_filter(), but the
+            # kernel is only computed once per focus position)
+            weights = _get_gaussian_kernel(dist)
+            for axis in range(sim_img.ndim):
+                ndimage.correlate1d(sim_img, weights, axis, output=sim_img, mode="reflect")
+
+        if self._noise:
+            # Shot noise: each pixel value is taken as the mean number of counts
+            noisy = numpy.random.poisson(sim_img)
+            numpy.clip(noisy, 0, numpy.iinfo(sim_img.dtype).max, out=noisy)
+            sim_img[...] = noisy
+
+        # update fake output metadata
+        metadata[model.MD_POS] = updated_phy_pos
+        metadata[model.MD_PIXEL_SIZE] = (pxs[0] * scale[0], pxs[1] * scale[1])
+        metadata[model.MD_ACQ_DATE] = time.time()
+        return model.DataArray(sim_img, metadata)
+
+    def _get_line(self, da, i):
+        """
+        Extract one line of an image, with the corresponding metadata
+        da (DataArray of shape YX): the complete image
+        i (0 <= int < Y): the index of the line
+        return (DataArray of shape 1X): the line, as a view of the image
+        """
+        md = da.metadata.copy()
+        pos = md[model.MD_POS]
+        pxs = md[model.MD_PIXEL_SIZE]
+        # Y goes "up" in the physical coordinates, while the lines go "down"
+        md[model.MD_POS] = (pos[0], pos[1] + ((da.shape[0] - 1) / 2 - i) * pxs[1])
+        md[model.MD_ACQ_DATE] = time.time()
+        return model.DataArray(da[i:i + 1], md)
+
+    def _acquire_thread(self):
         """
         Thread that simulates the SEM acquisition. It calculates and updates the
         center (e-beam) position based on the translation, imitates the delay according
         to the dwell time and resolution and provides the new generated output to
-        the Dataflow.
+        the Dataflows.
         """
         try:
             while not self._acquisition_must_stop.is_set():
                 dwelltime = self.parent._scanner.dwellTime.value
                 resolution = self.parent._scanner.resolution.value
-                duration = numpy.prod(resolution) * dwelltime
-                if self._acquisition_must_stop.wait(duration):
-                    break
-                # TODO: it's not a very proper simulation for multiple detectors,
-                # as in Odemis the convention for SEM is that the ebeam waits
-                # for _all_ the detectors to be ready before scanning.
-                self.data._waitSync()
-                callback(self._simulate_image())
+                if not self.lines._count_listeners():
+                    duration = numpy.prod(resolution) * dwelltime
+                    if self._acquisition_must_stop.wait(duration):
+                        break
+                    # TODO: it's not a very proper simulation for multiple detectors,
+                    # as in Odemis the convention for SEM is that the ebeam waits
+                    # for _all_ the detectors to be ready before scanning.
+                    self.data._waitSync()
+                    self.data.notify(self._simulate_image())
+                else:
+                    # The image is computed at once, but delivered line by line,
+                    # at the pace of the scan.
+                    self.data._waitSync()
+                    da = self._simulate_image()
+                    line_duration = resolution[0] * dwelltime
+                    for i in range(da.shape[0]):
+                        if self._acquisition_must_stop.wait(line_duration):
+                            return
+                        self.lines.notify(self._get_line(da, i))
+                    self.data.notify(da)
         except Exception:
             logging.exception("Unexpected failure during image acquisition")
         finally:
@@ -539,7 +658,7 @@ class SEMDataFlow(model.DataFlow):
     # start/stop_generate are _never_ called simultaneously (thread-safe)
     def start_generate(self):
         try:
-            self.component().start_acquire(self.notify)
+            self.component().start_acquire()
         except ReferenceError:
             # sem/component has been deleted, it's all fine, we'll be GC'd soon
             pass
@@ -597,6 +716,33 @@ class SEMDataFlow(model.DataFlow):
         if self._sync_event:
             self._evtq.get()
 
+
+class SEMLineDataFlow(model.DataFlow):
+    """
+    Dataflow sending each line of the SEM image as soon as it is scanned (ie,
+    as a DataArray of shape 1xX). The scan is synchronised with the .data of
+    the detector.
+    """
+    def __init__(self, detector):
+        """
+        detector (Detector): the detector that the dataflow corresponds to
+        """
+        model.DataFlow.__init__(self)
+        self.component = weakref.ref(detector)
+
+    def start_generate(self):
+        try:
+            self.component().start_acquire()
+        except ReferenceError:
+            pass
+
+    def stop_generate(self):
+        try:
+            self.component().stop_acquire()
+        except ReferenceError:
+            pass
+
+
 class EbeamFocus(model.Actuator):
     """
     Simulated focus component.
@@ -527,14 +527,14 @@ class BasicDataFlow(model.DataFlow):
     def stop_generate(self):
         self._stop()
 
-    def subscribe(self, listener):
+    def subscribe(self, listener, discard=None):
         # override subscribe. Only allow a subscriber to be added if no exception is raised on
         # self._check()
         with self._lock:
             count_before = self._count_listeners()
             if count_before == 0:
                 self._check()
-            super(BasicDataFlow, self).subscribe(listener)
+            super(BasicDataFlow, self).subscribe(listener, discard)
 
 
 class SPTError(HwError):
@@ -23,9 +23,13 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 from __future__ import division
 
+import gc
 import logging
+import numpy
 from odemis.driver import andorcam2
 import os
+import threading
+import time
 import unittest
 from unittest.case import skip
 
@@ -94,6 +98,69 @@ class TestSynchronized(VirtualTestSynchronized, unittest.TestCase):
     camera_kwargs = KWARGS
 
 
+class TestBufferPool(unittest.TestCase):
+    """
+    Check the memory of the images is recycled, using the fake camera
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.camera = CLASS_SIM(**KWARGS_SIM)
+        cls.camera.exposureTime.value = 0.01  # s
+        cls.camera.resolution.value = (256, 256)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.camera.terminate()
+
+    def _acquire(self, n, listener):
+        """
+        Acquire n images, passing them to the listener
+        """
+        received = threading.Event()
+        images = []
+
+        def on_image(df, data):
+            listener(data)
+            images.append(data.shape)
+            if len(images) >= n:
+                received.set()
+
+        self.camera.data.subscribe(on_image)
+        try:
+            self.assertTrue(received.wait(30))
+        finally:
+            self.camera.data.unsubscribe(on_image)
+        time.sleep(0.1)  # Wait for the acquisition thread to be over
+
+    def test_recycle(self):
+        """
+        Images which are not used anymore give back their memory
+        """
+        pool = self.camera._buffer_pool
+        hits, misses = pool.hits, pool.misses
+        self._acquire(10, lambda d: None)
+        logging.info("Buffer pool: %d hits, %d misses", pool.hits - hits, pool.misses - misses)
+        self.assertGreater(pool.hits - hits, 0)
+        self.assertLessEqual(pool.misses - misses, 3)
+
+    def test_kept_images(self):
+        """
+        The memory of images still in use is never reused
+        """
+        kept = []
+        self._acquire(10, lambda d: kept.append((d, d.copy())))
+        self.assertEqual(len(set(d.ctypes.data for d, c in kept)), len(kept))
+        for d, c in kept:
+            numpy.testing.assert_array_equal(d, c)
+
+        # Once they are not used anymore, they are recycled
+        pool = self.camera._buffer_pool
+        del kept[:]
+        gc.collect()
+        self.assertGreater(len(pool), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
 
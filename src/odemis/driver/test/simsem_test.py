@@ -23,6 +23,7 @@ from __future__ import division
 import Pyro4
 import copy
 import logging
+import numpy
 from odemis import model
 from odemis.driver import simsem
 import os
@@ -404,6 +405,39 @@ class TestSEM(unittest.TestCase):
         # if it has acquired a least 5 pictures we are already happy
         self.assertLessEqual(self.left, 10000)
 
+    def test_acquire_lines(self):
+        """
+        Check the lines are received one at a time, and match the full image
+        """
+        self.scanner.dwellTime.value = 10e-6
+        lines = []
+        frames = []
+
+        def receive_line(df, line):
+            lines.append(line)
+
+        def receive_frame(df, im):
+            frames.append(im)
+            df.unsubscribe(receive_frame)
+            self.sed.lines.unsubscribe(receive_line)
+            self.acq_done.set()
+
+        # Subscribe first to the lines, so that the first scan already sends them
+        self.sed.lines.subscribe(receive_line)
+        self.sed.data.subscribe(receive_frame)
+        self.acq_done.wait(10)
+
+        self.assertEqual(len(frames), 1)
+        im = frames[0]
+        self.assertEqual(len(lines), im.shape[0])
+        self.assertEqual(lines[0].shape, (1, im.shape[1]))
+        numpy.testing.assert_array_equal(numpy.concatenate(lines), im)
+        # Lines go down the image, so the physical position goes down too
+        self.assertGreater(lines[0].metadata[model.MD_POS][1],
+                           lines[-1].metadata[model.MD_POS][1])
+        self.assertLessEqual(lines[0].metadata[model.MD_ACQ_DATE],
+                             lines[-1].metadata[model.MD_ACQ_DATE])
+
     def receive_image(self, dataflow, image):
         """
         callback for df of test_acquire_flow()
@@ -437,5 +471,35 @@ class TestSEM(unittest.TestCase):
         f.result()
         self.assertEqual(self.focus.position.value, pos)
 
+class TestSEMNoise(unittest.TestCase):
+    """
+    Tests the simulation of the shot noise
+    """
+    @classmethod
+    def setUpClass(cls):
+        config = copy.deepcopy(CONFIG_SEM)
+        config["children"]["detector0"]["noise"] = True
+        cls.sem = simsem.SimSEM(**config)
+
+        for child in cls.sem.children.value:
+            if child.name == CONFIG_SED["name"]:
+                cls.sed = child
+            elif child.name == CONFIG_SCANNER["name"]:
+                cls.scanner = child
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sem.terminate()
+
+    def test_noise(self):
+        self.scanner.resolution.value = (256, 256)
+        im1 = self.sed.data.get()
+        im2 = self.sed.data.get()
+
+        # Each acquisition has a different noise, but the same average signal
+        self.assertFalse(numpy.array_equal(im1, im2))
+        self.assertAlmostEqual(im1.mean(), im2.mean(), delta=im1.mean() * 0.05)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -27,7 +27,10 @@ from past.builtins import basestring
 import Pyro4
 from Pyro4.core import isasync
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
 import logging
+import functools
 import math
 import odemis
 from future.moves.urllib.parse import quote
@@ -98,6 +101,77 @@ def getEvents(component):
     return dict(evts)
 
 
+def _exchangeVAs(component, values):
+    """
+    Set the value of several VAs of a component, in order. If one VA fails,
+    the VAs already set are put back to their previous value, in the same order.
+    component (object): the object with the VAs (which is not a proxy)
+    values (dict str -> value, or list of (str, value)): name of the VA -> new value
+    return (OrderedDict str -> value, OrderedDict str -> value): the previous
+      values, and the actual values once all the VAs are set.
+    raise AttributeError: if a VA doesn't exist (and then no VA is changed)
+    raise Exception: the error of the VA which failed
+    """
+    if isinstance(values, dict):
+        values = list(values.items())
+
+    # Check all the VAs exist before changing anything
+    vas = []
+    for name, v in values:
+        va = getattr(component, name, None)
+        if not isinstance(va, _vattributes.VigilantAttributeBase):
+            raise AttributeError("%s has no VA %s" % (component, name))
+        vas.append((name, va, v))
+
+    # Read all the values before changing anything, as setting a VA can change
+    # the others (eg, the scale of a scanner changes its resolution)
+    previous = OrderedDict()
+    for name, va, v in vas:
+        previous.setdefault(name, va.value)
+
+    try:
+        for name, va, v in vas:
+            va.value = v
+    except Exception:
+        logging.info("Failed to set VA %s to %s, will put back the previous values", name, v)
+        # Put back in the same order, as the VAs may depend on the previous ones
+        for pname, prev in previous.items():
+            try:
+                va = getattr(component, pname)
+                if va.value != prev:
+                    va.value = prev
+            except Exception:
+                logging.warning("Failed to put back VA %s to %s", pname, prev)
+        raise
+
+    # Read after setting all of them, as setting a VA can change the others
+    actual = OrderedDict((name, va.value) for name, va, v in vas)
+    return previous, actual
+
+
+@contextmanager
+def temporaryVAs(component, values):
+    """
+    Context manager to change temporarily the value of VAs of a component.
+    On entry, the VAs are set in the order given, and on exit, they are set
+    back, in the same order, to the value they had before. With a remote
+    component, each of these steps is a single remote call.
+    component (Component or any object with VAs)
+    values (dict str -> value, or list of (str, value)): name of the VA -> new value
+    yield (OrderedDict str -> value): the actual value of the VAs
+    """
+    if isinstance(component, ComponentBase):
+        exchange = component.exchangeVAs
+    else:  # Not a component, but could still have VAs => do it ourselves
+        exchange = functools.partial(_exchangeVAs, component)
+
+    previous, actual = exchange(values)
+    try:
+        yield actual
+    finally:
+        exchange(list(previous.items()))
+
+
 class ComponentBase(with_metaclass(ABCMeta, object)):
     """Abstract class for a component"""
 
@@ -178,6 +252,27 @@ class Component(ComponentBase):
     def name(self):
         return self._name
 
+    def updateVAs(self, values):
+        """
+        Set the value of several VAs at once. Via a proxy, it's a single remote
+        call. If a VA fails, the VAs already set are put back to their previous
+        value, and the exception is raised.
+        values (dict str -> value, or list of (str, value)): name of the VA ->
+          new value. The VAs are set in the order given.
+        return (OrderedDict str -> value): the actual value of the VAs, read
+          after all of them have been set.
+        """
+        return _exchangeVAs(self, values)[1]
+
+    def exchangeVAs(self, values):
+        """
+        Same as updateVAs(), but also returns the value of the VAs before they
+        were changed, typically to put them back later.
+        return (OrderedDict str -> value, OrderedDict str -> value): the previous
+          values, and the actual values.
+        """
+        return _exchangeVAs(self, values)
+
     def terminate(self):
         """
         Stop the Component from executing.
@@ -28,9 +28,12 @@ import collections
 import logging
 import multiprocessing
 import os
+import socket
 import threading
 from future.moves.urllib.parse import quote
 from odemis.util import inspect_getmembers
+from odemis.util.weak import WeakMethod, WeakRefLostError
+import zmq
 
 
 # Pyro4.config.COMMTIMEOUT = 30.0 # a bit of timeout
@@ -100,28 +103,124 @@ def getComponent(name=None, role=None):
     if name is None and role is None:
         raise ValueError("Need to specify at least a name or a role")
 
-    for c in getComponents():
-        if name is not None and c.name != name:
-            continue
-        if role is not None and c.role != role:
-            continue
-        return c
-    else:
+    c = _getRegistry().lookup(name, role)
+    if c is None:
         errors = []
         if name is not None:
             errors.append("name %s" % name)
         if role is not None:
             errors.append("role %s" % role)
         raise LookupError("No component with the %s" % (" and ".join(errors),))
+    return c
 
 
 def getComponents():
     """
     return (set of Component): all the HwComponents (alive) managed by the backend
     """
+    return _getRegistry().components
+    # return _getChildren(getMicroscope())
+
+
+class ComponentRegistry(object):
+    """
+    Keeps track of all the components alive in the backend, indexed by name
+    and role. It listens to the .alive VA of the microscope, so looking up a
+    component doesn't require any remote call, and the same proxy is returned
+    for a given component every time.
+    """
+
+    def __init__(self, microscope):
+        """
+        microscope (Microscope): the root component, which has the .alive VA
+        """
+        self.microscope = microscope
+        self._lock = threading.Lock()
+        # The (immutable) indexes are always replaced at once, so that the
+        # readers don't need the lock.
+        self._comps = frozenset({microscope})
+        self._by_name = {microscope.name: microscope}
+        self._by_role = {microscope.role: microscope}
+        microscope.alive.subscribe(self._onAlive, init=True)
+
+    def _onAlive(self, alive):
+        with self._lock:
+            # Reuse the proxies already known, as the new ones would need to be
+            # initialised again (eg, to subscribe to their VAs)
+            comps = {self.microscope}
+            for c in alive:
+                prev = self._by_name.get(c.name)
+                comps.add(prev if prev == c else c)
+
+            by_name = {}
+            by_role = {}
+            for c in comps:
+                by_name[c.name] = c
+                if c.role is not None:
+                    by_role.setdefault(c.role, c)
+
+            self._comps, self._by_name, self._by_role = frozenset(comps), by_name, by_role
+        logging.debug("Component registry updated to %d components", len(comps))
+
+    @property
+    def components(self):
+        """
+        (set of Component): all the components alive, including the microscope
+        """
+        return set(self._comps)
+
+    def lookup(self, name=None, role=None):
+        """
+        Find a component by name and/or role
+        return (Component or None): the component matching, or None if not found
+        """
+        if name is not None:
+            c = self._by_name.get(name)
+            if c is not None and role is not None and c.role != role:
+                return None
+        else:
+            c = self._by_role.get(role)
+        return c
+
+    def close(self):
+        """
+        Stop following the changes of the components alive
+        """
+        try:
+            self.microscope.alive.unsubscribe(self._onAlive)
+        except Exception:
+            # The backend might be gone already
+            logging.debug("Failed to unsubscribe from the microscope", exc_info=True)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def _getRegistry():
+    """
+    return (ComponentRegistry): the registry of the current microscope. It's
+      created the first time, and again whenever the microscope changes (ie,
+      _microscope is reset).
+    """
+    global _registry
     microscope = getMicroscope()
-    return microscope.alive.value | {microscope}
-    # return _getChildren(microscope)
+    registry = _registry
+    if registry is not None and registry.microscope is microscope:
+        return registry
+
+    # Created without holding the lock, as subscribing requires the
+    # subscription poller, which might be calling us.
+    registry = ComponentRegistry(microscope)
+    with _registry_lock:
+        if _registry is not None and _registry.microscope is microscope:
+            # Another thread was faster => use the one already available
+            registry, old = _registry, registry
+        else:
+            old, _registry = _registry, registry
+    if old is not None:
+        old.close()
+    return registry
 
 
 def _getChildren(root):
@@ -220,7 +319,7 @@ def load_roattributes(self, roattributes):
 
 if os.name != 'nt':
     import resource
-    FILES_PER_VA = 6
+    FILES_PER_VA = 2  # the 0MQ socket, and its connection
 
     def prepare_to_listen_to_more_vas(inc):
         """
@@ -245,6 +344,271 @@ else:
     def prepare_to_listen_to_more_vas(inc):
         pass
 
+class Subscription(object):
+    """
+    A subscription to the 0MQ messages of a remote VA or DataFlow, handled by
+    the SubscriptionPoller. Only the poller thread accesses the socket.
+    """
+    def __init__(self, uri, notifier, max_discard=0, rcvhwm=None):
+        """
+        uri (str): name of the ipc connection (without "ipc://")
+        notifier (callable): method to call with every message received, as a
+          list of zmq.Frame. It's called from a separate thread (but never
+          simultaneously for the same subscription), in the order the messages
+          were received.
+        max_discard (int): amount of messages that can be discarded in a row if
+          a new one is already available. 0 to notify all the messages.
+        rcvhwm (None or int): high water mark of the socket, None for the default
+        """
+        self.uri = uri
+        # don't keep strong reference to notifier so that it can be garbage
+        # collected normally and it will let us know then that we can stop
+        self.w_notifier = WeakMethod(notifier)
+        self.max_discard = max_discard
+        self.rcvhwm = rcvhwm
+        self.socket = None  # only accessed by the poller thread
+        # The following attributes are protected by the lock of the SubscriptionNotifier
+        self.messages = collections.deque()  # messages received, not yet notified
+        self.scheduled = False  # True if a thread is (or will be) notifying the messages
+        self.discarded = 0
+
+
+class SubscriptionNotifier(object):
+    """
+    Calls the notifiers of the subscriptions with the messages received by the
+    SubscriptionPoller, so that the poller is never blocked by a slow notifier.
+    The messages of a subscription are notified in order, by one thread at a
+    time. The threads are reused, and a new one is started whenever all are
+    busy, so that a notifier can even wait for a message of another subscription.
+    """
+    IDLE_TIMEOUT = 10  # s, after which a thread without anything to notify ends
+
+    def __init__(self, poller):
+        """
+        poller (SubscriptionPoller): the poller receiving the messages
+        """
+        self._poller = poller
+        self._cond = threading.Condition(threading.Lock())
+        self._ready = collections.deque()  # Subscriptions scheduled, but not yet handled by a thread
+        self._idle = 0  # number of threads waiting for a subscription to handle
+
+    def queue(self, sub, msg):
+        """
+        Schedule the notification of a message
+        sub (Subscription): the subscription which received the message
+        msg (list of zmq.Frame): the message
+        """
+        with self._cond:
+            # Replace the previous message if it's not yet notified
+            if sub.messages and sub.discarded < sub.max_discard:
+                sub.messages.popleft()
+                sub.discarded += 1
+            sub.messages.append(msg)
+            if sub.scheduled:
+                return  # The thread handling the subscription will notify it
+            sub.scheduled = True
+            self._ready.append(sub)
+            if len(self._ready) <= self._idle:
+                self._cond.notify()
+                return
+
+        t = threading.Thread(target=self._run, name="zmq subscriptions notifier")
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        # Warning: this might run even when ending (aka "in a __del__() state")
+        # Which means: logging might be None.
+        try:
+            while True:
+                with self._cond:
+                    while not self._ready:
+                        self._idle += 1
+                        try:
+                            self._cond.wait(self.IDLE_TIMEOUT)
+                        finally:
+                            self._idle -= 1
+                        if not self._ready:
+                            return  # Nothing to do for a while (or spurious wake up)
+                    sub = self._ready.popleft()
+                self._notify_messages(sub)
+        except Exception:
+            if logging:
+                logging.exception("Ending subscriptions notifier due to exception")
+
+    def _notify_messages(self, sub):
+        """
+        Notify all the messages of the subscription, until none is left
+        """
+        while True:
+            with self._cond:
+                if not sub.messages:
+                    sub.scheduled = False
+                    return
+                msg = sub.messages.popleft()
+                sub.discarded = 0
+
+            try:
+                sub.w_notifier(msg)
+            except WeakRefLostError:
+                # The receiver is gone => nothing left to do with this subscription
+                with self._cond:
+                    sub.messages.clear()
+                    sub.scheduled = False
+                self._poller.close(sub)
+                return
+            except Exception:
+                logging.exception("Exception when notifying a message from %s", sub.uri)
+
+
+class SubscriptionPoller(threading.Thread):
+    """
+    Receives the messages of all the remote VAs and DataFlows subscribed in
+    the process, with a single thread and a single 0MQ context.
+    The messages of each subscription are notified in order, via the
+    SubscriptionNotifier.
+    Use get_subscription_poller() to get the one of the current process.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="zmq subscriptions poller")
+        self.daemon = True
+        self._ctx = zmq.Context(1)
+        # The commands are queued, and the thread is woken up via the socket pair
+        self._cmd_lock = threading.Lock()
+        self._commands = collections.deque()  # (str, Subscription, Event or None)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._poller = zmq.Poller()
+        self._poller.register(self._wakeup_r, zmq.POLLIN)
+        self._sockets = {}  # zmq.Socket -> Subscription
+        self._notifier = SubscriptionNotifier(self)
+
+    def _send_command(self, cmd, sub, wait):
+        """
+        cmd (str): "SUB", "UNSUB" or "CLOSE"
+        sub (Subscription)
+        wait (bool): if True, wait until the command has been processed
+        """
+        done = threading.Event() if wait else None
+        with self._cmd_lock:
+            self._commands.append((cmd, sub, done))
+        self._wakeup_w.send(b"\x00")
+        if done:
+            done.wait()
+
+    def subscribe(self, sub):
+        """
+        Start receiving the messages of the subscription. It returns once the
+        0MQ subscription is active.
+        sub (Subscription)
+        """
+        self._send_command("SUB", sub, wait=True)
+
+    def unsubscribe(self, sub):
+        """
+        Stop receiving the messages of the subscription (asynchronous)
+        sub (Subscription)
+        """
+        self._send_command("UNSUB", sub, wait=False)
+
+    def close(self, sub):
+        """
+        Stop receiving the messages of the subscription and release its
+        resources (asynchronous)
+        sub (Subscription)
+        """
+        self._send_command("CLOSE", sub, wait=False)
+
+    def _run_command(self, cmd, sub):
+        if cmd == "SUB":
+            if sub.socket is None:
+                sub.socket = self._ctx.socket(zmq.SUB)
+                if sub.rcvhwm is not None:
+                    sub.socket.rcvhwm = sub.rcvhwm
+                sub.socket.connect("ipc://" + sub.uri)
+                self._sockets[sub.socket] = sub
+                self._poller.register(sub.socket, zmq.POLLIN)
+            sub.socket.setsockopt(zmq.SUBSCRIBE, b'')
+            logging.debug("Subscribed to %s", sub.uri)
+        elif cmd == "UNSUB":
+            if sub.socket is not None:
+                sub.socket.setsockopt(zmq.UNSUBSCRIBE, b'')
+                logging.debug("Unsubscribed from %s", sub.uri)
+        elif cmd == "CLOSE":
+            self._close_socket(sub)
+        else:
+            logging.warning("Received unknown command %s", cmd)
+
+    def _close_socket(self, sub):
+        if sub.socket is None:
+            return
+        self._poller.unregister(sub.socket)
+        del self._sockets[sub.socket]
+        sub.socket.close(linger=0)
+        sub.socket = None
+
+    def _process_commands(self):
+        try:
+            self._wakeup_r.recv(4096)
+        except socket.error:
+            pass  # Already read
+        while True:
+            with self._cmd_lock:
+                if not self._commands:
+                    return
+                cmd, sub, done = self._commands.popleft()
+            try:
+                self._run_command(cmd, sub)
+            except Exception:
+                logging.exception("Failed to run command %s on %s", cmd, sub.uri)
+            finally:
+                if done:
+                    done.set()
+
+    def _receive(self, sub):
+        """
+        Receive one message from the subscription, and schedule its notification
+        """
+        msg = sub.socket.recv_multipart(copy=False)
+        self._notifier.queue(sub, msg)
+
+    def run(self):
+        # Warning: this might run even when ending (aka "in a __del__() state")
+        # Which means: logging might be None.
+        try:
+            while True:
+                socks = dict(self._poller.poll())
+                for s in socks:
+                    if s is self._wakeup_r or s == self._wakeup_r.fileno():
+                        self._process_commands()
+                    else:
+                        sub = self._sockets.get(s)
+                        if sub is not None:  # Could have just been closed
+                            self._receive(sub)
+        except Exception:
+            if logging:
+                logging.exception("Ending subscriptions poller due to exception")
+
+
+_poller = None
+_poller_pid = None
+_poller_lock = threading.Lock()
+
+
+def get_subscription_poller():
+    """
+    return (SubscriptionPoller): the (running) poller of the current process
+    """
+    global _poller, _poller_pid
+    with _poller_lock:
+        # After a fork, the poller thread of the parent doesn't run in the child
+        if _poller is None or _poller_pid != os.getpid():
+            _poller = SubscriptionPoller()
+            _poller_pid = os.getpid()
+            _poller.start()
+        return _poller
+
+
 # Container management functions and class
 class ContainerObject(Pyro4.core.DaemonObject):
     """Object which represent the daemon for remote access"""
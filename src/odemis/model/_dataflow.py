@@ -28,15 +28,22 @@ from __future__ import division, print_function
 from past.builtins import basestring
 import Pyro4
 import logging
+import mmap
 import numpy
 from odemis.model import _metadata
 from odemis.util import inspect_getmembers
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
+import pickle
 import threading
 import time
 import zmq
 
+try:
+    import fcntl
+except ImportError:  # Windows => no shared memory transport
+    fcntl = None
+
 from . import _core
 
 
@@ -113,11 +120,14 @@ class DataFlowBase(object):
 #        # TODO timeout argument?
 #        pass
 
-    def subscribe(self, listener):
+    def subscribe(self, listener, discard=None):
         """
         Register a callback function to be called when the ActiveValue is
         listener (function): callback function which takes as arguments
            dataflow (this object) and data (the new data array)
+        discard (None or bool): whether the listener only needs the latest data.
+          Only used by the proxy (see DataFlowProxy.subscribe()), as locally
+          the listeners are always called with every data.
         """
         # TODO update rate argument to indicate how often we need an update?
         assert callable(listener)
@@ -186,14 +196,245 @@ class DataFlowBase(object):
                 logging.exception("Exception when notifying a data_flow")
 
 
+# Directory where the shared memory segments are created. It must be a RAM
+# file system, otherwise there is no gain compared to sending the data over 0MQ.
+SHM_DIRECTORY = "/dev/shm"
+# Number of slots in the ring buffer of each dataflow. It should be larger than
+# the number of messages which can be queued (see _update_pipe_hwm()), so that
+# a slot is normally not reused before the subscribers had a chance to read it.
+SHM_SLOTS = 8
+# Arrays smaller than this (in bytes) are always sent over 0MQ, as for them the
+# handling of the shared memory costs more than the copy.
+SHM_MIN_SIZE = 1024 * 1024
+# The header of each slot contains the generation number of the data (uint64).
+# It's 64 bytes long to keep the data aligned on a cache line.
+_SHM_HEADER_SIZE = 64
+
+
+class SharedMemoryRing(object):
+    """
+    Ring buffer of shared memory segments, used to pass arrays to the other
+    processes on the same computer, without copying them through a socket.
+    Each slot is a file in SHM_DIRECTORY. The beginning of the file contains
+    the generation number of the data, so that a reader can detect that the
+    slot has been reused before it could access it.
+    A reader keeps a shared lock (flock) on the slot as long as it uses the data.
+    When a slot is reused while a reader still holds it, the file is replaced
+    by a new one, so that the data seen by the reader is never modified.
+    A new file is fully written before it's moved to the path of the slot, so
+    that a reader never sees an empty or partially written file.
+    """
+
+    def __init__(self, name, nslots=SHM_SLOTS):
+        """
+        name (str): unique name used as prefix for the files
+        nslots (int > 0): number of slots in the ring
+        """
+        self._name = name
+        self._slots = [None] * nslots  # for each slot: None or (fd, mmap)
+        self._next = 0  # index of the next slot to use
+        self._generation = 0
+        # Number of times a slot could be reused, or had to be replaced
+        self.reused = 0
+        self.replaced = 0
+
+    def _slot_path(self, idx):
+        return os.path.join(SHM_DIRECTORY, "%s-%d" % (self._name, idx))
+
+    def _close_slot(self, idx):
+        """
+        Close and delete the file of the given slot (readers keep their copy)
+        """
+        fd, mm = self._slots[idx]
+        self._slots[idx] = None
+        mm.close()
+        os.close(fd)
+        try:
+            os.unlink(self._slot_path(idx))
+        except OSError:
+            logging.warning("Failed to delete shared memory %s", self._slot_path(idx))
+
+    def _open_slot(self, idx, size):
+        """
+        Create a new file for the given slot, and lock it for writing. The file
+          is created at a temporary path, so that it can be written before
+          the readers can open it.
+        return (str): the temporary path of the file
+        """
+        path = self._slot_path(idx) + ".new"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        self._slots[idx] = (fd, mm)
+        return path
+
+    def write(self, data):
+        """
+        Copy the data into the next slot of the ring.
+        Not thread-safe: only one thread should call it at a time.
+        data (numpy.ndarray): the data to share. It doesn't need to be contiguous.
+        return (str, int): path of the slot file, and generation number of the data
+        """
+        idx = self._next
+        self._next = (idx + 1) % len(self._slots)
+        self._generation += 1
+        size = _SHM_HEADER_SIZE + data.nbytes
+
+        if self._slots[idx] is not None:
+            fd, mm = self._slots[idx]
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # A reader still uses the data => leave the old file to it
+                self._close_slot(idx)
+                self.replaced += 1
+            else:
+                if len(mm) < size:
+                    self._close_slot(idx)
+                else:
+                    self.reused += 1
+
+        new_path = None
+        if self._slots[idx] is None:
+            new_path = self._open_slot(idx, size)
+
+        fd, mm = self._slots[idx]
+        header = sarray = None
+        try:
+            header = numpy.frombuffer(mm, dtype="<u8", count=1)
+            header[0] = self._generation
+            sarray = numpy.frombuffer(mm, dtype=data.dtype, count=data.size,
+                                      offset=_SHM_HEADER_SIZE)
+            sarray.shape = data.shape
+            sarray[...] = data
+            # The views must be gone before the mmap can be closed
+            del header, sarray
+            if new_path:
+                # Now the file is complete, the readers can open it
+                os.rename(new_path, self._slot_path(idx))
+        except Exception:
+            if new_path:
+                # Drop the new file, another one will be created next time
+                header = sarray = None
+                self._slots[idx] = None
+                mm.close()
+                os.close(fd)
+                os.unlink(new_path)
+            raise
+        finally:
+            if self._slots[idx] is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        return self._slot_path(idx), self._generation
+
+    def close(self):
+        """
+        Delete all the shared memory segments
+        """
+        for idx, slot in enumerate(self._slots):
+            if slot is not None:
+                self._close_slot(idx)
+
+
+def open_shared_array(path, generation, dtype, shape):
+    """
+    Map a slot written by SharedMemoryRing.write() into a (read-only) array.
+    As long as the array (or any view of it) exists, the slot is locked, so
+    that the writer doesn't modify it.
+    path (str): path of the slot file
+    generation (int): generation number of the expected data
+    dtype (numpy.dtype): type of the data
+    shape (tuple of int): shape of the data
+    return (numpy.ndarray or None): the data, or None if it's not available
+      anymore (because the slot has already been reused for newer data).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # The writer has already replaced the file (or is gone)
+        return None
+
+    count = 1
+    for d in shape:
+        count *= d
+    try:
+        # Blocks if the writer is currently updating the slot
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        size = os.fstat(fd).st_size
+        if size < _SHM_HEADER_SIZE + count * numpy.dtype(dtype).itemsize:
+            # Not the file expected (should not happen, but better be safe)
+            logging.warning("Shared memory %s is too short (%d bytes) for %s of %s",
+                            path, size, dtype, shape)
+            os.close(fd)
+            return None
+        mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    except Exception:
+        os.close(fd)
+        raise
+
+    header = numpy.frombuffer(mm, dtype="<u8", count=1)
+    if header[0] != generation:
+        del header
+        mm.close()
+        os.close(fd)
+        return None
+
+    # Keep the file open (and so locked) as long as the array is used
+    array = numpy.asarray(_SharedMapping(fd, mm, dtype, count))
+    array.shape = shape
+    return array
+
+
+class _SharedMapping(object):
+    """
+    Owner of a slot mapped by open_shared_array(). The slot file is kept open
+    (and so locked) until this object is deleted. It exposes the data via the
+    array interface, so that any array created from it keeps it alive.
+    """
+    def __init__(self, fd, mm, dtype, count):
+        """
+        fd (int): file descriptor of the slot, locked
+        mm (mmap.mmap): memory map of the whole slot
+        dtype (numpy.dtype): type of the data
+        count (int): number of elements of the data
+        """
+        self._fd = fd
+        self._mm = mm
+        self._array = numpy.frombuffer(mm, dtype=dtype, count=count,
+                                       offset=_SHM_HEADER_SIZE)
+        self.__array_interface__ = self._array.__array_interface__
+
+    def close(self):
+        """
+        Release the lock on the slot. The data must not be accessed afterwards.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
 # DataFlow object to create on the server (in a component)
 class DataFlow(DataFlowBase):
-    def __init__(self, max_discard=100): # XXX max_discard=100
+    def __init__(self, max_discard=100, use_shm=False): # XXX max_discard=100
         """
         max_discard (int): mount of messages that can be discarded in a row if
                             a new one is already available. 0 to keep (notify)
                             all the messages (dangerous if callback is slower
                             than the generator).
+        use_shm (bool): if True, large arrays are passed to the remote listeners
+          via shared memory, instead of being copied over the 0MQ socket. Only
+          used if max_discard > 0, as a slot of the shared memory ring can be
+          reused before a slow listener reads it, in which case the array is
+          dropped.
         """
         DataFlowBase.__init__(self)
         # different from ._listeners for notify() to do different things
@@ -203,6 +444,8 @@ class DataFlow(DataFlowBase):
         self._ctx = None
         self.pipe = None
         self._max_discard = max_discard
+        self._use_shm = use_shm
+        self._shm_ring = None  # SharedMemoryRing, created when registered
 
     def _getproxystate(self):
         """
@@ -231,10 +474,9 @@ class DataFlow(DataFlowBase):
 
         # When discarding, allow a bit of delay, but nothing more: if more than
         # 2 (=2x3) msg already queued, the _newest_ one will be dropped.
-        # TODO: in ZMQ v4, ZMQ_CONFLATE allows to have a queue of 1 message
-        # containing only the newest message. That sounds closer to what we
-        # need (though, currently multi-part messages are not supported).
-        # The best would be to drop the _oldest_ messages.
+        # Note that the proxies read the messages as soon as they arrive, and
+        # drop the _oldest_ ones for the listeners which only need the latest
+        # data (see LatestNotifierThread), so the queue rarely grows.
         hwm = 6 if self._max_discard else 10000
         if hasattr(self.pipe, "sndhwm"):  # zmq v3+
             self.pipe.sndhwm = hwm
@@ -277,6 +519,13 @@ class DataFlow(DataFlowBase):
         logging.debug("server is registered to send to " + "ipc://" + self._global_name)
         self.pipe.bind("ipc://" + self._global_name)
 
+        if self._use_shm:
+            if fcntl is None or not os.path.isdir(SHM_DIRECTORY):
+                logging.warning("Shared memory not available, will send data of %s over 0MQ",
+                                self._global_name)
+            else:
+                self._shm_ring = SharedMemoryRing("odemis-df-%x-%x" % (os.getpid(), id(self)))
+
     def _unregister(self):
         """
         unregister the dataflow from the daemon and clean up the 0MQ bindings
@@ -289,6 +538,9 @@ class DataFlow(DataFlowBase):
             self.pipe = None
             self._ctx.term()
             self._ctx = None
+        if self._shm_ring:
+            self._shm_ring.close()
+            self._shm_ring = None
 
     def _count_listeners(self):
         return len(self._listeners) + len(self._remote_listeners)
@@ -324,7 +576,7 @@ class DataFlow(DataFlowBase):
     # speed up a bit calls to them), but as Pyro doesn't ensure the order, it's
     # not possible because it could lead to wrong behaviour in case of quick
     # subscribe/unsubscribe.
-    def subscribe(self, listener):
+    def subscribe(self, listener, discard=None):
         with self._lock:
             count_before = self._count_listeners()
 
@@ -365,25 +617,39 @@ class DataFlow(DataFlowBase):
 
             # TODO thread-safe for self.pipe ?
             dformat = {"dtype": str(data.dtype), "shape": data.shape}
-            self.pipe.send_pyobj(dformat, zmq.SNDMORE)
-            self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
-            try:
-                if not data.flags["C_CONTIGUOUS"]:
-                    # if not in C order, it will be received incorrectly
-                    # TODO: if it's just rotated, send the info to reconstruct it
-                    # and avoid the memory copy
-                    raise TypeError("Need C ordered array")
-                self.pipe.send(memoryview(data), copy=False)
-            except TypeError:
-                # not all buffers can be sent zero-copy (e.g., has strides)
-                # try harder by copying (which removes the strides)
-                logging.debug("Failed to send data with zero-copy")
-                data = numpy.require(data, requirements=["C_CONTIGUOUS"])
-                self.pipe.send(memoryview(data), copy=False)
+            if (self._shm_ring and self._max_discard and
+                data.nbytes >= SHM_MIN_SIZE):
+                # Only the reference to the slot goes through the socket
+                dformat["shm"] = self._shm_ring.write(data)
+                self.pipe.send_pyobj(dformat, zmq.SNDMORE)
+                self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
+                self.pipe.send(b"")
+            else:
+                self._send_array(dformat, data)
 
         # publish locally
         DataFlowBase.notify(self, data)
 
+    def _send_array(self, dformat, data):
+        """
+        Send the array, with all its data, over 0MQ
+        """
+        self.pipe.send_pyobj(dformat, zmq.SNDMORE)
+        self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
+        try:
+            if not data.flags["C_CONTIGUOUS"]:
+                # if not in C order, it will be received incorrectly
+                # TODO: if it's just rotated, send the info to reconstruct it
+                # and avoid the memory copy
+                raise TypeError("Need C ordered array")
+            self.pipe.send(memoryview(data), copy=False)
+        except TypeError:
+            # not all buffers can be sent zero-copy (e.g., has strides)
+            # try harder by copying (which removes the strides)
+            logging.debug("Failed to send data with zero-copy")
+            data = numpy.require(data, requirements=["C_CONTIGUOUS"])
+            self.pipe.send(memoryview(data), copy=False)
+
     def __del__(self):
         if self._count_listeners() > 0:
             self.stop_generate()
@@ -396,10 +662,11 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
     def __init__(self, uri, max_discard=100): # XXX max_discard = 100
         """
         uri : see Proxy
-        max_discard (int): amount of messages that can be discarded in a row if
-                            a new one is already available. 0 to keep (notify)
-                            all the messages (dangerous if callback is slower
-                            than the generator).
+        max_discard (int): if > 0, by default, the listeners only receive the
+          latest data: if a new one is already available, the older ones are
+          discarded. 0 to keep (notify) all the messages (dangerous if callback
+          is slower than the generator). Can be overridden per listener, via
+          the discard argument of subscribe().
         Note: there is no reason to create a proxy explicitly!
         """
         Pyro4.Proxy.__init__(self, uri)
@@ -408,10 +675,10 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
         DataFlowBase.__init__(self)
         self.max_discard = max_discard
+        self._discard_listeners = set()  # subset of _listeners only receiving the latest data
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._subscription = None
+        self._latest_thread = None
 
     def __getstate__(self):
         # must permit to recreate a proxy to a data-flow in a different container
@@ -426,31 +693,89 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
         DataFlowBase.__init__(self)
+        self._discard_listeners = set()
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._subscription = None
+        self._latest_thread = None
 
     # .get() is a direct remote call
 
-    # next three methods are directly from DataFlowBase
-    #.subscribe()
-    #.unsubscribe()
-    #.notify()
+    def subscribe(self, listener, discard=None):
+        """
+        Register a callback function to be called when new data is available.
+        listener (function): callback function which takes as arguments
+           dataflow (this object) and data (the new data array)
+        discard (None or bool): if True, the listener only receives the latest
+          data: if it is slower than the generator, the older data is dropped
+          (without being decoded). It is called from a separate thread, so it
+          never delays the other listeners. If False, the listener receives all
+          the data, in order. If None, it's True if .max_discard > 0.
+        """
+        if discard is None:
+            discard = self.max_discard > 0
+        with self._lock:
+            if discard:
+                self._discard_listeners.add(WeakMethod(listener))
+                if not self._latest_thread:
+                    self._latest_thread = LatestNotifierThread(self._on_latest, self._global_name)
+                    self._latest_thread.start()
+            else:
+                self._discard_listeners.discard(WeakMethod(listener))
+            DataFlowBase.subscribe(self, listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._discard_listeners.discard(WeakMethod(listener))
+            DataFlowBase.unsubscribe(self, listener)
+
+    # .notify() is directly from DataFlowBase
+
+    def _notify_listeners(self, data, listeners):
+        """
+        Call the given listeners with the data
+        """
+        for l in listeners:
+            try:
+                l(self, data)
+            except WeakRefLostError:
+                self.unsubscribe(l)
+            except Exception:
+                # we cannot abort just because one listener failed
+                logging.exception("Exception when notifying a data_flow")
 
-    def _create_thread(self):
-        self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
-        self._commands = self._ctx.socket(zmq.PAIR)
-        self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
-        self._thread.start()
+    def _on_message(self, msg):
+        """
+        Called (via the SubscriptionNotifier) for every message received
+        msg (list of 3 zmq.Frame): the encoded DataArray
+        """
+        # to allow modify the sets while calling
+        all_listeners = frozenset(self._listeners)
+        discard_listeners = frozenset(self._discard_listeners)
+        lossless_listeners = all_listeners - discard_listeners
+
+        darray = None
+        if lossless_listeners:
+            darray = decode_dataarray(msg)
+            if darray is not None:
+                self._notify_listeners(darray, lossless_listeners)
+        if discard_listeners:
+            self._latest_thread.put(msg, darray)
+
+    def _on_latest(self, data):
+        """
+        Called by the LatestNotifierThread with the latest data
+        """
+        self._notify_listeners(data, frozenset(self._discard_listeners))
 
     def start_generate(self):
         # start the remote subscription
-        if not self._thread:
-            self._create_thread()
-        self._commands.send(b"SUB")
-        self._commands.recv() # synchronise
+        if not self._subscription:
+            # Never discard messages here: the listeners which only need the
+            # latest data get it via the LatestNotifierThread, which drops the
+            # oldest ones.
+            self._subscription = _core.Subscription(self._global_name, self._on_message,
+                                                    max_discard=0, rcvhwm=0)
+        _core.get_subscription_poller().subscribe(self._subscription)
 
         # send subscription to the actual dataflow
         # a bit tricky because the underlying method gets created on the fly
@@ -460,25 +785,22 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
     def stop_generate(self):
         # stop the remote subscription
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-        self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
+        # asynchronous (necessary to not deadlock)
+        _core.get_subscription_poller().unsubscribe(self._subscription)
 
     def __del__(self):
         try:
-            # end the thread (but it will stop as soon as it notices we are gone anyway)
-            if self._thread:
-                if self._thread.is_alive():
-                    if len(self._listeners):
-                        if logging:
-                            logging.debug("Stopping subscription while there "
-                                          "are still subscribers because dataflow '%s' is going out of context",
-                                          self._global_name)
-                        Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-                    self._commands.send(b"STOP")
-                    self._thread.join(1)
-                self._commands.close()
-                # Not needed: called when garbage-collected and it's dangerous
-                # as it blocks until all connections are closed.
-                # self._ctx.term()
+            # end the subscription (but it will stop as soon as it notices we are gone anyway)
+            if self._subscription:
+                if len(self._listeners):
+                    if logging:
+                        logging.debug("Stopping subscription while there "
+                                      "are still subscribers because dataflow '%s' is going out of context",
+                                      self._global_name)
+                    Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+                _core.get_subscription_poller().close(self._subscription)
+            if self._latest_thread:
+                self._latest_thread.stop()
         except Exception:
             pass
         try:
@@ -487,117 +809,95 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
             pass # don't be too rough if that fails, it's not big deal anymore
 
 
-class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
+def decode_dataarray(msg):
+    """
+    Reconstruct a DataArray received over 0MQ
+    msg (list of 3 zmq.Frame): format, metadata and data, as sent by
+      DataFlow.notify()
+    return (DataArray or None): the data, or None if it's not available anymore
+      (because it was in shared memory, which has already been reused)
+    """
+    array_format = pickle.loads(msg[0].bytes)
+    if "shm" in array_format:
+        # The data is in shared memory => direct (read-only) access
+        path, gen = array_format["shm"]
+        array = open_shared_array(path, gen, array_format["dtype"],
+                                  array_format["shape"])
+        if array is None:
+            return None
+    # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
+    elif len(msg[2]):
+        array = numpy.frombuffer(msg[2], dtype=array_format["dtype"])
+    else: # frombuffer doesn't support zero length array
+        array = numpy.empty((0,), dtype=array_format["dtype"])
+    array.shape = array_format["shape"]
+    return DataArray(array, metadata=pickle.loads(msg[1].bytes))
+
+
+class LatestNotifierThread(threading.Thread):
+    """
+    Passes the latest message received to the notifier. If the notifier is
+    slower than the messages arrive, the oldest messages are dropped, without
+    ever being decoded.
+    """
+    def __init__(self, notifier, uri):
         """
-        notifier (callable): method to call when a new array arrives
+        notifier (callable): method to call with the latest DataArray
         uri (string): unique string to identify the connection
-        max_discard (int)
-        zmq_ctx (0MQ context): available 0MQ context to use
         """
-        threading.Thread.__init__(self, name="zmq for dataflow " + uri)
+        threading.Thread.__init__(self, name="latest data for dataflow " + uri)
         self.daemon = True
         self.uri = uri
-        self.max_discard = max_discard
-        self._ctx = zmq_ctx
         # don't keep strong reference to notifier so that it can be garbage
         # collected normally and it will let us know then that we can stop
         self.w_notifier = WeakMethod(notifier)
+        self._latest = None  # (msg, DataArray or None) or None if nothing new
+        self._must_stop = False
+        self._cond = threading.Condition()
+        self.dropped = 0  # number of messages dropped since the beginning
 
-        # create a zmq synchronised channel to receive _commands
-        self._commands = zmq_ctx.socket(zmq.PAIR)
-        self._commands.connect("inproc://" + uri)
-
-        # create a zmq subscription to receive the data
-        self._data = zmq_ctx.socket(zmq.SUB)
-        # TODO find out if it does something and if it does, depend on max_discard
-        # (for now, we just set it to 0, the default, to never discard messages)
-        if hasattr(self._data, "rcvhwm"):  # zmq v3+
-            self._data.rcvhwm = 0
-        else:  # zmq v2
-            self._data.hwm = 0
-        self._data.connect("ipc://" + uri)
+    def put(self, msg, darray=None):
+        """
+        Set the latest message, replacing the previous one if it hasn't been
+        passed yet.
+        msg (list of 3 zmq.Frame): the encoded DataArray
+        darray (DataArray or None): the decoded DataArray, if already available
+        """
+        with self._cond:
+            if self._latest is not None:
+                self.dropped += 1
+            self._latest = (msg, darray)
+            self._cond.notify()
 
-        # TODO: we need a more advance support for max_discards to be able to
-        # ensure all the data is received when the client needs it.
-        # API should be either:
-        #  *  .max_discard = XXX (= per dataflow)
-        #  * .subscribe(callback, discard=True) (per subscriber)
+    def stop(self):
+        with self._cond:
+            self._must_stop = True
+            self._cond.notify()
 
     def run(self):
-        """
-        Process messages for commands and data
-        """
-        # Warning: this might run even when ending (aka "in a __del__() state")
-        # Which means: logging might be None, and zmq might not be working
-        # normally (apparently zmq.POLLIN == None during this time).
         try:
-            poller = zmq.Poller()
-            poller.register(self._commands, zmq.POLLIN)
-            poller.register(self._data, zmq.POLLIN)
-            discarded = 0
             while True:
-                socks = dict(poller.poll())
-
-                # process commands
-                if self._commands in socks:
-                    message = self._commands.recv()
-                    if message == b"SUB":
-                        self._data.setsockopt(zmq.SUBSCRIBE, b'')
-                        logging.debug("Subscribed to remote dataflow %s", self.uri)
-                        self._commands.send(b"SUBD")
-                    elif message == b"UNSUB":
-                        self._data.setsockopt(zmq.UNSUBSCRIBE, b'')
-                        if logging:
-                            logging.debug("Unsubscribed from remote dataflow %s", self.uri)
-                        # no confirmation (async)
-                    elif message == b"STOP":
+                with self._cond:
+                    while self._latest is None and not self._must_stop:
+                        self._cond.wait()
+                    if self._must_stop:
                         return
-                    else:
-                        logging.warning("Received unknown message %s", message)
-
-                # receive data
-                if self._data in socks:
-                    # TODO: be more resilient if wrong data is received (can
-                    # block forever)
-                    array_format = self._data.recv_pyobj()
-                    array_md = self._data.recv_pyobj()
-                    array_buf = self._data.recv(copy=False)
-                    # logging.debug("Received new DataArray over ZMQ for %s", self.uri)
-                    # more fresh data already?
-                    if (self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
-                        discarded < self.max_discard):
-                        discarded += 1
-                        # logging.debug("Discarding object received as a newer one is available")
-                        continue
-                    # TODO: only log the accumulated number every second, to avoid log flooding
-#                     if discarded:
-#                         logging.debug("Dataflow %s dropped %d arrays", self.uri, discarded)
-                    discarded = 0
-                    # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
-                    if len(array_buf):
-                        array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
-                    else: # frombuffer doesn't support zero length array
-                        array = numpy.empty((0,), dtype=array_format["dtype"])
-                    array.shape = array_format["shape"]
-                    darray = DataArray(array, metadata=array_md)
-
-                    try:
-                        self.w_notifier(darray)
-                    except WeakRefLostError:
-                        return  # It's a sign there is nothing left to do
+                    msg, darray = self._latest
+                    self._latest = None
+
+                if darray is None:
+                    darray = decode_dataarray(msg)
+                    if darray is None:
+                        continue  # Too old already
+                del msg
+                try:
+                    self.w_notifier(darray)
+                except WeakRefLostError:
+                    return  # It's a sign there is nothing left to do
+                del darray  # Don't hold the data (or shared memory) while waiting
         except Exception:
             if logging:
-                logging.exception("Ending ZMQ thread due to exception")
-        finally:
-            try:
-                self._commands.close()
-            except Exception:
-                print("Exception closing ZMQ commands connection")
-            try:
-                self._data.close()
-            except Exception:
-                print("Exception closing ZMQ data connection")
+                logging.exception("Ending latest data thread due to exception")
 
 
 def unregister_dataflows(self):
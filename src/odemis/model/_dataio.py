@@ -80,6 +80,27 @@ class DataArrayShadow(with_metaclass(ABCMeta, object)):
 #         return (DataArray): the shape of the DataArray is typically of shape
 #         """
 
+    def getTiles(self, tiles):
+        """
+        Fetches several tiles at once. Only available if the object supports
+        per tile access (ie, has a getTile() method).
+        By default, it just calls getTile() for each tile, but subclasses which
+        can read the tiles faster when they are requested together (eg, by
+        fetching them in parallel) should override it.
+        tiles (iterable of (0<=int, 0<=int, 0<=int)): X, Y indices and zoom
+          level of each tile (same as the arguments of getTile()).
+        return (list of DataArrays or Exceptions): the tiles, in the same order
+          as requested. If a tile couldn't be read, the exception raised is in
+          place of the tile, so that the other tiles are not lost.
+        """
+        das = []
+        for x, y, z in tiles:
+            try:
+                das.append(self.getTile(x, y, z))
+            except Exception as ex:
+                das.append(ex)
+        return das
+
 
 class AcquisitionData(with_metaclass(ABCMeta, object)):
     """
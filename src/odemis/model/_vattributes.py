@@ -25,11 +25,13 @@ from past.builtins import basestring, long
 import Pyro4
 from Pyro4.core import oneway
 import collections
+import copy
 import logging
 import numbers
 import numpy
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
+import pickle
 import threading
 import types
 import sys
@@ -156,8 +158,11 @@ class VigilantAttribute(VigilantAttributeBase):
         Equivalent to __getstate__() of the proxy version
         """
         proxy_state = Pyro4.core.pyroObjectSerializer(self)[2]
+        # If there is a getter, the value can change without notification, so
+        # it cannot be mirrored
+        mirrorable = self._getter is None
         return (proxy_state, _core.dump_roattributes(self), self.unit,
-                self.readonly, self.max_discard)
+                self.readonly, self.max_discard, mirrorable)
 
     def _check(self, value):
         """
@@ -342,9 +347,44 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self.max_discard = 100
         self.readonly = False # will be updated in __setstate__
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._subscription = None
+        self._init_mirror(False)
+
+    def _init_mirror(self, mirrorable):
+        """
+        mirrorable (bool): True if the value of the remote VA only changes with
+          a notification, and so can be mirrored.
+        """
+        self._mirrorable = mirrorable
+        self._mirror = False
+        self._mirror_lock = threading.Lock()
+        self._mirror_active = False  # True while the remote VA is subscribed
+        self._mirror_valid = False  # True if _mirror_value is the current value
+        self._mirror_written = False  # True if value was set since last time it was read
+        self._mirror_value = None
+        # Incremented on every change, to detect the ones happening during a read
+        self._mirror_changes = 0
+        self.mirror_hits = 0  # Number of reads served without RPC
+        self.mirror_misses = 0  # Number of reads in mirror mode which needed a RPC
+
+    @property
+    def mirror(self):
+        """
+        (bool): If True, while the VA is subscribed, the last value received is
+          kept locally, and reading .value returns it, without any remote call.
+          Setting the value is always done remotely, and the next read gets the
+          actual new value.
+        """
+        return self._mirror
+
+    @mirror.setter
+    def mirror(self, enabled):
+        if enabled and not self._mirrorable:
+            raise ValueError("VA %s cannot be mirrored as its value can change "
+                             "without notification" % (self._global_name,))
+        with self._mirror_lock:
+            self._mirror = enabled
+            self._mirror_valid = False
 
     def __getattr__(self, name):
         # Behaviour of .range and .choices remote attributes:
@@ -364,15 +404,58 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
 
     @property
     def value(self):
-        return self.__getattr__("_get_value")()
+        if not self._mirror:
+            return self.__getattr__("_get_value")()
+
+        with self._mirror_lock:
+            if self._mirror_valid:
+                self.mirror_hits += 1
+                # Copy, so that the caller can modify it without changing the mirror
+                return copy.deepcopy(self._mirror_value)
+            self.mirror_misses += 1
+            changes = self._mirror_changes
+
+        v = self.__getattr__("_get_value")()
+        with self._mirror_lock:
+            # Only trust the value if nothing changed during the call
+            if self._mirror_active and self._mirror_changes == changes:
+                self._mirror_value = copy.deepcopy(v)
+                self._mirror_valid = True
+                self._mirror_written = False
+        return v
 
     @value.setter
     def value(self, v):
         if self.readonly:
             raise NotSettableError("Value is read-only")
-        return self.__getattr__("_set_value")(v)
+        self._set_remote_value(v)
     # no delete remotely
 
+    def _set_remote_value(self, v):
+        """
+        Change the value of the remote VA, and invalidate the mirror
+        """
+        if not self._mirror:
+            self.__getattr__("_set_value")(v)
+            return
+
+        # The remote VA might not accept the value as-is, so the mirror is
+        # invalid until the value is read again. Invalidate before and after,
+        # to also discard the reads concurrent to the call.
+        self._invalidate_mirror()
+        try:
+            self.__getattr__("_set_value")(v)
+        finally:
+            self._invalidate_mirror()
+
+    def _invalidate_mirror(self):
+        with self._mirror_lock:
+            self._mirror_changes += 1
+            self._mirror_valid = False
+            # Notifications received before the next read might be older than
+            # the written value, so they cannot be trusted.
+            self._mirror_written = True
+
     # for enumerated VA
     @property
     def choices(self):
@@ -392,7 +475,7 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         proxy_state = Pyro4.Proxy.__getstate__(self)
         # we don't need value, it's always remotely accessed
         return (proxy_state, _core.dump_roattributes(self), self.unit,
-                self.readonly, self.max_discard)
+                self.readonly, self.max_discard, self._mirrorable)
 
     def __setstate__(self, state):
         """
@@ -402,7 +485,7 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
                             all the messages (dangerous if callback is slower
                             than the generator).
         """
-        proxy_state, roattributes, unit, self.readonly, self.max_discard = state
+        proxy_state, roattributes, unit, self.readonly, self.max_discard, mirrorable = state
         Pyro4.Proxy.__setstate__(self, proxy_state)
         VigilantAttributeBase.__init__(self, unit=unit)
         _core.load_roattributes(self, roattributes)
@@ -410,17 +493,22 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._subscription = None
+        self._init_mirror(mirrorable)
 
-    def _create_thread(self):
-        logging.debug("Creating thread for VA %s", self._global_name)
-        self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
-        self._commands = self._ctx.socket(zmq.PAIR)
-        self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
-        self._thread.start()
+    def _on_message(self, msg):
+        """
+        Called (via the SubscriptionNotifier) for every new value received
+        msg (list of 1 zmq.Frame): the pickled value
+        """
+        v = pickle.loads(msg[0].bytes)
+        if self._mirror:
+            with self._mirror_lock:
+                self._mirror_changes += 1
+                if self._mirror_active and not self._mirror_written:
+                    self._mirror_value = copy.deepcopy(v)
+                    self._mirror_valid = True
+        self.notify(v)
 
     def subscribe(self, listener, init=False):
         count_before = len(self._listeners)
@@ -435,14 +523,16 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         start the remote subscription
         """
-        if not self._thread:
-            self._create_thread()
-        self._commands.send(b"SUB")
-        self._commands.recv() # synchronise
+        if not self._subscription:
+            self._subscription = _core.Subscription(self._global_name, self._on_message,
+                                                    self.max_discard)
+        _core.get_subscription_poller().subscribe(self._subscription)
 
         # send subscription to the actual VA
         # a bit tricky because the underlying method gets created on the fly
         Pyro4.Proxy.__getattr__(self, "subscribe")(self._proxy_name)
+        with self._mirror_lock:
+            self._mirror_active = True
 
     def unsubscribe(self, listener):
         VigilantAttributeBase.unsubscribe(self, listener)
@@ -453,24 +543,24 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         stop the remote subscription
         """
+        with self._mirror_lock:
+            # Changes will not be received anymore
+            self._mirror_active = False
+            self._mirror_valid = False
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-        if self._commands:
-            self._commands.send(b"UNSUB")
+        if self._subscription:
+            _core.get_subscription_poller().unsubscribe(self._subscription)
 
     def __del__(self):
-        # end the thread (but it will stop as soon as it notices we are gone anyway)
+        # end the subscription (but it will stop as soon as it notices we are gone anyway)
         try:
-            if self._thread:
-                if self._thread.is_alive():
-                    if len(self._listeners):
-                        logging.warning("Stopping subscription while there are still subscribers "
-                                        "because VA '%s' is going out of context",
-                                        self._global_name)
-                        Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-                    self._commands.send(b"STOP")
-                    self._thread.join(1)
-                self._commands.close()
-            # self._ctx.term()
+            if self._subscription:
+                if len(self._listeners):
+                    logging.warning("Stopping subscription while there are still subscribers "
+                                    "because VA '%s' is going out of context",
+                                    self._global_name)
+                    Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+                _core.get_subscription_poller().close(self._subscription)
         except Exception:
             pass
 
@@ -480,76 +570,6 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
             pass  # don't be too rough if that fails, it's not big deal anymore
 
 
-class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
-        """
-        notifier (callable): method to call when a new value arrives
-        uri (string): unique string to identify the connection
-        max_discard (int)
-        zmq_ctx (0MQ context): available 0MQ context to use
-        """
-        threading.Thread.__init__(self, name="zmq for VA " + uri)
-        self.daemon = True
-        self.uri = uri
-        self.max_discard = max_discard
-        self._ctx = zmq_ctx
-        # don't keep strong reference to notifier so that it can be garbage
-        # collected normally and it will let us know then that we can stop
-        self.w_notifier = WeakMethod(notifier)
-
-        # create a zmq synchronised channel to receive commands
-        self._commands = zmq_ctx.socket(zmq.PAIR)
-        self._commands.connect("inproc://" + uri)
-
-        # create a zmq subscription to receive the data
-        self.data = zmq_ctx.socket(zmq.SUB)
-        self.data.connect("ipc://" + uri)
-
-    def run(self):
-        # Process messages for commands and data
-        poller = zmq.Poller()
-        poller.register(self._commands, zmq.POLLIN)
-        poller.register(self.data, zmq.POLLIN)
-        discarded = 0
-        while True:
-            socks = dict(poller.poll())
-
-            # process commands
-            if socks.get(self._commands) == zmq.POLLIN:
-                message = self._commands.recv()
-                if message == b"SUB":
-                    self.data.setsockopt(zmq.SUBSCRIBE, b'')
-                    self._commands.send(b"SUBD")
-                elif message == b"UNSUB":
-                    self.data.setsockopt(zmq.UNSUBSCRIBE, b'')
-                    # no confirmation (async)
-                elif message == b"STOP":
-                    self._commands.close()
-                    self.data.close()
-                    return
-
-            # receive data
-            if socks.get(self.data) == zmq.POLLIN:
-                value = self.data.recv_pyobj()
-                # more fresh data already?
-                if (
-                        self.data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
-                        discarded < self.max_discard
-                ):
-                    discarded += 1
-                    continue
-                if discarded:
-                    logging.debug("VA discarded %d values", discarded)
-                discarded = 0
-
-                try:
-                    self.w_notifier(value)
-                except WeakRefLostError:
-                    self._commands.close()
-                    self.data.close()
-                    return
-
-
 def unregister_vigilant_attributes(self):
     for _, value in inspect_getmembers(self, lambda x: isinstance(x, VigilantAttribute)):
         value._unregister()
@@ -750,7 +770,7 @@ class ListVAProxy(VigilantAttributeProxy):
     @property
     def value(self):
         # Transform a normal list into a notifying one
-        raw_list = self.__getattr__("_get_value")()
+        raw_list = VigilantAttributeProxy.value.fget(self)
         # When value change, same as setting the value
         val = _NotifyingList(raw_list, notifier=self.__value_setter)
         return val
@@ -763,7 +783,7 @@ class ListVAProxy(VigilantAttributeProxy):
     def __value_setter(self, v):
         if self.readonly:
             raise NotSettableError("Value is read-only")
-        self.__getattr__("_set_value")(v)
+        self._set_remote_value(v)
 
 
 class BooleanVA(VigilantAttribute):
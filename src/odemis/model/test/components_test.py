@@ -227,6 +227,163 @@ class TestActuator(unittest.TestCase):
 #             self.assertAlmostEqual(val, abs_mov_back[axis])
 
 
+class TestComponentRegistry(unittest.TestCase):
+    """
+    Test getComponent() and getComponents(), with a (local) microscope
+    """
+
+    def setUp(self):
+        self.ccd = model.HwComponent("Camera", "ccd")
+        self.stage = model.HwComponent("Stage", "stage")
+        self.mic = model.Microscope("Microscope", "sparc")
+        self.mic.alive.value = {self.ccd, self.stage}
+        self._prev_mic = model._core._microscope
+        model._core._microscope = self.mic
+
+    def tearDown(self):
+        model._core._microscope = self._prev_mic
+
+    def test_lookup(self):
+        self.assertIs(model.getComponent(role="ccd"), self.ccd)
+        self.assertIs(model.getComponent(name="Stage"), self.stage)
+        self.assertIs(model.getComponent(name="Stage", role="stage"), self.stage)
+        self.assertIs(model.getComponent(role="sparc"), self.mic)
+        self.assertEqual(model.getComponents(), {self.mic, self.ccd, self.stage})
+
+        with self.assertRaises(LookupError):
+            model.getComponent(role="spectrometer")
+        with self.assertRaises(LookupError):
+            model.getComponent(name="Stage", role="ccd")
+        with self.assertRaises(ValueError):
+            model.getComponent()
+
+    def test_alive_change(self):
+        """
+        The registry should follow the components being started and stopped
+        """
+        self.assertIs(model.getComponent(role="ccd"), self.ccd)
+        with self.assertRaises(LookupError):
+            model.getComponent(role="spectrometer")
+
+        spec = model.HwComponent("Spectrometer", "spectrometer")
+        self.mic.alive.value = {self.ccd, spec}
+        self.assertIs(model.getComponent(role="spectrometer"), spec)
+        self.assertEqual(model.getComponents(), {self.mic, self.ccd, spec})
+        with self.assertRaises(LookupError):
+            model.getComponent(role="stage")
+
+        # New microscope => new registry
+        mic2 = model.Microscope("Microscope 2", "sparc")
+        model._core._microscope = mic2
+        self.assertEqual(model.getComponents(), {mic2})
+        with self.assertRaises(LookupError):
+            model.getComponent(role="ccd")
+
+
+class TestUpdateVAs(unittest.TestCase):
+    """
+    Test updateVAs(), exchangeVAs() and temporaryVAs() on a local component
+    """
+
+    def setUp(self):
+        self.comp = model.HwComponent("Scanner", "e-beam")
+        self.comp.scale = model.FloatContinuous(1, (1, 16))
+        # resolution depends on the scale
+        self.comp.resolution = model.IntContinuous(512, (1, 512), setter=self._setResolution)
+        self.comp.dwellTime = model.FloatContinuous(1e-6, (1e-7, 1), setter=self._setDwellTime)
+
+    def _setResolution(self, value):
+        return min(value, int(512 / self.comp.scale.value))
+
+    def _setDwellTime(self, value):
+        # Rounded to 0.1 µs
+        return round(value, 7)
+
+    def test_update(self):
+        actual = self.comp.updateVAs([("scale", 4.0), ("resolution", 512), ("dwellTime", 2.04e-6)])
+        self.assertEqual(list(actual.keys()), ["scale", "resolution", "dwellTime"])
+        self.assertEqual(actual["scale"], 4)
+        self.assertEqual(actual["resolution"], 128)
+        self.assertAlmostEqual(actual["dwellTime"], 2e-6)
+        self.assertEqual(self.comp.resolution.value, 128)
+
+        # Order matters
+        self.comp.updateVAs([("resolution", 512), ("scale", 1.0)])
+        self.assertEqual(self.comp.resolution.value, 128)
+        self.comp.updateVAs({"scale": 1.0, "resolution": 512})
+        self.assertEqual(self.comp.resolution.value, 512)
+
+    def test_error(self):
+        """
+        If a VA fails, nothing should be changed
+        """
+        with self.assertRaises(IndexError):
+            self.comp.updateVAs([("scale", 2.0), ("resolution", 256), ("dwellTime", 10)])
+        self.assertEqual(self.comp.scale.value, 1)
+        self.assertEqual(self.comp.resolution.value, 512)
+        self.assertEqual(self.comp.dwellTime.value, 1e-6)
+
+        with self.assertRaises(AttributeError):
+            self.comp.updateVAs([("scale", 2.0), ("rotation", 1)])
+        self.assertEqual(self.comp.scale.value, 1)
+
+    def test_exchange(self):
+        prev, actual = self.comp.exchangeVAs([("scale", 2.0), ("resolution", 512)])
+        self.assertEqual(prev, {"scale": 1, "resolution": 512})
+        self.assertEqual(actual, {"scale": 2, "resolution": 256})
+
+    def test_temporary(self):
+        with model.temporaryVAs(self.comp, [("scale", 2.0), ("resolution", 100)]) as actual:
+            self.assertEqual(actual, {"scale": 2, "resolution": 100})
+            self.assertEqual(self.comp.resolution.value, 100)
+        self.assertEqual(self.comp.scale.value, 1)
+        self.assertEqual(self.comp.resolution.value, 512)
+
+        # Also put back in case of exception
+        with self.assertRaises(ValueError):
+            with model.temporaryVAs(self.comp, {"dwellTime": 1e-3}):
+                raise ValueError("Something went wrong")
+        self.assertEqual(self.comp.dwellTime.value, 1e-6)
+
+    def test_coupled(self):
+        """
+        Changing a VA changes another one, which is also changed
+        """
+        comp = FakeScanner("Scanner", "e-beam")
+
+        with model.temporaryVAs(comp, [("scale", 8.0), ("resolution", 100)]) as actual:
+            self.assertEqual(actual, {"scale": 8, "resolution": 100})
+        self.assertEqual(comp.scale.value, 1)
+        self.assertEqual(comp.resolution.value, 2048)
+
+        prev, actual = comp.exchangeVAs([("scale", 8.0), ("resolution", 100)])
+        self.assertEqual(prev, {"scale": 1, "resolution": 2048})
+
+        # If the second VA fails, both are put back
+        comp.updateVAs([("scale", 1.0), ("resolution", 2048)])
+        with self.assertRaises(IndexError):
+            comp.updateVAs([("scale", 2.0), ("resolution", 4096)])
+        self.assertEqual(comp.scale.value, 1)
+        self.assertEqual(comp.resolution.value, 2048)
+
+
+class FakeScanner(model.HwComponent):
+    """
+    Like a scanner, changing the scale also changes the resolution, to keep
+    the same field of view
+    """
+
+    def __init__(self, name, role):
+        model.HwComponent.__init__(self, name, role)
+        self.resolution = model.IntContinuous(2048, (1, 2048))
+        self.scale = model.FloatContinuous(1, (1, 16), setter=self._setScale)
+
+    def _setScale(self, value):
+        res = int(self.resolution.value * self.scale.value / value)
+        self.resolution.value = max(1, min(res, 2048))
+        return value
+
+
 class FakeActuator(Actuator):
     @isasync
     def moveRel(self, shift):
@@ -23,7 +23,10 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division, print_function
 from Pyro4.core import oneway
 from odemis import model
+import gc
 import logging
+import numpy
+import os
 import pickle
 import threading
 import time
@@ -295,6 +298,72 @@ class TestDataFlow(unittest.TestCase):
         
         self.assertEqual(self.left, 0)
 
-        
+
+
+@unittest.skipIf(not os.path.isdir(model.SHM_DIRECTORY), "No shared memory available")
+class TestSharedMemoryRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = model.SharedMemoryRing("odemis-test-%x" % os.getpid(), nslots=2)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_read_write(self):
+        data = numpy.arange(200 * 100, dtype=numpy.uint16).reshape(200, 100)
+        path, gen = self.ring.write(data)
+        sdata = model.open_shared_array(path, gen, data.dtype, data.shape)
+        numpy.testing.assert_array_equal(sdata, data)
+        self.assertFalse(sdata.flags.writeable)
+
+        # Non-contiguous arrays are also accepted
+        path, gen = self.ring.write(data[:, ::2])
+        sdata2 = model.open_shared_array(path, gen, data.dtype, (200, 50))
+        numpy.testing.assert_array_equal(sdata2, data[:, ::2])
+
+    def test_reuse(self):
+        data = numpy.ones((50, 60), dtype=numpy.float64)
+        path, gen = self.ring.write(data)
+        self.ring.write(data)
+
+        # The first slot is not used by anyone => it's reused
+        path2, gen2 = self.ring.write(data * 2)
+        self.assertEqual(path, path2)
+        self.assertEqual(self.ring.reused, 1)
+        # The old data is not available anymore
+        self.assertIsNone(model.open_shared_array(path, gen, data.dtype, data.shape))
+
+        # When a reader holds the slot, it's not modified, but replaced
+        sdata = model.open_shared_array(path2, gen2, data.dtype, data.shape)
+        self.ring.write(data)
+        path3, gen3 = self.ring.write(data * 3)
+        self.assertEqual(self.ring.replaced, 1)
+        numpy.testing.assert_array_equal(sdata, data * 2)
+        sdata3 = model.open_shared_array(path3, gen3, data.dtype, data.shape)
+        numpy.testing.assert_array_equal(sdata3, data * 3)
+
+        # Once the reader has released the data, the slot can be reused again
+        del sdata, sdata3
+        gc.collect()
+        self.ring.write(data)
+        self.ring.write(data)
+        self.assertEqual(self.ring.replaced, 1)
+        self.assertEqual(self.ring.reused, 4)
+
+    def test_short_slot(self):
+        """
+        An empty or too short slot file is reported as not available
+        """
+        data = numpy.ones((50, 60), dtype=numpy.float64)
+        path, gen = self.ring.write(data)
+        # Only complete files are visible to the readers
+        self.assertFalse(os.path.exists(path + ".new"))
+
+        self.assertIsNone(model.open_shared_array(path, gen, data.dtype, (100, 60)))
+        with open(path, "w"):  # Truncate it
+            pass
+        self.assertIsNone(model.open_shared_array(path, gen, data.dtype, data.shape))
+
+
 if __name__ == "__main__":
     unittest.main()
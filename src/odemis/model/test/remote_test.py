@@ -156,6 +156,81 @@ class SerializerTest(unittest.TestCase):
         daemon.shutdown()
 
 
+class SubscriptionNotifierTest(unittest.TestCase):
+    """
+    Test the notification of the messages received by the subscriptions
+    """
+
+    def setUp(self):
+        self.closed = []
+        self.notifier = model._core.SubscriptionNotifier(self)
+        self.received = {}  # str -> list of messages
+
+    def _create_sub(self, name, max_discard=0):
+        self.received[name] = []
+        notify = getattr(self, "notify_" + name)
+        return model._core.Subscription(name, notify, max_discard)
+
+    def close(self, sub):
+        # Called by the notifier, as if it were the poller
+        self.closed.append(sub)
+
+    def notify_slow(self, msg):
+        time.sleep(0.1)
+        self.received["slow"].append(msg)
+
+    def notify_fast(self, msg):
+        self.received["fast"].append(msg)
+
+    def notify_lossy(self, msg):
+        time.sleep(0.1)
+        self.received["lossy"].append(msg)
+
+    def test_order(self):
+        """
+        A slow notifier doesn't delay the other ones, and each subscription
+        gets the messages in order
+        """
+        slow = self._create_sub("slow")
+        fast = self._create_sub("fast")
+        for i in range(5):
+            self.notifier.queue(slow, i)
+        for i in range(100):
+            self.notifier.queue(fast, i)
+
+        time.sleep(0.1)
+        self.assertEqual(self.received["fast"], list(range(100)))
+        self.assertLess(len(self.received["slow"]), 5)
+        time.sleep(0.6)
+        self.assertEqual(self.received["slow"], list(range(5)))
+
+    def test_discard(self):
+        """
+        Old messages are discarded when newer ones are received
+        """
+        lossy = self._create_sub("lossy", max_discard=100)
+        for i in range(10):
+            self.notifier.queue(lossy, i)
+        time.sleep(0.5)
+        # The first one is notified immediately, while the next ones are replaced
+        self.assertEqual(self.received["lossy"], [0, 9])
+
+    def test_gone(self):
+        """
+        When the receiver is gone, the subscription is closed
+        """
+        class Receiver(object):
+            def notify(self, msg):
+                pass
+
+        receiver = Receiver()
+        sub = model._core.Subscription("gone", receiver.notify)
+        del receiver
+        self.notifier.queue(sub, 1)
+        time.sleep(0.1)
+        self.assertEqual(self.closed, [sub])
+
+
 # @unittest.skip("simple")
 class ProxyOfProxyTest(unittest.TestCase):
 # Test sharing a shared component from the client
@@ -597,6 +672,53 @@ class RemoteTest(unittest.TestCase):
         self.assertEqual(count_end, self.count)
         self.assertGreaterEqual(count_end, 1)
 
+    @unittest.skipIf(not os.path.isdir(model.SHM_DIRECTORY), "No shared memory available")
+    def test_dataflow_shm(self):
+        """
+        test passing the DataArrays via shared memory
+        """
+        self.count = 0
+        self.data_arrays_sent = 0
+        self.expected_shape = (2048, 2048)
+        self.comp.datashm.reset()
+
+        self.comp.datashm.subscribe(self.receive_data)
+        time.sleep(0.5)
+        self.comp.datashm.unsubscribe(self.receive_data)
+        count_end = self.count
+
+        time.sleep(0.1)
+        self.assertEqual(count_end, self.count)
+        self.assertGreaterEqual(count_end, 1)
+
+    def test_dataflow_slow_listener(self):
+        """
+        Check the data received by a slow listener, depending on the discard
+        policy. (See scripts/dataflow_latency.py to measure the latency.)
+        """
+        df = self.comp.data
+        for discard in (True, False):
+            self.indices = []
+            df.reset()
+            df.subscribe(self.receive_data_slow, discard=discard)
+            time.sleep(2)
+            df.unsubscribe(self.receive_data_slow)
+            time.sleep(0.5)  # make sure everything is received/dropped
+
+            # Always received in order
+            self.assertGreaterEqual(len(self.indices), 2)
+            self.assertTrue(all(d > 0 for d in numpy.diff(self.indices)))
+            if discard:
+                # Some are skipped, to keep up with the dataflow
+                self.assertGreater(max(numpy.diff(self.indices)), 1)
+            else:
+                # All the data is received
+                self.assertEqual(self.indices, list(range(1, len(self.indices) + 1)))
+
+    def receive_data_slow(self, dataflow, data):
+        self.indices.append(int(data[0][0]))
+        time.sleep(0.2)  # slower than the dataflow (20 Hz)
+
     def test_dataflow_empty(self):
         """
         test passing empty DataArray
@@ -713,11 +835,161 @@ class RemoteTest(unittest.TestCase):
         except TypeError:
             pass # as it should be
 
+    def test_va_mirror(self):
+        prop = self.comp.prop
+        prop.value = 42
+        prop.mirror = True
+        self.assertTrue(prop.mirror)
+
+        # Not subscribed => always remote
+        self.assertEqual(prop.value, 42)
+        self.assertEqual(prop.mirror_hits, 0)
+
+        self.called = 0
+        prop.subscribe(self.receive_va_update)
+        self.assertEqual(prop.value, 42)  # remote, and now mirrored
+        for i in range(10):
+            self.assertEqual(prop.value, 42)
+        self.assertEqual(prop.mirror_hits, 10)
+
+        # Change remotely => received via the notification
+        self.comp.change_prop(45)
+        time.sleep(0.1)  # give time to receive notifications
+        self.assertEqual(self.last_value, 45)
+        hits = prop.mirror_hits
+        self.assertEqual(prop.value, 45)
+        self.assertEqual(prop.mirror_hits, hits + 1)
+
+        # Change locally => next read is remote, and always the new value
+        misses = prop.mirror_misses
+        for i in range(10):
+            prop.value = i
+            self.assertEqual(prop.value, i)
+        self.assertEqual(prop.mirror_misses, misses + 10)
+        time.sleep(0.1)
+        self.assertEqual(prop.value, 9)
+
+        # Value modified by the setter
+        rounded = self.comp.rounded
+        rounded.mirror = True
+        rounded.subscribe(self.receive_va_update)
+        rounded.value = 2.7
+        self.assertEqual(rounded.value, 3)
+        time.sleep(0.1)
+        self.assertEqual(rounded.value, 3)
+        rounded.unsubscribe(self.receive_va_update)
+
+        # Unsubscribed => remote again
+        prop.unsubscribe(self.receive_va_update)
+        hits = prop.mirror_hits
+        self.assertEqual(prop.value, 9)
+        self.assertEqual(prop.mirror_hits, hits)
+
+        # List VA, which modifies itself
+        l = self.comp.listval
+        l.mirror = True
+        l.subscribe(self.receive_listva_update)
+        l.value = [2, 65]
+        l.value += [3]
+        self.assertEqual(l.value, [2, 65, 3])
+        l.value[-1] = 4
+        self.assertEqual(l.value, [2, 65, 4])
+        time.sleep(0.1)
+        self.assertEqual(l.value, [2, 65, 4])
+        self.assertGreater(l.mirror_hits, 0)
+        l.unsubscribe(self.receive_listva_update)
+
+        # VA with a getter => its value can change without notification
+        with self.assertRaises(ValueError):
+            self.comp.getterval.mirror = True
+
+        prop.mirror = False
+        rounded.mirror = False
+        l.mirror = False
+
+    def test_update_vas(self):
+        self.comp.prop.value = 42
+        prev, actual = self.comp.exchangeVAs([("prop", 3), ("rounded", 2.7)])
+        self.assertEqual(prev["prop"], 42)
+        self.assertEqual(actual, {"prop": 3, "rounded": 3})
+
+        actual = self.comp.updateVAs([("prop", 4), ("cont", 3.0)])
+        self.assertEqual(actual, {"prop": 4, "cont": 3})
+
+        # Out of range => no VA is changed
+        with self.assertRaises(IndexError):
+            self.comp.updateVAs([("prop", 5), ("cont", 4.0)])
+        self.assertEqual(self.comp.prop.value, 4)
+
+        with model.temporaryVAs(self.comp, {"prop": 10, "rounded": 1.2}) as actual:
+            self.assertEqual(actual, {"prop": 10, "rounded": 1})
+            self.assertEqual(self.comp.prop.value, 10)
+        self.assertEqual(self.comp.prop.value, 4)
+        self.assertEqual(self.comp.rounded.value, 3)
+
     def receive_va_update(self, value):
         self.called += 1
         self.last_value = value
         self.assertIsInstance(value, (int, float))
 
+    def test_subscription_threads(self):
+        """
+        Check that subscribing to many VAs and DataFlows doesn't create a thread
+        per subscription, and the values are still received in order
+        """
+        self.received = []
+        self.count = 0
+        self.expected_shape = (2048, 2048)
+        self.comp.data.reset()
+        prop = self.comp.prop
+        prop.subscribe(self.receive_any)
+        n_threads = threading.active_count()
+
+        vas = [self.comp.cont, self.comp.enum, self.comp.cut, self.comp.listval]
+        for va in vas:
+            va.subscribe(self.receive_any)
+        self.comp.data.subscribe(self.receive_data, discard=False)
+        # At most one thread to notify, as the notifications are quick
+        self.assertLessEqual(threading.active_count(), n_threads + 1)
+
+        for i in range(10):
+            prop.value = i
+        time.sleep(0.2)
+        self.assertEqual(self.received, list(range(10)))
+
+        self.comp.data.unsubscribe(self.receive_data)
+        for va in vas:
+            va.unsubscribe(self.receive_any)
+        prop.unsubscribe(self.receive_any)
+
+    def receive_any(self, value):
+        self.received.append(value)
+
+    def test_subscription_wait_other(self):
+        """
+        Check that a listener can wait for the notification of another VA
+        """
+        self.comp.cont.value = 0.0
+        self.cont_updated = threading.Event()
+        self.waited = []
+        self.comp.cont.subscribe(self.receive_cont)
+        self.comp.prop.subscribe(self.receive_prop_wait)
+
+        self.comp.prop.value = 12
+        time.sleep(2)
+        self.assertEqual(self.waited, [True])
+
+        self.comp.prop.unsubscribe(self.receive_prop_wait)
+        self.comp.cont.unsubscribe(self.receive_cont)
+
+    def receive_cont(self, value):
+        self.cont_updated.set()
+
+    def receive_prop_wait(self, value):
+        # Change another VA, and only return once its new value is notified
+        self.comp.cont.value = 1.0
+        self.waited.append(self.cont_updated.wait(1))
+
     def test_va_override(self):
         self.comp.prop.value = 42
         with self.assertRaises(AttributeError):
@@ -834,6 +1106,7 @@ class MyComponent(model.Component):
         self.startAcquire = model.Event() # triggers when the acquisition of .data starts
         self.data = FakeDataFlow(sae=self.startAcquire)
         self.datas = SynchronizableDataFlow()
+        self.datashm = FakeDataFlow(use_shm=True)
 
         self.data_count = 0
         self._df = None
@@ -844,11 +1117,19 @@ class MyComponent(model.Component):
         self.enum = model.StringEnumerated("a", {"a", "c", "bfds"})
         self.cut = model.IntVA(0, setter=self._setCut)
         self.listval = model.ListVA([2, 65])
+        self.rounded = model.FloatVA(0, setter=self._setRounded)
+        self.getterval = model.FloatVA(0, getter=self._getTime)
 
     def _setCut(self, value):
         self.data.cut = value
         return self.data.cut
 
+    def _setRounded(self, value):
+        return float(round(value))
+
+    def _getTime(self):
+        return time.time()
+
     @roattribute
     def my_value(self):
         return "ro"
@@ -1042,6 +1323,7 @@ class FakeDataFlow(model.DataFlow):
             array = self._create_one(self.shape, self.bpp, self.count)
             if len(array):
                 array[0][0] = self.count
+            array.metadata[model.MD_ACQ_DATE] = time.time()
 #            print "generating array %d" % self.count
             self.notify(array)
             time.sleep(0.05) # wait a bit see if the subscribers still want data
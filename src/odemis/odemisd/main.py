@@ -78,6 +78,11 @@ class BackendContainer(model.Container):
         self._must_stop = threading.Event()
         self._dry_run = dry_run
         # TODO: have an argument to ask for disabling parallel start? same as create_sub_containers?
+        self._ghosts_lock = threading.Lock()  # to be taken to modify .ghosts and .alive
+        self._persistent_lock = threading.RLock()  # to be taken to access the persistent data
+        self._start_time = time.time()
+        # list of (str, float, float, str): component name, start, end, outcome
+        self._startup_timeline = []
 
         # parse the instantiation file
         logging.debug("model instantiation file is: %s", self._model.name)
@@ -108,13 +113,16 @@ class BackendContainer(model.Container):
         """
 
         def on_va_change(value, comp_name=comp.name, prop_name=prop_name):
-            self._persistent_data[comp_name]['properties'][prop_name] = value
-            self._write_persistent_data()
+            with self._persistent_lock:
+                self._persistent_data[comp_name]['properties'][prop_name] = value
+                self._write_persistent_data()
 
-        self._persistent_data.setdefault(comp.name, {}).setdefault('properties', {})
+        with self._persistent_lock:
+            self._persistent_data.setdefault(comp.name, {}).setdefault('properties', {})
         try:
             va = getattr(comp, prop_name)
-            self._persistent_data[comp.name]['properties'][prop_name] = va.value
+            with self._persistent_lock:
+                self._persistent_data[comp.name]['properties'][prop_name] = va.value
         except AttributeError:
             logging.warning("Persistent property %s not found for component %s." % (prop_name, comp.name))
         else:     
@@ -125,17 +133,22 @@ class BackendContainer(model.Container):
         """
         Update all metadata in ._persistent_data and write values to settings file.
         """
-        for comp in self._instantiator.components:
+        # Components might be added simultaneously => work on a copy
+        for comp in list(self._instantiator.components):
             _, md_names = self._instantiator.get_persistent(comp.name)
+            if not md_names:
+                continue
             md_values = comp.getMetadata()
-            for md in md_names:
-                self._persistent_data.setdefault(comp.name, {}).setdefault('metadata', {})
-                fullname = "MD_" + md
-                try:
-                    self._persistent_data[comp.name]['metadata'][md] = md_values[getattr(model, fullname)]
-                except KeyError:
-                    logging.warning("Persistent metadata %s not found on component %s" % (md, comp.name))
-        self._write_persistent_data()
+            with self._persistent_lock:
+                for md in md_names:
+                    self._persistent_data.setdefault(comp.name, {}).setdefault('metadata', {})
+                    fullname = "MD_" + md
+                    try:
+                        self._persistent_data[comp.name]['metadata'][md] = md_values[getattr(model, fullname)]
+                    except KeyError:
+                        logging.warning("Persistent metadata %s not found on component %s" % (md, comp.name))
+        with self._persistent_lock:
+            self._write_persistent_data()
 
     def _write_persistent_data(self):
         """
@@ -186,76 +199,136 @@ class BackendContainer(model.Container):
     def _instantiate_all(self):
         """
         Thread continuously monitoring the components that need to be instantiated
+        The components are started in parallel, as soon as all the components
+        they depend on are available.
         """
+        executor = futures.ThreadPoolExecutor(max_workers=20)
+        starting = {}  # future -> name of the component being instantiated
         try:
             # Hack warning: there is a bug in python when using lock (eg, logging)
-            # and simultaneously using threads and process: is a thread acquires
+            # and simultaneously using threads and process: if a thread acquires
             # a lock while a process is created, it will never be released.
             # See http://bugs.python.org/issue6721
-            # To ensure this is not happening, we wait long enough that all (2)
-            # threads have started (and logging nothing) before creating new processes.
+            # The threads instantiating the components (including this one) hold
+            # the fork gate of the instantiator whenever they run, and the new
+            # container processes are only created when none of them runs.
+            # For the other threads (which are not supposed to log anything
+            # during the start-up), we wait long enough that all (2) have
+            # started before creating new processes.
             time.sleep(1)
 
+            gate = self._instantiator.fork_gate
             mic = self._instantiator.microscope
             failed = set() # set of str: name of components that failed recently
+            timeline_reported = False
             while not self._must_stop.is_set():
-                # Try to start simultaneously all the components that are
-                # independent from each other
-                nexts = set()
-                while not nexts:
+                with gate.running():
+                    # Start all the components which can be started now
                     instantiated = set(c.name for c in mic.alive.value) | {mic.name}
                     nexts = self._instantiator.get_instantiables(instantiated)
-                    # If still some non-failed component, immediately try again,
-                    # otherwise give some time for things to get fixed or broken
                     nexts -= failed
-                    if not nexts:
-                        if self._dry_run:
-                            return # everything instantiated, good enough
-
-                        if self._must_stop.wait(10):
-                            return
-                        failed = set() # not recent anymore
-
-                logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
-
-                for n in nexts:
-                    ghosts = mic.ghosts.value.copy()
-                    if n not in ghosts:
-                        logging.warning("going to instantiate %s but not a ghost", n)
-                    # TODO: run each of them in a future, so that they start
-                    # in parallel, and (bonus) when the future is done, check
-                    # immediately which component can be started. The only
-                    # difficulty is to ensure non-concurrent access to .ghosts
-                    # and .alive .
-                    try:
-                        ghosts[n] = ST_STARTING
-                        mic.ghosts.value = ghosts
-                        newcmps = self._instantiate_component(n)
-                        if self._must_stop.is_set():
-                            # in case the termination was too late to stop these new component
-                            for c in newcmps:
-                                try:
-                                    c.terminate()
-                                except Exception:
-                                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
-                            break
-                    except ValueError:
-                        if self._dry_run:
-                            raise
-                        # We now need to stop, but cannot call terminate()
-                        # directly, as it would deadlock, waiting for us
-                        logging.debug("Stopping instantiation due to unrecoverable error")
-                        threading.Thread(target=self.terminate).start()
-                        return
-                    if not newcmps:
-                        failed.add(n)
+                    nexts -= set(starting.values())
+                    if nexts:
+                        logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
+                    for n in nexts:
+                        if n not in mic.ghosts.value:
+                            logging.warning("going to instantiate %s but not a ghost", n)
+                        self._update_ghosts({n: ST_STARTING})
+                        starting[executor.submit(self._instantiate_component, n)] = n
+
+                if starting:
+                    # As soon as one is done, check which components can be started
+                    done, _ = futures.wait(starting, return_when=futures.FIRST_COMPLETED)
+                    with gate.running():
+                        for f in done:
+                            n = starting.pop(f)
+                            try:
+                                newcmps = f.result()
+                            except ValueError:
+                                if self._dry_run:
+                                    raise
+                                # We now need to stop, but cannot call terminate()
+                                # directly, as it would deadlock, waiting for us
+                                logging.debug("Stopping instantiation due to unrecoverable error")
+                                threading.Thread(target=self.terminate).start()
+                                return
+                            if not newcmps:
+                                failed.add(n)
+                            elif self._must_stop.is_set():
+                                # in case the termination was too late to stop these new component
+                                self._terminate_new_components(newcmps)
+                    continue
+
+                # Nothing left to start for now
+                with gate.running():
+                    if not timeline_reported and not mic.ghosts.value:
+                        self._log_startup_timeline()
+                        timeline_reported = True
+                if self._dry_run:
+                    return # everything instantiated, good enough
+
+                # If some components failed, give some time for things to get
+                # fixed or broken, and try again
+                if self._must_stop.wait(10):
+                    return
+                failed = set() # not recent anymore
 
         except Exception:
             logging.exception("Instantiator thread failed")
             raise
         finally:
+            # Wait for the components still starting, and stop them if we are
+            # stopping, as the termination could have been too late for them.
+            for f, n in starting.items():
+                try:
+                    newcmps = f.result()
+                except Exception:
+                    continue
+                if self._must_stop.is_set():
+                    self._terminate_new_components(newcmps)
+            executor.shutdown(wait=False)
             logging.debug("Instantiator thread finished")
 
+    def _terminate_new_components(self, comps):
+        for c in comps:
+            try:
+                c.terminate()
+            except Exception:
+                logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
+
+    def _update_ghosts(self, changes, new_alive=frozenset()):
+        """
+        Update the .ghosts and .alive VAs of the microscope. Safe to call from
+        multiple threads simultaneously.
+        changes (dict str -> value): component name -> new state. If the value
+          is None, the component is removed from the ghosts.
+        new_alive (set of HwComponent): components to add to .alive
+        """
+        mic = self._instantiator.microscope
+        with self._ghosts_lock:
+            if new_alive:
+                mic.alive.value = mic.alive.value | new_alive
+            ghosts = mic.ghosts.value.copy()
+            for n, state in changes.items():
+                if state is None:
+                    del ghosts[n]
+                else:
+                    ghosts[n] = state
+            mic.ghosts.value = ghosts
+
+    def _log_startup_timeline(self):
+        """
+        Log when each component started and how long it took, relative to the
+        start of the backend
+        """
+        lines = []
+        for name, tstart, tend, outcome in sorted(self._startup_timeline, key=lambda t: t[1]):
+            lines.append("%8.3f s -> %8.3f s (%7.3f s) %s: %s" %
+                         (tstart - self._start_time, tend - self._start_time,
+                          tend - tstart, name, outcome))
+        logging.info("All components started, after %g s:\n%s",
+                     time.time() - self._start_time, "\n".join(lines))
+
     def _instantiate_component(self, name):
         """
         Instantiate a component and handle the outcome
@@ -266,57 +339,59 @@ class BackendContainer(model.Container):
         """
         # TODO: use the AST from the microscope (instead of the original one
         # in _instantiator) to allow modifying it online?
-        mic = self._instantiator.microscope
-        ghosts = mic.ghosts.value.copy()
-        try:
-            comp = self._instantiator.instantiate_component(name)
-        except model.HwError as exp:
-            # HwError means: hardware problem, try again later
-            logging.warning("Failed to start component %s due to device error: %s",
-                            name, exp)
-            ghosts[name] = exp
-            mic.ghosts.value = ghosts
-            return set()
-        except Exception as exp:
-            # Anything else means: microscope file or driver is borked => give up
-            # Exception might have happened remotely, so log it nicely
-            logging.error("Failed to instantiate the model due to component %s", name)
-            logging.error("Full traceback of the error follows", exc_info=1)
+        # Hold the gate while running, so that no new container process is
+        # created while this thread might hold a lock
+        with self._instantiator.fork_gate.running():
+            tstart = time.time()
             try:
-                remote_tb = exp._pyroTraceback
-                logging.info("Remote exception %s", "".join(remote_tb))
-            except AttributeError:
-                pass
-            raise ValueError("Failed to instantiate component %s" % name)
-        else:
-            new_cmps = self._instantiator.get_children(comp)
-
-            # Check it created at least all the expected children
-            new_names = {c.name for c in new_cmps}
-            exp_names = self._instantiator.get_children_names(name)
-            if exp_names - new_names:
-                logging.error("Component %s instantiated components %s, while expected %s",
-                              name, new_names, exp_names)
-                raise ValueError("Component %s didn't instantiate all components" % (name,))
-            elif new_names - exp_names:  # Too many?
-                logging.warning("Component %s instantiated extra unexpected components %s",
-                                name, new_names - exp_names)
-
-            mic.alive.value = mic.alive.value | new_cmps
-            # update ghosts by removing all the new components
-            dchildren = self._instantiator.get_children_names(name)
-            for n in dchildren:
-                del ghosts[n]
-
-            mic.ghosts.value = ghosts
-
-            for c in new_cmps:
-                prop_names, _ = self._instantiator.get_persistent(c.name)
-                for prop_name in prop_names:
-                    self._observe_persistent_va(c, prop_name)
-            self._update_persistent_metadata()
-
-            return new_cmps
+                comp = self._instantiator.instantiate_component(name)
+            except model.HwError as exp:
+                # HwError means: hardware problem, try again later
+                logging.warning("Failed to start component %s due to device error: %s",
+                                name, exp)
+                self._startup_timeline.append((name, tstart, time.time(), "failed (%s)" % (exp,)))
+                self._update_ghosts({name: exp})
+                return set()
+            except Exception as exp:
+                # Anything else means: microscope file or driver is borked => give up
+                # Exception might have happened remotely, so log it nicely
+                logging.error("Failed to instantiate the model due to component %s", name)
+                logging.error("Full traceback of the error follows", exc_info=1)
+                try:
+                    remote_tb = exp._pyroTraceback
+                    logging.info("Remote exception %s", "".join(remote_tb))
+                except AttributeError:
+                    pass
+                raise ValueError("Failed to instantiate component %s" % name)
+            else:
+                new_cmps = self._instantiator.get_children(comp)
+
+                # Check it created at least all the expected children
+                new_names = {c.name for c in new_cmps}
+                exp_names = self._instantiator.get_children_names(name)
+                if exp_names - new_names:
+                    logging.error("Component %s instantiated components %s, while expected %s",
+                                  name, new_names, exp_names)
+                    raise ValueError("Component %s didn't instantiate all components" % (name,))
+                elif new_names - exp_names:  # Too many?
+                    logging.warning("Component %s instantiated extra unexpected components %s",
+                                    name, new_names - exp_names)
+
+                tend = time.time()
+                logging.info("Component %s started in %g s", name, tend - tstart)
+                self._startup_timeline.append((name, tstart, tend, "started"))
+
+                # update ghosts by removing all the new components
+                dchildren = self._instantiator.get_children_names(name)
+                self._update_ghosts({n: None for n in dchildren}, new_cmps)
+
+                for c in new_cmps:
+                    prop_names, _ = self._instantiator.get_persistent(c.name)
+                    for prop_name in prop_names:
+                        self._observe_persistent_va(c, prop_name)
+                self._update_persistent_metadata()
+
+                return new_cmps
 
     def _terminate_all_alive(self):
         """
@@ -26,11 +26,13 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 import collections
+from contextlib import contextmanager
 import itertools
 import logging
 from odemis import model
 from odemis.util import mock
 import re
+import threading
 import yaml
 
 
@@ -136,6 +138,93 @@ def get_class(name):
 # attribute because we want to be able to list all the components.
 
 
+class ForkGate(object):
+    """
+    Lock to pause all the threads instantiating components while a new process
+    is created (forked). Creating a process while another thread holds a lock
+    (eg, from logging) leaves that lock held forever in the new process (cf
+    http://bugs.python.org/issue6721).
+    The threads hold it (in shared mode) with running() while they execute code
+    in this process, and release it with waiting() while they are blocked waiting
+    for another process. A new process should only be created within forking(),
+    which waits until no other thread is running, and blocks them until the end.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._running = 0  # number of threads holding the gate (in shared mode)
+        self._forking = False
+        self._fork_waiting = 0  # number of threads waiting to fork
+        self._local = threading.local()  # .depth: number of running() of the current thread
+
+    def _acquire(self):
+        with self._cond:
+            # Forks have priority, to not be starved by the running threads
+            while self._forking or self._fork_waiting:
+                self._cond.wait()
+            self._running += 1
+
+    def _release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def running(self):
+        """
+        Hold the gate while running code in this process. Can be nested.
+        """
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._acquire()
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._release()
+
+    @contextmanager
+    def waiting(self):
+        """
+        Temporarily release the gate (if held by the current thread), typically
+        while waiting for a remote call to complete.
+        """
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            self._release()
+        self._local.depth = 0
+        try:
+            yield
+        finally:
+            if depth:
+                self._acquire()
+            self._local.depth = depth
+
+    @contextmanager
+    def forking(self):
+        """
+        Hold the gate exclusively, so that a new process can be created while
+        no other thread is running. The current thread may already hold it.
+        """
+        with self.waiting():
+            with self._cond:
+                self._fork_waiting += 1
+                try:
+                    while self._forking or self._running:
+                        self._cond.wait()
+                finally:
+                    self._fork_waiting -= 1
+                self._forking = True
+            try:
+                yield
+            finally:
+                with self._cond:
+                    self._forking = False
+                    self._cond.notify_all()
+
+
 class Instantiator(object):
     """
     manages the instantiation of a whole model
@@ -168,6 +257,13 @@ class Instantiator(object):
         self._comp_container = {}  # comp name -> container: the container that runs the given component
         self.create_sub_containers = create_sub_containers # flag for creating sub-containers
         self.dry_run = dry_run # flag for instantiating mock version of the components
+        # Several components can be instantiated simultaneously (from different
+        # threads), so the lock must be taken to access .components,
+        # .sub_containers, ._comp_container, and .microscope.children.
+        self._lock = threading.RLock()
+        # The threads instantiating components must hold the gate while running,
+        # so that no lock is held by them when a new container process is created.
+        self.fork_gate = ForkGate()
 
         self._preparate_microscope()
 
@@ -532,19 +628,13 @@ class Instantiator(object):
         # use the same container, otherwise, use the root container
 
         # Get the dependencies
-        dependency_names = attr.get("dependencies", {})
-        deps_cont = set()
-        for child_name in dependency_names.values():
-            try:
-                cont = self._comp_container[child_name]
-            except KeyError:
-                logging.warning("Component %s was not created yet, but %s depends on it", child_name, name)
-                continue
-            deps_cont.add(cont)
+        dependency_names = list(attr.get("dependencies", {}).values())
         # Ensure backwards compatibility with old-style children (children = dependencies + delegated comps)
         children_names = attr.get("children", {})
-        for child_name in children_names.values():
-            if "class" in self.ast[child_name]:
+        dependency_names += [c for c in children_names.values() if "class" in self.ast[c]]
+        deps_cont = set()
+        with self._lock:
+            for child_name in dependency_names:
                 try:
                     cont = self._comp_container[child_name]
                 except KeyError:
@@ -586,7 +676,8 @@ class Instantiator(object):
         # it on before we instantiate it
         if "power_supplier" in args:
             f = args["power_supplier"].supply({name: True})
-            f.result()
+            with self.fork_gate.waiting():
+                f.result()
 
         if self.dry_run and not class_name == "Microscope":
             # mock class for everything but Microscope (because it is safe)
@@ -597,21 +688,41 @@ class Instantiator(object):
             cont = self._get_container(name)
             if cont is None:
                 # new container has the same name as the component
-                cont, comp = model.createInNewContainer(name, class_comp, args)
-                self.sub_containers[name] = cont
+                with self.fork_gate.forking():
+                    cont = model.createNewContainer(name, validate=False)
+                try:
+                    # The component is initialised in the other process
+                    with self.fork_gate.waiting():
+                        comp = model.createInContainer(cont, class_comp, args)
+                except Exception:
+                    try:
+                        cont.terminate()  # Non blocking
+                    except Exception:
+                        logging.exception("Failed to stop the container %s after component failure",
+                                          name)
+                    raise
+                with self._lock:
+                    self.sub_containers[name] = cont
             else:
                 logging.debug("Creating %s in container %s", name, cont)
-                comp = model.createInContainer(cont, class_comp, args)
-            self._comp_container[name] = cont
+                if cont is self.root_container:
+                    # Initialised in this process => keep running
+                    comp = model.createInContainer(cont, class_comp, args)
+                else:
+                    with self.fork_gate.waiting():
+                        comp = model.createInContainer(cont, class_comp, args)
         except Exception:
             logging.error("Error while instantiating component %s.", name)
             raise
 
-        self.components.add(comp)
-        # Add all the children, which were created by delegation, to our list of components.
-        self.components |= comp.children.value
-        for child in comp.children.value:
-            self._comp_container[child.name] = cont
+        children = comp.children.value
+        with self._lock:
+            self._comp_container[name] = cont
+            self.components.add(comp)
+            # Add all the children, which were created by delegation, to our list of components.
+            self.components |= children
+            for child in children:
+                self._comp_container[child.name] = cont
 
         return comp
 
@@ -623,7 +734,9 @@ class Instantiator(object):
         Raises:
              LookupError: if no component is found
         """
-        for comp in self.components:
+        with self._lock:
+            comps = frozenset(self.components)
+        for comp in comps:
             if comp.name == name:
                 return comp
         raise LookupError("No component named '%s' found" % name)
@@ -844,11 +957,13 @@ class Instantiator(object):
             ValueError: if the component has already been instantiated
             KeyError: if component should be created by delegation
         """
-        for c in self.components:
-            if c.name == name:
-                raise ValueError("Trying to instantiate again component %s" % name)
+        with self._lock:
+            for c in self.components:
+                if c.name == name:
+                    raise ValueError("Trying to instantiate again component %s" % name)
 
-        comp = self._instantiate_comp(name)
+        with self.fork_gate.running():
+            comp = self._instantiate_comp(name)
 
         # Add to the microscope all the new components that should be child
         mchildren = self._microscope_ast["children"].values()
@@ -859,7 +974,8 @@ class Instantiator(object):
             self._update_metadata(c.name)
             self._update_affects(c.name)
         newchildren = set(c for c in newcmps if c.name in mchildren)
-        self.microscope.children.value = self.microscope.children.value | newchildren
+        with self._lock:
+            self.microscope.children.value = self.microscope.children.value | newchildren
 
         return comp
 
@@ -875,7 +991,8 @@ class Instantiator(object):
         """
         comps = set()
         if instantiated is None:
-            instantiated = set(c.name for c in self.components)
+            with self._lock:
+                instantiated = set(c.name for c in self.components)
         for n, attrs in self.ast.items():
             if n in instantiated: # should not be already instantiated
                 continue
@@ -30,11 +30,12 @@ except ImportError:  # Python 3 naming
 import logging
 from odemis import model
 import odemis
-from odemis.odemisd import main
+from odemis.odemisd import main, modelgen
 from odemis.util import timeout, test
 import os
 import subprocess
 import sys
+import threading
 import time
 import unittest
 import yaml
@@ -190,6 +191,11 @@ class TestCommandLine(unittest.TestCase):
         ret = self._wait_backend_starts(5)
         self.assertEqual(ret, 0, "backend status check returned %d" % (ret,))
 
+        # The components are started in parallel, and their timeline is logged
+        time.sleep(1)
+        with open("testdaemon.log") as f:
+            self.assertIn("All components started", f.read())
+
         # stop the backend
         cmdline = "odemisd --log-level=2 --log-target=test.log --kill"
         ret = main.main(cmdline.split())
@@ -526,6 +532,47 @@ class TestCommandLine(unittest.TestCase):
 # extends the class fully at module
 TestCommandLine.create_tests()
 
+
+class TestForkGate(unittest.TestCase):
+    """
+    Test the lock which pauses the instantiation threads while forking
+    """
+
+    def test_fork_waits_running(self):
+        gate = modelgen.ForkGate()
+        forked = threading.Event()
+
+        def fork():
+            with gate.forking():
+                forked.set()
+
+        with gate.running():
+            t = threading.Thread(target=fork)
+            t.start()
+            self.assertFalse(forked.wait(0.2), "Forked while a thread was running")
+            with gate.running():  # Nested is fine
+                pass
+            with gate.waiting():  # Let the fork happen
+                self.assertTrue(forked.wait(1))
+        t.join()
+
+    def test_running_waits_fork(self):
+        gate = modelgen.ForkGate()
+        ran = threading.Event()
+
+        def run():
+            with gate.running():
+                ran.set()
+
+        with gate.running():
+            with gate.forking():  # Fine, as only the current thread is running
+                t = threading.Thread(target=run)
+                t.start()
+                self.assertFalse(ran.wait(0.2), "Thread ran while forking")
+        self.assertTrue(ran.wait(1))
+        t.join()
+
+
 if __name__ == '__main__':
     unittest.main()
 
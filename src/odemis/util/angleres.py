@@ -21,13 +21,15 @@ If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from collections import OrderedDict
 import math
+import threading
 import matplotlib
 matplotlib.use("Agg")  # use non-GUI backend
 import matplotlib.pyplot as plt
 import numpy
 from numpy import ma
-from scipy.interpolate import LinearNDInterpolator
+from scipy import sparse
 from scipy.spatial import Delaunay as DelaunayTriangulation
 
 from odemis import model
@@ -51,6 +53,14 @@ AR_HOLE_DIAMETER = 0.6e-3  # m, diameter of the hole in the mirror
 AR_FOCUS_DISTANCE = 0.5e-3  # m, the vertical mirror cutoff, iow the min distance between the mirror and the sample
 AR_PARABOLA_F = 2.5e-3  # m, parabola_parameter=1/(4f): f: focal point of mirror (place of sample)
 
+# Number of projection operators kept in memory. Each one can take up to a few
+# hundred MB for the largest output sizes.
+AR_OPERATOR_CACHE_SIZE = 4
+
+# (function, arguments) -> operator, from the least to the most recently used
+_operators = OrderedDict()
+_operators_lock = threading.Lock()
+
 
 def _ExtractAngleInformation(data, hole):
     """
@@ -70,6 +80,31 @@ def _ExtractAngleInformation(data, hole):
             Mask is dilated for visualization to avoid edge effects during triangulation
             and interpolation.
     """
+    theta_data, phi_data, intensity_factor, circle_mask_dilated = _ExtractAngleGeometry(data, hole)
+
+    # intensity_data contains the intensity values from raw data.
+    # It already reflects the shape of the mirror
+    # and is normalized by omega (solid angle:
+    # measure for photon collection efficiency depending on theta and phi)
+    intensity_data = numpy.where(intensity_factor != 0, data, 0) * intensity_factor
+
+    return theta_data, phi_data, intensity_data, circle_mask_dilated
+
+
+def _ExtractAngleGeometry(data, hole):
+    """
+    Calculates the information of _ExtractAngleInformation() which only depends
+    on the mirror geometry, and not on the intensity of the pixels.
+    :param data: (model.DataArray) The image that was projected on the detector after being
+            reflected on the parabolic mirror. Only its shape and metadata are used.
+    :returns:
+        theta_data: array containing theta values for each px in raw data
+        phi_data: array containing phi values for each px in raw data
+        intensity_factor: array containing the factor to apply to each px in raw data
+            to obtain the intensity corrected for photon collection efficiency.
+            It is 0 outside of the mirror.
+        circle_mask_dilated: mask used to crop the data for angles collectible by the system.
+    """
 
     assert (len(data.shape) == 2)  # => 2D with greyscale
 
@@ -83,8 +118,8 @@ def _ExtractAngleInformation(data, hole):
 
     pole_pos = (pole_x, pole_y)
 
-    # Crop the input image to half circle (set values outside of half circle zero)
-    cropped_image = _CropHalfCircle(data, pixel_size, pole_pos, hole=hole)
+    # Mask to crop the input image to half circle (values outside of half circle are zero)
+    circle_mask = _CreateMirrorMask(data, pixel_size, pole_pos, hole=hole)
 
     # return dilated circle_mask to crop input data
     # hole=False for dilated mask to avoid edge effects during interpolation
@@ -117,13 +152,218 @@ def _ExtractAngleInformation(data, hole):
     # phi_data: array containing phi values for each px in raw data
     theta_data, phi_data, omega = _FindAngle(x_array, y_array, pixel_size, parabola_f)
 
-    # intensity_data contains the intensity values from raw data.
-    # It already reflects the shape of the mirror
-    # and is normalized by omega (solid angle:
-    # measure for photon collection efficiency depending on theta and phi)
-    intensity_data = cropped_image / omega
+    # The intensity is normalized by omega (solid angle: measure for photon
+    # collection efficiency depending on theta and phi)
+    intensity_factor = numpy.where(circle_mask, 1 / omega, 0)
 
-    return theta_data, phi_data, intensity_data, circle_mask_dilated
+    return theta_data, phi_data, intensity_factor, circle_mask_dilated
+
+
+def _getMirrorGeometry(data):
+    """
+    Extracts the metadata which defines the projection of the data.
+    :param data: (model.DataArray) The image that was projected on the detector.
+    :returns: (tuple) hashable representation of the shape and the mirror
+      metadata, to be passed to _geometryToData().
+    """
+    md = data.metadata
+    try:
+        geometry = (tuple(data.shape),
+                    tuple(md[model.MD_PIXEL_SIZE]),
+                    tuple(md[model.MD_AR_POLE]),
+                    md.get(model.MD_AR_PARABOLA_F, AR_PARABOLA_F),
+                    md.get(model.MD_AR_XMAX, AR_XMAX),
+                    md.get(model.MD_AR_HOLE_DIAMETER, AR_HOLE_DIAMETER),
+                    md.get(model.MD_AR_FOCUS_DISTANCE, AR_FOCUS_DISTANCE))
+    except KeyError:
+        raise ValueError("Metadata required: MD_PIXEL_SIZE, MD_AR_POLE, MD_AR_PARABOLA_F.")
+    return geometry
+
+
+def _geometryToData(geometry):
+    """
+    Creates a (fake) image corresponding to a mirror geometry.
+    :param geometry: (tuple) as returned by _getMirrorGeometry()
+    :returns: (model.DataArray) image with the right shape and metadata, but
+      with no actual content.
+    """
+    shape, pxs, pole, parabola_f, xmax, hole_diameter, focus_distance = geometry
+    md = {model.MD_PIXEL_SIZE: pxs,
+          model.MD_AR_POLE: pole,
+          model.MD_AR_PARABOLA_F: parabola_f,
+          model.MD_AR_XMAX: xmax,
+          model.MD_AR_HOLE_DIAMETER: hole_diameter,
+          model.MD_AR_FOCUS_DISTANCE: focus_distance}
+    return model.DataArray(numpy.broadcast_to(numpy.float64(0), shape), md)
+
+
+def _InterpolationMatrix(triang, src_indices, src_size, points):
+    """
+    Computes the linear interpolation (on a Delaunay triangulation) as a matrix.
+    The result is the same as the one of scipy.interpolate.LinearNDInterpolator,
+    but it can be computed for any new set of values with a single product.
+    :param triang: (Delaunay) the triangulation of the input positions
+    :param src_indices: (1D ndarray of int) for each point of the triangulation,
+      the index of the input value to use.
+    :param src_size: (int) number of input values
+    :param points: (ndarray of shape (N, 2)) the positions where to interpolate
+    :returns: (scipy.sparse.csr_matrix of shape (N, src_size)) interpolation
+      weights. The positions outside of the triangulation have no weight.
+    """
+    ndim = points.shape[1]
+    simplex = triang.find_simplex(points)
+    inside = numpy.nonzero(simplex >= 0)[0]
+    simplex = simplex[inside]
+
+    # Barycentric coordinates of each point in its triangle
+    trans = triang.transform[simplex]
+    bary = numpy.einsum("ijk,ik->ij", trans[:, :ndim, :], points[inside] - trans[:, ndim, :])
+    weights = numpy.column_stack((bary, 1 - bary.sum(axis=1)))
+
+    rows = numpy.repeat(inside, ndim + 1)
+    cols = src_indices[triang.simplices[simplex]].ravel()
+    return sparse.csr_matrix((weights.ravel(), (rows, cols)), shape=(len(points), src_size))
+
+
+def _getOperator(func, *args):
+    """
+    Returns the projection operator computed by the given function, reusing it
+    if it has been computed recently with the same arguments.
+    :param func: (callable) _PolarOperator or _RectangularOperator
+    :param args: (hashable) the arguments of the function
+    :returns: (scipy.sparse.csr_matrix) the operator
+    """
+    key = (func, args)
+    with _operators_lock:
+        op = _operators.pop(key, None)
+        if op is not None:
+            _operators[key] = op  # Now the most recently used
+            return op
+
+    # Compute it outside of the lock, as it can take a long time
+    op = func(*args)
+    with _operators_lock:
+        _operators[key] = op
+        while len(_operators) > AR_OPERATOR_CACHE_SIZE:
+            _operators.popitem(last=False)
+    return op
+
+
+def _PolarOperator(geometry, output_size, hole):
+    """
+    Computes the projection to polar view, for a given mirror geometry.
+    :param geometry: (tuple) as returned by _getMirrorGeometry()
+    :param output_size: (int) The size of the output (assumed to be square).
+    :param hole: (boolean) Crop the pole if True.
+    :returns: (scipy.sparse.csr_matrix of shape (output_size², Y*X)) the matrix
+      to multiply by the (flattened) data to get the (flattened) polar view.
+    """
+    data = _geometryToData(geometry)
+    theta_data, phi_data, intensity_factor, circle_mask_dilated = _ExtractAngleGeometry(data, hole)
+
+    # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
+    # We use a dilated mask for cropping to avoid edge effects during triangulation and interpolation.
+    # The additional data points (due to dilation) will be set to zero during the interpolation step by intensity_data.
+    theta_data_masked = theta_data[circle_mask_dilated]  # list of values for theta within mask
+    phi_data_masked = phi_data[circle_mask_dilated]  # list of values for phi within mask
+    src_indices = numpy.flatnonzero(circle_mask_dilated)  # position of each value in the data
+
+    # Convert the spherical coordinates theta and phi into polar coordinates for display in GUI
+    # theta equals radial distance r to center of whole (0 - 90 degree)
+    # phi equals angle (0 - 360 degree)
+    # map list of theta to r: map max theta (pi/2) to half the output_size of the final image
+    r = theta_data_masked * output_size / math.pi  # same as: theta_data_masked * (output_size/2) / (math.pi/2)
+    angle = phi_data_masked  # 0 - 2pi
+    x_data_polar = numpy.cos(angle) * r  # x = r * cos(angle)
+    y_data_polar = numpy.sin(angle) * r  # y = r * sin(angle)
+
+    # Multiple theta-phi combinations will be mapped to the same px in the output image after polar-transformation.
+    # Therefore, not all px in the output image are populated.
+    # Moreover, the data is masked with the mirror shape (mask_circle).
+    # Therefore, we perform a delaunay triangulation of the given data points.
+    # Each position of a meshgrid of the size specified for the output image
+    # is then interpolated from the intensity values of the positions spanning
+    # the triangle it is contained in (triangle from delaunay triangulation).
+    # Grid positions located outside of any delaunay triangle are set to 0.
+
+    # Note: delaunay triangulation input points: ndarray of floats, shape (numpyoints, ndim) -> transpose data for input
+    data_transposed = numpy.array([x_data_polar, y_data_polar]).T  # transpose moves angle orientation from CCW to CW
+    triang = DelaunayTriangulation(data_transposed)
+    # create grid of positions for interpolation: neg to pos as x/y data polar
+    # contain now values from -output_size/2 to +output_size/2
+    xi, yi = numpy.meshgrid(numpy.linspace(-output_size / 2, output_size / 2, output_size),
+                            numpy.linspace(-output_size / 2, output_size / 2, output_size))
+    # polar coordinate transformation starts with 0 at horizontal axis by definition
+    # rotate by 90 degrees CCW so we start 0 at top (angles will be CW orientated)
+    xi, yi = numpy.rot90(xi), numpy.rot90(yi)
+    points = numpy.column_stack((xi.ravel(), yi.ravel()))
+
+    interp = _InterpolationMatrix(triang, src_indices, data.size, points)
+    # Apply the intensity correction (and cropping) directly in the operator
+    interp = interp.multiply(intensity_factor.ravel()).tocsr()
+    interp.eliminate_zeros()
+    return interp
+
+
+def _RectangularOperator(geometry, output_size, hole):
+    """
+    Computes the projection to equirectangular view, for a given mirror geometry.
+    :param geometry: (tuple) as returned by _getMirrorGeometry()
+    :param output_size: (int, int) The size of the output (theta, phi).
+    :param hole: (boolean) Crop the pole if True.
+    :returns: (scipy.sparse.csr_matrix of shape (theta*phi, Y*X)) the matrix
+      to multiply by the (flattened) data to get the (flattened) rectangular view.
+    """
+    data = _geometryToData(geometry)
+    theta_data, phi_data, intensity_factor, circle_mask_dilated = _ExtractAngleGeometry(data, hole)
+    pixel_indices = numpy.arange(data.size).reshape(data.shape)
+
+    # extend the data range to take care of edge effects during interpolation step
+    # extend the range of phi from 0 - 2pi to -2pi to 2pi to take care of periodicity of phi
+    # Note: Don't try to extend the image left and right by an amount < pi.
+    # It will lead to the mentioned problems with the interpolation (even pi is not enough).
+
+    # So triple the data for theta, pixel position and mask, and extend phi to cover the range from -2pi to +2pi
+    # for interpolation only use the data from -pi to +3pi, which is sufficient to take care of most edge effects
+    low_border = int(phi_data.shape[1] - phi_data.shape[1] / 2 + 1)
+    high_border = int(phi_data.shape[1] * 2 + phi_data.shape[1] / 2 - 1)
+
+    phi_data_doubled = numpy.append(
+        numpy.append(phi_data - 2 * math.pi, phi_data, axis=1),
+        phi_data + 2 * math.pi, axis=1)[:, low_border: high_border]  # -pi to +3pi
+    theta_data_doubled = numpy.tile(theta_data, (1, 3))[:, low_border: high_border]
+    pixel_indices_doubled = numpy.tile(pixel_indices, (1, 3))[:, low_border: high_border]
+    circle_mask_dilated_doubled = numpy.tile(circle_mask_dilated, (1, 3))[:, low_border: high_border]
+
+    # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
+    # We use a dilated mask for cropping to avoid edge effects during triangulation.
+    # The additional data points (due to dilation) will be set to zero during the interpolation step by intensity_data.
+    theta_data_masked = theta_data_doubled[circle_mask_dilated_doubled]  # list containing values from 0 to +pi/2
+    phi_data_masked = phi_data_doubled[circle_mask_dilated_doubled]  # list containing values from -pi to + 3pi
+    src_indices = pixel_indices_doubled[circle_mask_dilated_doubled]
+
+    # Multiple theta-phi combinations will be mapped to the same px in the output image after polar-transformation.
+    # Therefore, not all px in the output image are populated.
+    # Moreover, the data is masked with the mirror shape (mask_circle).
+    # Therefore, we perform a delaunay triangulation of the given data points.
+    # Each position of a meshgrid of the size specified for the output image
+    # is then interpolated from the intensity values of the positions spanning
+    # the triangle it is contained in (triangle from delaunay triangulation).
+    # Grid positions located outside of any delaunay triangle are set to 0.
+
+    # Note: delaunay triangulation input points: ndarray of floats, shape (numpoints, ndim) -> transpose data for input
+    data_transposed = numpy.array([phi_data_masked, theta_data_masked]).T
+    triang = DelaunayTriangulation(data_transposed)
+    # create grid of positions for interpolation
+    xi, yi = numpy.meshgrid(numpy.linspace(0, 2 * numpy.pi, output_size[1]),
+                            numpy.linspace(0, numpy.pi / 2, output_size[0]))
+    points = numpy.column_stack((xi.ravel(), yi.ravel()))
+
+    interp = _InterpolationMatrix(triang, src_indices, data.size, points)
+    # Apply the intensity correction (and cropping) directly in the operator
+    interp = interp.multiply(intensity_factor.ravel()).tocsr()
+    interp.eliminate_zeros()
+    return interp
 
 
 def _FindAngle(x_array, y_array, pixel_size, parabola_f):
@@ -205,71 +445,17 @@ def AngleResolved2Polar(data, output_size, hole=True):
 
     data = _flipDataIfMirrorFlipped(data)
 
-    # calculate the corresponding theta and phi angles based on the geometrical properties
-    # of the mirror for each px on the raw data
-    # TODO the angles are all the same for a given mirror shape
-    # TODO runtime could be improved by calc mirror shape with pole pos at center and always move data to center
-    # TODO implement: if not theta, phi, intensity -> calc angles
-    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(data, hole)
-
-    # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
-    # We use a dilated mask for cropping to avoid edge effects during triangulation and interpolation.
-    # The additional data points (due to dilation) will be set to zero during the interpolation step by intensity_data.
-    theta_data_masked = theta_data[circle_mask_dilated]  # list of values for theta within mask
-    phi_data_masked = phi_data[circle_mask_dilated]  # list of values for phi within mask
-    intensity_data_masked = intensity_data[circle_mask_dilated]  # list of values for intensity within mask
-
-    # Convert the spherical coordinates theta and phi into polar coordinates for display in GUI
-    # theta equals radial distance r to center of whole (0 - 90 degree)
-    # phi equals angle (0 - 360 degree)
-    # map list of theta to r: map max theta (pi/2) to half the output_size of the final image
-    r = theta_data_masked * output_size / math.pi  # same as: theta_data_masked * (output_size/2) / (math.pi/2)
-    angle = phi_data_masked  # 0 - 2pi
-    x_data_polar = numpy.cos(angle) * r  # x = r * cos(angle)
-    y_data_polar = numpy.sin(angle) * r  # y = r * sin(angle)
-
-    # Multiple theta-phi combinations will be mapped to the same px in the output image after polar-transformation.
-    # Therefore, not all px in the output image are populated.
-    # Moreover, the data is masked with the mirror shape (mask_circle).
-    # Therefore, we perform a delaunay triangulation of the given data points.
-    # The delaunay object is passed to the interpolator with the corresponding intensity values (intensity_data).
-    # The interpolator also receives a meshgrid (set of coordinates) of the size specified for the output image.
-    # The input data points (theta and phi) are mapped on the meshgrid. As the meshgrid contains much more positions
-    # compared to the input data points, the interpolator fills up the empty grid positions with intensity values.
-    # These intensity values are interpolated from the intensity values of the positions spanning the triangle they
-    # are contained in (triangle from delaunay triangulation).
-    # Grid positions located outside of any delaunay triangle are set to NaN.
-
-    # Note: delaunay triangulation input points: ndarray of floats, shape (numpyoints, ndim) -> transpose data for input
-    data_transposed = numpy.array([x_data_polar, y_data_polar]).T  # transpose moves angle orientation from CCW to CW
-    triang = DelaunayTriangulation(data_transposed)
-    # create interpolation object
-    interp = LinearNDInterpolator(triang, intensity_data_masked.flat)
-    # create grid of positions for interpolation: neg to pos as x/y data polar
-    # contain now values from -output_size/2 to +output_size/2
-    xi, yi = numpy.meshgrid(numpy.linspace(-output_size / 2, output_size / 2, output_size),
-                            numpy.linspace(-output_size / 2, output_size / 2, output_size))
+    # The angles corresponding to each px of the raw data only depend on the
+    # geometrical properties of the mirror, so the whole projection is computed
+    # once, as a (cached) matrix, and then just applied to the data.
+    operator = _getOperator(_PolarOperator, _getMirrorGeometry(data), output_size, hole)
+    qz = operator.dot(numpy.asarray(data, dtype=numpy.float64).ravel())
+    qz.shape = (output_size, output_size)
+    qz[numpy.isnan(qz)] = 0  # remove NaNs, which could come from the data
 
-    # interpolate
-    qz = interp(xi, yi)
-    # polar coordinate transformation starts with 0 at horizontal axis by definition
-    qz = numpy.rot90(qz)  # rotate by 90 degrees CCW so we start 0 at top (angles will be CW orientated)
-    qz[numpy.isnan(qz)] = 0  # remove NaNs created during interpolation
     assert numpy.all(qz > -1)  # there should be no negative values, some very small due to interpolation are possible
     qz[qz < 0] = 0  # all negative values (due to interpolation or wrong background subtraction) set to zero
 
-    # plot the data
-    # plt.figure()
-    # plt.plot(theta_data_polar, phi_data_polar)
-    #
-    # plt.figure()
-    # plt.plot(triang.points[:, 0], triang.points[:, 1])
-    #
-    # plt.figure()
-    # plt.plot(triang.points[:, 0], triang.points[:, 1], 'o')
-    # plt.triplot(triang.points[:, 0], triang.points[:, 1], triang.simplices.copy())
-    # plt.title("delaunay tesselation (triangulation)")
-
     return model.DataArray(qz, data.metadata)
 
 
@@ -291,67 +477,12 @@ def AngleResolved2Rectangular(data, output_size, hole=True):
 
     data = _flipDataIfMirrorFlipped(data)
 
-    # calculate the corresponding theta and phi angles based on the geometrical properties
-    # of the mirror for each px on the raw data
-    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(data, hole)
-
-    # extend the data range to take care of edge effects during interpolation step
-    # extend the range of phi from 0 - 2pi to -2pi to 2pi to take care of periodicity of phi
-    # Note: Don't try to extend the image left and right by an amount < pi.
-    # It will lead to the mentioned problems with the interpolation (even pi is not enough).
-    # e.g. don't try the following - it produces edge effects...
-    # num = int(phi_data.shape[0] / 4)  # = pi
-    # phi_data_edge = numpy.append(numpy.append((phi_data - 2 * math.pi)[:, -num:], phi_data, axis=1),
-    #                              (phi_data + 2 * math.pi)[:, :num], axis=1)
-    # theta_data_edge = numpy.append(numpy.append(theta_data[:,-num:], theta_data, axis=1), theta_data[:,:num], axis=1)
-    # intensity_data_edge = numpy.append(numpy.append(intensity_data[:,-num:], intensity_data, axis=1),
-    #                                      intensity_data[:,:num], axis=1)
-    # circle_mask_dilated_2 = numpy.append(numpy.append(circle_mask_dilated[:, -num:], circle_mask_dilated, axis=1),
-    #                                      circle_mask_dilated[:, :num], axis=1)
-
-    # So triple the data for theta, intensity and mask, and extend phi to cover the range from -2pi to +2pi
-    # for interpolation only use the data from -pi to +3pi, which is sufficient to take care of most edge effects
-    low_border = int(phi_data.shape[1] - phi_data.shape[1] / 2 + 1)
-    high_border = int(phi_data.shape[1] * 2 + phi_data.shape[1] / 2 - 1)
-
-    phi_data_doubled = numpy.append(
-        numpy.append(phi_data - 2 * math.pi, phi_data, axis=1),
-        phi_data + 2 * math.pi, axis=1)[:, low_border: high_border]  # -pi to +3pi
-    theta_data_doubled = numpy.tile(theta_data, (1, 3))[:, low_border: high_border]
-    intensity_data_doubled = numpy.tile(intensity_data, (1, 3))[:, low_border: high_border]
-    circle_mask_dilated_doubled = numpy.tile(circle_mask_dilated, (1, 3))[:, low_border: high_border]
-
-    # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
-    # We use a dilated mask for cropping to avoid edge effects during triangulation.
-    # The additional data points (due to dilation) will be set to zero during the interpolation step by intensity_data.
-    theta_data_masked = theta_data_doubled[circle_mask_dilated_doubled]  # list containing values from 0 to +pi/2
-    phi_data_masked = phi_data_doubled[circle_mask_dilated_doubled]  # list containing values from -pi to + 3pi
-    intensity_data_masked = intensity_data_doubled[circle_mask_dilated_doubled]
-
-    # Multiple theta-phi combinations will be mapped to the same px in the output image after polar-transformation.
-    # Therefore, not all px in the output image are populated.
-    # Moreover, the data is masked with the mirror shape (mask_circle).
-    # Therefore, we perform a delaunay triangulation of the given data points.
-    # The delaunay object is passed to the interpolator with the corresponding intensity values (intensity_data).
-    # The interpolator also receives a meshgrid (set of coordinates) of the size specified for the output image.
-    # The input data points (theta and phi) are mapped on the meshgrid. As the meshgrid contains much more positions
-    # compared to the input data points, the interpolator fills up the empty grid positions with intensity values.
-    # These intensity values are interpolated from the intensity values of the positions spanning the triangle they
-    # are contained in (triangle from delaunay triangulation).
-    # Grid positions located outside of any delaunay triangle are set to NaN.
-
-    # Note: delaunay triangulation input points: ndarray of floats, shape (numpoints, ndim) -> transpose data for input
-    data_transposed = numpy.array([phi_data_masked, theta_data_masked]).T
-    triang = DelaunayTriangulation(data_transposed)
-    # create interpolation object
-    interp = LinearNDInterpolator(triang, intensity_data_masked.flat)
-    # create grid of positions for interpolation
-    xi, yi = numpy.meshgrid(numpy.linspace(0, 2 * numpy.pi, output_size[1]),
-                            numpy.linspace(0, numpy.pi / 2, output_size[0]))
-
-    # interpolate
-    qz = interp(xi, yi)
-    qz[numpy.isnan(qz)] = 0  # remove NaNs created during interpolation but keep negative values
+    # The projection only depends on the geometrical properties of the mirror,
+    # so it is computed once, as a (cached) matrix, and then applied to the data.
+    operator = _getOperator(_RectangularOperator, _getMirrorGeometry(data), tuple(output_size), hole)
+    qz = operator.dot(numpy.asarray(data, dtype=numpy.float64).ravel())
+    qz.shape = tuple(output_size)
+    qz[numpy.isnan(qz)] = 0  # remove NaNs, which could come from the data but keep negative values
 
     return model.DataArray(qz, data.metadata)
 
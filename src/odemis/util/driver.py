@@ -25,6 +25,7 @@ from Pyro4.errors import CommunicationError
 import collections
 import logging
 import math
+import numpy
 from odemis import model
 import os
 import re
@@ -246,3 +247,103 @@ def get_backend_status():
         return BACKEND_DEAD
 
     return BACKEND_DEAD  # Note: unreachable, but leave in case code will be changed
+
+
+class _BufferLease(object):
+    """
+    Owner of the memory of an array provided by a BufferPool. All the arrays
+    using this memory (including views, and DataArrays created from them) keep
+    a reference to it, so it's only garbage collected once none of them is used.
+    At that moment, the memory is given back to the pool.
+    """
+    __slots__ = ("__array_interface__", "buffer", "_pool")
+
+    def __init__(self, pool, buf, shape, dtype):
+        """
+        pool (BufferPool): the pool to which the memory is given back
+        buf (numpy.ndarray of uint8): the memory, big enough to contain the array
+        shape (tuple of int): shape of the array
+        dtype (numpy.dtype): type of the array
+        """
+        self._pool = pool
+        self.buffer = buf
+        self.__array_interface__ = {"version": 3,
+                                    "shape": shape,
+                                    "typestr": dtype.str,
+                                    "data": (buf.ctypes.data, False),
+                                   }
+
+    def __del__(self):
+        self._pool._release(self.buffer)
+
+
+class BufferPool(object):
+    """
+    Pool of memory buffers for the frames of a camera. Allocating a new (large)
+    buffer for every frame costs time, and makes the memory usage grow, as the
+    memory is not always given back to the system. Instead, the pool provides
+    arrays whose memory is recycled automatically once they are not used anymore,
+    that is, when all the arrays (and DataArrays, and views) sharing this memory
+    have been garbage collected.
+    The pool is thread-safe.
+    """
+
+    def __init__(self, max_free=4):
+        """
+        max_free (0<=int): maximum number of unused buffers to keep. When more
+          buffers are released, the oldest ones are freed.
+        """
+        self._max_free = max_free
+        self._free = collections.OrderedDict()  # id -> buffer (numpy.ndarray of uint8)
+        self._lock = threading.Lock()
+        # Statistics
+        self.hits = 0  # number of requests satisfied with a recycled buffer
+        self.misses = 0  # number of requests which needed a new buffer
+
+    def get(self, shape, dtype):
+        """
+        Provides an array of the given shape and type. Its content is undefined.
+        shape (tuple of int): shape of the array
+        dtype (numpy.dtype): type of the array
+        return (numpy.ndarray): C-contiguous array. Its memory goes back to the
+          pool when it is not used anymore.
+        """
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+        with self._lock:
+            for i, b in self._free.items():
+                if b.nbytes == nbytes:
+                    del self._free[i]
+                    buf = b
+                    self.hits += 1
+                    break
+            else:
+                buf = None
+                self.misses += 1
+
+        if buf is None:
+            buf = numpy.empty(nbytes, dtype=numpy.uint8)
+
+        return numpy.asarray(_BufferLease(self, buf, tuple(shape), dtype))
+
+    def _release(self, buf):
+        """
+        Called when a buffer is not used anymore
+        """
+        with self._lock:
+            self._free[id(buf)] = buf
+            while len(self._free) > self._max_free:
+                self._free.popitem(last=False)
+
+    def clear(self):
+        """
+        Frees all the unused buffers
+        """
+        with self._lock:
+            self._free.clear()
+
+    def __len__(self):
+        """
+        return (int): number of unused buffers currently in the pool
+        """
+        return len(self._free)
@@ -24,11 +24,15 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
 import math
+import multiprocessing
 import numpy
 from odemis import model
 import scipy.ndimage
+import threading
 import cv2
 from odemis.util.conversion import get_img_transformation_matrix
 
@@ -40,6 +44,12 @@ except ImportError:
     logging.warn("Failed to load optimised functions, slow version will be used.")
     img_fast = None
 
+# Number of threads used to convert an image to RGB
+RGB_THREADS = multiprocessing.cpu_count()
+# Minimum number of pixels converted by each thread (as starting a thread has a cost)
+RGB_MIN_PX_PER_THREAD = 2 ** 17
+_rgb_executor = ThreadPoolExecutor(max_workers=RGB_THREADS)
+
 # This is a weave-based optimised version (but weave requires g++ installed)
 #def DataArray2RGB_fast(data, irange, tint=(255, 255, 255)):
 #    """
@@ -186,25 +196,67 @@ def compactHistogram(hist, length):
     chist = hist.reshape(length, hist.size // length)
     return numpy.sum(chist, 1)
 
-# TODO: compute histogram faster. There are several ways:
-# * x=numpy.bincount(a.flat, minlength=depth) => fast (~0.03s for
-#   a 2048x2048 array) but only works on flat array with uint8 and uint16 and
-#   creates 2**16 bins if uint16 (so need to do a reshape and sum on top of it)
-# * numpy.histogram(a, bins=256, range=(0,depth)) => slow (~0.09s for a
-#   2048x2048 array) but works exactly as needed directly in every case.
-# * see weave? (~ 0.01s for 2048x2048 array of uint16) eg:
-#  timeit.timeit("counts=numpy.zeros((2**16), dtype=numpy.uint32);
-#  weave.inline( code, ['counts', 'idxa'])", "import numpy;from scipy import weave; code=r\"for (int i=0; i<Nidxa[0]; i++) { COUNTS1( IDXA1(i)>>8)++; }\"; idxa=numpy.ones((2048*2048), dtype=numpy.uint16)+15", number=100)
-# * see cython?
-# for comparison, a.min() + a.max() are 0.01s for 2048x2048 array
+# Maximum number of bins of a histogram of integer data (if the range is bigger,
+# each bin contains several values)
+HIST_MAX_INT_BINS = 8192
+
+
+def _subsample(data, max_samples):
+    """
+    Pick a regular subset of the data, in every dimension
+    data (numpy.ndarray): the data
+    max_samples (0<int): maximum number of values to keep (approximately)
+    return (numpy.ndarray): a (strided) view on the data
+    """
+    ndim = sum(1 for s in data.shape if s > 1)
+    if ndim == 0 or data.size <= max_samples:
+        return data
+    step = int(math.ceil((data.size / max_samples) ** (1 / ndim)))
+    return data.view(numpy.ndarray)[tuple(slice(None, None, step) for _ in data.shape)]
 
 
-def histogram(data, irange=None):
+def _histogram_int_pow2(data, irange):
+    """
+    Compute the histogram of integer data, when the range is a power of 2 wide,
+    by using bincount on the (shifted) values. It gives the same result as
+    numpy.histogram(), but in a fraction of the time.
+    data (numpy.ndarray of ints)
+    irange (tuple of 2 ints): min/max values, within the range of the data type
+    return (ndarray 1D of 0<=int): the histogram, with min(width, HIST_MAX_INT_BINS) bins
+    """
+    width = int(irange[1]) - int(irange[0]) + 1
+    length = min(HIST_MAX_INT_BINS, width)
+    shift = (width // length).bit_length() - 1
+    # Work on the unsigned version, so that substracting the minimum always
+    # fits. Values outside of the range wrap, and end up above the range.
+    udt = numpy.dtype("u%d" % data.itemsize)
+    idx = data.view(numpy.ndarray).view(udt)
+    owned = False
+    if irange[0] != 0:
+        irange0 = numpy.array(irange[0], dtype=data.dtype).view(udt)
+        idx = numpy.subtract(idx, irange0, dtype=udt)
+        owned = True
+    if shift:
+        idx = numpy.right_shift(idx, shift, out=idx if owned else None)
+        owned = True
+    # Put all the values outside of the range in an extra bin
+    idx = numpy.minimum(idx, length, out=idx if owned else None)
+    if idx.dtype.itemsize >= 8:
+        idx = idx.view(numpy.int64)  # bincount refuses uint64 (but all values are small)
+    return numpy.bincount(idx.ravel(), minlength=length + 1)[:length]
+
+
+def histogram(data, irange=None, max_samples=None):
     """
     Compute the histogram of the given image.
     data (numpy.ndarray of numbers): greyscale image
     irange (None or tuple of 2 unsigned int): min/max values to be found
       in the data. None => auto (min, max will be detected from the data)
+    max_samples (None or 0<int): if the data contains more values, only a
+      regular subset of the data (in every dimension) is used. This is much
+      faster, and typically good enough for display. Note that in such case,
+      the total count of the histogram is smaller than the size of the data.
+      None => all the data is used.
     return hist, edges:
      hist (ndarray 1D of 0<=int): number of pixels with the given value
       Note that the length of the returned histogram is not fixed. If irange
@@ -214,6 +266,9 @@ def histogram(data, irange=None):
        edges[1] is included in the bin. If irange is defined, it's the same
        values.
     """
+    if max_samples is not None:
+        data = _subsample(data, max_samples)
+
     if irange is None:
         if data.dtype.kind in "biu":
             idt = numpy.iinfo(data.dtype)
@@ -228,18 +283,19 @@ def histogram(data, irange=None):
 
     # short-cuts (for the most usual types)
     if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and len(data) > 0:
-        # TODO: for int (irange[0] < 0), treat as unsigned, and swap the first
-        # and second halves of the histogram.
-        # TODO: for 32 or 64 bits with full range, convert to a view looking
-        # only at the 2 high bytes.
         length = irange[1] - irange[0] + 1
         hist = numpy.bincount(data.flat, minlength=length)
         edges = (0, hist.size - 1)
         if edges[1] > irange[1]:
             logging.warning("Unexpected value %d outside of range %s", edges[1], irange)
+    elif (data.dtype.kind in "iu" and data.size > 0 and
+          _is_pow2_range(irange, data.dtype)):
+        # Typically, the range is based on the BPP, or the full type.
+        hist = _histogram_int_pow2(data, irange)
+        edges = (irange[0], irange[1])
     else:
         if data.dtype.kind in "biu":
-            length = min(8192, irange[1] - irange[0] + 1)
+            length = min(HIST_MAX_INT_BINS, irange[1] - irange[0] + 1)
         else:
             # For floats, it will automatically find the minimum and maximum
             length = 256
@@ -250,6 +306,176 @@ def histogram(data, irange=None):
     return hist, edges
 
 
+def _is_pow2_range(irange, dtype):
+    """
+    return (bool): True if the (integer) range has a width which is a power of 2,
+      and fits in the given data type.
+    """
+    idt = numpy.iinfo(dtype)
+    if not idt.min <= irange[0] < irange[1] <= idt.max:
+        return False
+    if int(irange[0]) != irange[0] or int(irange[1]) != irange[1]:
+        return False
+    width = int(irange[1]) - int(irange[0]) + 1
+    return width & (width - 1) == 0
+
+
+class HistogramAccumulator(object):
+    """
+    Computes the histogram of data received progressively, in several parts
+    (eg, during a scan). Each part only has to be looked at once, so getting
+    the histogram of the whole data doesn't require to go through all of it
+    again.
+    For integers of 16 bits or less, each value has its own bin. For the other
+    types, the bins cover the range of the data received so far. When new data
+    is outside of this range, the width of the bins is doubled (by merging pairs
+    of bins), so that the histogram is always exact, although at a lower
+    resolution.
+    Data must be passed with the same dtype every time. It's thread-safe.
+    """
+
+    def __init__(self, length=HIST_MAX_INT_BINS):
+        """
+        length (0<int): number of bins used for data which is not integer of
+          16 bits or less. The histogram returned might be shorter.
+        """
+        self._length = length
+        self._lock = threading.Lock()
+        self._dtype = None
+        self._hist = None  # ndarray of ints
+        self._lo = None  # value of the start of the first bin
+        self._bw = None  # width of each bin (power of 2)
+
+    def add(self, data):
+        """
+        Add data to the histogram
+        data (numpy.ndarray of numbers): data not yet added
+        """
+        data = data.view(numpy.ndarray)
+        if data.dtype.kind == "b":
+            data = data.view(numpy.uint8)
+        if data.size == 0:
+            return
+        if data.dtype.kind in "iu" and data.itemsize <= 2:
+            # Use the values themselves as indices
+            udt = numpy.dtype("u%d" % data.itemsize)
+            hist = numpy.bincount(data.view(udt).ravel(), minlength=2 ** (8 * data.itemsize))
+            with self._lock:
+                self._check_dtype(data.dtype)
+                if self._hist is None:
+                    self._hist = hist
+                else:
+                    self._hist += hist
+            return
+
+        if data.dtype.kind == "f":
+            mn, mx = data.min(), data.max()
+            if not (numpy.isfinite(mn) and numpy.isfinite(mx)):
+                data = data[numpy.isfinite(data)]
+                if data.size == 0:
+                    return
+                mn, mx = data.min(), data.max()
+            mn, mx = float(mn), float(mx)
+        else:
+            mn, mx = int(data.min()), int(data.max())
+
+        with self._lock:
+            self._check_dtype(data.dtype)
+            self._extend(mn, mx)
+            lo, bw = self._lo, self._bw
+            if data.dtype.kind == "f":
+                idx = numpy.subtract(data, lo, dtype=numpy.float64)
+                idx /= bw
+                idx = idx.astype(numpy.intp)
+                # Due to floating point rounding, the max might just be on the edge
+                numpy.minimum(idx, self._length - 1, out=idx)
+            else:
+                idx = numpy.subtract(data, lo, dtype=numpy.int64)
+                numpy.right_shift(idx, bw.bit_length() - 1, out=idx)
+            self._hist += numpy.bincount(idx.ravel(), minlength=self._length)
+
+    def _check_dtype(self, dtype):
+        if self._dtype is None:
+            self._dtype = dtype
+        elif self._dtype != dtype:
+            raise ValueError("Data of type %s cannot be added to histogram of %s" %
+                             (dtype, self._dtype))
+
+    def _extend(self, mn, mx):
+        """
+        Ensure the bins cover the given range, by increasing the width of the bins
+        mn, mx (numbers): minimum and maximum values to cover
+        """
+        length = self._length
+        if self._hist is None:
+            if isinstance(mn, int):
+                bw = 1
+            else:
+                # Start with bins as thin as possible, while still covering the data
+                width = (mx - mn) if mx > mn else abs(mn)
+                # frexp() returns e such that x = m * 2**e, with 0.5 <= m < 1
+                e = math.frexp(max(width, 1e-300) / length)[1]
+                bw = 2.0 ** (e - 1)
+            self._bw = bw
+            self._lo = (mn // bw) * bw
+            self._hist = numpy.zeros(length, dtype=numpy.int64)
+        else:
+            mn = min(mn, self._lo)
+            mx = max(mx, self._lo + (length - 1) * self._bw)
+
+        bw = self._bw
+        while True:
+            lo = (mn // bw) * bw  # the bins are always aligned on their width
+            if mx < lo + length * bw:
+                break
+            bw *= 2
+
+        if bw != self._bw:
+            # Merge the old bins into the new, wider, bins
+            shift = int(round((self._lo - lo) / self._bw))
+            factor = int(round(bw / self._bw))
+            nidx = (numpy.arange(length) + shift) // factor
+            hist = numpy.zeros(length, dtype=numpy.int64)
+            numpy.add.at(hist, nidx, self._hist)
+            self._hist = hist
+            self._bw = bw
+        elif lo != self._lo:
+            # Same width, just move the bins
+            shift = int(round((self._lo - lo) / bw))
+            hist = numpy.zeros(length, dtype=numpy.int64)
+            hist[shift:] = self._hist[:length - shift]
+            self._hist = hist
+        self._lo = lo
+
+    def get(self):
+        """
+        return hist, edges: in the same format as histogram(). The histogram is
+          empty if no data has been received yet.
+        """
+        with self._lock:
+            if self._hist is None:
+                return numpy.zeros(0, dtype=numpy.int64), (0, 0)
+            if self._bw is None:
+                # One bin per value
+                hist = self._hist.copy()
+                idt = numpy.iinfo(self._dtype)
+                if idt.min < 0:
+                    # Bins were ordered by the unsigned values => negatives are at the end
+                    hist = numpy.roll(hist, hist.size // 2)
+                return hist, (idt.min, idt.max)
+
+            # Only return the bins which contain data
+            nz = numpy.flatnonzero(self._hist)
+            first, last = nz[0], nz[-1]
+            hist = self._hist[first:last + 1].copy()
+            lo, bw = self._lo, self._bw
+            if self._dtype.kind == "f":
+                edges = (lo + first * bw, lo + (last + 1) * bw)
+            else:
+                edges = (lo + first * bw, lo + (last + 1) * bw - 1)
+            return hist, edges
+
+
 def guessDRange(data):
     """
     Guess the data range of the data given.
@@ -293,10 +519,9 @@ def isClipping(data, drange=None):
 
 # TODO: try to do cumulative histogram value mapping (=histogram equalization)?
 # => might improve the greys, but might be "too" clever
-def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
+def DataArray2RGB(data, irange=None, tint=(255, 255, 255), out=None):
     """
-    :param data: (numpy.ndarray of unsigned int) 2D image greyscale (unsigned
-        float might work as well)
+    :param data: (numpy.ndarray of int or float) 2D image greyscale
     :param irange: (None or tuple of 2 values) min/max intensities mapped
         to black/white
         None => auto (min, max are from the data);
@@ -304,10 +529,12 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         min must be < max, and must be of the same type as data.dtype.
     :param tint: (3-tuple of 0 < int <256) RGB colour of the final image (each
         pixel is multiplied by the value. Default is white.
+    :param out: (None or numpy.ndarray of uint8 of shape data.shape + (3 or 4,))
+        where to write the result. If it has 4 channels (RGBA), the alpha channel
+        is set to 255 (opaque). If None, a new RGB array is created.
     :return: (numpy.ndarray of 3*shape of uint8) converted image in RGB with the
-        same dimension
+        same dimension (or out, if it was provided)
     """
-    # TODO: handle signed values
     assert(data.ndim == 2) # => 2D with greyscale
 
     # Discard the DataArray aspect and just get the raw array, to be sure we
@@ -330,66 +557,159 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         if irange[0] == irange[1]:
             logging.info("Requested RGB conversion with null-range %s", irange)
 
+    if data.dtype.kind in "iu":
+        # Ensure B&W if there is only one value allowed
+        if irange[0] >= irange[1]:
+            if irange[0] > numpy.iinfo(data.dtype).min:
+                irange = (irange[0] - 1, irange[0])
+            else:
+                irange = (irange[0], irange[0] + 1)
+    else:  # floats et al.
+        # Ensure B&W if there is just one value allowed
+        if irange[0] >= irange[1]:
+            irange = (irange[0] - 1e-9, irange[0])
+
+    if out is None:
+        rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+    else:
+        if out.shape[:2] != data.shape or out.shape[2:] not in ((3,), (4,)) or out.dtype != numpy.uint8:
+            raise ValueError("out should be of shape %s + (3 or 4,) and uint8, but got %s %s" %
+                             (data.shape, out.shape, out.dtype))
+        rgb = out
+        if rgb.shape[2] == 4:
+            rgb[:, :, 3] = 255
+    tint = tuple(tint)
+
+    # Small integers (8 or 16 bits) => use a look-up table, once there are
+    # enough pixels to be worthy.
+    if data.dtype.kind in "iu" and data.dtype.itemsize <= 2 and data.size >= 2 ** (8 * data.dtype.itemsize) // 4:
+        lut = _get_rgb_lut(data.dtype, irange[0], irange[1], tint)
+        # The look-up table index is the bit pattern of the value, so that signed
+        # values can be used without conversion.
+        idx = data.view(numpy.dtype("u%d" % data.dtype.itemsize))
+        # Note: with mode="raise" (default), numpy.take() always uses a temporary buffer
+        if rgb.shape[2] == 4 and rgb.flags.c_contiguous:
+            # RGBA => copy each pixel at once, as a 32-bit value (~2x faster)
+            lut32 = numpy.empty((lut.shape[0], 4), dtype=numpy.uint8)
+            lut32[:, :3] = lut
+            lut32[:, 3] = 255
+            lut32 = lut32.view(numpy.uint32)[:, 0]
+            rgb32 = rgb.view(numpy.uint32)[:, :, 0]
+            convert = lambda s, e: numpy.take(lut32, idx[s:e], out=rgb32[s:e], mode="clip")
+        else:
+            convert = lambda s, e: numpy.take(lut, idx[s:e], axis=0, out=rgb[s:e, :, :3], mode="clip")
+    else:
+        convert = functools.partial(_DataArray2RGB_numpy, data, irange, tint, rgb)
+        if img_fast:
+            fast_convert = functools.partial(img_fast.DataArray2RGB, data, irange, tint, rgb)
+            try:
+                fast_convert(0, 0)  # Converts no row, but checks the data is supported
+                convert = fast_convert
+            except ValueError as exp:
+                logging.info("Fast conversion cannot run: %s", exp)
+            except Exception:
+                logging.exception("Failed to use the fast conversion")
+
+    # Convert (in parallel) each block of rows
+    nblocks = max(1, min(RGB_THREADS, data.shape[0], data.size // RGB_MIN_PX_PER_THREAD))
+    bounds = [data.shape[0] * i // nblocks for i in range(nblocks + 1)]
+    fs = [_rgb_executor.submit(convert, s, e) for s, e in zip(bounds[1:-1], bounds[2:])]
+    convert(bounds[0], bounds[1])
+    for f in fs:
+        f.result()
+
+    return rgb
+
+
+# (dtype, irange0, irange1, tint) -> LUT, as returned by _get_rgb_lut()
+_rgb_luts = {}
+# Maximum number of LUTs kept (each one takes up to 192 KB)
+RGB_LUTS_CACHE_SIZE = 8
+
+
+def _get_rgb_lut(dtype, irange0, irange1, tint):
+    """
+    Compute the look-up table to convert integer values to RGB
+    :param dtype: (numpy.dtype) type of the data (integer of 8 or 16 bits)
+    :param irange0, irange1: min/max intensities mapped to black/white
+    :param tint: (3-tuple of 0 < int <256) RGB colour of the white
+    :return: (numpy.ndarray of uint8 of shape (2**bits, 3)): RGB value for each
+      value, with the bit pattern of the value as index
+    """
+    key = (dtype, irange0, irange1, tint)
+    try:
+        return _rgb_luts[key]
+    except KeyError:
+        pass
+
+    values = numpy.arange(2 ** (8 * dtype.itemsize), dtype=numpy.dtype("u%d" % dtype.itemsize)).view(dtype)
+    lut = numpy.empty((1, values.size, 3), dtype=numpy.uint8)
+    _DataArray2RGB_numpy(values.reshape(1, -1), (irange0, irange1), tint, lut)
+    lut.shape = (values.size, 3)
+    lut.flags.writeable = False
+
+    if len(_rgb_luts) >= RGB_LUTS_CACHE_SIZE:
+        _rgb_luts.clear()
+    _rgb_luts[key] = lut
+    return lut
+
+
+def _DataArray2RGB_numpy(data, irange, tint, rgb, start=0, end=None):
+    """
+    Standard version of DataArray2RGB(), using numpy
+    :param data: (numpy.ndarray) 2D image greyscale
+    :param irange: (tuple of 2 values) min/max intensities mapped to black/white
+        (min < max)
+    :param tint: (3-tuple of 0 < int <256) RGB colour of the final image
+    :param rgb: (numpy.ndarray of uint8 of shape data.shape + (3 or 4,)) where
+        the result is written. The alpha channel (if any) is not touched.
+    :param start: (0<=int) first row to convert
+    :param end: (None or 0<=int) last row (excluded) to convert. None means the last row.
+    """
+    data = data[start:end]
+    rgb = rgb[start:end]
+
     if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
         # short-cut when data is already the same type
         # logging.debug("Applying direct range mapping to RGB")
         drescaled = data
-        # TODO: also write short-cut for 16 bits by reading only the high byte?
     else:
         # If data might go outside of the range, clip first
         if data.dtype.kind in "iu":
             # no need to clip if irange is the whole possible range
             idt = numpy.iinfo(data.dtype)
-            # Ensure B&W if there is only one value allowed
-            if irange[0] >= irange[1]:
-                if irange[0] > idt.min:
-                    irange = (irange[0] - 1, irange[0])
-                else:
-                    irange = (irange[0], irange[0] + 1)
-
-            if img_fast:
-                try:
-                    # only (currently) supports uint16
-                    return img_fast.DataArray2RGB(data, irange, tint)
-                except ValueError as exp:
-                    logging.info("Fast conversion cannot run: %s", exp)
-                except Exception:
-                    logging.exception("Failed to use the fast conversion")
-
             if irange[0] > idt.min or irange[1] < idt.max:
                 data = data.clip(*irange)
         else: # floats et al. => always clip
-            # Ensure B&W if there is just one value allowed
-            if irange[0] >= irange[1]:
-                irange = (irange[0] - 1e-9, irange[0])
             data = data.clip(*irange)
 
-        dshift = data - irange[0]
-        if data.dtype == numpy.uint8:
+        if data.dtype.kind == "i":
+            # Compute the shift as unsigned, as it could overflow the signed type
+            # (and it's always positive, once clipped)
+            udt = numpy.dtype("u%d" % data.dtype.itemsize)
+            dshift = numpy.subtract(data, irange[0], dtype=udt, casting="unsafe")
+        else:
+            dshift = data - irange[0]
+        if dshift.dtype == numpy.uint8:
             drescaled = dshift  # re-use memory for the result
         else:
-            # TODO: could directly use one channel of the 'rgb' variable?
             drescaled = numpy.empty(data.shape, dtype=numpy.uint8)
         # Ideally, it would be 255 / (irange[1] - irange[0]) + 0.5, but to avoid
         # the addition, we can just use 255.99, and with the rounding down, it's
         # very similar.
-        b = 255.99 / (irange[1] - irange[0])
+        if data.dtype.kind in "iu":
+            # Compute the range with Python int's, as it could overflow the data type
+            b = 255.99 / (int(irange[1]) - int(irange[0]))
+        else:
+            b = 255.99 / (irange[1] - irange[0])
         numpy.multiply(dshift, b, out=drescaled, casting="unsafe")
 
     # Now duplicate it 3 times to make it RGB (as a simple approximation of
     # greyscale)
-    # dstack doesn't work because it doesn't generate in C order (uses strides)
-    # apparently this is as fast (or even a bit better):
-
-    # 0 copy (1 malloc)
-    rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
-
     # Tint (colouration)
     if tint == (255, 255, 255):
         # fast path when no tint
         # Note: it seems numpy.repeat() is 10x slower ?!
-        # a = numpy.repeat(drescaled, 3)
-        # a.shape = data.shape + (3,)
         rgb[:, :, 0] = drescaled # 1 copy
         rgb[:, :, 1] = drescaled # 1 copy
         rgb[:, :, 2] = drescaled # 1 copy
@@ -402,8 +722,6 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         numpy.multiply(drescaled, gtint / 255, out=rgb[:, :, 1], casting="unsafe")
         numpy.multiply(drescaled, btint / 255, out=rgb[:, :, 2], casting="unsafe")
 
-    return rgb
-
 
 def getYXFromZYX(data, zIndex=0):
     """
@@ -23,93 +23,118 @@ import cython
 import numpy
 cimport numpy
 
-# TODO: use fused types to support multiple types (but needs Cython >= 0.20)
-ctypedef numpy.uint16_t uint16_t
+ctypedef numpy.uint8_t uint8_t
+
+# All the types of data which can be converted
+ctypedef fused numeric_t:
+    numpy.uint8_t
+    numpy.int8_t
+    numpy.uint16_t
+    numpy.int16_t
+    numpy.uint32_t
+    numpy.int32_t
+    numpy.uint64_t
+    numpy.int64_t
+    numpy.float32_t
+    numpy.float64_t
+
 
 # nogil allows multi-threading but prevents use of any Python objects or call
+@cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-cdef void cDataArray2RGB(uint16_t* data, int datalen, uint16_t irange0, uint16_t irange1,
-                         int* tint, numpy.uint8_t* ret) nogil:
-    cdef double b = 255. / <double>(irange1 - irange0)
-    cdef double br = (b * <double>tint[0]) / 255.
-    cdef double bg = (b * <double>tint[1]) / 255.
-    cdef double bb = (b * <double>tint[2]) / 255.
-
-    cdef numpy.uint8_t di
+cdef void cDataArray2RGB(const numeric_t[:, :] data, numeric_t irange0, numeric_t irange1,
+                         double b, bint single, const uint8_t[:, :] tint_lut,
+                         uint8_t[:, :, :] ret, Py_ssize_t start, Py_ssize_t end) nogil:
+    cdef float bf = <float> b
+    cdef numeric_t d
     cdef double df
-    cdef int retpos = 0
-
-    if tint[0] == tint[1] == tint[2] == 255:
-        # optimised version, without tinting (about 2x faster)
-        for i in range(datalen):
-            # clip
-            if data[i] <= irange0:
-                di = 0
-            elif data[i] >= irange1:
-                di = 255
+    cdef uint8_t di
+    cdef Py_ssize_t i, j
+
+    # The computation is the same as the standard version: first the value is
+    # clipped, then shifted and scaled (with the same float precision as numpy
+    # would use), and then tinted via the lookup table.
+    for i in range(start, end):
+        for j in range(data.shape[1]):
+            d = data[i, j]
+            if d < irange0:
+                d = irange0
+            elif d > irange1:
+                d = irange1
+
+            if numeric_t is numpy.float32_t or numeric_t is numpy.float64_t:
+                df = <double> (d - irange0)
             else:
-                di = <numpy.uint8_t> ((data[i] - irange0) * b + 0.5)
-            ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
-    else:
-        for i in range(datalen):
-            # clip
-            if data[i] <= irange0:
-                ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-            elif data[i] >= irange1:
-                ret[retpos] = tint[0]
-                retpos += 1
-                ret[retpos] = tint[1]
-                retpos += 1
-                ret[retpos] = tint[2]
-                retpos += 1
+                df = <double> d - <double> irange0
+
+            if single:
+                di = <uint8_t> (<float> df * bf)
             else:
-                df = (data[i] - irange0)
-                ret[retpos] = <numpy.uint8_t> (df * br + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bg + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bb + 0.5)
-                retpos += 1
-
-# This function is probably not needed, but I have no idea how to instantiate
-# a numpy array which can be passed as a pointer
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def wrapDataArray2RGB(numpy.ndarray[uint16_t, ndim=2] data not None,
-                  irange,
-                  tint,
-                  numpy.ndarray[numpy.uint8_t, ndim=3] ret not None):
-    cdef int ctint[3]
-    ctint[0] = tint[0]
-    ctint[1] = tint[1]
-    ctint[2] = tint[2]
-    cDataArray2RGB(&data[0,0], data.size, irange[0], irange[1], ctint, &ret[0,0,0])
-
-
-def DataArray2RGB(data, irange, tint=(255, 255, 255)):
-    if not data.flags.c_contiguous:
-        raise ValueError("Optimised version only works with C-contiguous arrays")
-    if data.dtype != numpy.uint16:
-        # Note: cython automatically detects such errors, but it seems that with
-        # ctyhon 0.23, it can leak memory.
-        raise ValueError("Optimised version only works on uint16 (got %s)" % (data.dtype,))
-    # Note: we could also make an optimised version for F-contiguous arrays,
-    # but it's not clear when it'd be useful. For more complex arrays, it's also
-    # probably possible to generate a faster version than numpy, but I don't
-    # know how.
+                di = <uint8_t> (df * b)
+
+            ret[i, j, 0] = tint_lut[0, di]
+            ret[i, j, 1] = tint_lut[1, di]
+            ret[i, j, 2] = tint_lut[2, di]
+
+
+def wrapDataArray2RGB(const numeric_t[:, :] data not None, numeric_t irange0, numeric_t irange1,
+                      double b, bint single, const uint8_t[:, :] tint_lut not None,
+                      uint8_t[:, :, :] ret not None, Py_ssize_t start, Py_ssize_t end):
+    with nogil:
+        cDataArray2RGB(data, irange0, irange1, b, single, tint_lut, ret, start, end)
+
+
+def DataArray2RGB(data, irange, tint=(255, 255, 255), ret=None, start=0, end=None):
+    """
+    Optimised version of img.DataArray2RGB(), for any integer and float 2D array
+    (whatever its strides). The GIL is released during the conversion, so
+    several parts of the same image can be converted in parallel.
+    data (numpy.ndarray): 2D image greyscale
+    irange (tuple of 2 values): min/max intensities mapped to black/white. min
+      must be < max.
+    tint (3-tuple of 0 < int <256): RGB colour of the final image
+    ret (None or numpy.ndarray of uint8 with shape data.shape + (3 or 4,)): where
+      to write the RGB values. If None, a new array is created. The alpha
+      channel (if any) is not touched.
+    start (0<=int): first row to convert
+    end (None or 0<=int): last row (excluded) to convert. None means the last row.
+    return (numpy.ndarray of uint8 with shape data.shape + (3 or 4,)): ret
+    """
+    if data.ndim != 2:
+        raise ValueError("Optimised version only works with 2D arrays")
+    irange = numpy.asarray(irange, dtype=data.dtype)
     if irange[0] >= irange[1]:
         raise ValueError("irange needs to be a tuple of low/high values")
-    ret = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
-    wrapDataArray2RGB(data, irange, tint, ret)
+    if data.dtype.kind in "iu":
+        # Compute the range with Python int's, as it could overflow the data type
+        b = 255.99 / (int(irange[1]) - int(irange[0]))
+    else:
+        b = 255.99 / (irange[1] - irange[0])
+    # Use the same precision as numpy would use for the scaling
+    calc_dtype = numpy.result_type(data.dtype, b)
+    if calc_dtype not in (numpy.float32, numpy.float64):
+        raise ValueError("Optimised version doesn't support computation in %s" % (calc_dtype,))
+    if ret is None:
+        ret = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+    if end is None:
+        end = data.shape[0]
+
+    tint_lut = get_tint_lut(tuple(tint))
+    wrapDataArray2RGB(data, irange[0], irange[1], b, calc_dtype == numpy.float32,
+                      tint_lut, ret, start, end)
     return ret
 
+
+def get_tint_lut(tint):
+    """
+    Compute the lookup table to convert a greyscale 8-bit value to RGB
+    tint (3-tuple of 0 < int <256): RGB colour of the white
+    return (numpy.ndarray of uint8 of shape (3, 256)): the value for each channel
+    """
+    grey = numpy.arange(256, dtype=numpy.uint8)
+    lut = numpy.empty((3, 256), dtype=numpy.uint8)
+    for c, t in enumerate(tint):
+        # Same computation as the standard version
+        numpy.multiply(grey, t / 255, out=lut[c], casting="unsafe")
+    return lut
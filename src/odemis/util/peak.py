@@ -16,8 +16,11 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+from concurrent import futures
 from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, RUNNING
 import logging
+import math
+import multiprocessing
 import numpy
 from odemis import model
 from scipy.optimize import curve_fit, OptimizeWarning
@@ -32,6 +35,9 @@ E_CHARGE = 1.602e-19  # J --> eV
 WL_TO_ENERGY = H_PLANK * C_LIGHT / E_CHARGE
 WIDTH_RATIO = 0.01
 
+# Number of processes used to fit a whole spectrum cube
+FIT_PROCESSES = multiprocessing.cpu_count()
+
 # TODO: this code is full of reliance on numpy being quite lax with wrong
 # computation, and easily triggers numpy warnings. To force numpy to be
 # stricter:
@@ -255,23 +261,12 @@ class PeakFitter(object):
                 ValueError if fitting cannot be applied
         """
         try:
-            # values based on experimental datasets
-            if len(wavelength) >= 2000:
-                divider = 20
-            elif len(wavelength) >= 1000:
-                divider = 25
-            else:
-                divider = 30
-            init_window_size = max(3, len(wavelength) // divider)
-            window_size = init_window_size
+            window_size = _get_init_window_size(len(wavelength))
             logging.debug("Starting peak detection on data (len = %d) with window = %d",
                           len(wavelength), window_size)
-            try:
-                wl_rng = wavelength[-1] - wavelength[0]
-                width = wl_rng * WIDTH_RATIO  # initial peak width estimation
-                FitFunction = PEAK_FUNCTIONS[type]
-            except KeyError:
+            if type not in PEAK_FUNCTIONS:
                 raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
+            width = (wavelength[-1] - wavelength[0]) * WIDTH_RATIO  # initial peak width estimation
             for step in range(5):
                 if future._fit_state == CANCELLED:
                     raise CancelledError()
@@ -284,46 +279,13 @@ class PeakFitter(object):
                     logging.debug("Retrying to fit peak with window = %d", window_size)
                     continue
 
-                fit_list = []
-                lower_bounds = []
-                upper_bounds = []
-                for (pos, amplitude) in peaks:
-                    if type in {'gaussian_energy', 'lorentzian_energy'}:
-                        energy = apply_jacobian_x(wavelength)
-                        spectra_energy = apply_jacobian_y(wavelength, spectrum)
-                        fit_list.extend(peak_to_energy(pos, width, amplitude))
-                        # lower & upper bounds for center position, width, amplitude in energy domain
-                        en_rng = energy[0] - energy[-1]
-                        lower_bounds.extend([energy[-1] - en_rng / 2, en_rng / 1e4, 0])
-                        upper_bounds.extend([energy[0] + en_rng / 2, en_rng * 10, numpy.inf])
-                    else:
-                        # lower & upper bounds for center position, width, amplitude in space domain
-                        fit_list.extend([pos, width, amplitude])
-                        lower_bounds.extend([wavelength[0] - wl_rng / 2, wl_rng / 1e3, 0])
-                        upper_bounds.extend([wavelength[-1] + wl_rng / 2, wl_rng * 10, numpy.inf])
-
-                # Initialize the offset with the minimum possible value
-                offset = 0
-                fit_list.append(offset)
-                # Set the lower & upper bounds for the offset
-                lower_bounds.extend([0])
-                upper_bounds.extend([min(spectrum)])
-                param_bounds = (lower_bounds, upper_bounds)
-
                 if future._fit_state == CANCELLED:
                     raise CancelledError()
 
                 try:
-                    with warnings.catch_warnings():
-                        # Hide scipy/optimize/minpack.py:690: OptimizeWarning: Covariance of the parameters could not be estimated
-                        warnings.filterwarnings("ignore", "", OptimizeWarning)
-                        # TODO, from scipy 0.17, curve_fit() supports the 'bounds' parameter.
-                        # It could be used to ensure the peaks params are positives.
-                        # (Once we don't support Ubuntu 12.04)
-                        if type in {'gaussian_energy', 'lorentzian_energy'}:
-                            params, _ = curve_fit(FitFunction, energy, spectra_energy, p0=fit_list, bounds=param_bounds)
-                        else:
-                            params, _ = curve_fit(FitFunction, wavelength, spectrum, p0=fit_list, bounds=param_bounds)
+                    peaks_params, offset = _fit_curve(spectrum, wavelength,
+                                                      [(pos, width, amplitude) for pos, amplitude in peaks],
+                                                      type)
                     break
                 except Exception as ex:
                     window_size = int(round(window_size * 1.2))
@@ -331,18 +293,8 @@ class PeakFitter(object):
                     continue
             else:
                 raise ValueError("Could not apply peak fitting of type %s." % type)
-            # reformat parameters to (list of 3 tuples, offset)
-            peaks_params = []
-            for pos, width, amplitude in _Grouped(params[:-1], 3):
-                # Note: to avoid negative peaks, the fit functions only take the
-                # absolute of the amplitude/width. So now amplitude and width
-                # have 50% chances to be negative => Force positive now.
-                if type in {'gaussian_energy', 'lorentzian_energy'}:
-                    peaks_params.append(peak_to_wavelength(pos, width, amplitude))
-                else:
-                    peaks_params.append((pos, width, amplitude))
-
-            return peaks_params, params[-1], type
+
+            return peaks_params, offset, type
         except CancelledError:
             logging.debug("Fitting of type %s was cancelled.", type)
         finally:
@@ -372,6 +324,291 @@ class PeakFitter(object):
         # really rough estimation
         return len(data) * 10e-3  # s
 
+    def FitCube(self, data, wavelength, type='gaussian_space', max_workers=FIT_PROCESSES):
+        """
+        Fits the main peak of every pixel of a spectrum cube, to produce maps of
+        the peak parameters. Each pixel is fitted with a single peak, using the
+        result of its neighbour as initial guess (which is faster and more
+        stable than detecting the peaks again).
+        data (DataArray of shape CYX or C11YX): the spectrum cube
+        wavelength (1d array of floats): The wavelength values corresponding to
+          the C dimension.
+        type (str): Type of fitting to be applied (cf Fit())
+        max_workers (0 <= int): number of processes to fit the pixels in parallel.
+          If 0, all the pixels are fitted in the same thread.
+        returns (model.ProgressiveFuture): Progress of the fitting. The result is
+          a tuple of 4 DataArrays of shape YX: position, width, amplitude and
+          offset of the peak (in the space domain), with NaN where the fitting
+          failed.
+        raises:
+                KeyError if given type not available
+                ValueError if the data doesn't have the right shape
+        """
+        if type not in PEAK_FUNCTIONS:
+            raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
+        if data.ndim == 5 and data.shape[1:3] == (1, 1):
+            data = data[:, 0, 0]
+        if data.ndim != 3:
+            raise ValueError("Data should be of shape CYX, but got %s" % (data.shape,))
+        if data.shape[0] != len(wavelength):
+            raise ValueError("Wavelength list has length %d, while data has %d channels" %
+                             (len(wavelength), data.shape[0]))
+
+        est_start = time.time() + 0.1
+        f = model.ProgressiveFuture(start=est_start,
+                                    end=est_start + self.estimateFitCubeTime(data, max_workers))
+        f._fit_state = RUNNING
+        f._fit_lock = threading.Lock()
+        f.task_canceller = self._CancelFit
+
+        return self._executor.submitf(f, self._DoFitCube, f, data, wavelength, type, max_workers)
+
+    def _DoFitCube(self, future, data, wavelength, type, max_workers):
+        """
+        Fits the pixels of the cube, by blocks of rows, in parallel.
+        future (model.ProgressiveFuture): Progressive future provided by the wrapper
+        data (DataArray of shape CYX): the spectrum cube
+        wavelength (1d array of floats), type (str), max_workers (0<=int): cf FitCube()
+        returns (4 DataArrays of shape YX): position, width, amplitude and offset
+        """
+        try:
+            spectra = numpy.asarray(data)
+            wavelength = numpy.asarray(wavelength)
+            height = spectra.shape[1]
+            # Several blocks per worker, to give regular progress updates, and
+            # allow to cancel quickly.
+            block_height = max(1, int(math.ceil(height / (max(1, max_workers) * 4))))
+            blocks = [(y, min(y + block_height, height)) for y in range(0, height, block_height)]
+            params = numpy.empty(spectra.shape[1:] + (4,))
+
+            start = time.time()
+            executor = _create_spawn_executor(max_workers) if max_workers else None
+            if executor:
+                fs = {executor.submit(_fit_block, spectra[:, y0:y1], wavelength, type): (y0, y1)
+                      for y0, y1 in blocks}
+                results = futures.as_completed(fs)
+            else:
+                executor = None
+                fs = {}
+                # Lazily fit each block in this thread
+                results = ((y0, y1) for y0, y1 in blocks)
+
+            try:
+                for i, r in enumerate(results, 1):
+                    if future._fit_state == CANCELLED:
+                        raise CancelledError()
+                    if executor:
+                        y0, y1 = fs[r]
+                        params[y0:y1] = r.result()
+                    else:
+                        y0, y1 = r
+                        params[y0:y1] = _fit_block(spectra[:, y0:y1], wavelength, type)
+
+                    dur = time.time() - start
+                    future.set_progress(end=time.time() + dur / i * (len(blocks) - i))
+            finally:
+                if executor:
+                    for bf in fs:
+                        bf.cancel()
+                    executor.shutdown(wait=True)
+
+            md = data.metadata.copy() if hasattr(data, "metadata") else {}
+            for k in (model.MD_WL_LIST, model.MD_WL_POLYNOMIAL, model.MD_DIMS):
+                md.pop(k, None)
+            maps = []
+            for i, name in enumerate(("position", "width", "amplitude", "offset")):
+                mmd = md.copy()
+                mmd[model.MD_DESCRIPTION] = "Peak %s" % (name,)
+                maps.append(model.DataArray(params[:, :, i].copy(), mmd))
+            return tuple(maps)
+        except CancelledError:
+            logging.debug("Fitting of cube with type %s was cancelled.", type)
+        finally:
+            with future._fit_lock:
+                if future._fit_state == CANCELLED:
+                    raise CancelledError()
+                future._fit_state = FINISHED
+
+    def estimateFitCubeTime(self, data, max_workers=FIT_PROCESSES):
+        """
+        Estimates the duration of fitting a whole cube
+        data (DataArray of shape CYX): the spectrum cube
+        max_workers (0 <= int): number of processes used
+        """
+        # really rough estimation, as most pixels are seeded by their neighbour
+        npixels = numpy.prod(data.shape[-2:])
+        return npixels * data.shape[0] * 0.1e-3 / max(1, max_workers)  # s
+
+
+def _get_init_window_size(length):
+    """
+    length (int): number of points in the spectrum
+    returns (int): the initial window size for the peak detection
+    """
+    # values based on experimental datasets
+    if length >= 2000:
+        divider = 20
+    elif length >= 1000:
+        divider = 25
+    else:
+        divider = 30
+    return max(3, length // divider)
+
+
+def _fit_curve(spectrum, wavelength, peaks, type, offset=0):
+    """
+    Fits the given peaks onto the spectrum.
+    spectrum (1d array of floats): The data representing the spectrum.
+    wavelength (1d array of floats): The wavelength values corresponding to the
+    spectrum given.
+    peaks (list of 3-tuple of floats): initial guess of the peaks parameters,
+      as (pos, width, amplitude), in the space domain.
+    type (str): Type of fitting to be applied (cf PEAK_FUNCTIONS)
+    offset (float): initial guess of the global offset
+    returns:
+         params (list of 3-tuple): Each peak parameters as (pos, width, amplitude)
+         offset (float): global offset to add
+    raises:
+            Exception if the fitting failed
+    """
+    FitFunction = PEAK_FUNCTIONS[type]
+    wl_rng = wavelength[-1] - wavelength[0]
+    if type in {'gaussian_energy', 'lorentzian_energy'}:
+        energy = apply_jacobian_x(wavelength)
+        spectra_energy = apply_jacobian_y(wavelength, spectrum)
+        en_rng = energy[0] - energy[-1]
+
+    fit_list = []
+    lower_bounds = []
+    upper_bounds = []
+    for (pos, width, amplitude) in peaks:
+        if type in {'gaussian_energy', 'lorentzian_energy'}:
+            fit_list.extend(peak_to_energy(pos, width, amplitude))
+            # lower & upper bounds for center position, width, amplitude in energy domain
+            lower_bounds.extend([energy[-1] - en_rng / 2, en_rng / 1e4, 0])
+            upper_bounds.extend([energy[0] + en_rng / 2, en_rng * 10, numpy.inf])
+        else:
+            # lower & upper bounds for center position, width, amplitude in space domain
+            fit_list.extend([pos, width, amplitude])
+            lower_bounds.extend([wavelength[0] - wl_rng / 2, wl_rng / 1e3, 0])
+            upper_bounds.extend([wavelength[-1] + wl_rng / 2, wl_rng * 10, numpy.inf])
+
+    fit_list.append(offset)
+    # Set the lower & upper bounds for the offset
+    lower_bounds.extend([0])
+    upper_bounds.extend([min(spectrum)])
+    param_bounds = (lower_bounds, upper_bounds)
+
+    with warnings.catch_warnings():
+        # Hide scipy/optimize/minpack.py:690: OptimizeWarning: Covariance of the parameters could not be estimated
+        warnings.filterwarnings("ignore", "", OptimizeWarning)
+        if type in {'gaussian_energy', 'lorentzian_energy'}:
+            params, _ = curve_fit(FitFunction, energy, spectra_energy, p0=fit_list, bounds=param_bounds)
+        else:
+            params, _ = curve_fit(FitFunction, wavelength, spectrum, p0=fit_list, bounds=param_bounds)
+
+    # reformat parameters to (list of 3 tuples, offset)
+    peaks_params = []
+    for pos, width, amplitude in _Grouped(params[:-1], 3):
+        # Note: to avoid negative peaks, the fit functions only take the
+        # absolute of the amplitude/width. So now amplitude and width
+        # have 50% chances to be negative => Force positive now.
+        if type in {'gaussian_energy', 'lorentzian_energy'}:
+            peaks_params.append(peak_to_wavelength(pos, width, amplitude))
+        else:
+            peaks_params.append((pos, width, amplitude))
+
+    return peaks_params, params[-1]
+
+
+def _fit_main_peak(spectrum, wavelength, type, seed=None):
+    """
+    Fits only the main (ie, highest) peak of the spectrum.
+    spectrum (1d array of floats): The data representing the spectrum.
+    wavelength (1d array of floats): The wavelength values corresponding to the
+    spectrum given.
+    type (str): Type of fitting to be applied (cf PEAK_FUNCTIONS)
+    seed (None or 4-tuple of floats): initial guess as (pos, width, amplitude, offset),
+      typically the result of a neighbouring pixel. If None, or if the fitting
+      fails from it, the initial guess is found by peak detection.
+    returns (4-tuple of floats): pos, width, amplitude and offset of the peak.
+      All NaN if the fitting failed.
+    """
+    if seed is not None:
+        pos, width, amplitude, offset = seed
+        try:
+            # The offset cannot be above the spectrum
+            offset = min(offset, min(spectrum))
+            ((pos, width, amplitude),), offset = _fit_curve(spectrum, wavelength,
+                                                            [(pos, width, amplitude)],
+                                                            type, offset)
+            return pos, width, amplitude, offset
+        except Exception as ex:
+            logging.debug("Failed to fit peak from neighbour, will detect it: %s", ex)
+
+    window_size = _get_init_window_size(len(wavelength))
+    width = (wavelength[-1] - wavelength[0]) * WIDTH_RATIO  # initial peak width estimation
+    for step in range(5):
+        try:
+            smoothed = Smooth(spectrum, window_len=window_size)
+            peaks = Detect(smoothed, wavelength, lookahead=window_size, delta=5)[0]
+            if peaks:
+                pos, amplitude = max(peaks, key=lambda p: p[1])
+                ((pos, width, amplitude),), offset = _fit_curve(spectrum, wavelength,
+                                                                [(pos, width, amplitude)],
+                                                                type)
+                return pos, width, amplitude, offset
+        except Exception as ex:
+            logging.debug("Failed to fit peak with window = %d due to error %s", window_size, ex)
+        window_size = int(round(window_size * 1.2))
+
+    return (float("nan"),) * 4
+
+
+def _fit_block(spectra, wavelength, type):
+    """
+    Fits the main peak of each pixel of a block of a spectrum cube. Each pixel
+    is seeded from the previous pixel on the same row, and the first pixel of
+    each row from the first pixel of the previous row.
+    Runs in a separate (spawned) process, so must be a module function, and
+    all the arguments must be picklable.
+    spectra (ndarray of shape CYX): the block of the cube
+    wavelength (1d array of floats): The wavelength values corresponding to C
+    type (str): Type of fitting to be applied (cf PEAK_FUNCTIONS)
+    returns (ndarray of shape YX4): the pos, width, amplitude and offset of
+      each pixel
+    """
+    params = numpy.empty(spectra.shape[1:] + (4,))
+    row_seed = None
+    for y in range(spectra.shape[1]):
+        seed = row_seed
+        for x in range(spectra.shape[2]):
+            p = _fit_main_peak(spectra[:, y, x], wavelength, type, seed)
+            params[y, x] = p
+            if not math.isnan(p[0]):
+                seed = p
+            if x == 0:
+                row_seed = seed
+
+    return params
+
+
+def _create_spawn_executor(max_workers):
+    """
+    Creates a pool of processes which are spawned, instead of forked. Forking is
+    avoided as this process typically has many threads, which could hold locks
+    (eg, logging) that would never be released in the child process.
+    max_workers (int > 0): maximum number of processes
+    returns (ProcessPoolExecutor or None): None if spawning is not supported
+      (before Python 3.7), in which case the caller should run serially.
+    """
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        return futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx)
+    except (AttributeError, TypeError):  # No get_context() or no mp_context
+        logging.info("Cannot spawn processes, will fit without parallelization")
+        return None
+
 
 def peak_to_energy(pos, width, amplitude):
     """
@@ -28,12 +28,22 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import numpy
 from numpy.polynomial import polynomial
 from odemis import model
 from builtins import range
 
 
+# Default sensitivity of the spike detection (the lower, the more sensitive)
+SPIKE_THRESHOLD = 8
+# Number of pixels left and right of spike that are also corrected
+SPIKE_MARGIN = 1
+# Minimum distance (in pixels) for spikes to be considered two separate spikes
+SPIKE_SPACING = 3
+
+
 def get_wavelength_per_pixel(da):
     """
     Computes the wavelength for each pixel along the C dimension
@@ -208,3 +218,99 @@ def coefficients_to_dataarray(coef):
     da.metadata[model.MD_WL_LIST] = wl_list
 
     return da
+
+
+def remove_spikes(data, threshold=SPIKE_THRESHOLD, max_workers=1):
+    """
+    Remove the spikes (typically caused by cosmic rays hitting the CCD) from
+    spectral data. The spike detection is performed by comparing the signal
+    differential with the average differential in the whole data. If the
+    differential for a given spectrum pixel exceeds the threshold, it is marked
+    as a spike. Subsequently, the identified pixels are replaced by a linear
+    interpolation of the neighbouring pixels in the spectrum.
+    Each spectrum is corrected independently, as they were acquired independently.
+
+    :param data: (numpy.array of shape C...): the spectra, with the wavelength
+      on the first dimension (typically, CTZYX or CYX).
+    :param threshold: (0<float): sensitivity of the detection (the lower, the
+      more sensitive)
+    :param max_workers: (1<=int): number of threads to use for correcting the
+      spectra. The data is split along the spectra (so, the rows for a CYX cube).
+    :return:
+       corrected data (numpy.array of the same shape and type as data): a copy
+         of the data, with the spikes removed. It's a DataArray (with the same
+         metadata) if data is a DataArray.
+       number of spectra corrected (int)
+       number of spikes corrected (int)
+    """
+    specdat = data.copy()
+    flatdat = specdat.reshape(data.shape[0], -1)  # C, P (view)
+    # This diff calculation requires higher numerical precision than 16 bits because it is squared.
+    diffspec = numpy.diff(numpy.float32(flatdat), axis=0) ** 2
+    ms_step = (diffspec / numpy.prod(diffspec.shape)).sum()
+    # The threshold is based on the global average.
+    # Using a more local average could help identifying spikes more precisely,
+    # but it is more involved and possibly overkill.
+    spike_threshold = ms_step * threshold ** 2
+
+    npos = flatdat.shape[1]
+    nblocks = max(1, min(max_workers, npos))
+    bounds = [npos * i // nblocks for i in range(nblocks + 1)]
+    blocks = [(flatdat[:, b:e], diffspec[:, b:e], spike_threshold) for b, e in zip(bounds[:-1], bounds[1:])]
+    if nblocks == 1:
+        results = [_remove_spikes_block(*blocks[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=nblocks) as executor:
+            results = list(executor.map(lambda args: _remove_spikes_block(*args), blocks))
+
+    npixels = sum(r[0] for r in results)
+    nspikes = sum(r[1] for r in results)
+    logging.debug("Corrected %d spikes in %d spectra", nspikes, npixels)
+    return specdat, npixels, nspikes
+
+
+def _remove_spikes_block(specdat, diffspec, threshold):
+    """
+    Remove the spikes in a set of spectra, in place
+    :param specdat: (numpy.array of shape CP): the spectra, which will be updated
+    :param diffspec: (numpy.array of shape C-1P): squared differential of the spectra
+    :param threshold: (float): minimum value of the squared differential for a spike
+    :return:
+       number of spectra corrected (int)
+       number of spikes corrected (int)
+    """
+    lenc = specdat.shape[0]
+    spike_steps = diffspec > threshold
+    # Only one step that deviates is no spike
+    pixels = numpy.flatnonzero(numpy.count_nonzero(spike_steps, axis=0) > 1)
+    if not pixels.size:
+        return 0, 0
+
+    # Indices of the spike starts and ends, ordered per spectrum
+    sidx, cidx = numpy.nonzero(spike_steps[:, pixels].T)
+    # Steps further away than the spacing (or in another spectrum) are a new spike
+    first = numpy.ones(cidx.shape, dtype=bool)
+    first[1:] = (sidx[1:] != sidx[:-1]) | (numpy.diff(cidx) > SPIKE_SPACING)
+    starts = numpy.flatnonzero(first)
+    ends = numpy.append(starts[1:], cidx.size) - 1
+    spike_spec = sidx[starts]
+    min_edge = numpy.maximum(cidx[starts] - SPIKE_MARGIN, 0)
+    max_edge = numpy.minimum(cidx[ends] + SPIKE_MARGIN, lenc - 1)
+
+    # Replace each spike by a line between its edges (computed like numpy.linspace()).
+    # Spikes are separated by more than the margin, so the edges are never
+    # part of another spike.
+    spectra = specdat[:, pixels]
+    edge_start = spectra[min_edge, spike_spec].astype(numpy.float64)
+    edge_end = spectra[max_edge, spike_spec].astype(numpy.float64)
+    lengths = max_edge - min_edge + 1
+    step = (edge_end - edge_start) / (lengths - 1)
+    spike_of_px = numpy.repeat(numpy.arange(starts.size), lengths)
+    ends_px = numpy.cumsum(lengths)
+    pos = numpy.arange(ends_px[-1]) - numpy.repeat(ends_px - lengths, lengths)
+    line = pos * step[spike_of_px] + edge_start[spike_of_px]
+    line[ends_px - 1] = edge_end
+    spectra[min_edge[spike_of_px] + pos, spike_spec[spike_of_px]] = line
+    specdat[:, pixels] = spectra
+
+    return pixels.size, starts.size
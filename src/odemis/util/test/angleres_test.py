@@ -138,6 +138,32 @@ class TestAngleResolvedDataConversion(unittest.TestCase):
 
         numpy.testing.assert_allclose(result, desired_output[0], atol=1e-07)
 
+    def test_cached_projection(self):
+        """
+        Test the projection is reused for data with the same mirror geometry
+        """
+        data = ensure2DImage(self.data[0])
+        angleres._operators.clear()
+
+        result = angleres.AngleResolved2Polar(data, 201)
+        result_rect = angleres.AngleResolved2Rectangular(data, (90, 360))
+
+        # Same geometry, different content => no new computation of the projection
+        data2 = model.DataArray(data.astype(numpy.float64) * 2, data.metadata)
+        result2 = angleres.AngleResolved2Polar(data2, 201)
+        result_rect2 = angleres.AngleResolved2Rectangular(data2, (90, 360))
+        self.assertEqual(len(angleres._operators), 2)
+        numpy.testing.assert_allclose(result2, result * 2)
+        numpy.testing.assert_allclose(result_rect2, result_rect * 2)
+
+        # Different pole => new projection
+        data3 = model.DataArray(data, data.metadata.copy())
+        pole = data.metadata[model.MD_AR_POLE]
+        data3.metadata[model.MD_AR_POLE] = (pole[0] + 10, pole[1])
+        result3 = angleres.AngleResolved2Polar(data3, 201)
+        self.assertEqual(len(angleres._operators), 3)
+        self.assertFalse(numpy.allclose(result3, result))
+
     def test_uint16_input(self):
         """
         Tests for input of DataArray with uint16 ndarray.
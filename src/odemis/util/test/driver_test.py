@@ -22,11 +22,12 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import logging
+import numpy
 from odemis import model
 import odemis
 from odemis.util import test
 from odemis.util.driver import getSerialDriver, speedUpPyroConnect, readMemoryUsage, \
-    get_linux_version
+    get_linux_version, BufferPool
 import os
 import sys
 import time
@@ -83,6 +84,43 @@ class TestDriver(unittest.TestCase):
                 v = get_linux_version()
 
 
+class TestBufferPool(unittest.TestCase):
+
+    def test_recycle(self):
+        pool = BufferPool(max_free=2)
+        a = pool.get((100, 200), numpy.uint16)
+        self.assertEqual(a.shape, (100, 200))
+        self.assertEqual(a.dtype, numpy.uint16)
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+        addr = a.ctypes.data
+
+        # Views and DataArrays keep the memory in use
+        da = model.DataArray(a, {model.MD_EXP_TIME: 1})
+        view = da.T[10:20]
+        del a, da
+        b = pool.get((100, 200), numpy.uint16)
+        self.assertNotEqual(b.ctypes.data, addr)
+        self.assertEqual((pool.hits, pool.misses), (0, 2))
+
+        # Once all are deleted, the memory is reused, for any shape of same size
+        del view
+        self.assertEqual(len(pool), 1)
+        c = pool.get((200, 50), numpy.uint32)
+        self.assertEqual(c.ctypes.data, addr)
+        self.assertEqual((pool.hits, pool.misses), (1, 2))
+        self.assertEqual(len(pool), 0)
+
+        # Different size => new buffer
+        d = pool.get((10, 10), numpy.uint16)
+        self.assertEqual((pool.hits, pool.misses), (1, 3))
+
+        # Only max_free unused buffers are kept
+        del b, c, d
+        self.assertEqual(len(pool), 2)
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
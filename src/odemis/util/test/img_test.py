@@ -311,6 +311,111 @@ class TestHistogram(unittest.TestCase):
         nchist = img.compactHistogram(hist, depth)
         numpy.testing.assert_array_equal(hist, nchist)
 
+    def test_int_pow2(self):
+        """
+        The histogram of integers with a range of a power of 2 is computed via a
+        short-cut, which should give the same result as numpy.histogram()
+        """
+        for dtype, irange in ((numpy.int16, (-2048, 2047)),
+                              (numpy.uint32, (0, 2 ** 32 - 1)),
+                              (numpy.uint32, (1024, 1024 + 2 ** 20 - 1)),
+                              (numpy.int32, (-2 ** 31, 2 ** 31 - 1)),
+                              (numpy.int64, (-512, 511)),
+                              ):
+            idt = numpy.iinfo(dtype)
+            # Include values outside of the range
+            vmin = max(idt.min, irange[0] - (irange[1] - irange[0]))
+            vmax = min(idt.max, irange[1] + (irange[1] - irange[0]))
+            grey_img = numpy.random.randint(vmin, vmax, size=(256, 300), dtype=dtype)
+            grey_img[0, 0] = irange[0]
+            grey_img[0, 1] = irange[1]
+            hist, edges = img.histogram(grey_img, irange)
+            length = min(8192, irange[1] - irange[0] + 1)
+            hist_np, _ = numpy.histogram(grey_img, bins=length, range=irange)
+            self.assertEqual(edges, irange)
+            numpy.testing.assert_array_equal(hist, hist_np)
+
+    def test_max_samples(self):
+        size = (2048, 1024)
+        grey_img = numpy.zeros(size, dtype="uint16") + 1500
+        grey_img[::2, ::2] = 0
+        hist, edges = img.histogram(grey_img, (0, 4095), max_samples=2 ** 19)
+        self.assertEqual(edges, (0, 4095))
+        self.assertEqual(numpy.sum(hist), 2 ** 19)
+        self.assertEqual(hist[0], numpy.sum(hist))  # Picked every other pixel
+
+        hist, edges = img.histogram(grey_img, (0, 4095), max_samples=2 ** 18)
+        self.assertLessEqual(numpy.sum(hist), 2 ** 18)
+        self.assertGreater(numpy.sum(hist), 2 ** 16)
+
+        # Small data => all the data is used
+        hist, edges = img.histogram(grey_img[:10, :10], (0, 4095), max_samples=2 ** 18)
+        self.assertEqual(numpy.sum(hist), 100)
+
+
+class TestHistogramAccumulator(unittest.TestCase):
+
+    def test_uint16(self):
+        acc = img.HistogramAccumulator()
+        hist, edges = acc.get()
+        self.assertEqual(len(hist), 0)
+
+        data = numpy.random.randint(0, 4096, size=(200, 300)).astype(numpy.uint16)
+        for l in data:
+            acc.add(l)
+        hist, edges = acc.get()
+        self.assertEqual(edges, (0, 2 ** 16 - 1))
+        hist_all, edges_all = img.histogram(data, (0, 2 ** 16 - 1))
+        numpy.testing.assert_array_equal(hist, hist_all)
+
+    def test_int16(self):
+        acc = img.HistogramAccumulator()
+        data = numpy.random.randint(-300, 300, size=(200, 300)).astype(numpy.int16)
+        for l in data:
+            acc.add(l)
+        hist, edges = acc.get()
+        self.assertEqual(edges, (-2 ** 15, 2 ** 15 - 1))
+        self.assertEqual(numpy.sum(hist), data.size)
+        self.assertEqual(hist[-300 + 2 ** 15], numpy.sum(data == -300))
+        self.assertEqual(hist[42 + 2 ** 15], numpy.sum(data == 42))
+
+    def test_growing_range(self):
+        """
+        The range of the data increases with each new part
+        """
+        for dtype in (numpy.uint32, numpy.int64, numpy.float32, numpy.float64):
+            acc = img.HistogramAccumulator()
+            parts = []
+            for i in range(4, 31, 3):
+                p = (numpy.random.random_sample(1000) * 2 ** i - 5).astype(dtype)
+                acc.add(p)
+                parts.append(p)
+            data = numpy.concatenate(parts)
+            hist, edges = acc.get()
+            self.assertLessEqual(len(hist), 8192)
+            self.assertEqual(numpy.sum(hist), data.size)
+            self.assertLessEqual(edges[0], data.min())
+            self.assertGreaterEqual(edges[1], data.max())
+
+            # Each value should be in the right bin
+            if dtype in (numpy.uint32, numpy.int64):
+                bins = numpy.linspace(edges[0], edges[1] + 1, len(hist) + 1)
+            else:
+                bins = numpy.linspace(edges[0], edges[1], len(hist) + 1)
+            hist_np, _ = numpy.histogram(data, bins=bins)
+            numpy.testing.assert_array_equal(hist, hist_np)
+
+    def test_float_nan(self):
+        acc = img.HistogramAccumulator()
+        acc.add(numpy.array([1.5, numpy.nan, 2.5]))
+        acc.add(numpy.array([numpy.inf, 2, -7.25]))
+        hist, edges = acc.get()
+        self.assertEqual(numpy.sum(hist), 4)
+        self.assertEqual(edges[0], -7.25)
+        self.assertGreater(edges[1], 2.5)
+        self.assertEqual(hist[0], 1)
+        self.assertEqual(hist[-1], 1)
+
 
 class TestDataArray2RGB(unittest.TestCase):
     @staticmethod
@@ -456,7 +561,7 @@ class TestDataArray2RGB(unittest.TestCase):
         data[2, :] = 56
         data[200, 2] = 3
 
-        data_nc = data.swapaxes(0, 1) # non-contiguous cannot be treated by fast conversion
+        data_nc = data.swapaxes(0, 1) # non-contiguous is also handled by fast conversion
 
         # convert to RGB
         hist, edges = img.histogram(data)
@@ -474,10 +579,49 @@ class TestDataArray2RGB(unittest.TestCase):
         std_dur = time.time() - tstart
         rgb_nc_back = rgb_nc.swapaxes(0, 1)
 
-        print("Time fast conversion = %g s, standard = %g s" % (fast_dur, std_dur))
-        self.assertLess(fast_dur, std_dur)
-        # ±1, to handle the value shifts by the standard converter to handle floats
-        numpy.testing.assert_almost_equal(rgb, rgb_nc_back, decimal=0)
+        logging.info("Time contiguous conversion = %g s, non-contiguous = %g s", fast_dur, std_dur)
+        numpy.testing.assert_array_equal(rgb, rgb_nc_back)
+
+    def test_out(self):
+        """Test conversion into a given buffer, for all the types"""
+        shape = (512, 300)
+        irange = (10, 100)
+        tint = (0, 73, 255)
+        for dtype in ("uint8", "int8", "uint16", "int16", "uint32", "int32", "int64", "float32", "float64"):
+            data = numpy.random.randint(0, 120, shape).astype(dtype)
+            data = numpy.asfortranarray(data)
+            rgb = img.DataArray2RGB(data, irange, tint=tint)
+            self.assertEqual(rgb.shape, shape + (3,))
+
+            out = numpy.zeros(shape + (3,), dtype=numpy.uint8)
+            ret = img.DataArray2RGB(data, irange, tint=tint, out=out)
+            self.assertIs(ret, out)
+            numpy.testing.assert_array_equal(out, rgb)
+
+            out = numpy.zeros(shape + (4,), dtype=numpy.uint8)
+            img.DataArray2RGB(data, irange, tint=tint, out=out)
+            numpy.testing.assert_array_equal(out[..., :3], rgb)
+            self.assertTrue(numpy.all(out[..., 3] == 255))
+
+        with self.assertRaises(ValueError):
+            img.DataArray2RGB(data, irange, out=numpy.zeros(shape[::-1] + (3,), dtype=numpy.uint8))
+
+    def test_signed_full_range(self):
+        """Test signed data with a range larger than half of the type range"""
+        for dtype in ("int8", "int16"):
+            idt = numpy.iinfo(dtype)
+            for shape in ((16, 8), (1024, 512)):  # small and big images are converted differently
+                data = numpy.zeros(shape, dtype=dtype)
+                data[0, 0] = idt.min
+                data[0, 1] = idt.max
+                data[0, 2] = -1
+                out = img.DataArray2RGB(data, irange=(idt.min, idt.max))
+                numpy.testing.assert_equal(out[0, 0], [0, 0, 0])
+                numpy.testing.assert_equal(out[0, 1], [255, 255, 255])
+                # Middle values => grey (-1 and 0 are both about half of the range)
+                self.assertIn(out[0, 2, 0], (127, 128))
+                self.assertIn(out[1, 1, 0], (127, 128))
+                self.assertLessEqual(out[0, 2, 0], out[1, 1, 0])
 
     def test_tint(self):
         """test with tint (on the fast path)"""
@@ -16,11 +16,13 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+from concurrent.futures._base import CancelledError
 import logging
 import numpy
 from odemis.dataio import hdf5
 from odemis.util import peak
 import os
+import time
 import unittest
 import matplotlib.pyplot as plt
 
@@ -132,6 +134,61 @@ class TestPeak(unittest.TestCase):
         # Assert wrong fitting type
         self.assertRaises(KeyError, peak.Curve, wl, params, offset, type='wrongType')
 
+    def test_fit_cube(self):
+        data = self.data[:, :10, :15]
+        wl = self.wl_in_meters
+
+        for workers in (0, 2):
+            f = self._peak_fitter.FitCube(data, wl, type='gaussian_space', max_workers=workers)
+            pos, width, amplitude, offset = f.result()
+            for m in (pos, width, amplitude, offset):
+                self.assertEqual(m.shape, data.shape[1:])
+            # Almost all the pixels should have been fitted
+            self.assertLess(numpy.isnan(pos).sum(), pos.size // 10)
+            self.assertTrue(numpy.all(width[~numpy.isnan(width)] > 0))
+            self.assertTrue(numpy.all(amplitude[~numpy.isnan(amplitude)] >= 0))
+
+            # Same as fitting just the main peak of the pixel
+            spec = data[:, 5, 7]
+            params, off, _ = self._peak_fitter.Fit(spec, wl, type='gaussian_space').result()
+            main_pos = max(params, key=lambda p: p[2])[0]
+            self.assertAlmostEqual(pos[5, 7], main_pos, delta=(wl[-1] - wl[0]) / 10)
+
+    def test_fit_cube_no_spawn(self):
+        """
+        When processes cannot be spawned, the cube is fitted in this process
+        """
+        data = self.data[:, :4, :5]
+        wl = self.wl_in_meters
+        ref = self._peak_fitter.FitCube(data, wl, type='gaussian_space', max_workers=0).result()
+
+        # Simulate a Python version without multiprocessing contexts
+        class OldMultiprocessing(object):
+            pass
+
+        orig_mp = peak.multiprocessing
+        peak.multiprocessing = OldMultiprocessing()
+        try:
+            self.assertIsNone(peak._create_spawn_executor(2))
+            f = self._peak_fitter.FitCube(data, wl, type='gaussian_space', max_workers=2)
+            maps = f.result()
+        finally:
+            peak.multiprocessing = orig_mp
+
+        for m, r in zip(maps, ref):
+            numpy.testing.assert_array_equal(m, r)
+
+    def test_fit_cube_cancel(self):
+        data = self.data
+        wl = self.wl_in_meters
+        f = self._peak_fitter.FitCube(data, wl, type='gaussian_space', max_workers=0)
+        time.sleep(0.5)
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+        self.assertRaises(CancelledError, f.result)
+
+        self.assertRaises(ValueError, self._peak_fitter.FitCube, data, wl[:-1])
+
 
 if __name__ == "__main__":
     unittest.main()
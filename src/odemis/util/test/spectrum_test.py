@@ -74,6 +74,55 @@ class TestGetWavelength(unittest.TestCase):
         self.assertEqual(wl[0], metadata[model.MD_WL_POLYNOMIAL][0])
         
 
+class TestRemoveSpikes(unittest.TestCase):
+
+    def test_spikes(self):
+        shape = (256, 1, 1, 20, 30)
+        numpy.random.seed(0)
+        data = numpy.random.poisson(100, shape).astype(numpy.uint16)
+        md = {model.MD_DESCRIPTION: "spectrum", model.MD_DIMS: "CTZYX"}
+        da = model.DataArray(data, md)
+        orig = da.copy()
+        # One spike in the middle of the spectrum, two spikes in one spectrum,
+        # and spikes at the edges
+        da[100:102, 0, 0, 5, 6] = 5000
+        da[20, 0, 0, 10, 1] = 6000
+        da[200:203, 0, 0, 10, 1] = 6000
+        da[1, 0, 0, 0, 0] = 5000
+        da[-2, 0, 0, 19, 29] = 5000
+
+        cor, npixels, nspikes = spectrum.remove_spikes(da, max_workers=2)
+        self.assertEqual(npixels, 4)
+        self.assertEqual(nspikes, 5)
+        self.assertEqual(cor.shape, da.shape)
+        self.assertEqual(cor.dtype, da.dtype)
+        self.assertEqual(cor.metadata, md)
+        self.assertEqual(da[20, 0, 0, 10, 1], 6000)  # Input not modified
+        self.assertLess(cor.max(), 500)
+
+        # The spectra without spikes are untouched
+        mask = numpy.ones(shape[-2:], dtype=bool)
+        mask[5, 6] = mask[10, 1] = mask[0, 0] = mask[19, 29] = False
+        numpy.testing.assert_array_equal(cor[..., mask], orig[..., mask])
+
+        # The spike (and margin) is replaced by a line between the neighbouring pixels
+        spec = cor[:, 0, 0, 5, 6]
+        line = numpy.linspace(orig[98, 0, 0, 5, 6], orig[102, 0, 0, 5, 6], 5)
+        numpy.testing.assert_array_equal(spec[98:103], line.astype(numpy.uint16))
+
+        # Same result with a single thread
+        cor1, npixels1, nspikes1 = spectrum.remove_spikes(da)
+        numpy.testing.assert_array_equal(cor, cor1)
+        self.assertEqual((npixels1, nspikes1), (npixels, nspikes))
+
+    def test_no_spikes(self):
+        data = numpy.ones((64, 10, 10), dtype=numpy.float32)
+        data[::2] = 2
+        cor, npixels, nspikes = spectrum.remove_spikes(data)
+        self.assertEqual((npixels, nspikes), (0, 0))
+        numpy.testing.assert_array_equal(cor, data)
+
+
 class TestCoefToDA(unittest.TestCase):
     
     def test_simple(self):